@@ -27,9 +27,11 @@ def generate_random_id(list_of_current_IDs: list) -> unique_numeric_id_as_str:
     trace_id = str(random.randint(1000000, 9999999))
     print("[TRACE] func: generate_random_id start " + trace_id)
 
+    # membership in a set is O(1); in a list it is O(n)
+    set_of_current_IDs = set(list_of_current_IDs)
     found_new_ID = False
     while not found_new_ID:
         new_id = str(random.randint(1000000, 9999999))
-        if new_id not in list_of_current_IDs:
+        if new_id not in set_of_current_IDs:
             found_new_ID = True
     return str(new_id)
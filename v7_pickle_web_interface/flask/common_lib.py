@@ -34,10 +34,15 @@ import sqlite3
 # https://docs.python.org/3/library/json.html
 import json
 import json_schema  # a PDG file
+import relational_db  # a PDG file
+import instrumentation  # a PDG file
 from jsonschema import validate  # type: ignore
 import logging
 import os
+import pickle
 import random
+import threading
+import time
 
 # import redis
 
@@ -46,6 +51,18 @@ logger = logging.getLogger(__name__)
 # global proc_timeout
 # proc_timeout = 30
 
+# Each gunicorn worker keeps a snapshot of the parsed database so that
+# repeated calls to read_db do not re-parse the same unchanged JSON blob.
+# keys are path_to_db; values are {"version": int, "pickled dat": bytes}
+# The snapshot is stored pickled so every caller gets a private copy;
+# pickle.loads is roughly twice as fast as json.loads for the PDG content.
+db_snapshot = {}  # type: dict
+db_snapshot_lock = threading.Lock()
+
+# "json" stores the content as a single JSON string in the table "data"
+# "relational" stores one row per entry; see relational_db.py
+db_backend = os.environ.get("PDG_DB_BACKEND", "json")
+
 # def connect_redis():
 #    """
 #    https://stackoverflow.com/questions/31663288/how-do-i-properly-use-connection-pools-in-redis
@@ -100,14 +117,119 @@ def validate_content(dat: dict) -> None:
     return
 
 
+def get_db_version(path_to_db: str):
+    """
+    The version counter is incremented by write_db in the same transaction
+    that inserts the content, so a change in version means the content changed.
+
+    PRAGMA data_version is not used because it is only meaningful
+    for a connection that stays open, and read_db opens a new connection per call.
+
+    Args:
+        path_to_db: filename of the SQL file
+    Returns:
+        version: integer, or None if the database lacks a version counter
+    Raises:
+
+    >>> get_db_version("pdg.db")
+    """
+    # trace_id = str(random.randint(1000000, 9999999))
+    # logger.info("[trace start " + trace_id + "]")
+
+    if not os.path.exists(path_to_db):
+        return None
+
+    conn = create_sql_connection(path_to_db)
+    if conn is None:
+        raise Exception("no connection to sql database")
+
+    db_version = None
+    try:
+        for row in conn.execute("SELECT version FROM db_version"):
+            db_version = row[0]
+    except sqlite3.OperationalError as err:
+        # database was created before the version counter existed
+        logger.debug("no db_version table; " + str(err))
+    conn.close()
+
+    # logger.info("[trace end " + trace_id + "]")
+    return db_version
+
+
+def read_db_version_in_transaction(cur):
+    """
+    get_db_version for a connection that is already in a transaction
+
+    Args:
+        cur: sqlite3 cursor
+    Returns:
+        version: integer, or None if the database lacks a version counter
+    Raises:
+
+    >>> read_db_version_in_transaction(cur)
+    """
+    # logger.info("[trace]")
+    db_version = None
+    try:
+        for row in cur.execute("SELECT version FROM db_version"):
+            db_version = row[0]
+    except sqlite3.OperationalError:
+        pass
+    return db_version
+
+
+@instrumentation.timed("database")
 def read_db(path_to_db: str) -> dict:
     """
+    Return the content of the database as a dict.
+
+    The parsed content is cached per process and only re-read from SQL when
+    the version counter in the database differs from the cached version.
+    The caller gets its own copy, so mutating "dat" does not alter the snapshot.
+
+    Args:
+        path_to_db: filename of the SQL file
+    Returns:
+        dat: dict
+    Raises:
+
     >>> read_db('physics_derivation_graph.sqlite3')
     """
     # trace_id = str(random.randint(1000000, 9999999))
     # logger.info("[trace start " + trace_id + "]")
     logger.info("[trace]")
 
+    # the version has to be read before the content;
+    # otherwise old content could be cached under the new version
+    db_version = get_db_version(path_to_db)
+
+    if db_version is not None:
+        dat = get_snapshot(path_to_db, db_version)
+        if dat is not None:
+            # logger.info("[trace end " + trace_id + "]")
+            return dat
+
+    if db_backend == "relational":
+        dat = read_db_from_relational_tables(path_to_db)
+    else:
+        dat = read_db_from_sql(path_to_db)
+
+    if db_version is not None:
+        store_snapshot(path_to_db, db_version, dat)
+
+    # logger.info("[trace end " + trace_id + "]")
+    return dat
+
+
+def read_db_from_sql(path_to_db: str) -> dict:
+    """
+    read_db without the snapshot cache
+
+    >>> read_db_from_sql('physics_derivation_graph.sqlite3')
+    """
+    # trace_id = str(random.randint(1000000, 9999999))
+    # logger.info("[trace start " + trace_id + "]")
+
     # OLD implementation:
     #    with open(path_to_db, 'rb') as fil:
     #        dat = pickle.load(fil)
@@ -169,8 +291,98 @@ def read_db(path_to_db: str) -> dict:
     return dat
 
 
-def write_db(path_to_db: str, dat: dict) -> None:
+def read_db_from_relational_tables(path_to_db: str) -> dict:
+    """
+    read_db for the relational backend, without the snapshot cache
+
+    >>> read_db_from_relational_tables('pdg.db')
+    """
+    # trace_id = str(random.randint(1000000, 9999999))
+    # logger.info("[trace start " + trace_id + "]")
+    conn = create_sql_connection(path_to_db)
+    if conn is None:
+        raise Exception("no connection to sql database")
+    cur = conn.cursor()
+    if not relational_db.tables_exist(cur):
+        conn.close()
+        raise Exception("dat not loaded from SQL DB; relational tables do not exist")
+    dat = relational_db.read_dat(cur)
+    conn.close()
+    # logger.info("[trace end " + trace_id + "]")
+    return dat
+
+
+def increment_db_version(cur) -> int:
+    """
+    The caller is responsible for the transaction;
+    the increment should be committed together with the change of content.
+
+    Args:
+        cur: sqlite3 cursor
+    Returns:
+        db_version: the new value of the version counter
+    Raises:
+
+    >>> increment_db_version(cur)
+    2
+    """
+    # logger.info("[trace]")
+    cur.execute("""CREATE TABLE IF NOT EXISTS db_version (version INTEGER NOT NULL)""")
+    db_version = None
+    for row in cur.execute("SELECT version FROM db_version"):
+        db_version = row[0]
+    if db_version is None:
+        db_version = 1
+        cur.execute("INSERT INTO db_version VALUES (?)", (db_version,))
+    else:
+        db_version += 1
+        cur.execute("UPDATE db_version SET version = ?", (db_version,))
+    return db_version
+
+
+def store_snapshot(path_to_db: str, db_version: int, dat: dict) -> None:
     """
+    >>> store_snapshot('pdg.db', 2, dat)
+    """
+    # logger.info("[trace]")
+    with db_snapshot_lock:
+        db_snapshot[path_to_db] = {
+            "version": db_version,
+            "pickled dat": pickle.dumps(dat, protocol=pickle.HIGHEST_PROTOCOL),
+        }
+    return
+
+
+def get_snapshot(path_to_db: str, db_version: int):
+    """
+    Returns:
+        a copy of the snapshot if it was taken at db_version; otherwise None
+
+    >>> get_snapshot('pdg.db', 2)
+    """
+    # logger.info("[trace]")
+    with db_snapshot_lock:
+        snapshot = db_snapshot.get(path_to_db)
+    if (snapshot is None) or (snapshot["version"] != db_version):
+        return None
+    return pickle.loads(snapshot["pickled dat"])
+
+
+@instrumentation.timed("database")
+def write_db(path_to_db: str, dat: dict, expected_version=None) -> bool:
+    """
+    Replace the content of the database in one transaction.
+
+    Args:
+        path_to_db: filename of the SQL file
+        dat: dict
+        expected_version: if not None, the content is only written if the
+                          database version is still expected_version;
+                          see unit_of_work
+    Returns:
+        False if the database changed since expected_version; otherwise True
+    Raises:
+
     >>> dat = {}
     >>> write_db('physics_derivation_graph.sqlite3', dat)
     [trace] compute: write_db
@@ -193,12 +405,28 @@ def write_db(path_to_db: str, dat: dict) -> None:
 
     #    logger.info(sqlite3.version)
 
+    if db_backend == "relational":
+        is_written = write_db_to_relational_tables(path_to_db, dat, expected_version)
+        logger.info("[trace end " + trace_id + "]")
+        return is_written
+
     conn = create_sql_connection(path_to_db)
     if conn is not None:
         cur = conn.cursor()
     else:
         raise Exception("no connection to sql database")
 
+    # without an explicit transaction the DROP and CREATE are committed
+    # separately from the INSERT, and a reader could find no table "data"
+    cur.execute("BEGIN IMMEDIATE")
+    if (expected_version is not None) and (
+        read_db_version_in_transaction(cur) != expected_version
+    ):
+        conn.rollback()
+        conn.close()
+        logger.info("[trace end " + trace_id + "]")
+        return False
+
     try:  # delete whatever is in SQL to prepare for overwriting with SQL
         cur.execute("""drop table data""")
         logger.debug("deleted table from sql")
@@ -215,13 +443,516 @@ def write_db(path_to_db: str, dat: dict) -> None:
     # according to https://www.sqlite.org/limits.html
     # max input size defaults to 1,000,000,000 or about 1 GB of data (!)
 
+    # the version counter is used by read_db to detect changes;
+    # it is bumped in the same transaction as the INSERT
+    db_version = increment_db_version(cur)
+
     conn.commit()
     conn.close()
 
+    # this process just wrote the content, so the snapshot can be refreshed
+    # without reading it back from SQL
+    store_snapshot(path_to_db, db_version, dat)
+
     logger.info("[trace end " + trace_id + "]")
+    return True
+
+
+def write_db_to_relational_tables(
+    path_to_db: str, dat: dict, expected_version=None
+) -> bool:
+    """
+    Only the entries that differ from the current content are written,
+    so the cost scales with the size of the edit rather than the size of the graph.
+
+    The current content is taken from the snapshot if the snapshot is up to date;
+    otherwise it is read from the tables.
+
+    Args:
+        path_to_db: filename of the SQL file
+        dat: dict
+        expected_version: see write_db
+    Returns:
+        False if the database changed since expected_version; otherwise True
+    Raises:
+
+    >>> write_db_to_relational_tables('pdg.db', dat)
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    conn = create_sql_connection(path_to_db)
+    if conn is None:
+        raise Exception("no connection to sql database")
+    cur = conn.cursor()
+
+    # take the write lock before reading the current version so that
+    # the comparison is made against content no other writer can change
+    cur.execute("BEGIN IMMEDIATE")
+    relational_db.create_tables(cur)
+    previous_version = read_db_version_in_transaction(cur)
+    if (expected_version is not None) and (previous_version != expected_version):
+        conn.rollback()
+        conn.close()
+        logger.info("[trace end " + trace_id + "]")
+        return False
+    previous_dat = get_snapshot(path_to_db, previous_version)
+    if previous_dat is None:
+        previous_dat = relational_db.read_dat(cur)
+
+    try:
+        relational_db.write_dat(cur, dat, previous_dat)
+        db_version = increment_db_version(cur)
+        conn.commit()
+    except sqlite3.Error as err:
+        conn.rollback()
+        conn.close()
+        logger.error("common_lib write_db_to_relational_tables " + str(err))
+        raise Exception("unable to write to database; " + str(err))
+    conn.close()
+
+    store_snapshot(path_to_db, db_version, dat)
+
+    logger.info("[trace end " + trace_id + "]")
+    return True
+
+
+def unit_of_work(path_to_db: str, list_of_mutations: list, max_attempts: int = 5):
+    """
+    Apply several mutations to the content and write the result once.
+
+    Optimistic concurrency: the database version is read with the content and
+    checked again when writing (see write_db). If another writer committed in between,
+    nothing is written and the mutations are applied again to the new content,
+    so concurrent edits are not lost.
+    Mutations may therefore run more than once and should only modify dat.
+
+    Args:
+        path_to_db: filename of the SQL file
+        list_of_mutations: functions that take dat, modify it in place,
+                           and may return a value
+        max_attempts: how many times to retry after a concurrent write
+    Returns:
+        list_of_results: the return value of each mutation
+    Raises:
+        Exception if the database kept changing
+
+    >>> unit_of_work('pdg.db', [lambda dat: dat["symbols"].pop("1054")])
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    for attempt in range(max_attempts):
+        # the version is read before the content, so the content is at least
+        # as new as the version; see get_db_version
+        db_version = get_db_version(path_to_db)
+        dat = read_db(path_to_db)
+        list_of_results = [mutation(dat) for mutation in list_of_mutations]
+        if write_db(path_to_db, dat, expected_version=db_version):
+            logger.info("[trace end " + trace_id + "]")
+            return list_of_results
+        logger.debug("database changed during unit of work; attempt " + str(attempt))
+
+    logger.error("database changed during every attempt of unit of work")
+    raise Exception("database was modified by other users; please try again")
+
+
+def apply_change_to_dat(dat: dict, change: dict) -> None:
+    """
+    Apply one fine-grained change to the "dat" nested dictionary in place.
+
+    Args:
+        dat: dict
+        change: dict with keys
+                "action" -- "update entry", "delete entry", "update step", or "delete step"
+                "entry type" -- top-level key of dat (for entries)
+                "entry id", "entry" -- for entries
+                "deriv id", "step id", "step" -- for steps
+    Returns:
+        None
+    Raises:
+        Exception if the action is not recognized
+
+    >>> apply_change_to_dat(dat, {"action": "delete step", "deriv id": "000001", "step id": "1029890"})
+    """
+    # logger.info("[trace]")
+    if change["action"] == "update entry":
+        entries = dat[change["entry type"]]
+        entry = change["entry"]
+        if change["entry type"] == "derivations":
+            # steps are changed using "update step"
+            entry = dict(entry)
+            if change["entry id"] in entries.keys():
+                entry["steps"] = entries[change["entry id"]]["steps"]
+            elif "steps" not in entry.keys():
+                entry["steps"] = {}
+        entries[change["entry id"]] = entry
+    elif change["action"] == "delete entry":
+        entries = dat[change["entry type"]]
+        if change["entry id"] in entries.keys():
+            del entries[change["entry id"]]
+    elif change["action"] == "update step":
+        dat["derivations"][change["deriv id"]]["steps"][change["step id"]] = change[
+            "step"
+        ]
+    elif change["action"] == "delete step":
+        steps = dat["derivations"][change["deriv id"]]["steps"]
+        if change["step id"] in steps.keys():
+            del steps[change["step id"]]
+    else:
+        logger.error("unrecognized change " + str(change["action"]))
+        raise Exception("unrecognized change " + str(change["action"]))
     return
 
 
+def apply_change(path_to_db: str, change: dict) -> None:
+    """
+    Write one fine-grained change to the database.
+
+    For the relational backend only the affected rows are written.
+    For the JSON backend this is a read-modify-write of the whole blob.
+
+    Args:
+        path_to_db: filename of the SQL file
+        change: see apply_change_to_dat
+    Returns:
+        None
+    Raises:
+
+    >>> apply_change('pdg.db', {"action": "delete entry", "entry type": "symbols", "entry id": "1054"})
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    if db_backend != "relational":
+        unit_of_work(path_to_db, [lambda dat: apply_change_to_dat(dat, change)])
+        logger.info("[trace end " + trace_id + "]")
+        return
+
+    conn = create_sql_connection(path_to_db)
+    if conn is None:
+        raise Exception("no connection to sql database")
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    relational_db.create_tables(cur)
+    previous_version = read_db_version_in_transaction(cur)
+
+    try:
+        if change["action"] == "update entry":
+            if change["entry type"] == "derivations":
+                # steps of an existing derivation are retained; see apply_change_to_dat
+                cur.execute(
+                    "SELECT deriv_id FROM derivations WHERE deriv_id=?",
+                    (change["entry id"],),
+                )
+                is_new_derivation = cur.fetchone() is None
+                relational_db.upsert_entry(
+                    cur, "derivations", change["entry id"], change["entry"]
+                )
+                if is_new_derivation:
+                    for step_id, step_dict in change["entry"].get("steps", {}).items():
+                        relational_db.upsert_step(
+                            cur, change["entry id"], step_id, step_dict
+                        )
+            else:
+                relational_db.upsert_entry(
+                    cur, change["entry type"], change["entry id"], change["entry"]
+                )
+        elif change["action"] == "delete entry":
+            relational_db.delete_entry(cur, change["entry type"], change["entry id"])
+        elif change["action"] == "update step":
+            relational_db.upsert_step(
+                cur, change["deriv id"], change["step id"], change["step"]
+            )
+        elif change["action"] == "delete step":
+            relational_db.delete_step(cur, change["step id"])
+        else:
+            raise Exception("unrecognized change " + str(change["action"]))
+        db_version = increment_db_version(cur)
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        conn.close()
+        logger.error("common_lib apply_change " + str(err))
+        raise Exception("unable to write to database; " + str(err))
+    conn.close()
+
+    # keep the snapshot current without re-reading every table
+    dat = get_snapshot(path_to_db, previous_version)
+    if dat is not None:
+        apply_change_to_dat(dat, change)
+        store_snapshot(path_to_db, db_version, dat)
+
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+def update_entry(
+    path_to_db: str, entry_type: str, entry_id: str, entry_dict: dict
+) -> None:
+    """
+    Add or replace one entry, e.g. one symbol or one expression.
+    For derivations the existing steps are retained; use update_step for steps.
+
+    Args:
+        path_to_db: filename of the SQL file
+        entry_type: top-level key of "dat", e.g. "expressions"
+        entry_id: key of the entry within dat[entry_type]
+        entry_dict: value of the entry
+    Returns:
+        None
+    Raises:
+
+    >>> update_entry('pdg.db', "expressions", "0000040490", expr_dict)
+    """
+    apply_change(
+        path_to_db,
+        {
+            "action": "update entry",
+            "entry type": entry_type,
+            "entry id": entry_id,
+            "entry": entry_dict,
+        },
+    )
+    return
+
+
+def delete_entry(path_to_db: str, entry_type: str, entry_id: str) -> None:
+    """
+    >>> delete_entry('pdg.db', "symbols", "1054")
+    """
+    apply_change(
+        path_to_db,
+        {"action": "delete entry", "entry type": entry_type, "entry id": entry_id},
+    )
+    return
+
+
+def update_step(path_to_db: str, deriv_id: str, step_id: str, step_dict: dict) -> None:
+    """
+    >>> update_step('pdg.db', "000001", "1029890", step_dict)
+    """
+    apply_change(
+        path_to_db,
+        {
+            "action": "update step",
+            "deriv id": deriv_id,
+            "step id": step_id,
+            "step": step_dict,
+        },
+    )
+    return
+
+
+def delete_step(path_to_db: str, deriv_id: str, step_id: str) -> None:
+    """
+    >>> delete_step('pdg.db', "000001", "1029890")
+    """
+    apply_change(
+        path_to_db,
+        {"action": "delete step", "deriv id": deriv_id, "step id": step_id},
+    )
+    return
+
+
+# IDs are numeric strings with a fixed number of digits
+id_digits = {
+    "symbol": 4,
+    "derivation": 6,
+    "step": 7,
+    "local expression": 7,
+    "expression": 10,
+}
+# IDs reserved by this process but not yet handed out by allocate_id;
+# keys are (path_to_db, id_type); values are {"version": int, "ids": list}
+# where each item of "ids" is (time reserved, ID)
+id_pool = {}  # type: dict
+id_pool_lock = threading.Lock()
+id_batch_size = 20
+# a reservation that was never used (e.g., the request failed) is released after this
+id_reservation_max_age_in_seconds = 7 * 24 * 60 * 60
+# pooled IDs are discarded well before their reservation is released, so an ID
+# handed out by allocate_id is never also reserved by another worker
+id_pool_max_age_in_seconds = id_reservation_max_age_in_seconds / 2
+
+
+def ids_in_use(dat: dict, id_type: str) -> set:
+    """
+    Args:
+        dat: the nested dictionary from read_db
+        id_type: a key of id_digits
+    Returns:
+        set of IDs
+    Raises:
+
+    >>> ids_in_use(dat, "symbol")
+    """
+    # logger.info("[trace]")
+    if id_type == "symbol":
+        return set(dat["symbols"].keys())
+    if id_type == "derivation":
+        return set(dat["derivations"].keys())
+    if id_type == "expression":
+        return set(dat["expressions"].keys())
+    if id_type == "local expression":
+        return set(dat["expr local to global"].keys())
+    if id_type == "step":
+        set_of_ids = set()
+        for deriv_id, deriv_dict in dat["derivations"].items():
+            set_of_ids.update(deriv_dict["steps"].keys())
+        return set_of_ids
+    logger.error("unrecognized ID type " + str(id_type))
+    raise Exception("unrecognized ID type " + str(id_type))
+
+
+def reserve_ids(path_to_db: str, id_type: str, number_of_ids: int) -> list:
+    """
+    Reserve IDs that are not used in the database and not reserved by another caller.
+
+    Reservations are rows in the table "id_reservations" of the same SQLite file,
+    written under BEGIN IMMEDIATE, so concurrent gunicorn workers cannot reserve
+    the same ID. Bulk imports should reserve all the IDs they need with one call.
+
+    When most of the ID space is taken (e.g. 4-digit symbol IDs), the free IDs
+    are enumerated rather than guessed at random.
+
+    Args:
+        path_to_db: filename of the SQL file
+        id_type: a key of id_digits
+        number_of_ids: how many IDs to reserve
+    Returns:
+        list_of_ids
+    Raises:
+        Exception if there are not enough free IDs
+
+    >>> reserve_ids("pdg.db", "step", 3)
+    ['4925831', '1093847', '8837201']
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    lowest_id = 10 ** (id_digits[id_type] - 1)
+    highest_id = 10 ** id_digits[id_type] - 1
+
+    conn = create_sql_connection(path_to_db)
+    if conn is None:
+        raise Exception("no connection to sql database")
+    cur = conn.cursor()
+    try:
+        # no other worker can reserve IDs or write content until COMMIT
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS id_reservations (
+            id_type TEXT NOT NULL, id TEXT NOT NULL, reserved_at REAL NOT NULL,
+            PRIMARY KEY (id_type, id))"""
+        )
+        set_of_ids_in_use = ids_in_use(read_db(path_to_db), id_type)
+
+        # release reservations that were used or abandoned
+        set_of_reserved_ids = set()
+        list_of_released = []
+        for row in cur.execute(
+            "SELECT id, reserved_at FROM id_reservations WHERE id_type=?", (id_type,)
+        ):
+            if (row[0] in set_of_ids_in_use) or (
+                time.time() - row[1] > id_reservation_max_age_in_seconds
+            ):
+                list_of_released.append((id_type, row[0]))
+            else:
+                set_of_reserved_ids.add(row[0])
+        cur.executemany(
+            "DELETE FROM id_reservations WHERE id_type=? AND id=?", list_of_released
+        )
+
+        unavailable_ids = set_of_ids_in_use | set_of_reserved_ids
+        number_unavailable = sum(
+            1
+            for this_id in unavailable_ids
+            if this_id.isdigit() and (lowest_id <= int(this_id) <= highest_id)
+        )
+        number_free = highest_id - lowest_id + 1 - number_unavailable
+        if number_free < number_of_ids:
+            logger.error("not enough free IDs of type " + id_type)
+            raise Exception("not enough free IDs of type " + id_type)
+
+        list_of_ids = []  # type: list
+        if number_unavailable * 2 > highest_id - lowest_id + 1:
+            # random guesses would mostly collide
+            list_of_free_ids = [
+                str(candidate)
+                for candidate in range(lowest_id, highest_id + 1)
+                if str(candidate) not in unavailable_ids
+            ]
+            list_of_ids = random.sample(list_of_free_ids, number_of_ids)
+        else:
+            while len(list_of_ids) < number_of_ids:
+                proposed_id = str(random.randint(lowest_id, highest_id))
+                if proposed_id not in unavailable_ids:
+                    unavailable_ids.add(proposed_id)
+                    list_of_ids.append(proposed_id)
+
+        cur.executemany(
+            "INSERT INTO id_reservations VALUES (?, ?, ?)",
+            [(id_type, this_id, time.time()) for this_id in list_of_ids],
+        )
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        conn.close()
+        logger.error("common_lib reserve_ids " + str(err))
+        raise Exception("unable to reserve IDs; " + str(err))
+    conn.close()
+
+    logger.info("[trace end " + trace_id + "]")
+    return list_of_ids
+
+
+def allocate_id(path_to_db: str, id_type: str) -> str:
+    """
+    Hand out one ID from the IDs this process reserved (see reserve_ids);
+    IDs are reserved id_batch_size at a time.
+
+    If the database changed since the batch was reserved, the remaining IDs
+    are checked against the content in case the content was replaced
+    (e.g., by an upload) by something other than this allocator.
+    IDs that stayed in the pool longer than id_pool_max_age_in_seconds are
+    discarded, since their reservation may have been released.
+
+    Args:
+        path_to_db: filename of the SQL file
+        id_type: a key of id_digits
+    Returns:
+        the ID
+    Raises:
+
+    >>> allocate_id("pdg.db", "symbol")
+    '4213'
+    """
+    # logger.info("[trace]")
+    db_version = get_db_version(path_to_db)
+    with id_pool_lock:
+        pool = id_pool.get((path_to_db, id_type))
+        if (pool is not None) and (len(pool["ids"]) > 0):
+            oldest_allowed = time.time() - id_pool_max_age_in_seconds
+            pool["ids"] = [x for x in pool["ids"] if x[0] > oldest_allowed]
+            if pool["version"] != db_version:
+                set_of_ids_in_use = ids_in_use(read_db(path_to_db), id_type)
+                pool["ids"] = [x for x in pool["ids"] if x[1] not in set_of_ids_in_use]
+                pool["version"] = db_version
+            if len(pool["ids"]) > 0:
+                return pool["ids"].pop()[1]
+
+    reserved_at = time.time()
+    list_of_ids = reserve_ids(path_to_db, id_type, id_batch_size)
+    proposed_id = list_of_ids.pop()
+    with id_pool_lock:
+        pool = id_pool.setdefault(
+            (path_to_db, id_type), {"version": db_version, "ids": []}
+        )
+        pool["ids"].extend([(reserved_at, this_id) for this_id in list_of_ids])
+    return proposed_id
+
+
 def json_to_sql(path_to_json: str, path_to_sql: str) -> None:
     """
     When the website is initialized, the first step is to load the content
@@ -24,9 +24,13 @@ import json
 from functools import wraps
 import errno
 import signal
+import fcntl
+import threading
+import concurrent.futures
 import os
 import re
 import glob
+import io
 
 # move and copy files
 import shutil
@@ -37,11 +41,8 @@ import datetime
 # hash email addresses, file contents
 import hashlib
 
-# image dimensions in pixels
-import cv2  # type: ignore
 import sympy  # type: ignore
 from subprocess import PIPE  # https://docs.python.org/3/library/subprocess.html
-import subprocess  # https://stackoverflow.com/questions/39187886/what-is-the-difference-between-subprocess-popen-and-subprocess-run/39187984
 import random
 import logging
 import collections
@@ -50,9 +51,15 @@ import pickle
 from jsonschema import validate  # type: ignore
 import json_schema  # a PDG file
 import validate_steps_sympy as vir  # a PDG file
+import validate_dimensions_sympy as vdim  # a PDG file
 import common_lib as clib  # a PDG file
 import logs_to_stats
 import latex_to_sympy
+import latex_to_png  # a PDG file
+import dot_to_image  # a PDG file
+import db_export  # a PDG file
+import expression_search  # a PDG file
+import instrumentation  # a PDG file
 from typing import Tuple, TextIO, List  # mypy
 from typing_extensions import (
     TypedDict,
@@ -284,20 +291,35 @@ def update_expr_sympy(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
 
-    dat["expressions"][expr_global_id]["AST"] = expr_updated_sympy
+    clib.unit_of_work(
+        path_to_db,
+        [lambda dat: update_expr_sympy_of_dat(dat, expr_global_id, expr_updated_sympy)],
+    )
 
     if os.path.exists("/home/appuser/app/static/" + expr_global_id + "_ast.png"):
         os.remove("/home/appuser/app/static/" + expr_global_id + "_ast.png")
     if os.path.exists("/home/appuser/app/" + expr_global_id + "_ast.png"):
         os.remove("/home/appuser/app/" + expr_global_id + "_ast.png")
 
-    clib.write_db(path_to_db, dat)
+    revalidate_after_edit([], [expr_global_id], path_to_db)
     logger.info("[trace end " + trace_id + "]")
     return
 
 
+def update_expr_sympy_of_dat(
+    dat: dict, expr_global_id: str, expr_updated_sympy: str
+) -> None:
+    """
+    The mutation used by update_expr_sympy; see clib.unit_of_work
+
+    >>> update_expr_sympy_of_dat(dat, "4928924", "Symbol('pdg0203')")
+    """
+    # logger.info("[trace]")
+    dat["expressions"][expr_global_id]["AST"] = expr_updated_sympy
+    return
+
+
 def generate_latex_from_sympy(deriv_id: str, path_to_db: str) -> dict:
     """
     for each expression in a step, return the Latex generated by Sympy
@@ -341,7 +363,8 @@ def update_symbol_in_step(
 ) -> None:
     """
     In a webform the user associated a sympy symbol with a PDG symbol_id.
-    This function updates the database to reflect that selection
+    This function updates the database to reflect that selection;
+    to update several symbols with one write, use update_symbols_in_step
 
 
     Args:
@@ -360,38 +383,98 @@ def update_symbol_in_step(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
+    update_symbols_in_step([(sympy_symbol, symbol_id)], deriv_id, step_id, path_to_db)
+    logger.info("[trace end " + trace_id + "]")
+    return
 
-    logger.debug("sympy_symbol = " + sympy_symbol)
-    logger.debug("symbol_id = " + symbol_id)
-    for expr_global_id in list_expr_in_step(deriv_id, step_id, path_to_db):
-        expr_latex = dat["expressions"][expr_global_id]["latex"]
-        logger.debug("expr_latex = " + expr_latex)
-        symbols_in_expr = latex_to_sympy.list_symbols_used_in_latex_from_sympy(
-            expr_latex
-        )
-        if sympy_symbol in symbols_in_expr:
-            logger.debug("sympy_symbol = " + sympy_symbol)
-            if "'" + sympy_symbol + "'" in dat["expressions"][expr_global_id]["AST"]:
-                dat["expressions"][expr_global_id]["AST"] = dat["expressions"][
-                    expr_global_id
-                ]["AST"].replace("'" + sympy_symbol + "'", "'pdg" + symbol_id + "'")
-                logger.debug(str(dat["expressions"][expr_global_id]["AST"]))
-            elif dat["expressions"][expr_global_id]["AST"] == "":
-                dat["expressions"][expr_global_id]["AST"] = (
-                    "Symbol('" + sympy_symbol + "')"
-                )
-            else:
-                logger.debug(
-                    "not sure what to do with "
-                    + dat["expressions"][expr_global_id]["AST"]
-                )
 
-    clib.write_db(path_to_db, dat)
+def update_symbols_in_step(
+    list_of_updates: list, deriv_id: str, step_id: str, path_to_db: str
+) -> None:
+    """
+    Apply every symbol selection from the webform in one unit of work;
+    see clib.unit_of_work
+
+    Args:
+        list_of_updates: list of (sympy_symbol, symbol_id)
+        deriv_id: numeric identifier of the derivation
+        step_id: numeric identifier of the step within the derivation
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        None
+    Raises:
+
+    >>> update_symbols_in_step([('v_0', '0231')], "000001", "1029890", "pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+    if len(list_of_updates) > 0:
+        clib.unit_of_work(
+            path_to_db,
+            [
+                lambda dat: update_symbols_in_step_of_dat(
+                    dat, list_of_updates, deriv_id, step_id
+                )
+            ],
+        )
     logger.info("[trace end " + trace_id + "]")
     return
 
 
+def update_symbols_in_step_of_dat(
+    dat: dict, list_of_updates: list, deriv_id: str, step_id: str
+) -> None:
+    """
+    The mutation used by update_symbols_in_step; modifies dat in place.
+
+    Args:
+        dat: the nested dictionary from clib.read_db
+        list_of_updates: list of (sympy_symbol, symbol_id)
+        deriv_id: numeric identifier of the derivation
+        step_id: numeric identifier of the step within the derivation
+    Returns:
+        None
+    Raises:
+
+    >>> update_symbols_in_step_of_dat(dat, [('v_0', '0231')], "000001", "1029890")
+    """
+    # logger.info("[trace]")
+    list_of_expr_global_ids = []
+    for connection_type in ["feeds", "inputs", "outputs"]:
+        for local_id in dat["derivations"][deriv_id]["steps"][step_id][connection_type]:
+            list_of_expr_global_ids.append(dat["expr local to global"][local_id])
+
+    # the Latex does not change while updating the AST, so parse each expression once
+    symbols_per_expr = {}
+    for expr_global_id in list_of_expr_global_ids:
+        expr_latex = dat["expressions"][expr_global_id]["latex"]
+        logger.debug("expr_latex = " + expr_latex)
+        symbols_per_expr[
+            expr_global_id
+        ] = latex_to_sympy.list_symbols_used_in_latex_from_sympy(expr_latex)
+
+    for sympy_symbol, symbol_id in list_of_updates:
+        logger.debug("sympy_symbol = " + sympy_symbol)
+        logger.debug("symbol_id = " + symbol_id)
+        for expr_global_id in list_of_expr_global_ids:
+            if sympy_symbol in symbols_per_expr[expr_global_id]:
+                logger.debug("sympy_symbol = " + sympy_symbol)
+                expr_ast = dat["expressions"][expr_global_id]["AST"]
+                if "'" + sympy_symbol + "'" in expr_ast:
+                    dat["expressions"][expr_global_id]["AST"] = expr_ast.replace(
+                        "'" + sympy_symbol + "'", "'pdg" + symbol_id + "'"
+                    )
+                    logger.debug(str(dat["expressions"][expr_global_id]["AST"]))
+                elif expr_ast == "":
+                    dat["expressions"][expr_global_id]["AST"] = (
+                        "Symbol('" + sympy_symbol + "')"
+                    )
+                else:
+                    logger.debug("not sure what to do with " + expr_ast)
+    return
+
+
 def find_symbols_in_step_that_lack_id(
     deriv_id: str, step_id: str, path_to_db: str
 ) -> list:
@@ -514,6 +597,8 @@ def fill_in_missing_PDG_AST_ids(
     """
     if a symbol detected by Sympy has only one candidate ID, then update
 
+    The updates are written with a single write; nothing is written if
+    no symbol has exactly one candidate.
 
     Args:
         path_to_db: filename of the SQL database containing
@@ -527,8 +612,8 @@ def fill_in_missing_PDG_AST_ids(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
 
+    list_of_updates = []
     for sympy_symbol_without_id, list_of_candidate_ids in symbol_candidate_dict.items():
         if len(list_of_candidate_ids) == 1:
             logger.debug(
@@ -537,16 +622,7 @@ def fill_in_missing_PDG_AST_ids(
                 + " using symbol ID "
                 + list_of_candidate_ids[0]
             )
-            for expr_global_id in list_expr_in_step(deriv_id, step_id, path_to_db):
-                expr_latex = dat["expressions"][expr_global_id]["latex"]
-                symbols_in_expr = latex_to_sympy.list_symbols_used_in_latex_from_sympy(
-                    expr_latex
-                )
-                if sympy_symbol_without_id in symbols_in_expr:
-                    dat["expressions"][expr_global_id]["AST"].replace(
-                        "'" + sympy_symbol_without_id + "'",
-                        "'pdg" + list_of_candidate_ids[0] + "'",
-                    )
+            list_of_updates.append((sympy_symbol_without_id, list_of_candidate_ids[0]))
         else:
             logger.debug(
                 "sympy symbol "
@@ -554,7 +630,7 @@ def fill_in_missing_PDG_AST_ids(
                 + " has more than one ID: "
                 + str(list_of_candidate_ids)
             )
-    clib.write_db(path_to_db, dat)
+    update_symbols_in_step(list_of_updates, deriv_id, step_id, path_to_db)
     logger.info("[trace end " + trace_id + "]")
     return
 
@@ -824,13 +900,13 @@ def create_AST_png_per_expression_in_step(
             expr_global_id = dat["expr local to global"][local_id]
             expr_latex = dat["expressions"][expr_global_id]["latex"]
             # logger.debug('latex = ' + expr_latex)
-            output_filename = expr_global_id + "_ast.png"
-
             cleaned_expr_latex = latex_to_sympy.remove_latex_presention_markings(
                 expr_latex
             )
 
-            latex_to_sympy.create_AST_png_for_latex(cleaned_expr_latex, output_filename)
+            output_filename = latex_to_sympy.create_AST_png_for_latex(
+                cleaned_expr_latex
+            )
 
             symbols_from_sympy = latex_to_sympy.list_symbols_used_in_latex_from_sympy(
                 cleaned_expr_latex
@@ -1064,14 +1140,41 @@ def md5_of_string(str_to_hash: str) -> str:
     return hashlib.md5(str_to_hash.encode("utf-8")).hexdigest()
 
 
+# the export of the database to JSON, pickle, SQL, RDF, and Cypher runs
+# in a background thread so that page views do not wait on it.
+# Artifacts are only rebuilt when the content of the database changes;
+# the md5 of the content for the last good export is stored in static/
+export_file_names = {
+    "json": "data.json",
+    "pkl": "data.pkl",
+    "sql": "physics_derivation_graph.sqlite3",
+    "rdf": "data.rdf",
+    "neo4j": "neo4j.txt",
+}
+export_hash_file = "/home/appuser/app/static/export_content_md5.txt"
+# serializes exports across gunicorn workers
+export_lock_file = "/home/appuser/app/export.lock"
+# single formats exported on request; see export_db_content_in_format
+export_folder = "/home/appuser/app/static/exports/"
+export_request = threading.Event()
+export_pending_path = {}  # type: dict
+export_thread_lock = threading.Lock()
+export_thread = {}  # type: dict
+
+
 def create_files_of_db_content(path_to_db: str) -> list:
     """
+    Request an export of the database content and return the names of
+    the last good export artifacts in static/
+
+    The export itself happens in a background thread; see export_db_content.
+    The returned dataframe is empty because dataframes are not built on the request path.
 
     Args:
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
     Returns:
-
+        [json_file_name, all_df, df_pkl_file, sql_file, rdf_file, neo4j_file]
     Raises:
 
     >>> create_files_of_db_content("pdg.db")
@@ -1079,55 +1182,226 @@ def create_files_of_db_content(path_to_db: str) -> list:
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
 
+    request_export_of_db_content(path_to_db)
+
+    all_df = {}  # type: dict
+    logger.info("[trace end " + trace_id + "]")
+    return [
+        export_file_names["json"],
+        all_df,
+        export_file_names["pkl"],
+        export_file_names["sql"],
+        export_file_names["rdf"],
+        export_file_names["neo4j"],
+    ]
+
+
+def request_export_of_db_content(path_to_db: str) -> None:
+    """
+    Wake the background export thread, starting it if needed.
+    Repeated requests while an export is running are coalesced into one.
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        None
+    Raises:
+
+    >>> request_export_of_db_content("pdg.db")
+    """
+    # logger.info("[trace]")
+    with export_thread_lock:
+        export_pending_path["path_to_db"] = path_to_db
+        # after gunicorn forks a worker, threads of the parent do not exist in the child
+        if ("thread" not in export_thread.keys()) or (
+            not export_thread["thread"].is_alive()
+        ):
+            export_thread["thread"] = threading.Thread(
+                target=export_worker, name="pdg_export", daemon=True
+            )
+            export_thread["thread"].start()
+    export_request.set()
+    return
+
+
+def export_worker() -> None:
+    """
+    body of the background export thread
+
+    >>> export_worker()
+    """
+    logger.info("[trace]")
+    while True:
+        export_request.wait()
+        export_request.clear()
+        with export_thread_lock:
+            path_to_db = export_pending_path["path_to_db"]
+        try:
+            export_db_content(path_to_db)
+        except Exception as err:
+            logger.error("export of database content failed: " + str(err))
+
+
+def atomic_copy_to_static(file_name: str) -> None:
+    """
+    copy then rename so that a partially written file is never served
+
+    >>> atomic_copy_to_static("data.json")
+    """
+    # logger.info("[trace]")
+    destination = "/home/appuser/app/static/" + file_name
+    shutil.copy(file_name, destination + ".tmp")
+    os.replace(destination + ".tmp", destination)
+    return
+
+
+def export_db_content(path_to_db: str) -> str:
+    """
+    Write the database content to JSON, pickle of dataframes, SQL, RDF, and Cypher
+    and place each file in static/
+
+    Nothing is rebuilt if the md5 of the content matches the last good export.
+    If one format fails the others are still exported; the previous file
+    for the failed format remains in static/
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        content_md5: md5 of the content that was exported
+    Raises:
+
+    >>> export_db_content("pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
     dat = clib.read_db(path_to_db)
-    json_file_name = "data.json"
-    with open(json_file_name, "w") as json_file_handle:
-        json.dump(
-            dat, json_file_handle, indent=4, separators=(",", ": "), sort_keys=True
+    content_md5 = md5_of_string(json.dumps(dat, sort_keys=True))
+
+    with open(export_lock_file, "w") as lock_handle:
+        # another worker may be exporting the same content
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+
+        if os.path.isfile(export_hash_file):
+            with open(export_hash_file, "r") as fil:
+                previous_md5 = fil.read().strip()
+            if (previous_md5 == content_md5) and all(
+                os.path.isfile("/home/appuser/app/static/" + file_name)
+                for file_name in export_file_names.values()
+            ):
+                logger.debug("export is current; content md5 " + content_md5)
+                logger.info("[trace end " + trace_id + "]")
+                return content_md5
+
+        # data.json is also what the database is loaded from on startup;
+        # export_to_file writes to a temporary file and then renames it
+        json_file_name = db_export.export_to_file(
+            dat, "json", export_file_names["json"]
         )
-    shutil.copy(json_file_name, "/home/appuser/app/static/")
+        atomic_copy_to_static(json_file_name)
 
-    try:
-        all_df = convert_json_to_dataframes(path_to_db)
-    except Exception as err:
-        logger.error("creating df failed: " + str(err))
-    else:
-        all_df = {}
+        # the md5 is only recorded if every format was exported,
+        # so that a failed format is retried on the next request
+        export_succeeded = True
 
-    try:
-        df_pkl_file = convert_df_to_pkl(all_df)
-    except Exception as err:
-        logger.error("creating pickle failed: " + str(err))
-    else:  # https://stackoverflow.com/a/2792574
-        shutil.copy(df_pkl_file, "/home/appuser/app/static/")
+        # a pickle of dataframes is built in memory regardless,
+        # so only this format goes through dataframes
+        try:
+            all_df = convert_json_to_dataframes(path_to_db)
+            df_pkl_file = convert_df_to_pkl(all_df)
+        except Exception as err:
+            logger.error("creating pickle failed: " + str(err))
+            export_succeeded = False
+        else:  # https://stackoverflow.com/a/2792574
+            atomic_copy_to_static(df_pkl_file)
+
+        for export_format, file_key in [
+            ("sql", "sql"),
+            ("rdf", "rdf"),
+            ("cypher", "neo4j"),
+        ]:
+            try:
+                export_file = db_export.export_to_file(
+                    dat, export_format, export_file_names[file_key]
+                )
+            except Exception as err:
+                logger.error("creating " + export_format + " failed: " + str(err))
+                export_succeeded = False
+            else:  # https://stackoverflow.com/a/2792574
+                atomic_copy_to_static(export_file)
 
-    try:
-        sql_file = convert_dataframes_to_sql(all_df)
-    except Exception as err:
-        logger.error("creating SQL failed: " + str(err))
-    else:  # https://stackoverflow.com/a/2792574
-        shutil.copy(sql_file, "/home/appuser/app/static/")
+        if export_succeeded:
+            with open(export_hash_file + ".tmp", "w") as fil:
+                fil.write(content_md5)
+            os.replace(export_hash_file + ".tmp", export_hash_file)
 
-    try:
-        rdf_file = convert_data_to_rdf(path_to_db)
-    except Exception as err:
-        logger.error("creating RDF failed: " + str(err))
-    else:  # https://stackoverflow.com/a/2792574
-        shutil.copy(rdf_file, "/home/appuser/app/static/")
+    logger.info("[trace end " + trace_id + "]")
+    return content_md5
 
-    try:
-        neo4j_file = convert_data_to_cypher(path_to_db)
-    except Exception as err:
-        logger.error("creating Cypher failed: " + str(err))
-    else:  # https://stackoverflow.com/a/2792574
-        shutil.copy(neo4j_file, "/home/appuser/app/static/")
+
+def export_db_content_in_format(
+    path_to_db: str, export_format: str, compress: bool = False
+) -> str:
+    """
+    Export a single format on request, e.g. for /api/v1/export
+
+    The file is named by the md5 of the content, so it is only written once
+    per change of the database; exports of previous content are removed.
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+        export_format: a key of db_export.export_formats
+        compress: gzip the export
+    Returns:
+        name of the file relative to static/
+    Raises:
+        Exception if the format is not recognized
+
+    >>> export_db_content_in_format("pdg.db", "rdf", compress=True)
+    'exports/0cc175b9c0f1b6a831c399e269772661_data.rdf.gz'
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    if export_format not in db_export.export_formats.keys():
+        logger.error("unrecognized export format: " + export_format)
+        raise Exception("unrecognized export format: " + export_format)
+    file_name = db_export.export_formats[export_format]["file name"]
+
+    dat = clib.read_db(path_to_db)
+    content_md5 = md5_of_string(json.dumps(dat, sort_keys=True))
+    # export_to_file appends ".gz" if compress
+    path_before_compression = export_folder + content_md5 + "_" + file_name
+    if compress:
+        file_name += ".gz"
+    path_to_export = export_folder + content_md5 + "_" + file_name
+
+    if not os.path.isfile(path_to_export):
+        os.makedirs(export_folder, exist_ok=True)
+        with open(export_lock_file, "w") as lock_handle:
+            # another worker may be exporting the same content
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            if not os.path.isfile(path_to_export):
+                db_export.export_to_file(
+                    dat, export_format, path_before_compression, compress
+                )
+            for stale_export in glob.glob(export_folder + "*_" + file_name):
+                if stale_export != path_to_export:
+                    try:
+                        os.remove(stale_export)
+                    except FileNotFoundError:  # removed by another worker
+                        pass
 
     logger.info("[trace end " + trace_id + "]")
-    return [json_file_name, all_df, df_pkl_file, sql_file, rdf_file, neo4j_file]
+    return os.path.relpath(path_to_export, "/home/appuser/app/static/")
 
 
 def convert_json_to_dataframes(path_to_db: str) -> dict:
     """
+    The rows of each table come from the generators in db_export.table_rows
 
     Args:
         path_to_db: filename of the SQL database containing
@@ -1144,188 +1418,11 @@ def convert_json_to_dataframes(path_to_db: str) -> dict:
     dat = clib.read_db(path_to_db)
 
     all_dfs = {}
-
-    logger.debug("starting TABLE: derivations")
-    derivations_list_of_dicts = []
-    for deriv_id in dat["derivations"].keys():
-        this_deriv = {}
-        this_deriv["deriv ID"] = deriv_id
-        this_deriv["name"] = dat["derivations"][deriv_id]["name"]
-        this_deriv["notes"] = dat["derivations"][deriv_id]["notes"]
-        this_deriv["creation date"] = dat["derivations"][deriv_id]["creation date"]
-        this_deriv["author"] = dat["derivations"][deriv_id]["author"]
-        derivations_list_of_dicts.append(this_deriv)
-    all_dfs["derivations"] = pandas.DataFrame(derivations_list_of_dicts)
-
-    logger.debug("starting TABLE: expressions")
-    expressions_list_of_dicts = []
-    for expression_id, expression_dict in dat["expressions"].items():
-        this_expr = {}
-        this_expr["expression ID"] = expression_id
-        this_expr["latex"] = expression_dict["latex"]
-        this_expr["notes"] = expression_dict["notes"]
-        this_expr["creation date"] = expression_dict["creation date"]
-        this_expr["author"] = expression_dict["author"]
-        this_expr["AST"] = expression_dict["AST"]
-        if "AST" in expression_dict.keys():
-            this_expr["AST"] = expression_dict["AST"]
-        expressions_list_of_dicts.append(this_expr)
-    all_dfs["expressions"] = pandas.DataFrame(expressions_list_of_dicts)
-
-    logger.debug("starting TABLE: inference rules")
-    infrules_list_of_dicts = []
-    for infrule_name, infrule_dict in dat["inference rules"].items():
-        this_infrule = {}
-        this_infrule["inference rule"] = infrule_name
-        this_infrule["number of feeds"] = infrule_dict["number of feeds"]
-        this_infrule["number of inputs"] = infrule_dict["number of inputs"]
-        this_infrule["number of outputs"] = infrule_dict["number of outputs"]
-        this_infrule["latex"] = infrule_dict["latex"]
-        this_infrule["notes"] = infrule_dict["notes"]
-        this_infrule["creation date"] = infrule_dict["creation date"]
-        this_infrule["author"] = infrule_dict["author"]
-        infrules_list_of_dicts.append(this_infrule)
-    all_dfs["infrules"] = pandas.DataFrame(infrules_list_of_dicts)
-
-    logger.debug("starting TABLE: steps")
-    steps_list_of_dicts = []
-    inputs_list_of_dicts = []
-    feeds_list_of_dicts = []
-    outputs_list_of_dicts = []
-    for deriv_id in dat["derivations"].keys():
-        for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-            steps_list_of_dicts.append(
-                {
-                    "step ID": step_id,
-                    "inference rule": step_dict["inf rule"],
-                    "linear index": step_dict["linear index"],
-                }
-            )
-            for expr_local_id in step_dict["inputs"]:
-                inputs_list_of_dicts.append(
-                    {"step ID": step_id, "expr local ID": expr_local_id}
-                )
-            for expr_local_id in step_dict["feeds"]:
-                feeds_list_of_dicts.append(
-                    {"step ID": step_id, "expr local ID": expr_local_id}
-                )
-            for expr_local_id in step_dict["outputs"]:
-                outputs_list_of_dicts.append(
-                    {"step ID": step_id, "expr local ID": expr_local_id}
-                )
-    all_dfs["steps"] = pandas.DataFrame(steps_list_of_dicts)
-    all_dfs["step inputs"] = pandas.DataFrame(inputs_list_of_dicts)
-    all_dfs["step feeds"] = pandas.DataFrame(feeds_list_of_dicts)
-    all_dfs["step outputs"] = pandas.DataFrame(outputs_list_of_dicts)
-    logger.debug("finished steps")
-
-    logger.debug("starting local_to_global")
-    local_to_global_list_of_dicts = []
-    for local_id, global_id in dat["expr local to global"].items():
-        local_to_global_list_of_dicts.append(
-            {"expr local id": local_id, "expr global id": global_id}
+    for table_name, list_of_columns in db_export.table_columns.items():
+        logger.debug("starting TABLE: " + table_name)
+        all_dfs[table_name] = pandas.DataFrame.from_records(
+            db_export.table_rows[table_name](dat), columns=list_of_columns
         )
-    all_dfs["expr local global"] = pandas.DataFrame(local_to_global_list_of_dicts)
-
-    logger.debug("starting symbols")
-    symbols_list_of_dicts = []
-    for symbol_id, symbol_dict in dat["symbols"].items():
-        if "values" in symbol_dict.keys():  # the symbol is a constant
-            this_symb = {}
-            this_symb["symbol id"] = symbol_id
-            this_symb["latex"] = symbol_dict["latex"]
-            this_symb["category"] = symbol_dict["category"]
-            this_symb["scope"] = ";".join(
-                symbol_dict["scope"]
-            )  # TODO: an entry in a table should not be a list (tidy data)
-            if "references" in symbol_dict.keys():
-                this_symb["references"] = " ".join(
-                    symbol_dict["references"]
-                )  # TODO: an entry in a table should not be a list (tidy data)
-            if "name" in symbol_dict.keys():
-                this_symb["name"] = symbol_dict["name"]
-            if "dimensions" in symbol_dict.keys():
-                this_symb["dimensions"] = str(
-                    symbol_dict["dimensions"]
-                )  # TODO: this is actually a dict
-            for value_dict in symbol_dict["values"]:
-                # TODO: a constant can have multiple values with different units
-                this_symb["value"] = value_dict["value"]
-                this_symb["units"] = value_dict["units"]
-            symbols_list_of_dicts.append(this_symb)
-        else:  # no 'values' in symbol_dict.keys(); the symbols is a variable
-            this_symb = {}
-            this_symb["symbol id"] = symbol_id
-            this_symb["latex"] = symbol_dict["latex"]
-            if "category" in symbol_dict.keys():
-                this_symb["category"] = symbol_dict["category"]
-            this_symb["scope"] = ";".join(
-                symbol_dict["scope"]
-            )  # TODO: an entry in a table should not be a list (tidy data)
-            if "references" in symbol_dict.keys():
-                this_symb["references"] = " ".join(
-                    symbol_dict["references"]
-                )  # TODO: an entry in a table should not be a list (tidy data)
-            if "name" in symbol_dict.keys():
-                this_symb["name"] = symbol_dict["name"]
-            if "dimensions" in symbol_dict.keys():
-                this_symb["dimensions"] = str(
-                    symbol_dict["dimensions"]
-                )  # TODO: this is actually a dict
-            symbols_list_of_dicts.append(this_symb)
-    all_dfs["symbols"] = pandas.DataFrame(symbols_list_of_dicts)
-
-    logger.debug("starting measures")
-    measures_list_of_dicts = []
-    for measure_name, measure_dict in dat["measures"].items():
-        if "references" in measure_dict.keys():
-            for ref in measure_dict["references"]:
-                this_measure = {}
-                this_measure["measure"] = measure_name
-                this_measure["reference"] = ref
-                measures_list_of_dicts.append(this_measure)
-        else:
-            this_measure = {}
-            this_measure["measure"] = measure_name
-            measures_list_of_dicts.append(this_measure)
-    all_dfs["measures"] = pandas.DataFrame(measures_list_of_dicts)
-
-    logger.debug("starting units")
-    units_list_of_dicts = []
-    for unit_name, unit_dict in dat["units"].items():
-        for this_ref in unit_dict["references"]:
-            this_unit = {}
-            this_unit["unit"] = unit_name
-            if "dimensions" in unit_dict.keys():
-                this_unit["dimension: length"] = unit_dict["dimensions"]["length"]
-                this_unit["dimension: time"] = unit_dict["dimensions"]["time"]
-                this_unit["dimension: mass"] = unit_dict["dimensions"]["mass"]
-                this_unit["dimension: temperature"] = unit_dict["dimensions"][
-                    "temperature"
-                ]
-                this_unit["dimension: charge"] = unit_dict["dimensions"]["charge"]
-                this_unit["dimension: amount of substance"] = unit_dict["dimensions"][
-                    "amount of substance"
-                ]
-                this_unit["dimension: luminous intensity"] = unit_dict["dimensions"][
-                    "luminous intensity"
-                ]
-
-            this_unit["reference"] = this_ref
-            units_list_of_dicts.append(this_unit)
-    all_dfs["units"] = pandas.DataFrame(units_list_of_dicts)
-
-    logger.debug("starting operators")
-    operators_list_of_dicts = []
-    for operator_name, operator_dict in dat["operators"].items():
-        for this_scope in operator_dict["scope"]:
-            this_op = {}
-            this_op["operator"] = operator_name
-            this_op["operator latex"] = operator_dict["latex"]
-            this_op["argument count"] = operator_dict["argument count"]
-            this_op["scope"] = this_scope
-            operators_list_of_dicts.append(this_op)
-    all_dfs["operators"] = pandas.DataFrame(operators_list_of_dicts)
 
     logger.debug("finished creation of dataframe")
     logger.info("[trace end " + trace_id + "]")
@@ -1391,13 +1488,10 @@ def convert_dataframes_to_sql(all_dfs) -> str:
 
 def convert_data_to_rdf(path_to_db: str) -> str:
     """
-    this conversion is lossy
+    this conversion is lossy; see db_export.write_rdf
 
     https://github.com/allofphysicsgraph/proofofconcept/issues/14
 
-    https://www.w3.org/RDF/
-    https://en.wikipedia.org/wiki/Web_Ontology_Language
-
     Args:
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
@@ -1411,65 +1505,9 @@ def convert_data_to_rdf(path_to_db: str) -> str:
     logger.info("[trace start " + trace_id + "]")
     dat = clib.read_db(path_to_db)
 
-    rdf_str = ""
-    # https://www.w3.org/TR/1999/REC-rdf-syntax-19990222/#basic
-    rdf_str += '<?xml version="1.0"?>'
-    rdf_str += "<rdf:RDF"
-    rdf_str += '  xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
-    rdf_str += '  xmlns:s="http://description.org/schema/">'
-    for expression_id, expression_dict in dat["expressions"].items():
-        rdf_str += expression_id + " has_latex '" + expression_dict["latex"] + "'\n"
-    for infrule_name, infrule_dict in dat["inference rules"].items():
-        rdf_str += (
-            # https://stackoverflow.com/questions/22520932/python-remove-all-non-alphabet-chars-from-string
-            "".join(filter(str.isalnum, infrule_name))
-            + " has_input_count "
-            + str(infrule_dict["number of inputs"])
-            + "\n"
-        )
-        rdf_str += (
-            "".join(filter(str.isalnum, infrule_name))
-            + " has_feed_count "
-            + str(infrule_dict["number of feeds"])
-            + "\n"
-        )
-        rdf_str += (
-            "".join(filter(str.isalnum, infrule_name))
-            + " has_output_count "
-            + str(infrule_dict["number of outputs"])
-            + "\n"
-        )
-        rdf_str += (
-            "".join(filter(str.isalnum, infrule_name))
-            + " has_latex '"
-            + infrule_dict["latex"]
-            + "'\n"
-        )
-    for deriv_id in dat["derivations"].keys():
-        for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-            rdf_str += deriv_id + " has_step " + step_id + "\n"
-            rdf_str += (
-                step_id
-                + " has_infrule "
-                + "".join(filter(str.isalnum, step_dict["inf rule"]))
-                + "\n"
-            )
-            rdf_str += (
-                step_id + " has_linear_index " + str(step_dict["linear index"]) + "\n"
-            )
-            for expr_local_id in step_dict["inputs"]:
-                rdf_str += step_id + " has_input_expr " + expr_local_id + "\n"
-            for expr_local_id in step_dict["feeds"]:
-                rdf_str += step_id + " has_feed_expr " + expr_local_id + "\n"
-            for expr_local_id in step_dict["outputs"]:
-                rdf_str += step_id + " has_output_expr " + expr_local_id + "\n"
-    for local_id, global_id in dat["expr local to global"].items():
-        rdf_str += local_id + " local_is_global " + global_id + "\n"
-    rdf_str += "</rdf:RDF>"
-
-    rdf_file = "data.rdf"
-    with open(rdf_file, "w") as fil:
-        fil.write(rdf_str)
+    rdf_file = db_export.export_to_file(
+        dat, "rdf", db_export.export_formats["rdf"]["file name"]
+    )
     logger.info("[trace end " + trace_id + "]")
     return rdf_file
 
@@ -1490,7 +1528,7 @@ def convert_data_to_cypher(path_to_db: str) -> str:
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
     Returns:
-        cypher_file
+        cypher_file; see db_export.write_cypher
     Raises:
 
 
@@ -1503,124 +1541,9 @@ def convert_data_to_cypher(path_to_db: str) -> str:
 
     dat = clib.read_db(path_to_db)
 
-    cypher_str = ""
-
-    for expression_id, expression_dict in dat["expressions"].items():
-        cypher_str += "CREATE (id" + expression_id + ":expression {\n"
-        if len(expression_dict["name"]) > 0:
-            cypher_str += "  name: '" + expression_dict["name"] + "',\n"
-        if len(expression_dict["notes"]) > 0:
-            cypher_str += "  notes: '" + expression_dict["notes"] + "',\n"
-        cypher_str += "  creation_date: '" + expression_dict["creation date"] + "',\n"
-        cypher_str += "  author: '" + expression_dict["author"] + "',\n"
-        # TODO: not clear how to include AST and references to symbols
-        cypher_str += (
-            "       latex: '"
-            + expression_dict["latex"].replace("\\", "\\\\").replace("'", "\\'")
-            + "'})\n"
-        )
-    for infrule_name, infrule_dict in dat["inference rules"].items():
-        # https://stackoverflow.com/questions/22520932/python-remove-all-non-alphabet-chars-from-string
-        cypher_str += (
-            "CREATE (" + "".join(filter(str.isalnum, infrule_name)) + ":infrule {\n"
-        )
-        cypher_str += (
-            "       num_inputs: " + str(infrule_dict["number of inputs"]) + ",\n"
-        )
-        cypher_str += (
-            "       num_feeds: " + str(infrule_dict["number of feeds"]) + ",\n"
-        )
-        cypher_str += (
-            "       num_outputs: " + str(infrule_dict["number of outputs"]) + ",\n"
-        )
-        cypher_str += "       author: " + str(infrule_dict["author"]) + ",\n"
-        cypher_str += (
-            "       creation_date: " + str(infrule_dict["creation date"]) + ",\n"
-        )
-        cypher_str += "       latex: '" + infrule_dict["latex"] + "'})\n"
-
-    for deriv_id in dat["derivations"].keys():
-        cypher_str += "CREATE (" + deriv_id + ":derivation {\n"
-        if len(dat["derivations"][deriv_id]["name"]) > 0:
-            cypher_str += (
-                "  name: '"
-                + "".join(filter(str.isalnum, dat["derivations"][deriv_id]["name"]))
-                + "',\n"
-            )
-        if len(dat["derivations"][deriv_id]["notes"]) > 0:
-            cypher_str += "  notes: '" + dat["derivations"][deriv_id]["notes"] + "',\n"
-        cypher_str += (
-            "  creation_date: '"
-            + dat["derivations"][deriv_id]["creation date"]
-            + "',\n"
-        )
-        cypher_str += "  author: '" + dat["derivations"][deriv_id]["author"] + "'}\n"
-
-        # https://neo4j.com/docs/cypher-manual/current/syntax/comments/
-        for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-            cypher_str += "CREATE (id" + step_id + ":step {\n"
-            cypher_str += "  creation_date: '" + step_dict["creation date"] + "',\n"
-            cypher_str += "  author: '" + step_dict["author"] + "'}\n"
-            # step to deriv via linear index
-            cypher_str += (
-                "CREATE (id"
-                + step_id
-                + ")<-[:linear_index {linear_index: '"
-                + str(step_dict["linear index"])
-                + "}']-(id"
-                + deriv_id
-                + ")\n"
-            )
-            # step to infrule
-            cypher_str += (
-                "CREATE (id"
-                + step_id
-                + ")<-[:infrule]-("
-                + "".join(filter(str.isalnum, step_dict["inf rule"]))
-                + ")\n"
-            )
-
-            # within each step, link to expr
-            for expr_local_id in step_dict["inputs"]:
-                cypher_str += (
-                    "CREATE (id"
-                    + step_id
-                    + ")<-[:expr { local_id: '"
-                    + expr_local_id
-                    + "'}]-(id"
-                    + dat["expr local to global"][expr_local_id]
-                    + ")\n"
-                )
-            for expr_local_id in step_dict["feeds"]:
-                cypher_str += (
-                    "CREATE (id"
-                    + step_id
-                    + ")<-[:expr { local_id: '"
-                    + expr_local_id
-                    + "'}]-(id"
-                    + dat["expr local to global"][expr_local_id]
-                    + ")\n"
-                )
-            for expr_local_id in step_dict["outputs"]:
-                cypher_str += (
-                    "CREATE (id"
-                    + step_id
-                    + ")-[:expr { local_id: '"
-                    + expr_local_id
-                    + "'}]->(id"
-                    + dat["expr local to global"][expr_local_id]
-                    + ")\n"
-                )
-
-    # for symbol_id, symbol_dict in dat['symbols'].items():
-    #    cypher_str += "CREATE ()"
-
-    # for operator_name, operator_dict in dat['operators'].items():
-    #    cypher_str += "CREATE ()"
-
-    cypher_file = "neo4j.txt"
-    with open(cypher_file, "w") as fil:
-        fil.write(cypher_str)
+    cypher_file = db_export.export_to_file(
+        dat, "cypher", db_export.export_formats["cypher"]["file name"]
+    )
     logger.info("[trace end " + trace_id + "]")
     return cypher_file
 
@@ -1872,7 +1795,8 @@ def get_sorted_list_of_derivations(path_to_db: str) -> list:
 def create_symbol_id(path_to_db: str) -> str:
     """
     When creating a new symbol, need to ensure
-    that ID is not already used in the Physics Derivation Graph
+    that ID is not already used in the Physics Derivation Graph;
+    see clib.allocate_id
 
     Args:
         path_to_db: filename of the SQL database containing
@@ -1885,19 +1809,7 @@ def create_symbol_id(path_to_db: str) -> str:
     """
     # trace_id = str(random.randint(1000000, 9999999))
     # logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-    symbol_ids_in_use = list(dat["symbols"].keys())
-    found_valid_id = False
-    loop_count = 0
-    while not found_valid_id:
-        loop_count += 1
-        proposed_symbol_id = str(random.randint(1000, 9999))  # 4 digits
-
-        if proposed_symbol_id not in symbol_ids_in_use:
-            found_valid_id = True
-        if loop_count > 100000:
-            logger.error("too many; this seems unlikely")
-            raise Exception("this seems unlikely")
+    proposed_symbol_id = clib.allocate_id(path_to_db, "symbol")
     # logger.info("[trace end " + trace_id + "]")
     return proposed_symbol_id
 
@@ -1905,7 +1817,8 @@ def create_symbol_id(path_to_db: str) -> str:
 def create_deriv_id(path_to_db: str) -> str:
     """
     When creating a new derivation, need to ensure
-    that ID is not already used in the Physics Derivation Graph
+    that ID is not already used in the Physics Derivation Graph;
+    see clib.allocate_id
 
     Args:
         path_to_db: filename of the SQL database containing
@@ -1918,27 +1831,15 @@ def create_deriv_id(path_to_db: str) -> str:
     """
     # trace_id = str(random.randint(1000000, 9999999))
     # logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-    deriv_ids_in_use = list(dat["derivations"].keys())
-
-    found_valid_id = False
-    loop_count = 0
-    while not found_valid_id:
-        loop_count += 1
-        proposed_deriv_id = str(random.randint(100000, 999999))  # 6 digits
-
-        if proposed_deriv_id not in deriv_ids_in_use:
-            found_valid_id = True
-        if loop_count > 10000000:
-            logger.error("too many; this seems unlikely")
-            raise Exception("this seems unlikely")
+    proposed_deriv_id = clib.allocate_id(path_to_db, "derivation")
     # logger.info("[trace end " + trace_id + "]")
     return proposed_deriv_id
 
 
 def create_expr_global_id(path_to_db: str) -> str:
     """
-    search DB to find whether proposed expr ID already exists
+    ensure the proposed expr ID does not already exist;
+    see clib.allocate_id
 
     Args:
         path_to_db: filename of the SQL database containing
@@ -1947,36 +1848,19 @@ def create_expr_global_id(path_to_db: str) -> str:
         proposed_global_expr_id
     Raises:
 
-
-    >>> create_expr_id("pdg.db")
+    >>> create_expr_global_id("pdg.db")
     """
     # trace_id = str(random.randint(1000000, 9999999))
     # logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-
-    global_expr_ids_in_use = list(dat["expressions"].keys())
-
-    found_valid_id = False
-    loop_count = 0
-    while not found_valid_id:
-        loop_count += 1
-        proposed_global_expr_id = str(
-            random.randint(1000000000, 9999999999)
-        )  # 10 digits
-
-        if proposed_global_expr_id not in global_expr_ids_in_use:
-            found_valid_id = True
-        if loop_count > 10000000000:
-            logger.error("too many; this seems unlikely")
-            raise Exception("this seems unlikely")
+    proposed_global_expr_id = clib.allocate_id(path_to_db, "expression")
     # logger.info("[trace end " + trace_id + "]")
     return proposed_global_expr_id
 
 
 def create_step_id(path_to_db: str) -> str:
     """
-    search DB to find whether proposed step ID already exists
-
+    ensure the proposed step ID does not already exist;
+    see clib.allocate_id
 
     Args:
         path_to_db: filename of the SQL database containing
@@ -1985,36 +1869,19 @@ def create_step_id(path_to_db: str) -> str:
         proposed_step_id
     Raises:
 
-
     >>> create_step_id("pdg.db")
     """
     # trace_id = str(random.randint(1000000, 9999999))
     # logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-
-    step_ids_in_use = []
-    for deriv_id in dat["derivations"].keys():
-        for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-            step_ids_in_use.append(step_id)  # formerly 'inf rule local ID'
-
-    found_valid_id = False
-    loop_count = 0
-    while not found_valid_id:
-        loop_count += 1
-        proposed_step_id = str(random.randint(1000000, 9999999))  # 7 digits
-        if proposed_step_id not in step_ids_in_use:
-            found_valid_id = True
-        if loop_count > 10000000000:
-            logger.error("too many reached; this seems unlikely")
-            raise Exception("this seems unlikely")
+    proposed_step_id = clib.allocate_id(path_to_db, "step")
     # logger.info("[trace end " + trace_id + "]")
     return proposed_step_id
 
 
 def create_expr_local_id(path_to_db: str) -> str:
     """
-    search DB to find whether proposed local expression ID already exists
-
+    ensure the proposed local expression ID does not already exist;
+    see clib.allocate_id
 
     Args:
         path_to_db: filename of the SQL database containing
@@ -2023,25 +1890,11 @@ def create_expr_local_id(path_to_db: str) -> str:
         proposed_local_id
     Raises:
 
-
     >>> create_expr_local_id("pdg.db")
     """
     # trace_id = str(random.randint(1000000, 9999999))
     # logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-
-    local_ids_in_use = list(dat["expr local to global"].keys())
-
-    found_valid_id = False
-    loop_count = 0
-    while not found_valid_id:
-        loop_count += 1
-        proposed_local_id = str(random.randint(1000000, 9999999))  # 7 digits
-        if proposed_local_id not in local_ids_in_use:
-            found_valid_id = True
-        if loop_count > 10000000000:
-            logger.error("unlikely")
-            raise Exception("this seems unlikely")
+    proposed_local_id = clib.allocate_id(path_to_db, "local expression")
     # logger.info("[trace end " + trace_id + "]")
     return proposed_local_id
 
@@ -2076,6 +1929,9 @@ def file_tail(full_path_to_file: str, number_of_lines_of_log_tail: int) -> list:
 
 def generate_auth_summary() -> list:
     """
+    New lines of auth.log are added to the daily aggregates (see
+    logs_to_stats.ingest_auth_log) and the plots are drawn from the aggregates.
+    A plot is redrawn when new lines were ingested or when it does not exist yet.
 
     Args:
         None
@@ -2089,31 +1945,50 @@ def generate_auth_summary() -> list:
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
 
-    df = logs_to_stats.auth_log_to_df(
-        "/home/appuser/app/logs/auth.log", "/home/appuser/app/static/iso3166.csv"
+    number_of_new_lines = logs_to_stats.ingest_auth_log(
+        "/home/appuser/app/logs/auth.log",
+        "/home/appuser/app/static/iso3166.csv",
+        logs_to_stats.path_to_auth_log_stats_db,
+        # a large backlog is ingested over several visits rather than in one request
+        max_seconds=proc_timeout / 3,
     )
-
-    logger.debug("generated df from auth log")
+    logger.debug("ingested " + str(number_of_new_lines) + " lines of auth log")
 
     creation_date = datetime.datetime.now().strftime("%Y-%m-%d")
+    path_to_store = logs_to_stats.path_to_auth_log_stats_db
+    destination_folder = "/home/appuser/app/static/"
 
     list_of_picture_names = []
 
     pic_name = "unique_usernames_" + creation_date + ".png"
-    if not os.path.exists("/home/appuser/app/static/" + pic_name):
-        logs_to_stats.plot_username_distribution(
-            df, "/home/appuser/app/static/", pic_name
+    if (number_of_new_lines > 0) or (not os.path.exists(destination_folder + pic_name)):
+        logs_to_stats.plot_username_distribution_from_store(
+            path_to_store, destination_folder, pic_name
         )
     list_of_picture_names.append(pic_name)
 
     pic_name = "unique_IP_address_per_day_" + creation_date + ".png"
-    if not os.path.exists("/home/appuser/app/static/" + pic_name):
-        logs_to_stats.plot_ip_vs_time(df, "/home/appuser/app/static/", pic_name)
+    if (number_of_new_lines > 0) or (not os.path.exists(destination_folder + pic_name)):
+        logs_to_stats.plot_daily_count_from_store(
+            path_to_store,
+            "daily_ip",
+            "number of unique IP addresses",
+            "IP addresses observed per day",
+            destination_folder,
+            pic_name,
+        )
     list_of_picture_names.append(pic_name)
 
     pic_name = "unique_user_names_per_day_" + creation_date + ".png"
-    if not os.path.exists("/home/appuser/app/static/" + pic_name):
-        logs_to_stats.plot_username_vs_time(df, "/home/appuser/app/static/", pic_name)
+    if (number_of_new_lines > 0) or (not os.path.exists(destination_folder + pic_name)):
+        logs_to_stats.plot_daily_count_from_store(
+            path_to_store,
+            "daily_username",
+            "number of unique user names",
+            "unique user name attempts observed per day",
+            destination_folder,
+            pic_name,
+        )
     list_of_picture_names.append(pic_name)
 
     pic_name = (
@@ -2121,9 +1996,9 @@ def generate_auth_summary() -> list:
         + creation_date
         + ".png"
     )
-    if not os.path.exists("/home/appuser/app/static/" + pic_name):
-        logs_to_stats.plot_country_per_day_vs_time(
-            df, "/home/appuser/app/static/", pic_name
+    if (number_of_new_lines > 0) or (not os.path.exists(destination_folder + pic_name)):
+        logs_to_stats.plot_country_per_day_from_store(
+            path_to_store, destination_folder, pic_name
         )
     list_of_picture_names.append(pic_name)
 
@@ -2250,110 +2125,505 @@ def extract_operators_from_expression_dict(expr_id: str, path_to_db: str) -> lis
 #    return list_of_expr_ids
 
 
-def popularity_of_derivations(path_to_db: str) -> dict:
+# one graph index per database; see get_graph_index
+graph_index_per_db = {}  # type: dict
+graph_index_lock = threading.Lock()
+
+
+def operators_in_AST(ast) -> list:
     """
-    For each derivation,
-    * how many steps are present?
-    * what other derivations have expressions in common?
+    the operators are the non-numeric parts of the keys of the flattened AST;
+    see flatten_dict
 
     Args:
-        path_to_db: filename of the SQL database containing
-                    a JSON entry that returns a nested dictionary
+        ast: the "AST" field of an expression
     Returns:
-        derivations_popularity_dict['name of deriv']['number of steps'] = 4
-        derivations_popularity_dict['name of deriv']['shares expressions with'] = ["000001", "000004"]
-
+        list_of_operators: unique operator names
     Raises:
 
-
-    >>> popularity_of_derivations("pdg.db")
+    >>> operators_in_AST({'equals': [{'nabla': ['2911']}, {'function': ['1452']}]})
+    ['equals', 'nabla', 'function']
     """
-    trace_id = str(random.randint(1000000, 9999999))
-    logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-    derivations_popularity_dict = {}
-    expressions_per_derivation = {}
-    for deriv_id in dat["derivations"].keys():
-        derivations_popularity_dict[deriv_id] = {
-            "number of steps": len(list(dat["derivations"][deriv_id]["steps"].keys())),
-            "shares expressions with": [],
-        }
-        # which expressions are shared?
-        # first, build a list of expr_global_id per derivation
-        # logger.debug('build a list of expr_global_id per derivation')
-        expressions_per_derivation[deriv_id] = []
-        for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-            for connection_type in ["inputs", "feeds", "outputs"]:
-                for expr_local_id in step_dict[connection_type]:
-                    expressions_per_derivation[deriv_id].append(
-                        dat["expr local to global"][expr_local_id]
-                    )
-        # logger.debug('remove duplicates')
-        # remove duplicates
-        expressions_per_derivation[deriv_id] = list(
-            set(expressions_per_derivation[deriv_id])
-        )
-    # logger.debug('find intersections')
-    # find intersections
-
-    for deriv_id1, list1_of_expr_global_id in expressions_per_derivation.items():
-        for deriv_id2, list2_of_expr_global_id in expressions_per_derivation.items():
-            if deriv_id1 != deriv_id2:
-                for expr_global_id1 in list1_of_expr_global_id:
-                    if expr_global_id1 in list2_of_expr_global_id:
-                        tup = (deriv_id2, expr_global_id1)
-                        # logger.debug(str(tup))
-                        derivations_popularity_dict[deriv_id1][
-                            "shares expressions with"
-                        ].append(tup)
-        # remove duplicates
-        derivations_popularity_dict[deriv_id1]["shares expressions with"] = list(
-            set(derivations_popularity_dict[deriv_id1]["shares expressions with"])
-        )
-    logger.info("[trace end " + trace_id + "]")
-    return derivations_popularity_dict
+    # logger.info("[trace]")
+    list_of_operators = []
+    for this_str in flatten_dict(ast).keys():  # 'equals_0_addition_0'
+        for operator_candidate in this_str.split("_"):
+            try:
+                int(operator_candidate)
+            except ValueError:
+                if operator_candidate not in list_of_operators:
+                    list_of_operators.append(operator_candidate)
+    return list_of_operators
 
 
-def popularity_of_operators(path_to_db: str) -> dict:
+def build_graph_index(dat: dict, previous_graph_index: dict) -> dict:
     """
+    Index every relation used by the popularity_of_* functions in one pass over dat.
+
+    Parsing an AST (for symbols and operators) is the expensive part, so the
+    parse of an expression is reused from previous_graph_index when the AST is unchanged.
+    The other relations only require walking the steps and are rebuilt.
+
+    Args:
+        dat: the nested dictionary from clib.read_db
+        previous_graph_index: the index for an earlier version of dat, or {}
+    Returns:
+        graph_index
+    Raises:
+
+    >>> build_graph_index(dat, {})
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    previous_parse_per_expression = previous_graph_index.get(
+        "parse per expression", {}
+    )
+    graph_index = {
+        "symbol IDs": list(dat["symbols"].keys()),
+        "operator names": list(dat["operators"].keys()),
+        "inference rule names": list(dat["inference rules"].keys()),
+        "expression IDs": list(dat["expressions"].keys()),
+        # expr_global_id: {"AST": str, "symbols": list or None, "operators": list}
+        "parse per expression": {},
+        "number of steps per derivation": {},
+        "expressions per derivation": {},
+        "derivations per expression": {},
+        "expressions per symbol": {},
+        "expressions per operator": {},
+        "steps per inference rule": {},
+        "steps per expression": {},
+        # expr_global_id: [(deriv_id, step_id, connection type)]
+        "uses per expression": {},
+    }  # type: dict
+
+    for expr_global_id, expr_dict in dat["expressions"].items():
+        previous_parse = previous_parse_per_expression.get(expr_global_id)
+        if (previous_parse is not None) and (
+            previous_parse["AST"] == expr_dict.get("AST")
+        ):
+            parse = previous_parse
+        elif "AST" in expr_dict.keys():
+            parse = {
+                "AST": expr_dict["AST"],
+                "symbols": latex_to_sympy.get_symbol_IDs_from_AST_str(
+                    expr_dict["AST"]
+                ),
+                "operators": operators_in_AST(expr_dict["AST"]),
+            }
+        else:
+            parse = {"AST": None, "symbols": None, "operators": []}
+        graph_index["parse per expression"][expr_global_id] = parse
+        for symbol_id in parse["symbols"] or []:
+            graph_index["expressions per symbol"].setdefault(symbol_id, []).append(
+                expr_global_id
+            )
+        for operator in parse["operators"]:
+            graph_index["expressions per operator"].setdefault(operator, []).append(
+                expr_global_id
+            )
+
+    for deriv_id, deriv_dict in dat["derivations"].items():
+        graph_index["number of steps per derivation"][deriv_id] = len(
+            deriv_dict["steps"]
+        )
+        expressions_in_this_deriv = {}  # type: dict
+        for step_id, step_dict in deriv_dict["steps"].items():
+            graph_index["steps per inference rule"].setdefault(
+                step_dict["inf rule"], []
+            ).append((deriv_id, step_id))
+            for connection_type in ["inputs", "feeds", "outputs"]:
+                for expr_local_id in step_dict[connection_type]:
+                    expr_global_id = dat["expr local to global"][expr_local_id]
+                    expressions_in_this_deriv[expr_global_id] = True
+                    steps_of_expr = graph_index["steps per expression"].setdefault(
+                        expr_global_id, []
+                    )
+                    if (deriv_id, step_id) not in steps_of_expr:
+                        steps_of_expr.append((deriv_id, step_id))
+                    graph_index["uses per expression"].setdefault(
+                        expr_global_id, []
+                    ).append((deriv_id, step_id, connection_type))
+        graph_index["expressions per derivation"][deriv_id] = list(
+            expressions_in_this_deriv.keys()
+        )
+        for expr_global_id in expressions_in_this_deriv.keys():
+            graph_index["derivations per expression"].setdefault(
+                expr_global_id, []
+            ).append(deriv_id)
+
+    logger.info("[trace end " + trace_id + "]")
+    return graph_index
+
+
+def get_graph_index(path_to_db: str) -> dict:
+    """
+    The index is rebuilt when the database version changes (see clib.get_db_version),
+    so every write is reflected; the caller must not modify the index.
 
     Args:
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
     Returns:
-        operator_popularity_dict
+        graph_index; see build_graph_index
+    Raises:
+
+    >>> get_graph_index("pdg.db")
+    """
+    # logger.info("[trace]")
+    db_version = clib.get_db_version(path_to_db)
+    with graph_index_lock:
+        entry = graph_index_per_db.get(path_to_db, {})
+    if ("graph index" in entry.keys()) and (entry["db version"] == db_version):
+        return entry["graph index"]
+
+    dat = clib.read_db(path_to_db)
+    graph_index = build_graph_index(dat, entry.get("graph index", {}))
+    with graph_index_lock:
+        graph_index_per_db[path_to_db] = {
+            "db version": db_version,
+            "graph index": graph_index,
+        }
+    return graph_index
+
+
+def derivations_containing_expressions(
+    list_of_expr_global_ids: list, path_to_db: str
+) -> dict:
+    """
+    Look up each expression in the graph index rather than scanning every step.
+
+    Args:
+        list_of_expr_global_ids: global IDs of expressions
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        dict where the keys are the expression global IDs and the values are
+        {"derivations": [deriv_id], "uses": [{"derivation", "step", "role"}]}
+        where role is "inputs", "feeds", or "outputs";
+        the value is None for IDs that are not expressions
     Raises:
 
+    >>> derivations_containing_expressions(["0000040490"], "pdg.db")
+    {'0000040490': {'derivations': ['000010'], 'uses': [{'derivation': '000010', 'step': '5940300', 'role': 'feeds'}]}}
+    """
+    # logger.info("[trace]")
+    graph_index = get_graph_index(path_to_db)
+    result_dict = {}  # type: dict
+    for expr_global_id in list_of_expr_global_ids:
+        # every expression has an entry, so this is a dict lookup rather than a scan
+        if expr_global_id not in graph_index["parse per expression"].keys():
+            result_dict[expr_global_id] = None
+            continue
+        result_dict[expr_global_id] = {
+            "derivations": list(
+                graph_index["derivations per expression"].get(expr_global_id, [])
+            ),
+            "uses": [
+                {"derivation": deriv_id, "step": step_id, "role": connection_type}
+                for deriv_id, step_id, connection_type in graph_index[
+                    "uses per expression"
+                ].get(expr_global_id, [])
+            ],
+        }
+    return result_dict
 
-    >>> popularity_of_operators("pdg.db")
+
+def steps_affected_by_edit(
+    list_of_symbol_ids: list, list_of_expr_global_ids: list, path_to_db: str
+) -> dict:
+    """
+    Follow the dependencies symbol -> expression -> step -> derivation
+    to find what an edit of the symbols and expressions makes stale.
+
+    Args:
+        list_of_symbol_ids: symbols that were edited
+        list_of_expr_global_ids: expressions that were edited
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        affected_dict = {"expressions": [expr_global_id],
+                         "steps": [(deriv_id, step_id)],
+                         "derivations": [deriv_id]}
+    Raises:
+
+    >>> steps_affected_by_edit(["1054"], [], "pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    graph_index = get_graph_index(path_to_db)
+    affected_dict = {
+        "expressions": [],
+        "steps": [],
+        "derivations": [],
+    }  # type: dict
+    for symbol_id in list_of_symbol_ids:
+        for expr_global_id in graph_index["expressions per symbol"].get(symbol_id, []):
+            if expr_global_id not in affected_dict["expressions"]:
+                affected_dict["expressions"].append(expr_global_id)
+    for expr_global_id in list_of_expr_global_ids:
+        if expr_global_id not in affected_dict["expressions"]:
+            affected_dict["expressions"].append(expr_global_id)
+    for expr_global_id in affected_dict["expressions"]:
+        for deriv_id, step_id in graph_index["steps per expression"].get(
+            expr_global_id, []
+        ):
+            if (deriv_id, step_id) not in affected_dict["steps"]:
+                affected_dict["steps"].append((deriv_id, step_id))
+            if deriv_id not in affected_dict["derivations"]:
+                affected_dict["derivations"].append(deriv_id)
+    logger.info("[trace end " + trace_id + "]")
+    return affected_dict
+
+
+def revalidate_affected_steps(affected_dict: dict, path_to_db: str) -> dict:
+    """
+    Re-render and re-check only what an edit made stale;
+    see steps_affected_by_edit.
+
+    The PNGs of the affected expressions are rendered again.
+    The step validations and dimension checks are cached by content
+    (see vir.validate_step_cached and vdim.check_dimensions_of_AST),
+    so asking for them refreshes exactly the entries that changed.
+    The d3js and PDF files of a derivation are named by the hash of their content,
+    so they are regenerated when the derivation is next viewed.
+
+    Args:
+        affected_dict: see steps_affected_by_edit
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        revalidation_dict = {"steps": {deriv_id: {step_id: result}},
+                             "dimensions": {expr_global_id: result}}
+    Raises:
+
+    >>> revalidate_affected_steps(steps_affected_by_edit(["1054"], [], "pdg.db"), "pdg.db")
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
+
     dat = clib.read_db(path_to_db)
-    operator_popularity_dict = {}
+    create_pngs_from_latex(
+        {
+            expr_global_id: dat["expressions"][expr_global_id]["latex"]
+            for expr_global_id in affected_dict["expressions"]
+            if expr_global_id in dat["expressions"].keys()
+        }
+    )
 
-    operators_per_expr = {}
-    for expr_id, expr_dict in dat["expressions"].items():
-        if "AST" in expr_dict.keys():
-            flt_dict = flatten_dict(expr_dict["AST"])
-        else:
-            flt_dict = {}
-        list_of_str = list(flt_dict.keys())
-        list_of_operators = []
-        for this_str in list_of_str:  # 'equals_0_addition_0'
-            list_of_operator_candidates = this_str.split("_")
-            for operator_candidate in list_of_operator_candidates:
-                try:
-                    int(operator_candidate)
-                except ValueError:
-                    list_of_operators.append(operator_candidate)
-        operators_per_expr[expr_id] = list(set(list_of_operators))
+    revalidation_dict = {"steps": {}, "dimensions": {}}  # type: dict
+    for deriv_id, step_id in affected_dict["steps"]:
+        if (deriv_id not in dat["derivations"].keys()) or (
+            step_id not in dat["derivations"][deriv_id]["steps"].keys()
+        ):
+            continue  # deleted since the edit
+        try:
+            result = vir.validate_step_cached(deriv_id, step_id, path_to_db)
+        except Exception as err:
+            logger.error(deriv_id + " " + step_id + ": " + str(err))
+            result = "failed"
+        revalidation_dict["steps"].setdefault(deriv_id, {})[step_id] = result
+    for expr_global_id in affected_dict["expressions"]:
+        if expr_global_id not in dat["expressions"].keys():
+            continue
+        try:
+            revalidation_dict["dimensions"][expr_global_id] = vdim.validate_dimensions(
+                expr_global_id, path_to_db
+            )
+        except Exception as err:
+            logger.error(expr_global_id + ": " + str(err))
+            revalidation_dict["dimensions"][expr_global_id] = "failed"
+    logger.info("[trace end " + trace_id + "]")
+    return revalidation_dict
+
+
+# created when first used; see revalidate_after_edit
+revalidation_executor = {}  # type: dict
+revalidation_executor_lock = threading.Lock()
+
+
+def revalidate_after_edit(
+    list_of_symbol_ids: list, list_of_expr_global_ids: list, path_to_db: str
+) -> concurrent.futures.Future:
+    """
+    Called by the functions that edit symbols and expressions
+    and by the API (see pdg_api.api_revalidate_steps_affected_by_edit).
+    The work, including finding the affected steps, is done in a background
+    thread so that the edit returns immediately;
+    by the time the user opens an affected step, its validation is usually cached.
+
+    Args:
+        list_of_symbol_ids: symbols that were edited
+        list_of_expr_global_ids: expressions that were edited
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        future whose result is the return value of
+        revalidate_steps_affected_by_edit, or None if it failed
+    Raises:
+
+    >>> revalidate_after_edit([], ["9999999953"], "pdg.db")
+    """
+    # logger.info("[trace]")
+    future = get_revalidation_executor().submit(
+        log_exception_of_background_task,
+        revalidate_steps_affected_by_edit,
+        list_of_symbol_ids,
+        list_of_expr_global_ids,
+        path_to_db,
+    )
+    evict_validation_results_in_background(path_to_db)
+    return future
+
+
+def revalidate_steps_affected_by_edit(
+    list_of_symbol_ids: list, list_of_expr_global_ids: list, path_to_db: str
+) -> dict:
+    """
+    see steps_affected_by_edit and revalidate_affected_steps
+
+    Args:
+        list_of_symbol_ids: symbols that were edited
+        list_of_expr_global_ids: expressions that were edited
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        revalidation_dict (see revalidate_affected_steps)
+    Raises:
+
+    >>> revalidate_steps_affected_by_edit([], ["9999999953"], "pdg.db")
+    """
+    # logger.info("[trace]")
+    affected_dict = steps_affected_by_edit(
+        list_of_symbol_ids, list_of_expr_global_ids, path_to_db
+    )
+    logger.debug(
+        str(len(affected_dict["steps"]))
+        + " steps in "
+        + str(len(affected_dict["derivations"]))
+        + " derivations affected by edit"
+    )
+    return revalidate_affected_steps(affected_dict, path_to_db)
+
+
+def get_revalidation_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    one thread, so revalidation does not compete with page requests
+
+    >>> get_revalidation_executor()
+    """
+    # logger.info("[trace]")
+    with revalidation_executor_lock:
+        if "executor" not in revalidation_executor.keys():
+            revalidation_executor["executor"] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="pdg_revalidate"
+            )
+    return revalidation_executor["executor"]
+
+
+def evict_validation_results_in_background(
+    path_to_db: str,
+) -> concurrent.futures.Future:
+    """
+    Remove stored validation results that no longer match the content;
+    see vir.evict_validation_results.
+    Called when the program starts and after edits.
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        future whose result is the number of results removed
+    Raises:
+
+    >>> evict_validation_results_in_background("pdg.db")
+    """
+    # logger.info("[trace]")
+    return get_revalidation_executor().submit(
+        log_exception_of_background_task,
+        vir.evict_validation_results,
+        path_to_db,
+    )
+
+
+def log_exception_of_background_task(function_to_run, *args):
+    """
+    an exception in an executor is only raised when the result is read,
+    so for tasks whose result is not read the exception is logged
+
+    >>> log_exception_of_background_task(vir.evict_validation_results, "pdg.db")
+    """
+    # logger.info("[trace]")
+    try:
+        return function_to_run(*args)
+    except Exception as err:
+        logger.error(function_to_run.__name__ + " failed: " + str(err))
+        return None
+
+
+def popularity_of_derivations(path_to_db: str) -> dict:
+    """
+    For each derivation,
+    * how many steps are present?
+    * what other derivations have expressions in common?
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        derivations_popularity_dict['name of deriv']['number of steps'] = 4
+        derivations_popularity_dict['name of deriv']['shares expressions with'] = ["000001", "000004"]
+
+    Raises:
+
+
+    >>> popularity_of_derivations("pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+    graph_index = get_graph_index(path_to_db)
+    derivations_popularity_dict = {}
+    for deriv_id, list_of_expr in graph_index["expressions per derivation"].items():
+        # which expressions are shared?
+        list_of_shared = []
+        for expr_global_id in list_of_expr:
+            for other_deriv_id in graph_index["derivations per expression"][
+                expr_global_id
+            ]:
+                if other_deriv_id != deriv_id:
+                    list_of_shared.append((other_deriv_id, expr_global_id))
+        derivations_popularity_dict[deriv_id] = {
+            "number of steps": graph_index["number of steps per derivation"][
+                deriv_id
+            ],
+            "shares expressions with": list_of_shared,
+        }
+    logger.info("[trace end " + trace_id + "]")
+    return derivations_popularity_dict
+
+
+def popularity_of_operators(path_to_db: str) -> dict:
+    """
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        operator_popularity_dict
+    Raises:
 
-    for operator, operator_dict in dat["operators"].items():
-        operator_popularity_dict[operator] = []
-        for expr_id, list_of_ops in operators_per_expr.items():
-            if operator in list_of_ops:
-                operator_popularity_dict[operator].append(expr_id)
+
+    >>> popularity_of_operators("pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+    graph_index = get_graph_index(path_to_db)
+    operator_popularity_dict = {}
+    for operator in graph_index["operator names"]:
+        operator_popularity_dict[operator] = list(
+            graph_index["expressions per operator"].get(operator, [])
+        )
     logger.info("[trace end " + trace_id + "]")
     return operator_popularity_dict
 
@@ -2375,25 +2645,18 @@ def popularity_of_symbols_in_expressions(path_to_db: str) -> dict:
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-
-    symbol_popularity_dict = {}
-    # TODO: this is a join that is really slow!
-    for symbol_id, symbol_dict in dat["symbols"].items():
-        list_of_uses = []
-        for expr_global_id, expr_dict in dat["expressions"].items():
-            if "AST" in expr_dict.keys():
-                # logger.debug("ast = " + expr_dict["AST"])
+    graph_index = get_graph_index(path_to_db)
 
-                list_of_symbol_IDs_for_this_expr = (
-                    latex_to_sympy.get_symbol_IDs_from_AST_str(expr_dict["AST"])
-                )
-            else:  # no AST in expr_dict
+    for expr_global_id, parse in graph_index["parse per expression"].items():
+        if parse["symbols"] is None:  # no AST in expr_dict
+            if len(graph_index["symbol IDs"]) > 0:
                 raise Exception("no AST in " + expr_global_id)
-                list_of_symbol_IDs_for_this_expr = []
-            if symbol_id in list_of_symbol_IDs_for_this_expr:
-                list_of_uses.append(expr_global_id)
-        symbol_popularity_dict[symbol_id] = list_of_uses
+
+    symbol_popularity_dict = {}
+    for symbol_id in graph_index["symbol IDs"]:
+        symbol_popularity_dict[symbol_id] = list(
+            graph_index["expressions per symbol"].get(symbol_id, [])
+        )
 
     logger.info("[trace end " + trace_id + "]")
     return symbol_popularity_dict
@@ -2405,6 +2668,7 @@ def popularity_of_symbols_in_derivations(
     """
 
     Args:
+        symbol_popularity_dict_in_expr: from popularity_of_symbols_in_expressions
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
     Returns:
@@ -2417,29 +2681,20 @@ def popularity_of_symbols_in_derivations(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
+    graph_index = get_graph_index(path_to_db)
 
     symbol_popularity_dict_in_deriv = {}
-
-    # symbol per expression
-    symbol_popularity_dict_in_expr = popularity_of_symbols_in_expressions(path_to_db)
-    # logger.debug(str(symbol_popularity_dict_in_expr))
-
-    # expression per derivation
-    expression_popularity_dict = popularity_of_expressions(path_to_db)
-    # logger.debug(str(expression_popularity_dict))
-
-    for symbol_id, list_of_expr in symbol_popularity_dict_in_expr.items():
-        # logger.debug(symbol_id)
-        this_symbol_is_in_derivations = []
-        for expr_global_id in list_of_expr:
-            # logger.debug(expr_global_id)
-            for deriv_id in expression_popularity_dict[expr_global_id]:
-                this_symbol_is_in_derivations.append(deriv_id)
-        # logger.debug(this_symbol_is_in_derivations)
-        # logger.debug(symbol_id)
+    for symbol_id in graph_index["symbol IDs"]:
+        this_symbol_is_in_derivations = {}  # type: dict
+        for expr_global_id in graph_index["expressions per symbol"].get(
+            symbol_id, []
+        ):
+            for deriv_id in graph_index["derivations per expression"].get(
+                expr_global_id, []
+            ):
+                this_symbol_is_in_derivations[deriv_id] = True
         symbol_popularity_dict_in_deriv[symbol_id] = list(
-            set(this_symbol_is_in_derivations)
+            this_symbol_is_in_derivations.keys()
         )
 
     logger.info("[trace end " + trace_id + "]")
@@ -2461,30 +2716,11 @@ def popularity_of_expressions(path_to_db: str) -> dict:
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
+    graph_index = get_graph_index(path_to_db)
     expression_popularity_dict = {}
-
-    deriv_uses_expr_global_id = {}
-    for deriv_id in dat["derivations"].keys():
-        list_of_all_expr_global_IDs_for_this_deriv = []
-        for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-            for connection_type in ["inputs", "feeds", "outputs"]:
-                for expr_local_id in step_dict[connection_type]:
-                    list_of_all_expr_global_IDs_for_this_deriv.append(
-                        dat["expr local to global"][expr_local_id]
-                    )
-
-        deriv_uses_expr_global_id[deriv_id] = list(
-            set(list_of_all_expr_global_IDs_for_this_deriv)
-        )
-
-    for expr_global_id, expr_dict in dat["expressions"].items():
-        expression_popularity_dict[expr_global_id] = []
-        for deriv_id, list_of_expr in deriv_uses_expr_global_id.items():
-            if expr_global_id in list_of_expr:
-                expression_popularity_dict[expr_global_id].append(deriv_id)
+    for expr_global_id in graph_index["expression IDs"]:
         expression_popularity_dict[expr_global_id] = list(
-            set(expression_popularity_dict[expr_global_id])
+            graph_index["derivations per expression"].get(expr_global_id, [])
         )
 
     # logger.debug("expression_popularity_dict = %s", expression_popularity_dict)
@@ -2508,15 +2744,13 @@ def count_of_infrules(path_to_db: str) -> dict:
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
+    graph_index = get_graph_index(path_to_db)
     infrule_count_dict = {}
-    for infrule_name, infrule_dict in dat["inference rules"].items():
-        infrule_count_dict[infrule_name] = 0
-        for deriv_id in dat["derivations"].keys():
-            for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-                if step_dict["inf rule"] == infrule_name:
-                    infrule_count_dict[infrule_name] += 1
-
+    for infrule_name in graph_index["inference rule names"]:
+        infrule_count_dict[infrule_name] = len(
+            graph_index["steps per inference rule"].get(infrule_name, [])
+        )
+    logger.info("[trace end " + trace_id + "]")
     return infrule_count_dict
 
 
@@ -2539,22 +2773,15 @@ def popularity_of_infrules(path_to_db: str) -> dict:
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
+    graph_index = get_graph_index(path_to_db)
     infrule_popularity_dict = {}
-    for infrule_name, infrule_dict in dat["inference rules"].items():
-        list_of_uses = []
-        for deriv_id in dat["derivations"].keys():
-            list_of_infrules = []
-            for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-                list_of_infrules.append(step_dict["inf rule"])
-
-            list_of_infrule_for_this_deriv = list(set(list_of_infrules))
-
-            # logger.debug('popularity_of_infrules; list =',list_of_infrule_for_this_deriv)
-            # logger.debug('popularity_of_infrules; infrule_name =',infrule_name)
-            if infrule_name in list_of_infrule_for_this_deriv:
-                list_of_uses.append(deriv_id)
-        infrule_popularity_dict[infrule_name] = list_of_uses
+    for infrule_name in graph_index["inference rule names"]:
+        list_of_uses = {}  # type: dict
+        for deriv_id, step_id in graph_index["steps per inference rule"].get(
+            infrule_name, []
+        ):
+            list_of_uses[deriv_id] = True
+        infrule_popularity_dict[infrule_name] = list(list_of_uses.keys())
     logger.info("[trace end " + trace_id + "]")
     return infrule_popularity_dict
 
@@ -2616,35 +2843,30 @@ def search_list_of_strings(
     return match_list
 
 
-def search_expression_latex(pattern: str, path_to_db: str, delimiter="\s+") -> dict:
+def search_expression_latex(pattern: str, path_to_db: str) -> dict:
     """
-    based on search_list_of_strings
-    adapted to dat['expressions'] to find latex and return a modified dat['expressions']
+    Search the Latex, name, notes, and symbol IDs of expressions
+    using the inverted index in expression_search; see expression_search.parse_query
+    for the query syntax. Unlike search_list_of_strings, the pattern is not a regex.
 
     Args:
+        pattern: e.g. "cos 2", "cos OR sin", "\\fra*"
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
     Returns:
-        match_dict
+        match_dict: a subset of dat['expressions'], best match first
     Raises:
-    >>> search_expression_latex("pdg.db")
+    >>> search_expression_latex("cos 2", "pdg.db")
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
 
-    dat = clib.read_db(path_to_db)
-
-    ands = re.split(delimiter, pattern)
+    list_of_expr_global_ids = expression_search.search_expressions(pattern, path_to_db)
 
+    dat = clib.read_db(path_to_db)
     match_dict = {}
-    for expr_id, expr_dict in dat["expressions"].items():
-        line = expr_dict["latex"]
-        ignore_line = False
-        for word in ands:
-            if not re.findall(word, line):
-                ignore_line = True
-        if not ignore_line:
-            match_dict[expr_id] = expr_dict
+    for expr_global_id in list_of_expr_global_ids:
+        match_dict[expr_global_id] = dat["expressions"][expr_global_id]
     logger.debug("number of matches = " + str(len(match_dict)))
 
     logger.info("[trace end " + trace_id + "]")
@@ -2778,12 +3000,20 @@ def create_tex_file_for_expr(tmp_file: str, input_latex_str: str) -> None:
     return
 
 
-def generate_d3js_json_map_of_derivations(path_to_db: str) -> str:
+def generate_d3js_json_map_of_derivations(
+    path_to_db: str, precompute_layout: bool = True
+) -> str:
     """
+    Derivations are nodes (group 0) connected through the expressions they share (group 1).
+
+    The map has many nodes, so by default the layout is computed here once
+    (see precompute_d3js_layout) rather than by a force simulation in every browser.
+    The JSON file is named by the hash of its content (see write_d3js_payload).
 
     Args:
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
+        precompute_layout: whether to include node coordinates
     Returns:
         json_filename
     Raises:
@@ -2797,116 +3027,69 @@ def generate_d3js_json_map_of_derivations(path_to_db: str) -> str:
 
     dat = clib.read_db(path_to_db)
 
-    #    json_filename = "all_derivations.json"
-    #    with open(json_filename, "w") as fil:
-    json_str = ""
+    # everything that determines the content of the JSON file
+    latex_per_png_name = {}
+    for deriv_id, deriv_dict in derivation_popularity_dict.items():
+        latex_per_png_name[deriv_id + "_name"] = (
+            "\\text{" + dat["derivations"][deriv_id]["name"].replace("^", "") + "}"
+        )
+        for other_deriv_id, expr_global_id in deriv_dict["shares expressions with"]:
+            latex_per_png_name[expr_global_id] = dat["expressions"][expr_global_id][
+                "latex"
+            ]
+    content_md5 = hashlib.md5(
+        json.dumps(
+            [derivation_popularity_dict, latex_per_png_name, precompute_layout],
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+    json_filename = "d3js_all_derivations_" + content_md5 + ".json"
+    if d3js_json_is_cached(json_filename):
+        logger.info("[trace end " + trace_id + "]")
+        return json_filename
+
+    # render the missing PNGs together rather than one at a time
+    create_pngs_from_latex(
+        {
+            png_name: input_latex_str
+            for png_name, input_latex_str in latex_per_png_name.items()
+            if not os.path.isfile("/home/appuser/app/static/" + png_name + ".png")
+        }
+    )
 
-    json_str += "{ \n"
-    json_str += '  "nodes": [\n'
+    node_per_id = {}
+    list_of_links = []
+    for deriv_id, deriv_dict in derivation_popularity_dict.items():
+        node_per_id[deriv_id] = d3js_node(
+            deriv_id,
+            0,
+            deriv_id + "_name",
+            "https://derivationmap.net/review_derivation/"
+            + deriv_id
+            + "/?referrer=d3js",
+            -1,
+        )
+    for deriv_id, deriv_dict in derivation_popularity_dict.items():
+        for other_deriv_id, expr_global_id in deriv_dict["shares expressions with"]:
+            if expr_global_id not in node_per_id.keys():
+                node_per_id[expr_global_id] = d3js_node(
+                    expr_global_id,
+                    1,
+                    expr_global_id,
+                    "https://derivationmap.net/list_all_expressions?referrer=d3js#"
+                    + expr_global_id,
+                    -1,
+                )
+            for source_id in [deriv_id, other_deriv_id]:
+                link = {"source": source_id, "target": expr_global_id, "value": 1}
+                if link not in list_of_links:
+                    list_of_links.append(link)
 
-    if True:
-        list_of_nodes = []
-        list_of_edges = []
+    d3js_payload = {"nodes": list(node_per_id.values()), "links": list_of_links}
+    if precompute_layout:
+        precompute_d3js_layout(d3js_payload)
+    write_d3js_payload(d3js_payload, json_filename)
 
-        for deriv_id, deriv_dict in derivation_popularity_dict.items():
-            # https://stackoverflow.com/questions/22520932/python-remove-all-non-alphabet-chars-from-string
-            this_deriv = deriv_id
-            if not os.path.isfile(
-                "/home/appuser/app/static/" + this_deriv + "_name" + ".png"
-            ):
-                create_png_from_latex(
-                    "\\text{"
-                    + dat["derivations"][deriv_id]["name"].replace("^", "")
-                    + "}",
-                    this_deriv + "_name",
-                )
-            image = cv2.imread(
-                "/home/appuser/app/static/" + this_deriv + "_name" + ".png"
-            )
-            list_of_nodes.append(
-                '    {"id": "'
-                + this_deriv
-                + '", "group": 0, "img": "/static/'
-                + this_deriv
-                + "_name"
-                + '.png", '
-                + '"url": "https://derivationmap.net/review_derivation/'
-                + deriv_id
-                + '/?referrer=d3js", "width": '
-                + str(image.shape[1])
-                + ", "
-                + '"height": '
-                + str(image.shape[0])
-                + ', "linear index": -1},\n'
-            )
-
-        for deriv_id, deriv_dict in derivation_popularity_dict.items():
-            this_deriv = deriv_id
-            for tup in deriv_dict["shares expressions with"]:
-                other_deriv_name = tup[0]
-                expr_global_id = tup[1]
-                if not os.path.isfile(
-                    "/home/appuser/app/static/" + expr_global_id + ".png"
-                ):
-                    expr_latex = dat["expressions"][expr_global_id]["latex"]
-                    create_png_from_latex(expr_latex, expr_global_id)
-                image = cv2.imread(
-                    "/home/appuser/app/static/" + expr_global_id + ".png"
-                )
-                list_of_nodes.append(
-                    '    {"id": "'
-                    + expr_global_id
-                    + '", "group": 1, "img": "/static/'
-                    + expr_global_id
-                    + '.png", '
-                    + '"url": "https://derivationmap.net/list_all_expressions?referrer=d3js#'
-                    + expr_global_id
-                    + '", "width": '
-                    + str(image.shape[1])
-                    + ", "
-                    + '"height": '
-                    + str(image.shape[0])
-                    + ', "linear index": -1},\n'
-                )
-
-                list_of_edges.append(
-                    '    {"source": "'
-                    + this_deriv
-                    + '", "target": "'
-                    + expr_global_id
-                    + '", "value": 1},\n'
-                )
-                list_of_edges.append(
-                    '    {"source": "'
-                    + other_deriv_name
-                    + '", "target": "'
-                    + expr_global_id
-                    + '", "value": 1},\n'
-                )
-
-    list_of_nodes = list(set(list_of_nodes))
-    all_nodes = "".join(list_of_nodes)
-    all_nodes = (
-        all_nodes[:-2] + "\n"
-    )  # remove the trailing comma to be compliant with JSON
-    json_str += all_nodes
-
-    json_str += "  ],\n"
-    json_str += '  "links": [\n'
-
-    list_of_edges = list(set(list_of_edges))
-    all_edges = "".join(list_of_edges)
-    all_edges = all_edges[:-2] + "\n"
-    json_str += all_edges
-
-    json_str += "  ]\n"
-    json_str += "}"
-
-    json_filename = "all_derivations.json"
-    with open(json_filename, "w") as fil:
-        fil.write(json_str)
-
-    shutil.move(json_filename, "/home/appuser/app/static/" + json_filename)
     logger.info("[trace end " + trace_id + "]")
     return json_filename
 
@@ -3008,7 +3191,7 @@ def generate_graphviz_map_of_derivations(path_to_db: str) -> str:
     output_filename = "all_derivation.png"
     # neato -Tpng graphviz.dot > /home/appuser/app/static/graphviz.png
     #    process = Popen(['neato','-Tpng','graphviz.dot','>','/home/appuser/app/static/graphviz.png'], stdout=PIPE, stderr=PIPE)
-    process = subprocess.run(
+    process = instrumentation.run_subprocess(
         ["neato", "-Tpng", dot_filename, "-o" + output_filename],
         stdout=PIPE,
         stderr=PIPE,
@@ -3419,7 +3602,16 @@ def generate_tex_for_derivation(deriv_id: str, user_email: str, path_to_db: str)
             + make_string_safe_for_latex(dat["derivations"][deriv_id]["name"])
             + "}\n"
         )
-        lat_file.write("\\date{\\today}\n")
+        # the date is written out rather than \today so that it is part of the
+        # .tex hashed by md5_of_pdf_inputs; a cached PDF is then never from another day
+        today = datetime.date.today()
+        lat_file.write(
+            "\\date{"
+            + today.strftime("%B ")
+            + str(today.day)
+            + today.strftime(", %Y")
+            + "}\n"
+        )
         lat_file.write("\\author{" + make_string_safe_for_latex(user_email) + "}\n")
         lat_file.write("\\setlength{\\topmargin}{-.5in}\n")
         lat_file.write("\\setlength{\\textheight}{9in}\n")
@@ -3524,8 +3716,71 @@ def generate_tex_for_derivation(deriv_id: str, user_email: str, path_to_db: str)
     return tex_filename  # pass back filename without extension because bibtex cannot handle .tex
 
 
+# PDFs are cached by the MD5 of their inputs; see generate_pdf_for_derivation
+pdf_cache_folder = "/home/appuser/app/pdf_cache/"  # must end with /
+
+
+def md5_of_pdf_inputs(tex_content: str, list_of_diagrams: list) -> str:
+    """
+    The PDF only depends on the .tex (which includes the date), pdg.bib
+    (if anything is cited), and the diagrams included by the .tex;
+    if none of these changed the PDF is unchanged.
+
+    Args:
+        tex_content: content of the .tex file
+        list_of_diagrams: file names in static/diagrams/ included by the .tex
+    Returns:
+        hex digest
+    Raises:
+
+    >>> md5_of_pdf_inputs("\\documentclass{article}...", ["file.png"])
+    """
+    # logger.info("[trace]")
+    hash_of_inputs = hashlib.md5(tex_content.encode("utf-8"))
+    if "\\cite" in tex_content:
+        with open("/home/appuser/app/static/pdg.bib", "rb") as bib_file:
+            hash_of_inputs.update(bib_file.read())
+    for file_name in sorted(list_of_diagrams):
+        hash_of_inputs.update(file_name.encode("utf-8"))
+        try:
+            with open("/home/appuser/app/static/diagrams/" + file_name, "rb") as fil:
+                hash_of_inputs.update(fil.read())
+        except FileNotFoundError:
+            logger.warning("diagram " + file_name + " not found")
+    return hash_of_inputs.hexdigest()
+
+
+def run_pdf_build_command(list_of_args: list, tmp_latex_folder: str) -> str:
+    """
+    Args:
+        list_of_args: command to run, e.g. ["bibtex", "000001"]
+        tmp_latex_folder: the folder the command is run in
+    Returns:
+        standard out of the command
+    Raises:
+
+    >>> run_pdf_build_command(["bibtex", "000001"], "/tmp/tmp_latex_folder_123/")
+    """
+    # logger.info("[trace]")
+    process = instrumentation.run_subprocess(
+        list_of_args,
+        cwd=tmp_latex_folder,
+        stdout=PIPE,
+        stderr=PIPE,
+        timeout=proc_timeout,
+    )
+    # https://stackoverflow.com/questions/41171791/how-to-suppress-or-capture-the-output-of-subprocess-run
+    command_stdout = process.stdout.decode("utf-8")
+    command_stderr = process.stderr.decode("utf-8")
+    logger.debug(list_of_args[0] + " std out: %s", command_stdout)
+    logger.debug(list_of_args[0] + " std err: %s", command_stderr)
+    return command_stdout
+
+
 def generate_pdf_for_derivation(deriv_id: str, user_email: str, path_to_db: str) -> str:
     """
+    If the .tex, pdg.bib, and diagrams are unchanged since the last build,
+    the PDF is copied from pdf_cache_folder instead of being rebuilt.
 
     Args:
         deriv_id: numeric identifier of the derivation
@@ -3540,131 +3795,120 @@ def generate_pdf_for_derivation(deriv_id: str, user_email: str, path_to_db: str)
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-
-    # to isolate the build process, create a temporary folder
-    tmp_latex_folder = "tmp_latex_folder_" + str(random.randint(1000000, 9999999))
-    tmp_latex_folder_full_path = os.getcwd() + "/" + tmp_latex_folder + "/"
-    os.mkdir(tmp_latex_folder_full_path)
 
     # destination for the PDF once file is built
     path_to_pdf = "/home/appuser/app/static/"  # must end with /
     pdf_filename = deriv_id
 
-    # no longer necessary since the temporary build folder is empty
-    # remove_file_debris([path_to_pdf], [pdf_filename], ["log", "pdf"])
-
     tex_filename_without_extension = generate_tex_for_derivation(
         deriv_id, user_email, path_to_db
     )
-    shutil.move(tex_filename_without_extension + ".tex", tmp_latex_folder_full_path)
-
-    # copy the current pdg.bib from static to local for use with bibtex when compiling tex to PDF
-    # https://docs.python.org/3/library/shutil.html
-    shutil.copy("/home/appuser/app/static/pdg.bib", tmp_latex_folder_full_path)
-    # shutil.copy("/home/appuser/app/static/pdg.bib", "/home/appuser/app/")
-
-    # images need to be in the temporary folder to compile the .tex to PDF
-    # https://docs.python.org/3/library/shutil.html#shutil.copytree
-    # shutil.copytree(
-    #        "/home/appuser/app/static/diagrams/", tmp_latex_folder_full_path
-    # )
-    for filename in glob.glob("/home/appuser/app/static/diagrams/*"):
-        # logger.info("copied "+filename+" from "+filename+" to "+tmp_latex_folder_full_path)
-        shutil.copy(filename, tmp_latex_folder_full_path)
-
-    # TODO: it would be good to check whether \cite appears in the .tex content
-
-    # first of the latex runs
-    process = subprocess.run(
-        ["latex", "-halt-on-error", tex_filename_without_extension + ".tex"],
-        cwd=tmp_latex_folder_full_path,
-        stdout=PIPE,
-        stderr=PIPE,
-        timeout=proc_timeout,
-    )
-    # https://stackoverflow.com/questions/41171791/how-to-suppress-or-capture-the-output-of-subprocess-run
-    latex_stdout = process.stdout.decode("utf-8")
-    latex_stderr = process.stderr.decode("utf-8")
-
-    logger.debug("latex std out: %s", latex_stdout)
-    logger.debug("latex std err: %s", latex_stderr)
-
-    if "Text line contains an invalid character" in latex_stdout:
-        logger.error("no PDF generated - tex contains invalid character")
-        raise Exception("no PDF generated - tex contains invalid character")
-    if "No pages of output." in latex_stdout:
-        logger.error("no PDF generated - reason unknown")
-        raise Exception("no PDF generated - reason unknown")
-
-    # first of two bibtex runs
-    process = subprocess.run(
-        ["bibtex", tex_filename_without_extension],
-        cwd=tmp_latex_folder_full_path,
-        stdout=PIPE,
-        stderr=PIPE,
-        timeout=proc_timeout,
+    with open(tex_filename_without_extension + ".tex", "r") as lat_file:
+        tex_content = lat_file.read()
+
+    # only the diagrams the .tex includes are needed to build the PDF
+    list_of_diagrams = sorted(
+        set(re.findall(r"\\includegraphics{([^}]+)}", tex_content))
     )
-    # https://stackoverflow.com/questions/41171791/how-to-suppress-or-capture-the-output-of-subprocess-run
-    bibtex_stdout = process.stdout.decode("utf-8")
-    bibtex_stderr = process.stderr.decode("utf-8")
-    logger.debug("bibtex std out: %s", bibtex_stdout)
-    logger.debug("bibtex std err: %s", bibtex_stderr)
-
-    # second of two bibtex runs
-    process = subprocess.run(
-        ["bibtex", tex_filename_without_extension],
-        cwd=tmp_latex_folder_full_path,
-        stdout=PIPE,
-        stderr=PIPE,
-        timeout=proc_timeout,
-    )
-    # https://stackoverflow.com/questions/41171791/how-to-suppress-or-capture-the-output-of-subprocess-run
-    bibtex_stdout = process.stdout.decode("utf-8")
-    bibtex_stderr = process.stderr.decode("utf-8")
-    logger.debug("bibtex std out: %s", bibtex_stdout)
-    logger.debug("bibtex std err: %s", bibtex_stderr)
-
-    # run latex a second time to enable references to work
-    process = subprocess.run(
-        ["latex", "-halt-on-error", tex_filename_without_extension + ".tex"],
-        cwd=tmp_latex_folder_full_path,
-        stdout=PIPE,
-        stderr=PIPE,
-        timeout=proc_timeout,
+    cite_in_tex = "\\cite" in tex_content
+
+    # one cached PDF per derivation; the file name records the inputs it was built from
+    cached_pdf = (
+        pdf_cache_folder
+        + pdf_filename
+        + "_"
+        + md5_of_pdf_inputs(tex_content, list_of_diagrams)
+        + ".pdf"
     )
+    if os.path.isfile(cached_pdf):
+        logger.debug("PDF is unchanged; using " + cached_pdf)
+        os.remove(tex_filename_without_extension + ".tex")
+        tmp_pdf = path_to_pdf + pdf_filename + ".pdf." + trace_id
+        shutil.copy(cached_pdf, tmp_pdf)
+        os.replace(tmp_pdf, path_to_pdf + pdf_filename + ".pdf")
+        logger.info("[trace end " + trace_id + "]")
+        return pdf_filename + ".pdf"
 
-    # https://tex.stackexchange.com/questions/204291/bibtex-latex-compiling
-    # run latex a third time to enable references to work
-    process = subprocess.run(
-        ["latex", "-halt-on-error", tex_filename_without_extension + ".tex"],
-        cwd=tmp_latex_folder_full_path,
-        stdout=PIPE,
-        stderr=PIPE,
-        timeout=proc_timeout,
-    )
+    # to isolate the build process, create a temporary folder
+    tmp_latex_folder = "tmp_latex_folder_" + str(random.randint(1000000, 9999999))
+    tmp_latex_folder_full_path = os.getcwd() + "/" + tmp_latex_folder + "/"
+    os.mkdir(tmp_latex_folder_full_path)
+    try:
+        shutil.move(
+            tex_filename_without_extension + ".tex", tmp_latex_folder_full_path
+        )
 
-    # https://tex.stackexchange.com/questions/73783/dvipdfm-or-dvipdfmx-or-dvipdft
-    # TODO: how does dvipdfmx know the name of the .tex input? In the process below only the output filename is specified (!)
-    process = subprocess.run(
-        ["dvipdfmx", pdf_filename + ".dvi"],
-        cwd=tmp_latex_folder_full_path,
-        stdout=PIPE,
-        stderr=PIPE,
-        timeout=proc_timeout,
-    )
+        if cite_in_tex:
+            # copy the current pdg.bib from static to local for use with bibtex
+            # https://docs.python.org/3/library/shutil.html
+            shutil.copy("/home/appuser/app/static/pdg.bib", tmp_latex_folder_full_path)
+
+        # images need to be in the temporary folder to compile the .tex to PDF;
+        # a symlink is sufficient and avoids copying every file in static/diagrams/
+        for file_name in list_of_diagrams:
+            path_to_diagram = "/home/appuser/app/static/diagrams/" + file_name
+            if os.path.isfile(path_to_diagram):
+                os.symlink(path_to_diagram, tmp_latex_folder_full_path + file_name)
+            else:
+                logger.error("diagram " + file_name + " not found")
 
-    dvipdf_stdout = process.stdout.decode("utf-8")
-    dvipdf_stderr = process.stderr.decode("utf-8")
+        # first of the latex runs
+        latex_stdout = run_pdf_build_command(
+            ["latex", "-halt-on-error", tex_filename_without_extension + ".tex"],
+            tmp_latex_folder_full_path,
+        )
+        if "Text line contains an invalid character" in latex_stdout:
+            logger.error("no PDF generated - tex contains invalid character")
+            raise Exception("no PDF generated - tex contains invalid character")
+        if "No pages of output." in latex_stdout:
+            logger.error("no PDF generated - reason unknown")
+            raise Exception("no PDF generated - reason unknown")
+
+        if cite_in_tex:
+            # a single bibtex run creates the .bbl; running bibtex again has no effect
+            run_pdf_build_command(
+                ["bibtex", tex_filename_without_extension], tmp_latex_folder_full_path
+            )
+            latex_stdout = "Rerun"  # the .bbl has to be read by latex
+
+        # https://tex.stackexchange.com/questions/204291/bibtex-latex-compiling
+        # run latex again while references are unresolved, as the original
+        # sequence of latex, bibtex, bibtex, latex, latex did, but stop once
+        # latex does not ask for another run
+        number_of_reruns = 0
+        while ("Rerun" in latex_stdout) and (number_of_reruns < 2):
+            latex_stdout = run_pdf_build_command(
+                ["latex", "-halt-on-error", tex_filename_without_extension + ".tex"],
+                tmp_latex_folder_full_path,
+            )
+            number_of_reruns += 1
 
-    logger.debug("dvipdf std out: %s", dvipdf_stdout)
-    logger.debug("dvipdf std err: %s", dvipdf_stderr)
+        # https://tex.stackexchange.com/questions/73783/dvipdfm-or-dvipdfmx-or-dvipdft
+        # dvipdfmx names the PDF after the .dvi
+        run_pdf_build_command(
+            ["dvipdfmx", pdf_filename + ".dvi"], tmp_latex_folder_full_path
+        )
+
+        tmp_pdf = path_to_pdf + pdf_filename + ".pdf." + trace_id
+        shutil.copy(tmp_latex_folder_full_path + pdf_filename + ".pdf", tmp_pdf)
+        os.replace(tmp_pdf, path_to_pdf + pdf_filename + ".pdf")
+
+        # replace the previously cached PDF for this derivation
+        os.makedirs(pdf_cache_folder, exist_ok=True)
+        for stale_pdf in glob.glob(pdf_cache_folder + pdf_filename + "_*.pdf"):
+            if stale_pdf != cached_pdf:
+                try:
+                    os.remove(stale_pdf)
+                except FileNotFoundError:  # removed by another build
+                    pass
+        shutil.move(
+            tmp_latex_folder_full_path + pdf_filename + ".pdf",
+            cached_pdf + "." + trace_id,
+        )
+        os.replace(cached_pdf + "." + trace_id, cached_pdf)
+    finally:
+        shutil.rmtree(tmp_latex_folder_full_path)
 
-    shutil.move(
-        tmp_latex_folder_full_path + pdf_filename + ".pdf",
-        path_to_pdf + pdf_filename + ".pdf",
-    )
-    shutil.rmtree(tmp_latex_folder_full_path)
     # return True, pdf_filename + ".pdf"
     logger.info("[trace end " + trace_id + "]")
     return pdf_filename + ".pdf"
@@ -3755,22 +3999,42 @@ def update_linear_index(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
     if "." not in valu:
-        valu = int(valu)
+        linear_index = int(valu)  # type: float
     else:
-        valu = float(valu)
+        linear_index = float(valu)
+    clib.unit_of_work(
+        path_to_db,
+        [
+            lambda dat: update_linear_index_of_dat(
+                dat, deriv_id, step_id, linear_index
+            )
+        ],
+    )
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+def update_linear_index_of_dat(
+    dat: dict, deriv_id: str, step_id: str, linear_index: float
+) -> None:
+    """
+    The mutation used by update_linear_index; see clib.unit_of_work
+
+    >>> update_linear_index_of_dat(dat, "000001", "1029890", 42)
+    """
+    # logger.info("[trace]")
     if deriv_id in dat["derivations"].keys():
         if step_id in dat["derivations"][deriv_id]["steps"].keys():
-            dat["derivations"][deriv_id]["steps"][step_id]["linear index"] = valu
+            dat["derivations"][deriv_id]["steps"][step_id][
+                "linear index"
+            ] = linear_index
         else:
             logger.error("missing " + step_id + " in " + deriv_id)
             raise Exception("missing " + step_id + " in " + deriv_id)
     else:
         logger.error("missing " + deriv_id)
         raise Exception("missing " + deriv_id)
-    clib.write_db(path_to_db, dat)
-    logger.info("[trace end " + trace_id + "]")
     return
 
 
@@ -3805,7 +4069,9 @@ def edges_in_derivation(deriv_id: str, path_to_db: str) -> list:
     return list_of_edges
 
 
-def create_d3js_json(deriv_id: str, path_to_db: str) -> str:
+def create_d3js_json(
+    deriv_id: str, path_to_db: str, precompute_layout: bool = False
+) -> str:
     """
     Produce a JSON file that contains something like
     {
@@ -3822,10 +4088,15 @@ def create_d3js_json(deriv_id: str, path_to_db: str) -> str:
     for inspiration based on the last time I implemented this, see
     v3_CSV/bin/create_json_per_derivation_from_connectionsDB.py
 
+    The JSON file is named by the hash of the derivation's steps and expressions,
+    so the file is only rebuilt when the derivation changes.
+
     Args:
         deriv_id: numeric identifier of the derivation
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
+        precompute_layout: whether to include node coordinates;
+                           see precompute_d3js_layout
     Returns:
         d3js_json_filename: name of JSON file to be read by d3js
     Raises:
@@ -3837,176 +4108,338 @@ def create_d3js_json(deriv_id: str, path_to_db: str) -> str:
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
 
-    d3js_json_filename = deriv_id + ".json"
-
     dat = clib.read_db(path_to_db)
 
-    json_str = "{\n"
-    json_str += '  "nodes": [\n'
-    list_of_nodes = []
-    for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-        png_name = "".join(filter(str.isalnum, step_dict["inf rule"]))
-        # logger.debug("PNG name = " + png_name)
-
-        if not os.path.isfile("/home/appuser/app/static/" + png_name + ".png"):
-            create_png_from_latex("\\text{" + step_dict["inf rule"] + "}", png_name)
-            # logger.debug("created PNG " + png_name)
-
-        image = cv2.imread("/home/appuser/app/static/" + png_name + ".png")
-        # logger.debug("type for cv2 image is " + str(type(image)))
-
-        # construct the node JSON content
-        list_of_nodes.append(
-            '    {"id": "'
-            + step_id
-            + '", "group": '
-            + str(step_dict["linear index"])
-            + ", "
-            + '"img": "/static/'
-            + png_name
-            + '.png", '
-            + '"url": "https://derivationmap.net/list_all_inference_rules?referrer=d3js#'
-            + step_dict["inf rule"]
-            + '", "width": '
-            + str(image.shape[1])
-            + ", "
-            + '"height": '
-            + str(image.shape[0])
-            + ", "
-            + '"linear index": '
-            + str(step_dict["linear index"])
-            + "},\n"
+    # everything that determines the content of the JSON file
+    steps_dict = dat["derivations"][deriv_id]["steps"]
+    latex_per_expr = {}
+    for step_id, step_dict in steps_dict.items():
+        for connection_type in ["inputs", "feeds", "outputs"]:
+            for expr_local_id in step_dict[connection_type]:
+                expr_global_id = dat["expr local to global"][expr_local_id]
+                latex_per_expr[expr_global_id] = dat["expressions"][expr_global_id][
+                    "latex"
+                ]
+    content_md5 = hashlib.md5(
+        json.dumps(
+            [steps_dict, latex_per_expr, precompute_layout], sort_keys=True
+        ).encode("utf-8")
+    ).hexdigest()
+    d3js_json_filename = "d3js_" + deriv_id + "_" + content_md5 + ".json"
+    if d3js_json_is_cached(d3js_json_filename):
+        logger.info("[trace end " + trace_id + "]")
+        return d3js_json_filename
+
+    # render the missing PNGs together rather than one at a time
+    create_missing_pngs_for_derivation(deriv_id, path_to_db)
+
+    node_per_id = {}
+    for step_id, step_dict in steps_dict.items():
+        node_per_id[step_id] = d3js_node(
+            step_id,
+            step_dict["linear index"],
+            "".join(filter(str.isalnum, step_dict["inf rule"])),
+            "https://derivationmap.net/list_all_inference_rules?referrer=d3js#"
+            + step_dict["inf rule"],
+            step_dict["linear index"],
         )
-
-    list_of_expr = list_expr_in_derivation(deriv_id, path_to_db)
-    for global_expr_id in list_of_expr:
-        png_name = global_expr_id
-        # logger.debug("PNG name = " + png_name)
-
-        if not os.path.isfile("/home/appuser/app/static/" + png_name + ".png"):
-            create_png_from_latex(dat["expressions"][global_expr_id]["latex"], png_name)
-            # logger.debug("created PNG " + png_name)
-
-        image = cv2.imread("/home/appuser/app/static/" + png_name + ".png")
-        # logger.debug("type for cv2 image is " + str(type(image)))
-
-        # construct the node JSON content
-        list_of_nodes.append(
-            '    {"id": "'
-            + global_expr_id
-            + '", "group": 0, '
-            + '"img": "/static/'
-            + png_name
-            + '.png", '
-            + '"url": "https://derivationmap.net/list_all_expressions?referrer=d3js#'
-            + global_expr_id
-            + '", "width": '
-            + str(image.shape[1])
-            + ", "
-            + '"height": '
-            + str(image.shape[0])
-            + ", "
-            + '"linear index": -1},\n'
+    for expr_global_id in latex_per_expr.keys():
+        node_per_id[expr_global_id] = d3js_node(
+            expr_global_id,
+            0,
+            expr_global_id,
+            "https://derivationmap.net/list_all_expressions?referrer=d3js#"
+            + expr_global_id,
+            -1,
         )
 
-    list_of_nodes = list(set(list_of_nodes))
-    all_nodes = "".join(list_of_nodes)
-    all_nodes = (
-        all_nodes[:-2] + "\n"
-    )  # remove the trailing comma to be compliant with JSON
-    json_str += all_nodes
-
-    json_str += "  ],\n"
-    json_str += '  "links": [\n'
-
-    list_of_edges = edges_in_derivation(deriv_id, path_to_db)
-    list_of_edge_str = []
-    for edge_tuple in list_of_edges:
-        list_of_edge_str.append(
-            '    {"source": "'
-            + edge_tuple[0]
-            + '", "target": "'
-            + edge_tuple[1]
-            + '", "value": 1},\n'
-        )
-    list_of_edge_str = list(set(list_of_edge_str))
-    # logger.debug('number of edges = %s', len(list_of_edge_str))
-    all_edges = "".join(list_of_edge_str)
-    all_edges = all_edges[:-2] + "\n"
-    # logger.debug('all edges = %s', all_edges)
-    json_str += all_edges
-    json_str += "  ]\n"
-    json_str += "}\n"
-    with open("/home/appuser/app/static/" + d3js_json_filename, "w") as fil:
-        fil.write(json_str)
+    list_of_links = []
+    for step_id, step_dict in steps_dict.items():
+        list_of_edges = []
+        for connection_type in ["inputs", "feeds"]:
+            for expr_local_id in step_dict[connection_type]:
+                list_of_edges.append(
+                    (dat["expr local to global"][expr_local_id], step_id)
+                )
+        for expr_local_id in step_dict["outputs"]:
+            list_of_edges.append((step_id, dat["expr local to global"][expr_local_id]))
+        for source_id, target_id in list_of_edges:
+            link = {"source": source_id, "target": target_id, "value": 1}
+            if link not in list_of_links:
+                list_of_links.append(link)
+
+    d3js_payload = {"nodes": list(node_per_id.values()), "links": list_of_links}
+    if precompute_layout:
+        precompute_d3js_layout(d3js_payload)
+    write_d3js_payload(d3js_payload, d3js_json_filename)
 
     logger.info("[trace end " + trace_id + "]")
     return d3js_json_filename
 
 
+def d3js_node(
+    node_id: str, group: int, png_name: str, url: str, linear_index: int
+) -> dict:
+    """
+    Args:
+        node_id: step ID, expression global ID, or derivation ID
+        group: used by d3js to color the node
+        png_name: name of the PNG in static/, without the extension
+        url: where clicking on the node leads
+        linear_index: of the step; -1 for nodes that are not steps
+    Returns:
+        node dict for the "nodes" list of the d3js JSON
+    Raises:
+
+    >>> d3js_node("0000040490", 0, "0000040490", "https://derivationmap.net/", -1)
+    """
+    # logger.info("[trace]")
+    width, height = latex_to_png.png_dimensions(
+        "/home/appuser/app/static/" + png_name + ".png"
+    )
+    return {
+        "id": node_id,
+        "group": group,
+        "img": "/static/" + png_name + ".png",
+        "url": url,
+        "width": width,
+        "height": height,
+        "linear index": linear_index,
+    }
+
+
+def precompute_d3js_layout(
+    d3js_payload: dict, number_of_iterations: int = 100
+) -> None:
+    """
+    Force-directed layout (Fruchterman and Reingold, 1991) computed once on the server,
+    so that the browser does not need to run a force simulation.
+    Coordinates are between 0 and 1; _d3_js.html scales them to the page
+    and pins the nodes when "layout" is "precomputed".
+
+    The initial positions are seeded so the same graph always gets the same layout.
+
+    Args:
+        d3js_payload: {"nodes": [...], "links": [...]};
+                      "x" and "y" are added to each node
+        number_of_iterations:
+    Returns:
+        None
+    Raises:
+
+    >>> precompute_d3js_layout({"nodes": [{"id": "a"}, {"id": "b"}], "links": []})
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    number_of_nodes = len(d3js_payload["nodes"])
+    index_per_id = {
+        node_dict["id"]: indx for indx, node_dict in enumerate(d3js_payload["nodes"])
+    }
+    list_of_links = [
+        (index_per_id[link["source"]], index_per_id[link["target"]])
+        for link in d3js_payload["links"]
+    ]
+    seeded_random = random.Random(number_of_nodes)
+    x_pos = [seeded_random.random() for indx in range(number_of_nodes)]
+    y_pos = [seeded_random.random() for indx in range(number_of_nodes)]
+    # ideal distance between nodes
+    ideal_distance = (1.0 / max(1, number_of_nodes)) ** 0.5
+    temperature = 0.1
+    for iteration in range(number_of_iterations):
+        x_disp = [0.0] * number_of_nodes
+        y_disp = [0.0] * number_of_nodes
+        # every pair of nodes repels
+        for indx1 in range(number_of_nodes):
+            for indx2 in range(indx1 + 1, number_of_nodes):
+                x_delta = x_pos[indx1] - x_pos[indx2]
+                y_delta = y_pos[indx1] - y_pos[indx2]
+                distance_squared = max(1e-9, x_delta * x_delta + y_delta * y_delta)
+                force = ideal_distance * ideal_distance / distance_squared
+                x_disp[indx1] += x_delta * force
+                y_disp[indx1] += y_delta * force
+                x_disp[indx2] -= x_delta * force
+                y_disp[indx2] -= y_delta * force
+        # linked nodes attract
+        for indx1, indx2 in list_of_links:
+            x_delta = x_pos[indx1] - x_pos[indx2]
+            y_delta = y_pos[indx1] - y_pos[indx2]
+            distance = (x_delta * x_delta + y_delta * y_delta) ** 0.5
+            force = distance / ideal_distance
+            x_disp[indx1] -= x_delta * force
+            y_disp[indx1] -= y_delta * force
+            x_disp[indx2] += x_delta * force
+            y_disp[indx2] += y_delta * force
+        # each node moves at most "temperature", which decreases every iteration
+        for indx in range(number_of_nodes):
+            displacement = max(1e-9, (x_disp[indx] ** 2 + y_disp[indx] ** 2) ** 0.5)
+            step = min(displacement, temperature) / displacement
+            x_pos[indx] += x_disp[indx] * step
+            y_pos[indx] += y_disp[indx] * step
+        temperature *= 0.95
+
+    # rescale to between 0 and 1
+    if number_of_nodes > 0:
+        x_min, x_max = min(x_pos), max(x_pos)
+        y_min, y_max = min(y_pos), max(y_pos)
+        for indx, node_dict in enumerate(d3js_payload["nodes"]):
+            node_dict["x"] = round((x_pos[indx] - x_min) / max(1e-9, x_max - x_min), 4)
+            node_dict["y"] = round((y_pos[indx] - y_min) / max(1e-9, y_max - y_min), 4)
+    d3js_payload["layout"] = "precomputed"
+
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+# the d3js JSON files in static/ are named by the hash of their content;
+# once they take more space, the least recently used are removed.
+# Files of previous versions are not removed as soon as a new version is written,
+# since a page that was returned with the name of an older version may still load it
+d3js_cache_max_bytes = 50 * 1024 * 1024
+
+
+def d3js_json_is_cached(json_filename: str) -> bool:
+    """
+    Args:
+        json_filename: name of the file in static/
+    Returns:
+        whether the file exists; if so, it is marked as recently used
+    Raises:
+
+    >>> d3js_json_is_cached("d3js_000001_abc.json")
+    False
+    """
+    # logger.info("[trace]")
+    try:
+        # the modification time is used to find the least recently used files
+        os.utime("/home/appuser/app/static/" + json_filename)
+    except FileNotFoundError:  # not written yet, or evicted
+        return False
+    return True
+
+
+def write_d3js_payload(d3js_payload: dict, json_filename: str) -> None:
+    """
+    Write to static/; see enforce_d3js_cache_size_limit
+
+    Args:
+        d3js_payload: {"nodes": [...], "links": [...]}
+        json_filename: name of the file in static/
+    Returns:
+        None
+    Raises:
+
+    >>> write_d3js_payload(d3js_payload, "d3js_000001_abc.json")
+    """
+    # logger.info("[trace]")
+    path_to_json = "/home/appuser/app/static/" + json_filename
+    tmp_path = path_to_json + "." + str(random.randint(1000000, 9999999))
+    with open(tmp_path, "w") as fil:
+        json.dump(d3js_payload, fil, indent=2)
+    os.replace(tmp_path, path_to_json)
+    enforce_d3js_cache_size_limit()
+    return
+
+
+def enforce_d3js_cache_size_limit() -> int:
+    """
+    Remove the least recently used d3js JSON files
+    until they take less than d3js_cache_max_bytes
+
+    Returns:
+        number of files removed
+    Raises:
+
+    >>> enforce_d3js_cache_size_limit()
+    0
+    """
+    # logger.info("[trace]")
+    list_of_entries = []
+    total_bytes = 0
+    for path_to_json in glob.glob("/home/appuser/app/static/d3js_*.json"):
+        try:
+            file_stat = os.stat(path_to_json)
+        except FileNotFoundError:  # removed by another worker
+            continue
+        list_of_entries.append((file_stat.st_mtime, file_stat.st_size, path_to_json))
+        total_bytes += file_stat.st_size
+
+    number_removed = 0
+    if total_bytes > d3js_cache_max_bytes:
+        for mtime, size, path_to_json in sorted(list_of_entries):
+            try:
+                os.remove(path_to_json)
+            except FileNotFoundError:  # removed by another worker
+                pass
+            total_bytes -= size
+            number_removed += 1
+            if total_bytes <= d3js_cache_max_bytes:
+                break
+        logger.debug("removed " + str(number_removed) + " d3js JSON files")
+    return number_removed
+
+
 def create_derivation_png(deriv_id: str, path_to_db: str) -> str:
+    """
+    Args:
+        deriv_id: numeric identifier of the derivation
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        output_filename: name of PNG relative to static/
+    Raises:
+
+    >>> create_derivation_png("000001", "pdg.db")
+    """
+    return create_derivation_graphviz(deriv_id, path_to_db, "png")
+
+
+def create_derivation_graphviz(
+    deriv_id: str, path_to_db: str, output_format: str = "svg"
+) -> str:
     """
     for a clear description of the graphviz language, see
     https://www.graphviz.org/doc/info/lang.html
 
+    The image is named by the hash of the DOT; see dot_to_image
+
     Args:
         deriv_id: numeric identifier of the derivation
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
+        output_format: "png" or "svg"
     Returns:
-        output_filename: name of file produced by graphviz
+        output_filename: name of file produced by graphviz, relative to static/
     Raises:
 
 
-    >>> create_derivation_png("000001", "pdg.db")
+    >>> create_derivation_graphviz("000001", "pdg.db", "svg")
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
 
     dat = clib.read_db(path_to_db)
 
-    dot_filename = "/home/appuser/app/static/derivation_" + deriv_id + ".dot"
-    with open(dot_filename, "w") as fil:
-        fil.write("digraph physicsDerivation { \n")
-        fil.write("overlap = false;\n")
-        fil.write(
-            'label="derivation: '
-            + dat["derivations"][deriv_id]["name"]
-            + '\nhttps://derivationmap.net";\n'
-        )
-        fil.write("fontsize=12;\n")
+    create_missing_pngs_for_derivation(deriv_id, path_to_db)
 
-        for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
-            write_step_to_graphviz_file(deriv_id, step_id, fil, path_to_db)
-
-        fil.write("}\n")
-
-    # name the PNG file referencing the hash of the .dot so we can detect changes
-    output_filename = (
-        "derivation_" + deriv_id + "_" + md5_of_file(dot_filename) + ".png"
+    fil = io.StringIO()
+    fil.write("digraph physicsDerivation { \n")
+    fil.write("overlap = false;\n")
+    fil.write(
+        'label="derivation: '
+        + dat["derivations"][deriv_id]["name"]
+        + '\nhttps://derivationmap.net";\n'
     )
-    # neato -Tpng graphviz.dot > /home/appuser/app/static/graphviz.png
-    #    process = Popen(['neato','-Tpng','graphviz.dot','>','/home/appuser/app/static/graphviz.png'], stdout=PIPE, stderr=PIPE)
+    fil.write("fontsize=12;\n")
 
-    # force redraw when updating step
-    # a better way would be to check the md5 hash of the .dot file
-    if not os.path.exists("/home/appuser/app/static/" + output_filename):
-        process = subprocess.run(
-            ["neato", "-Tpng", dot_filename, "-o" + output_filename],
-            stdout=PIPE,
-            stderr=PIPE,
-            timeout=proc_timeout,
-        )
+    for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
+        write_step_to_graphviz_file(deriv_id, step_id, fil, path_to_db)
 
-        neato_stdout = process.stdout.decode("utf-8")
-        if len(neato_stdout) > 0:
-            logger.debug(neato_stdout)
-        neato_stderr = process.stderr.decode("utf-8")
-        if len(neato_stderr) > 0:
-            logger.debug(neato_stderr)
+    fil.write("}\n")
 
-        shutil.move(output_filename, "/home/appuser/app/static/" + output_filename)
-    # return True, "no invalid latex", output_filename
+    output_filename = dot_to_image.create_image_from_dot(
+        fil.getvalue(), output_format, "neato"
+    )
     logger.info("[trace end " + trace_id + "]")
     return output_filename
 
@@ -4038,49 +4471,24 @@ def create_step_graphviz_png(deriv_id: str, step_id: str, path_to_db: str) -> st
     logger.info("[trace start " + trace_id + "]")
     dat = clib.read_db(path_to_db)
 
-    dot_filename = "/home/appuser/app/static/graphviz.dot"
-    remove_file_debris(["/home/appuser/app/static/"], ["graphviz"], ["dot"])
-
-    with open(dot_filename, "w") as fil:
-        fil.write("digraph physicsDerivation { \n")
-        fil.write("overlap = false;\n")
-        fil.write(
-            'label="step '
-            + step_id
-            + " in "
-            + dat["derivations"][deriv_id]["name"]
-            + '\nhttps://derivationmap.net";\n'
-        )
-        fil.write("fontsize=12;\n")
-
-        write_step_to_graphviz_file(deriv_id, step_id, fil, path_to_db)
-        fil.write("}\n")
+    fil = io.StringIO()
+    fil.write("digraph physicsDerivation { \n")
+    fil.write("overlap = false;\n")
+    fil.write(
+        'label="step '
+        + step_id
+        + " in "
+        + dat["derivations"][deriv_id]["name"]
+        + '\nhttps://derivationmap.net";\n'
+    )
+    fil.write("fontsize=12;\n")
 
-    #    with open(dot_filename,'r') as fil:
-    #       logger.debug(fil.read())
+    write_step_to_graphviz_file(deriv_id, step_id, fil, path_to_db)
+    fil.write("}\n")
 
-    output_filename = step_id + ".png"
+    # the name is the hash of the DOT, so the PNG is redrawn when the step changes
+    output_filename = dot_to_image.create_image_from_dot(fil.getvalue(), "png", "neato")
     logger.debug("output_filename = %s", output_filename)
-    remove_file_debris(["./"], ["graphviz"], ["png"])
-
-    # neato -Tpng graphviz.dot > /home/appuser/app/static/graphviz.png
-    #    process = Popen(['neato','-Tpng','graphviz.dot','>','/home/appuser/app/static/graphviz.png'], stdout=PIPE, stderr=PIPE)
-    if not os.path.exists("/home/appuser/app/static/" + output_filename):
-        process = subprocess.run(
-            ["neato", "-Tpng", dot_filename, "-o" + output_filename],
-            stdout=PIPE,
-            stderr=PIPE,
-            timeout=proc_timeout,
-        )
-        neato_stdout = process.stdout.decode("utf-8")
-        if len(neato_stdout) > 0:
-            logger.debug(neato_stdout)
-        neato_stderr = process.stderr.decode("utf-8")
-        if len(neato_stderr) > 0:
-            logger.debug(neato_stderr)
-
-        shutil.move(output_filename, "/home/appuser/app/static/" + output_filename)
-    # return True, "no invalid latex", output_filename
     logger.info("[trace end " + trace_id + "]")
     return output_filename
 
@@ -4097,14 +4505,13 @@ def generate_graphviz_of_step_with_numeric_IDs(
         path_to_db: filename of the SQL database containing
                     a JSON entry that returns a nested dictionary
     Returns:
-        output_filename: name of PNG file generated by graphviz
+        output_filename: name of PNG file generated by graphviz, relative to static/
     Raises:
 
     >>> generate_graphviz_of_step_with_numeric_IDs("000001", "1029890", "pdg.db")
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dot_filename = "/home/appuser/app/static/graphviz.dot"
     dat = clib.read_db(path_to_db)
     if deriv_id in dat["derivations"].keys():
         if step_id in dat["derivations"][deriv_id]["steps"].keys():
@@ -4120,125 +4527,94 @@ def generate_graphviz_of_step_with_numeric_IDs(
         logger.error(deriv_id + " not in database")
         raise Exception(deriv_id + " not in database")
 
-    remove_file_debris(["/home/appuser/app/static/"], ["graphviz"], ["dot"])
-    with open(dot_filename, "w") as fil:
-        fil.write("digraph physicsDerivation { \n")
-        fil.write("overlap = false;\n")
-        fil.write(
-            'label="step '
-            + step_id
-            + " in "
-            + dat["derivations"][deriv_id]["name"]
-            + '\nhttps://derivationmap.net";\n'
-        )
-        fil.write("fontsize=12;\n")
+    fil = io.StringIO()
+    fil.write("digraph physicsDerivation { \n")
+    fil.write("overlap = false;\n")
+    fil.write(
+        'label="step '
+        + step_id
+        + " in "
+        + dat["derivations"][deriv_id]["name"]
+        + '\nhttps://derivationmap.net";\n'
+    )
+    fil.write("fontsize=12;\n")
+
+    # the following code is similar to write_step_to_graphviz_file()
+    infrule_png_name = "".join(filter(str.isalnum, step_dict["inf rule"]))
+    if not os.path.isfile("/home/appuser/app/static/" + infrule_png_name + ".png"):
+        create_png_from_latex("\\text{" + step_dict["inf rule"] + "}", infrule_png_name)
+    fil.write(
+        infrule_png_name
+        + ' [shape=invtrapezium, color=blue, label="",image="/home/appuser/app/static/'
+        + infrule_png_name
+        + ".png"
+        + '",labelloc=b];\n'
+    )
 
-        # the following code is similar to write_step_to_graphviz_file()
-        infrule_png_name = "".join(filter(str.isalnum, step_dict["inf rule"]))
-        if not os.path.isfile("/home/appuser/app/static/" + infrule_png_name + ".png"):
+    stepid_png_name = "step_id_" + step_id
+    if not os.path.isfile("/home/appuser/app/static/" + stepid_png_name + ".png"):
+        create_png_from_latex("\\text{" + step_dict["inf rule"] + "}", stepid_png_name)
+    fil.write(
+        step_id
+        + ' [shape=invtrapezium, color=blue, label="",image="/home/appuser/app/static/'
+        + stepid_png_name
+        + ".png"
+        + '",labelloc=b];\n'
+    )
+    fil.write(infrule_png_name + " -> " + step_id + ";\n")
+
+    for expr_local_id in step_dict["inputs"]:
+        # TODO:
+        # latex -> global_id -> local_id -> step_id
+
+        expr_global_id = dat["expr local to global"][expr_local_id]
+        latex_png_name = expr_global_id
+        if not os.path.isfile("/home/appuser/app/static/" + latex_png_name + ".png"):
             create_png_from_latex(
-                "\\text{" + step_dict["inf rule"] + "}", infrule_png_name
+                dat["expressions"][expr_global_id]["latex"], latex_png_name
             )
+        fil.write(expr_local_id + " -> " + step_id + ";\n")
         fil.write(
-            infrule_png_name
-            + ' [shape=invtrapezium, color=blue, label="",image="/home/appuser/app/static/'
-            + infrule_png_name
+            expr_local_id
+            + ' [shape=ellipse, color=black,label="",image="/home/appuser/app/static/'
+            + latex_png_name
             + ".png"
             + '",labelloc=b];\n'
         )
 
-        stepid_png_name = "step_id_" + step_id
-        if not os.path.isfile("/home/appuser/app/static/" + stepid_png_name + ".png"):
-            create_png_from_latex(
-                "\\text{" + step_dict["inf rule"] + "}", stepid_png_name
-            )
+    for expr_local_id in step_dict["outputs"]:
+        # TODO:
+        # step_id -> local_id -> global_id -> latex
+
+        expr_global_id = dat["expr local to global"][expr_local_id]
+        png_name = expr_global_id
+        if not os.path.isfile("/home/appuser/app/static/" + png_name + ".png"):
+            create_png_from_latex(dat["expressions"][expr_global_id]["latex"], png_name)
+        fil.write(step_id + " -> " + expr_local_id + ";\n")
+        fil.write(
+            expr_local_id
+            + ' [shape=ellipse, color=black,label="",image="/home/appuser/app/static/'
+            + png_name
+            + ".png"
+            + '",labelloc=b];\n'
+        )
+
+    for expr_local_id in step_dict["feeds"]:
+        expr_global_id = dat["expr local to global"][expr_local_id]
+        png_name = expr_global_id
+        if not os.path.isfile("/home/appuser/app/static/" + png_name + ".png"):
+            create_png_from_latex(dat["expressions"][expr_global_id]["latex"], png_name)
+        fil.write(expr_local_id + " -> " + step_id + ";\n")
         fil.write(
-            step_id
-            + ' [shape=invtrapezium, color=blue, label="",image="/home/appuser/app/static/'
-            + stepid_png_name
+            expr_local_id
+            + ' [shape=box, color=red,label="",image="/home/appuser/app/static/'
+            + png_name
             + ".png"
             + '",labelloc=b];\n'
         )
-        fil.write(infrule_png_name + " -> " + step_id + ";\n")
-
-        for expr_local_id in step_dict["inputs"]:
-            # TODO:
-            # latex -> global_id -> local_id -> step_id
-
-            expr_global_id = dat["expr local to global"][expr_local_id]
-            latex_png_name = expr_global_id
-            if not os.path.isfile(
-                "/home/appuser/app/static/" + latex_png_name + ".png"
-            ):
-                create_png_from_latex(
-                    dat["expressions"][expr_global_id]["latex"], latex_png_name
-                )
-            fil.write(expr_local_id + " -> " + step_id + ";\n")
-            fil.write(
-                expr_local_id
-                + ' [shape=ellipse, color=black,label="",image="/home/appuser/app/static/'
-                + latex_png_name
-                + ".png"
-                + '",labelloc=b];\n'
-            )
-
-        for expr_local_id in step_dict["outputs"]:
-            # TODO:
-            # step_id -> local_id -> global_id -> latex
-
-            expr_global_id = dat["expr local to global"][expr_local_id]
-            png_name = expr_global_id
-            if not os.path.isfile("/home/appuser/app/static/" + png_name + ".png"):
-                create_png_from_latex(
-                    dat["expressions"][expr_global_id]["latex"], png_name
-                )
-            fil.write(step_id + " -> " + expr_local_id + ";\n")
-            fil.write(
-                expr_local_id
-                + ' [shape=ellipse, color=black,label="",image="/home/appuser/app/static/'
-                + png_name
-                + ".png"
-                + '",labelloc=b];\n'
-            )
-
-        for expr_local_id in step_dict["feeds"]:
-            expr_global_id = dat["expr local to global"][expr_local_id]
-            png_name = expr_global_id
-            if not os.path.isfile("/home/appuser/app/static/" + png_name + ".png"):
-                create_png_from_latex(
-                    dat["expressions"][expr_global_id]["latex"], png_name
-                )
-            fil.write(expr_local_id + " -> " + step_id + ";\n")
-            fil.write(
-                expr_local_id
-                + ' [shape=box, color=red,label="",image="/home/appuser/app/static/'
-                + png_name
-                + ".png"
-                + '",labelloc=b];\n'
-            )
 
-    output_filename = step_id + "_with_numeric_IDs.png"
+    output_filename = dot_to_image.create_image_from_dot(fil.getvalue(), "png", "neato")
     logger.debug("output_filename = %s", output_filename)
-    remove_file_debris(["./"], ["graphviz"], ["png"])
-
-    # neato -Tpng graphviz.dot > /home/appuser/app/static/graphviz.png
-    #    process = Popen(['neato','-Tpng','graphviz.dot','>','/home/appuser/app/static/graphviz.png'], stdout=PIPE, stderr=PIPE)
-    if not os.path.exists("/home/appuser/app/static/" + output_filename):
-        process = subprocess.run(
-            ["neato", "-Tpng", dot_filename, "-o" + output_filename],
-            stdout=PIPE,
-            stderr=PIPE,
-            timeout=proc_timeout,
-        )
-        neato_stdout = process.stdout.decode("utf-8")
-        if len(neato_stdout) > 0:
-            logger.debug(neato_stdout)
-        neato_stderr = process.stderr.decode("utf-8")
-        if len(neato_stderr) > 0:
-            logger.debug(neato_stderr)
-
-        shutil.move(output_filename, "/home/appuser/app/static/" + output_filename)
-    # return True, "no invalid latex", output_filename
     logger.info("[trace end " + trace_id + "]")
     return output_filename
 
@@ -4248,13 +4624,16 @@ def create_png_from_latex(input_latex_str: str, png_name: str) -> None:
     latex -halt-on-error file.tex
     dvipng file.dvi -T tight -o file.png
 
+    The rendering is done by latex_to_png, which caches PNGs by the md5 of the .tex
+    and runs latex in a temporary folder rather than changing the working directory.
+
     this function relies on latex  being available on the command line
     this function relies on dvipng being available on the command line
     this function assumes generated PNG should be placed in /home/appuser/app/static/
 
     Args:
-        path_to_db: filename of the SQL database containing
-                    a JSON entry that returns a nested dictionary
+        input_latex_str: Latex of the expression
+        png_name: name of the PNG in static/, without the extension
     Returns:
         None
 
@@ -4267,95 +4646,89 @@ def create_png_from_latex(input_latex_str: str, png_name: str) -> None:
 
     destination_folder = "/home/appuser/app/static/"
 
-    #    logger.debug("png_name = %s", png_name)
-    #    logger.debug("input latex str = %s", input_latex_str)
-
-    # TODO: I'd like to have the latex build process take place in an isolated directory
-    # instead of the /home/appuser/app/ location used now
-
-    tmp_latex_folder = "tmp_latex_folder_" + str(random.randint(1000000, 9999999))
-    tmp_latex_folder_full_path = os.getcwd() + "/" + tmp_latex_folder + "/"
-    original_dir = os.getcwd()
-    os.mkdir(tmp_latex_folder_full_path)
-    os.chdir(tmp_latex_folder_full_path)
-
-    tmp_file = "lat"
-
     logger.debug("latex = " + str(input_latex_str))
-    create_tex_file_for_expr(tmp_file, input_latex_str)
+    errors = latex_to_png.create_pngs_from_latex(
+        {destination_folder + png_name + ".png": input_latex_str}
+    )
+    if len(errors) > 0:
+        logger.error("PNG creation failed for %s", png_name)
+        shutil.copy(destination_folder + "error.png", destination_folder + png_name)
+        raise Exception(
+            "no PNG created for " + png_name + "; " + list(errors.values())[0]
+        )
 
-    tex_filename_with_hash = png_name + "_" + md5_of_file(tmp_file + ".tex") + ".tex"
+    logger.debug(destination_folder + png_name + ".png")
+    logger.info("[trace end " + trace_id + "]")
+    return
 
-    # shutil.move(tmp_file + ".tex", tex_filename_with_hash)
-    # logger.debug(str(os.listdir()))
 
-    # only make PNG if .tex did not exist
-    if not os.path.exists("/home/appuser/app/static/" + tex_filename_with_hash):
-        shutil.copy(tmp_file + ".tex", destination_folder + tex_filename_with_hash)
+def create_pngs_from_latex(latex_per_png_name: dict) -> None:
+    """
+    Render several PNGs in batches rather than one after another.
+    Failures are logged; the other PNGs are still created.
 
-        process = subprocess.run(
-            ["latex", "-halt-on-error", tmp_file + ".tex"],
-            stdout=PIPE,
-            stderr=PIPE,
-            timeout=proc_timeout,
-        )
-        # https://stackoverflow.com/questions/41171791/how-to-suppress-or-capture-the-output-of-subprocess-run
-        latex_stdout = process.stdout.decode("utf-8")
-        latex_stderr = process.stderr.decode("utf-8")
+    Args:
+        latex_per_png_name: keys are the names of PNGs in static/, without the extension;
+                            values are the Latex
+    Returns:
+        None
+    Raises:
 
-        #    logger.debug(str(os.listdir()))
+    >>> create_pngs_from_latex({"9999999953": "a = b"})
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
 
-        logger.debug("latex std out:" + str(latex_stdout))
-        logger.debug("latex std err:" + str(latex_stderr))
+    destination_folder = "/home/appuser/app/static/"
+    errors = latex_to_png.create_pngs_from_latex(
+        {
+            destination_folder + png_name + ".png": input_latex_str
+            for png_name, input_latex_str in latex_per_png_name.items()
+        }
+    )
+    for path_to_png, error_str in errors.items():
+        logger.error("PNG creation failed for " + path_to_png + ": " + error_str)
 
-        if "Text line contains an invalid character" in latex_stdout:
-            logging.error("tex input contains invalid charcter")
-            shutil.copy(destination_folder + "error.png", destination_folder + png_name)
-            raise Exception("no png generated due to invalid character in tex input.")
-        #    remove_file_debris(["./"], [tmp_file], ["png"])
-
-        # dvipng file.dvi -T tight -o file.png
-        process = subprocess.run(
-            ["dvipng", tmp_file + ".dvi", "-T", "tight", "-o", tmp_file + ".png"],
-            stdout=PIPE,
-            stderr=PIPE,
-            timeout=proc_timeout,
-        )
-        # https://stackoverflow.com/questions/41171791/how-to-suppress-or-capture-the-output-of-subprocess-run
-        png_stdout = process.stdout.decode("utf-8")
-        png_stderr = process.stderr.decode("utf-8")
-
-        if len(png_stdout) > 0:
-            if "This is dvipng" not in png_stdout:
-                logger.debug("png std out %s", png_stdout)
-        if len(png_stderr) > 0:
-            logger.debug("png std err %s", png_stderr)
-
-        # logger.debug(str(os.listdir()))
-
-        if "No such file or directory" in png_stderr:
-            logging.error("PNG creation failed for %s", png_name)
-            shutil.copy(destination_folder + "error.png", destination_folder + png_name)
-            # return False, "no PNG created. Check usepackage in latex"
-            raise Exception(
-                "no PNG created for " + png_name + ". Check 'usepackage' in latex"
-            )
+    logger.info("[trace end " + trace_id + "]")
+    return
 
-        if not (os.path.isfile(tmp_file + ".png")):
-            logging.error("PNG creation failed for %s", png_name)
 
-        shutil.move(tmp_file + ".png", destination_folder + png_name + ".png")
+def create_missing_pngs_for_derivation(deriv_id: str, path_to_db: str) -> None:
+    """
+    Render every missing inference rule and expression PNG of a derivation at once,
+    so that the per-step functions find them already in static/
 
-    logger.debug(destination_folder + png_name + ".png")
+    Args:
+        deriv_id: numeric identifier of the derivation
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        None
+    Raises:
 
-    os.chdir(original_dir)
-    shutil.rmtree(tmp_latex_folder_full_path)
+    >>> create_missing_pngs_for_derivation("000001", "pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
 
-    #    if os.path.isfile(destination_folder + png_name):
-    # os.remove('/home/appuser/app/static/'+name_of_png)
-    #        logger.error("png already exists!")
+    dat = clib.read_db(path_to_db)
+    latex_per_png_name = {}
+    for step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
+        png_name = "".join(filter(str.isalnum, step_dict["inf rule"]))
+        latex_per_png_name[png_name] = "\\text{" + step_dict["inf rule"] + "}"
+        for connection_type in ["inputs", "feeds", "outputs"]:
+            for expr_local_id in step_dict[connection_type]:
+                expr_global_id = dat["expr local to global"][expr_local_id]
+                latex_per_png_name[expr_global_id] = dat["expressions"][
+                    expr_global_id
+                ]["latex"]
+    latex_per_png_name = {
+        png_name: input_latex_str
+        for png_name, input_latex_str in latex_per_png_name.items()
+        if not os.path.isfile("/home/appuser/app/static/" + png_name + ".png")
+    }
+    create_pngs_from_latex(latex_per_png_name)
 
-    # return True, "success"
     logger.info("[trace end " + trace_id + "]")
     return
 
@@ -4386,15 +4759,30 @@ def update_expr_latex(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
 
-    dat["expressions"][expr_global_id]["latex"] = expr_updated_latex
+    clib.unit_of_work(
+        path_to_db,
+        [lambda dat: update_expr_latex_of_dat(dat, expr_global_id, expr_updated_latex)],
+    )
 
-    clib.write_db(path_to_db, dat)
+    revalidate_after_edit([], [expr_global_id], path_to_db)
     logger.info("[trace end " + trace_id + "]")
     return
 
 
+def update_expr_latex_of_dat(
+    dat: dict, expr_global_id: str, expr_updated_latex: str
+) -> None:
+    """
+    The mutation used by update_expr_latex; see clib.unit_of_work
+
+    >>> update_expr_latex_of_dat(dat, "000001", "revised latex expr")
+    """
+    # logger.info("[trace]")
+    dat["expressions"][expr_global_id]["latex"] = expr_updated_latex
+    return
+
+
 def modify_latex_in_step(
     expr_local_id_of_latex_to_modify: str,
     revised_latex: str,
@@ -4422,30 +4810,48 @@ def modify_latex_in_step(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
 
+    # the ID is allocated once; the mutation may run more than once
     expr_global_id = create_expr_global_id(path_to_db)
 
     entry = {}
     entry["latex"] = revised_latex
     entry["creation date"] = datetime.datetime.now().strftime("%Y-%m-%d")
     entry["author"] = md5_of_string(str(user_email).lower())
-    entry["notes"] = dat["expressions"][
-        dat["expr local to global"][expr_local_id_of_latex_to_modify]
-    ]["notes"]
-    entry["name"] = dat["expressions"][
-        dat["expr local to global"][expr_local_id_of_latex_to_modify]
-    ]["name"]
     entry["AST"] = ""
 
-    dat["expressions"][expr_global_id] = entry
-    dat["expr local to global"][expr_local_id_of_latex_to_modify] = expr_global_id
-
-    clib.write_db(path_to_db, dat)
+    clib.unit_of_work(
+        path_to_db,
+        [
+            lambda dat: modify_latex_in_step_of_dat(
+                dat, expr_local_id_of_latex_to_modify, expr_global_id, entry
+            )
+        ],
+    )
     logger.info("[trace end " + trace_id + "]")
     return
 
 
+def modify_latex_in_step_of_dat(
+    dat: dict, expr_local_id: str, expr_global_id: str, entry: dict
+) -> None:
+    """
+    The mutation used by modify_latex_in_step; see clib.unit_of_work
+    The notes and name are copied from the expression being replaced.
+
+    >>> modify_latex_in_step_of_dat(dat, "959242", "9999999953", entry)
+    """
+    # logger.info("[trace]")
+    previous_expr_dict = dat["expressions"][dat["expr local to global"][expr_local_id]]
+    entry = dict(entry)
+    entry["notes"] = previous_expr_dict["notes"]
+    entry["name"] = previous_expr_dict["name"]
+
+    dat["expressions"][expr_global_id] = entry
+    dat["expr local to global"][expr_local_id] = expr_global_id
+    return
+
+
 def delete_step_from_derivation(
     deriv_id: str, step_to_delete: str, path_to_db: str
 ) -> None:
@@ -4465,16 +4871,30 @@ def delete_step_from_derivation(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
+    clib.unit_of_work(
+        path_to_db,
+        [lambda dat: delete_step_from_derivation_of_dat(dat, deriv_id, step_to_delete)],
+    )
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+def delete_step_from_derivation_of_dat(
+    dat: dict, deriv_id: str, step_to_delete: str
+) -> None:
+    """
+    The mutation used by delete_step_from_derivation; see clib.unit_of_work
+
+    >>> delete_step_from_derivation_of_dat(dat, "000001", "1029890")
+    """
+    # logger.info("[trace]")
     if deriv_id in dat["derivations"].keys():
         if step_to_delete in dat["derivations"][deriv_id]["steps"].keys():
             del dat["derivations"][deriv_id]["steps"][step_to_delete]
-            clib.write_db(path_to_db, dat)
         else:
             raise Exception(step_to_delete + " not in derivations dat")
     else:
         raise Exception(deriv_id + " not in derivations dat")
-    logger.info("[trace end " + trace_id + "]")
     return
 
 
@@ -4494,15 +4914,26 @@ def delete_derivation(deriv_id: str, path_to_db: str) -> str:
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
     # TODO: if expr is only used in this derivation, does the user want dangling expressions removed?
+    clib.unit_of_work(
+        path_to_db, [lambda dat: delete_derivation_of_dat(dat, deriv_id)]
+    )
+    logger.info("[trace end " + trace_id + "]")
+    return "successfully deleted " + deriv_id
+
+
+def delete_derivation_of_dat(dat: dict, deriv_id: str) -> None:
+    """
+    The mutation used by delete_derivation; see clib.unit_of_work
+
+    >>> delete_derivation_of_dat(dat, "000001")
+    """
+    # logger.info("[trace]")
     if deriv_id in dat["derivations"].keys():
         del dat["derivations"][deriv_id]
     else:
         raise Exception("name of derivation not in dat")
-    clib.write_db(path_to_db, dat)
-    logger.info("[trace end " + trace_id + "]")
-    return "successfully deleted " + deriv_id
+    return
 
 
 def add_symbol(
@@ -4538,7 +4969,6 @@ def add_symbol(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
 
     symbol_dict = {}
     symbol_dict["category"] = category
@@ -4562,10 +4992,12 @@ def add_symbol(
     symbol_dict["creation date"] = datetime.datetime.now().strftime("%Y-%m-%d")
     symbol_id = create_symbol_id(path_to_db)
     logger.debug("new symbol ID:" + symbol_id)
-    dat["symbols"][symbol_id] = symbol_dict
 
     logger.debug(str(symbol_dict))
-    clib.write_db(path_to_db, dat)
+    clib.unit_of_work(
+        path_to_db,
+        [lambda dat: dat["symbols"].update({symbol_id: symbol_dict})],
+    )
 
     logger.info("[trace end " + trace_id + "]")
     return
@@ -4615,17 +5047,32 @@ def add_inf_rule(
 
     logger.debug("add_inf_rule; arg_dict = %s", arg_dict)
 
-    dat = clib.read_db(path_to_db)
-    if inf_rule_dict_from_form["inf_rule_name"] in dat["inference rules"].keys():
+    clib.unit_of_work(
+        path_to_db,
+        [
+            lambda dat: add_inf_rule_to_dat(
+                dat, inf_rule_dict_from_form["inf_rule_name"], arg_dict
+            )
+        ],
+    )
+    status_msg = "success"
+    logger.info("[trace end " + trace_id + "]")
+    return status_msg
+
+
+def add_inf_rule_to_dat(dat: dict, name_of_inf_rule: str, arg_dict: dict) -> None:
+    """
+    The mutation used by add_inf_rule; see clib.unit_of_work
+
+    >>> add_inf_rule_to_dat(dat, "testola", arg_dict)
+    """
+    # logger.info("[trace]")
+    if name_of_inf_rule in dat["inference rules"].keys():
         status_msg = "inference rule already exists"
         logger.error(status_msg)
         raise Exception(status_msg)
-    else:
-        dat["inference rules"][inf_rule_dict_from_form["inf_rule_name"]] = arg_dict
-        clib.write_db(path_to_db, dat)
-        status_msg = "success"
-    logger.info("[trace end " + trace_id + "]")
-    return status_msg
+    dat["inference rules"][name_of_inf_rule] = arg_dict
+    return
 
 
 def delete_inf_rule(name_of_inf_rule: str, path_to_db: str) -> str:
@@ -4642,8 +5089,6 @@ def delete_inf_rule(name_of_inf_rule: str, path_to_db: str) -> str:
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
-    status_msg = ""
     infrule_popularity_dict = popularity_of_infrules(path_to_db)
     # logger.debug('name_of_inf_rule',name_of_inf_rule)
     # logger.debug(infrule_popularity_dict)
@@ -4656,17 +5101,41 @@ def delete_inf_rule(name_of_inf_rule: str, path_to_db: str) -> str:
         )
         logger.info("[trace end " + trace_id + "]")
         return status_message
-    if name_of_inf_rule in dat["inference rules"].keys():
-        del dat["inference rules"][name_of_inf_rule]
+    [was_deleted] = clib.unit_of_work(
+        path_to_db,
+        [lambda dat: delete_entry_of_dat(dat, "inference rules", name_of_inf_rule)],
+    )
+    if was_deleted:
         status_msg = name_of_inf_rule + " deleted"
-        clib.write_db(path_to_db, dat)
-
     else:
         status_msg = name_of_inf_rule + " does not exist in database"
     logger.info("[trace end " + trace_id + "]")
     return status_msg
 
 
+def delete_entry_of_dat(dat: dict, entry_type: str, entry_id: str) -> bool:
+    """
+    The mutation used by delete_inf_rule, delete_symbol, delete_operator,
+    and delete_expr; see clib.unit_of_work
+
+    Args:
+        dat: the nested dictionary from clib.read_db
+        entry_type: top-level key of dat, e.g. "symbols"
+        entry_id: key of the entry within dat[entry_type]
+    Returns:
+        True if the entry existed and was deleted
+    Raises:
+
+    >>> delete_entry_of_dat(dat, "symbols", "1054")
+    True
+    """
+    # logger.info("[trace]")
+    if entry_id in dat[entry_type].keys():
+        del dat[entry_type][entry_id]
+        return True
+    return False
+
+
 def add_symbol_to_expr(expr_global_id: str, symbol_id: str, path_to_db: str) -> None:
     """
 
@@ -4682,16 +5151,28 @@ def add_symbol_to_expr(expr_global_id: str, symbol_id: str, path_to_db: str) ->
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
+    clib.unit_of_work(
+        path_to_db,
+        [lambda dat: add_symbol_to_expr_of_dat(dat, expr_global_id, symbol_id)],
+    )
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+def add_symbol_to_expr_of_dat(dat: dict, expr_global_id: str, symbol_id: str) -> None:
+    """
+    The mutation used by add_symbol_to_expr; see clib.unit_of_work
+
+    >>> add_symbol_to_expr_of_dat(dat, "4928924", "1054")
+    """
+    # logger.info("[trace]")
     if expr_global_id in dat["expressions"].keys():
         if symbol_id in dat["symbols"].keys():
             dat["expressions"][expr_global_id]["AST"].append(symbol_id)
-            clib.write_db(path_to_db, dat)
         else:
             raise Exception(symbol_id + " is not in symbols")
     else:
         raise Exception(expr_global_id + " is not in expressions list")
-    logger.info("[trace end " + trace_id + "]")
     return
 
 
@@ -4715,7 +5196,12 @@ def edit_expr_note(expr_global_id: str, new_note: str, path_to_db: str) -> str:
     if expr_global_id in dat["expressions"].keys():
         dat["expressions"][expr_global_id]["notes"] = new_note
         status_msg = "updated note"
-        clib.write_db(path_to_db, dat)
+        clib.update_entry(
+            path_to_db,
+            "expressions",
+            expr_global_id,
+            dat["expressions"][expr_global_id],
+        )
     else:
         status_msg = expr_global_id + " is not in expressions"
         logger.error(status_msg)
@@ -4734,7 +5220,12 @@ def edit_expr_name(expr_global_id: str, new_name: str, path_to_db: str) -> str:
     if expr_global_id in dat["expressions"].keys():
         dat["expressions"][expr_global_id]["name"] = new_name
         status_msg = "updated name to " + new_name
-        clib.write_db(path_to_db, dat)
+        clib.update_entry(
+            path_to_db,
+            "expressions",
+            expr_global_id,
+            dat["expressions"][expr_global_id],
+        )
     else:
         status_msg = expr_global_id + " is not in expressions"
         logger.error(status_msg)
@@ -4766,7 +5257,12 @@ def edit_step_note(deriv_id: str, step_id: str, new_note: str, path_to_db: str)
         if step_id in dat["derivations"][deriv_id]["steps"].keys():
             dat["derivations"][deriv_id]["steps"][step_id]["notes"] = new_note
             status_msg = "updated note"
-            clib.write_db(path_to_db, dat)
+            clib.update_step(
+                path_to_db,
+                deriv_id,
+                step_id,
+                dat["derivations"][deriv_id]["steps"][step_id],
+            )
         else:
             status_msg = step_id + " is not in derivation " + deriv_id
             logger.error(step_id + " is not in derivation " + deriv_id)
@@ -4798,7 +5294,9 @@ def edit_derivation_note(deriv_id: str, new_note: str, path_to_db: str) -> str:
     if deriv_id in dat["derivations"].keys():
         dat["derivations"][deriv_id]["notes"] = new_note
         status_msg = "updated note"
-        clib.write_db(path_to_db, dat)
+        clib.update_entry(
+            path_to_db, "derivations", deriv_id, dat["derivations"][deriv_id]
+        )
     else:
         status_msg = deriv_id + " does not appear in derivations; no change made"
         logger.error(status_msg)
@@ -4828,7 +5326,9 @@ def rename_derivation(deriv_id: str, new_name: str, path_to_db: str) -> str:
     if deriv_id in dat["derivations"].keys():
         dat["derivations"][deriv_id]["name"] = new_name
         status_msg = "renamed to " + new_name
-        clib.write_db(path_to_db, dat)
+        clib.update_entry(
+            path_to_db, "derivations", deriv_id, dat["derivations"][deriv_id]
+        )
     else:
         status_msg = deriv_id + " does not appear in derivations; no change made"
     logger.info("[trace end " + trace_id + "]")
@@ -4852,7 +5352,27 @@ def rename_inf_rule(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
+    [status_msg] = clib.unit_of_work(
+        path_to_db,
+        [
+            lambda dat: rename_inf_rule_in_dat(
+                dat, old_name_of_inf_rule, new_name_of_inf_rule
+            )
+        ],
+    )
+    logger.info("[trace end " + trace_id + "]")
+    return status_msg
+
+
+def rename_inf_rule_in_dat(
+    dat: dict, old_name_of_inf_rule: str, new_name_of_inf_rule: str
+) -> str:
+    """
+    The mutation used by rename_inf_rule; see clib.unit_of_work
+
+    >>> rename_inf_rule_in_dat(dat, "add X to both sides", "add X to each side")
+    """
+    # logger.info("[trace]")
     status_msg = ""
     if old_name_of_inf_rule in dat["inference rules"].keys():
         dat["inference rules"][new_name_of_inf_rule] = dat["inference rules"][
@@ -4878,8 +5398,6 @@ def rename_inf_rule(
         status_msg = (
             old_name_of_inf_rule + " does not exist in database; no action taken"
         )
-    clib.write_db(path_to_db, dat)
-    logger.info("[trace end " + trace_id + "]")
     return status_msg
 
 
@@ -4903,9 +5421,9 @@ def edit_operator_latex(operator: str, revised_latex: str, path_to_db: str) -> s
     if operator in dat["operators"].keys():
         dat["operators"][operator]["latex"] = revised_latex
         status_msg = operator + "updated"
+        clib.update_entry(path_to_db, "operators", operator, dat["operators"][operator])
     else:
         status_msg = operator + " does not exist in database"
-    clib.write_db(path_to_db, dat)
     logger.info("[trace end " + trace_id + "]")
     return status_msg
 
@@ -4930,9 +5448,10 @@ def edit_symbol_latex(symbol: str, revised_latex: str, path_to_db: str) -> str:
     if symbol in dat["symbols"].keys():
         dat["symbols"][symbol]["latex"] = revised_latex
         status_msg = symbol + " updated"
+        clib.update_entry(path_to_db, "symbols", symbol, dat["symbols"][symbol])
+        revalidate_after_edit([symbol], [], path_to_db)
     else:
         status_msg = symbol + " does not exist in database"
-    clib.write_db(path_to_db, dat)
     logger.info("[trace end " + trace_id + "]")
     return status_msg
 
@@ -4958,9 +5477,14 @@ def edit_inf_rule_latex(inf_rule_name: str, revised_latex: str, path_to_db: str)
     if inf_rule_name in dat["inference rules"].keys():
         dat["inference rules"][inf_rule_name]["latex"] = revised_latex
         status_msg = inf_rule_name + " updated"
+        clib.update_entry(
+            path_to_db,
+            "inference rules",
+            inf_rule_name,
+            dat["inference rules"][inf_rule_name],
+        )
     else:
         status_msg = inf_rule_name + " does not exist in database"
-    clib.write_db(path_to_db, dat)
     logger.info("[trace end " + trace_id + "]")
     return status_msg
 
@@ -5016,16 +5540,35 @@ def modify_latex_in_expressions(
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
 
+    clib.unit_of_work(
+        path_to_db,
+        [
+            lambda dat: modify_latex_in_expressions_of_dat(
+                dat, global_id_of_latex_to_modify, revised_latex
+            )
+        ],
+    )
+
+    revalidate_after_edit([], [global_id_of_latex_to_modify], path_to_db)
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+def modify_latex_in_expressions_of_dat(
+    dat: dict, global_id_of_latex_to_modify: str, revised_latex: str
+) -> None:
+    """
+    The mutation used by modify_latex_in_expressions; see clib.unit_of_work
+
+    >>> modify_latex_in_expressions_of_dat(dat, "9999999953", "a = b")
+    """
+    # logger.info("[trace]")
     if global_id_of_latex_to_modify in dat["expressions"].keys():
         dat["expressions"][global_id_of_latex_to_modify]["latex"] = revised_latex
         dat["expressions"][global_id_of_latex_to_modify]["AST"] = ""
     else:
         raise Exception(global_id_of_latex_to_modify + " not in db")
-
-    clib.write_db(path_to_db, dat)
-    logger.info("[trace end " + trace_id + "]")
     return
 
 
@@ -5043,7 +5586,6 @@ def delete_symbol(symbol_to_delete: str, path_to_db: str) -> str:
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
     status_msg = ""
     symbol_popularity_dict = popularity_of_symbols_in_expressions(path_to_db)
     if len(symbol_popularity_dict[symbol_to_delete]) > 0:
@@ -5053,9 +5595,14 @@ def delete_symbol(symbol_to_delete: str, path_to_db: str) -> str:
             + str(symbol_popularity_dict[symbol_to_delete])
         )
     else:
-        del dat["symbols"][symbol_to_delete]
-        status_message = "successfully deleted " + symbol_to_delete
-    clib.write_db(path_to_db, dat)
+        [was_deleted] = clib.unit_of_work(
+            path_to_db,
+            [lambda dat: delete_entry_of_dat(dat, "symbols", symbol_to_delete)],
+        )
+        if was_deleted:
+            status_msg = "successfully deleted " + symbol_to_delete
+        else:
+            status_msg = symbol_to_delete + " does not exist in database"
     logger.info("[trace end " + trace_id + "]")
     return status_msg
 
@@ -5074,7 +5621,6 @@ def delete_operator(operator_to_delete: str, path_to_db: str) -> str:
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
-    dat = clib.read_db(path_to_db)
     status_msg = ""
     operator_popularity_dict = popularity_of_operators(path_to_db)
     if len(operator_popularity_dict[operator_to_delete]) > 0:
@@ -5084,9 +5630,14 @@ def delete_operator(operator_to_delete: str, path_to_db: str) -> str:
             + str(operator_popularity_dict[operator_to_delete])
         )
     else:
-        del dat["symbols"][operator_to_delete]
-        status_message = "successfully deleted " + operator_to_delete
-    clib.write_db(path_to_db, dat)
+        [was_deleted] = clib.unit_of_work(
+            path_to_db,
+            [lambda dat: delete_entry_of_dat(dat, "operators", operator_to_delete)],
+        )
+        if was_deleted:
+            status_msg = "successfully deleted " + operator_to_delete
+        else:
+            status_msg = operator_to_delete + " does not exist in database"
     logger.info("[trace end " + trace_id + "]")
     return status_msg
 
@@ -5106,7 +5657,6 @@ def delete_expr(expr_global_id: str, path_to_db: str) -> str:
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
     status_message = ""
-    dat = clib.read_db(path_to_db)
     expression_popularity_dict = popularity_of_expressions(path_to_db)
     if len(expression_popularity_dict[expr_global_id]) > 0:
         status_message = (
@@ -5115,10 +5665,14 @@ def delete_expr(expr_global_id: str, path_to_db: str) -> str:
             + str(expression_popularity_dict[expr_global_id])
         )
     else:  # expr is not in use
-        del dat["expressions"][expr_global_id]
-        status_message = "successfully deleted " + expr_global_id
-    logger.debug("delete_expr; dat[expr].keys = %s", dat["expressions"].keys())
-    clib.write_db(path_to_db, dat)
+        [was_deleted] = clib.unit_of_work(
+            path_to_db,
+            [lambda dat: delete_entry_of_dat(dat, "expressions", expr_global_id)],
+        )
+        if was_deleted:
+            status_message = "successfully deleted " + expr_global_id
+        else:
+            status_message = expr_global_id + " does not exist in database"
     logger.info("[trace end " + trace_id + "]")
     return status_message
 
@@ -5138,22 +5692,24 @@ def initialize_derivation(
     >>> initialize_derivation("pdg.db")
     """
     logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
     deriv_id = create_deriv_id(path_to_db)
-    dat["derivations"][deriv_id] = {
+    deriv_dict = {
         "name": name_of_derivation,
         "author": md5_of_string(str(user_email).lower()),
         "notes": notes,
         "creation date": datetime.datetime.now().strftime("%Y-%m-%d"),
         "steps": {},
     }
-    clib.write_db(path_to_db, dat)
+    clib.unit_of_work(
+        path_to_db, [lambda dat: dat["derivations"].update({deriv_id: deriv_dict})]
+    )
 
     # logger.info("[trace end " + trace_id + "]")
     return deriv_id
 
 
-def create_step(
+def add_step_to_dat(
+    dat: dict,
     latex_for_step_dict: dict,
     inf_rule: str,
     deriv_id: str,
@@ -5161,15 +5717,21 @@ def create_step(
     path_to_db: str,
 ) -> str:
     """
+        The mutation used by create_step; modifies dat in place.
+        New expression and step IDs are allocated using path_to_db.
+
         https://strftime.org/
 
         Args:
+            dat: the nested dictionary from clib.read_db
+            latex_for_step_dict: the webform
+            inf_rule: name of the inference rule
             deriv_id: numeric identifier of the derivation
             user_email: email address of the content author
             path_to_db: filename of the SQL database containing
                         a JSON entry that returns a nested dictionary
         Returns:
-
+            inf_rule_local_ID: the step ID
         Raises:
 
 
@@ -5183,8 +5745,6 @@ def create_step(
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
 
-    dat = clib.read_db(path_to_db)
-
     if deriv_id not in dat["derivations"].keys():
         logger.debug(deriv_id + "was not in derivations; it has been added.")
         dat["derivations"][deriv_id] = {}
@@ -5409,11 +5969,49 @@ def create_step(
             )
         dat["derivations"][deriv_id]["steps"][inf_rule_local_ID] = step_dict
 
-    clib.write_db(path_to_db, dat)
-
     logger.info("[trace end " + trace_id + "]")
     return inf_rule_local_ID
 
+
+def create_step(
+    latex_for_step_dict: dict,
+    inf_rule: str,
+    deriv_id: str,
+    user_email: str,
+    path_to_db: str,
+) -> str:
+    """
+    Add the step and its new expressions with a single write.
+    If another user writes to the database concurrently, the step is added
+    to their version of the content rather than overwriting it; see clib.unit_of_work
+
+    Args:
+        latex_for_step_dict: the webform
+        inf_rule: name of the inference rule
+        deriv_id: numeric identifier of the derivation
+        user_email: email address of the content author
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        step_id
+    Raises:
+
+    >>> create_step(latex_for_step_dict, 'begin derivation', '000001', 'a@b.com', "pdg.db")
+    9492849
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+    [step_id] = clib.unit_of_work(
+        path_to_db,
+        [
+            lambda dat: add_step_to_dat(
+                dat, latex_for_step_dict, inf_rule, deriv_id, user_email, path_to_db
+            )
+        ],
+    )
+    logger.info("[trace end " + trace_id + "]")
+    return step_id
+
     # the following was moved into controller.py so that when a single step fails the notice is provided to the user
     # def determine_derivation_validity(deriv_id: str, path_to_db: str) -> dict:
     #    """
@@ -16,6 +16,16 @@ logger = logging.getLogger(__name__)
 
 class Config(object):
     SECRET_KEY = os.environ.get("SECRET_KEY")
+    # a request with ?profile=<PROFILING_TOKEN> is profiled with cProfile;
+    # see /monitoring/timing. Profiling is disabled if not set
+    PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN")
+    # API requests that change state (e.g. revalidation) must have the header
+    # "Authorization: Bearer <API_TOKEN>". They are refused if not set
+    API_TOKEN = os.environ.get("API_TOKEN")
+    # comma-separated; the accounts that can see /monitoring/timing
+    ADMIN_EMAILS = [
+        email for email in os.environ.get("ADMIN_EMAILS", "").split(",") if email
+    ]
 
 
 # use of os.urandom is from https://realpython.com/flask-google-login/
@@ -28,6 +28,7 @@
 """
 
 import os
+import hmac
 import json
 import shutil
 import time
@@ -116,12 +117,19 @@ import json_schema  # PDG
 import compute  # PDG
 import validate_steps_sympy as vir  # PDG
 import validate_dimensions_sympy as vdim  # PDG
+import latex_to_sympy  # PDG
+import instrumentation  # PDG
 
 # global proc_timeout
 proc_timeout = 30
 path_to_db = "pdg.db"
-# the following is done once upon program load
-clib.json_to_sql("data.json", path_to_db)
+# the following is done once upon program load.
+# When the program is started as "python3 controller.py", the validation
+# workers (see validate_steps_sympy.py) import this file as "__mp_main__";
+# they must not overwrite the database with data.json
+if __name__ != "__mp_main__":
+    clib.json_to_sql("data.json", path_to_db)
+    compute.evict_validation_results_in_background(path_to_db)
 
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.user_loader
 login_manager = LoginManager()
@@ -152,6 +160,11 @@ app.config["GOOGLE_LOGIN_REDIRECT_SCHEME"] = "https"
 import pdg_api
 
 app.register_blueprint(pdg_api.bp)
+# authenticated with a token rather than the session cookie,
+# so a cross-site request cannot use it and a CSRF token is not needed
+csrf.exempt(pdg_api.api_revalidate_steps_affected_by_edit)
+# read-only; POST so that a list of IDs too long for a URL fits in the body
+csrf.exempt(pdg_api.api_derivations_per_expression)
 
 
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.user_loader
@@ -731,6 +744,14 @@ def before_request():
     elapsed_time = lambda: "%.5f seconds" % (time.time() - g.request_start_time)
     # logger.debug("created elapsed_time function")
     g.request_time = elapsed_time
+    instrumentation.start_request()
+    g.profiler = None
+    # compare_digest, like pdg_api.request_has_api_token, so the time taken
+    # does not reveal how much of the token matched
+    if (app.config.get("PROFILING_TOKEN") is not None) and hmac.compare_digest(
+        request.args.get("profile", ""), app.config["PROFILING_TOKEN"]
+    ):
+        g.profiler = instrumentation.start_profile()
     return
 
 
@@ -749,6 +770,16 @@ def after_request(response):
         flash("after_request:" + str(err))
         # logger.error(str(err))
         diff = 0
+    # the URL rule rather than the URL, so that e.g. every derivation counts as one route
+    if request.url_rule is not None:
+        route = request.url_rule.rule
+    else:
+        route = "no matching route"
+    if getattr(g, "profiler", None) is not None:
+        # the path without the query string, which contains the profiling token
+        instrumentation.end_profile(g.profiler, request.path)
+        g.profiler = None
+    instrumentation.end_request(route, diff)
     if (
         (response.response)
         and (200 <= response.status_code < 300)
@@ -1162,11 +1193,14 @@ def monitoring():
         "/home/appuser/app/logs/flask_critical_and_error_and_warning_and_info_and_debug.log",
         number_of_lines_to_tail,
     )
+    # per gunicorn worker; the worker that served this page
+    parse_latex_cache_info = latex_to_sympy.parse_latex_cache_info()
 
     logger.info("[trace page monitoring end " + trace_id + "]")
     return render_template(
         "monitoring.html",
         list_of_pics=list_of_pics,
+        parse_latex_cache_info=parse_latex_cache_info,
         tail_of_auth_log_as_list=tail_of_auth_log_as_list,
         tail_of_ufw_log_as_list=tail_of_ufw_log_as_list,
         tail_of_nginx_log_as_list=tail_of_nginx_log_as_list,
@@ -1176,6 +1210,31 @@ def monitoring():
     )
 
 
+@app.route("/monitoring/timing", methods=["GET", "POST"])
+@login_required
+def monitoring_timing():
+    """
+    Where the time of requests is spent; see instrumentation.py
+    Linked from /monitoring. The profiles show the internals of the server,
+    so only the accounts in Config.ADMIN_EMAILS can see this page
+
+    >>> monitoring_timing()
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace page start " + trace_id + "]" + current_user.email)
+    if current_user.email not in app.config["ADMIN_EMAILS"]:
+        logger.info("[trace page end " + trace_id + "]")
+        return "Error: this page is only for administrators", 403
+    timing_report = instrumentation.timing_report()
+    logger.info("[trace page end " + trace_id + "]")
+    return render_template(
+        "monitoring_timing.html",
+        timing_report=timing_report,
+        worker_pid=os.getpid(),
+        title="Timing",
+    )
+
+
 @app.route("/static_dir", methods=["GET", "POST"])
 def static_dir():
     """
@@ -1725,7 +1784,7 @@ def list_all_steps():
         # the derivation steps table is shown, so we need to vaildate the step
         for this_step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
             try:
-                derivation_step_validity_dict[this_step_id] = vir.validate_step(
+                derivation_step_validity_dict[this_step_id] = vir.validate_step_cached(
                     deriv_id, this_step_id, path_to_db
                 )
             except Exception as err:
@@ -2341,7 +2400,7 @@ def select_derivation_step_to_edit(deriv_id: str):
         )  # keys are step_id, value is a string of either "failed" or "valid"
         for this_step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
             try:
-                derivation_step_validity_dict[this_step_id] = vir.validate_step(
+                derivation_step_validity_dict[this_step_id] = vir.validate_step_cached(
                     deriv_id, step_id, path_to_db
                 )
             except Exception as err:
@@ -2610,7 +2669,7 @@ def provide_expr_for_inf_rule(deriv_id: str, inf_rule: str):
         )
 
         try:
-            step_validity_msg = vir.validate_step(deriv_id, step_id, path_to_db)
+            step_validity_msg = vir.validate_step_cached(deriv_id, step_id, path_to_db)
         except Exception as err:
             flash(str(err))
             logger.warning(str(err))
@@ -2636,7 +2695,7 @@ def provide_expr_for_inf_rule(deriv_id: str, inf_rule: str):
         )  # keys are step_id, value is a string of either "failed" or "valid"
         for this_step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
             try:
-                derivation_step_validity_dict[this_step_id] = vir.validate_step(
+                derivation_step_validity_dict[this_step_id] = vir.validate_step_cached(
                     deriv_id, step_id, path_to_db
                 )
             except Exception as err:
@@ -2784,6 +2843,7 @@ def update_symbols(deriv_id: str, step_id: str):
         elif request.form["submit_button"] == "update symbols":
             # ('existing symbol for v_{0}', '5153'), ('submit_button', 'update symbols')])
 
+            list_of_updates = []
             for this_key in request.form.keys():
                 if this_key.startswith("symbol_radio_"):
                     if request.form[this_key].startswith("symbol radio "):
@@ -2792,13 +2852,7 @@ def update_symbols(deriv_id: str, step_id: str):
                         new_symbol_id = selected_string.split(" ")[0]
                         sympy_symbol = selected_string.split(" ")[1]
                         if new_symbol_id != "NONE":
-                            compute.update_symbol_in_step(
-                                sympy_symbol,
-                                new_symbol_id,
-                                deriv_id,
-                                step_id,
-                                path_to_db,
-                            )
+                            list_of_updates.append((sympy_symbol, new_symbol_id))
                             flash("updated " + sympy_symbol + " as ID " + new_symbol_id)
                     elif request.form[this_key].startswith("existing symbol for "):
                         for find_key in request.form.keys():
@@ -2808,13 +2862,7 @@ def update_symbols(deriv_id: str, step_id: str):
                                     "existing symbol for ", ""
                                 )
                                 if new_symbol_id != "NONE":
-                                    compute.update_symbol_in_step(
-                                        sympy_symbol,
-                                        new_symbol_id,
-                                        deriv_id,
-                                        step_id,
-                                        path_to_db,
-                                    )
+                                    list_of_updates.append((sympy_symbol, new_symbol_id))
                                     flash(
                                         "updated "
                                         + sympy_symbol
@@ -2836,13 +2884,7 @@ def update_symbols(deriv_id: str, step_id: str):
                     new_symbol_id = request.form[this_key]
                     sympy_symbol = this_key.replace("existing symbol for ", "")
                     if new_symbol_id != "NONE":
-                        compute.update_symbol_in_step(
-                            sympy_symbol,
-                            new_symbol_id,
-                            deriv_id,
-                            step_id,
-                            path_to_db,
-                        )
+                        list_of_updates.append((sympy_symbol, new_symbol_id))
                         flash("updated " + sympy_symbol + " as ID " + new_symbol_id)
                 elif this_key == "csrf_token":
                     continue  # go to next iteration of loop
@@ -2851,6 +2893,8 @@ def update_symbols(deriv_id: str, step_id: str):
                 else:
                     flash("unrecognized button text: " + str(this_key))
                     logger.error("unrecognized button text: " + str(this_key))
+            # one write for all of the selections
+            compute.update_symbols_in_step(list_of_updates, deriv_id, step_id, path_to_db)
             logger.info("[trace page end " + trace_id + "]")
             return redirect(
                 url_for("update_symbols", deriv_id=deriv_id, step_id=step_id)
@@ -2937,7 +2981,7 @@ def update_symbols(deriv_id: str, step_id: str):
         derivation_step_validity_dict = {}
         for this_step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
             try:
-                derivation_step_validity_dict[this_step_id] = vir.validate_step(
+                derivation_step_validity_dict[this_step_id] = vir.validate_step_cached(
                     deriv_id, this_step_id, path_to_db
                 )
             except Exception as err:
@@ -3080,7 +3124,7 @@ def step_review(deriv_id: str, step_id: str):
         derivation_step_validity_dict = {}
         for this_step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
             try:
-                derivation_step_validity_dict[this_step_id] = vir.validate_step(
+                derivation_step_validity_dict[this_step_id] = vir.validate_step_cached(
                     deriv_id, this_step_id, path_to_db
                 )
             except Exception as err:
@@ -3413,11 +3457,14 @@ def review_derivation(deriv_id: str):
             logger.error("unrecognized button")
 
     try:
-        derivation_png = compute.create_derivation_png(deriv_id, path_to_db)
+        # SVG is smaller than PNG for derivations with many steps
+        derivation_graphviz_file = compute.create_derivation_graphviz(
+            deriv_id, path_to_db, "svg"
+        )
     except Exception as err:
         logger.error(str(err))
         flash(str(err))
-        derivation_png = "error.png"
+        derivation_graphviz_file = "error.png"
 
     try:
         d3js_json_filename = compute.create_d3js_json(deriv_id, path_to_db)
@@ -3434,15 +3481,9 @@ def review_derivation(deriv_id: str):
         derivation_dimensions_validity_dict = {}
         derivation_units_validity_dict = {}
         for this_step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
+            # steps whose content is unchanged are read from the validation results store
             try:
-                step_hash = compute.hash_of_step(deriv_id, this_step_id, path_to_db)
-            except Exception as err:
-                logger.error(this_step_id + ": " + str(err))
-                flash("in step " + this_step_id + ": " + str(err))
-            # if step_hash in database:
-            # else:
-            try:
-                derivation_step_validity_dict[this_step_id] = vir.validate_step(
+                derivation_step_validity_dict[this_step_id] = vir.validate_step_cached(
                     deriv_id, this_step_id, path_to_db
                 )
             except Exception as err:
@@ -3527,7 +3568,7 @@ def review_derivation(deriv_id: str):
         list_of_symbols_for_this_derivation=list_of_symbols_for_this_derivation,
         symbol_popularity_dict=symbol_popularity_dict,
         symbol_popularity_dict_in_expr=symbol_popularity_dict_in_expr,
-        name_of_graphviz_png=derivation_png,
+        name_of_graphviz_file=derivation_graphviz_file,
         json_for_d3js=d3js_json_filename,
         derivation_step_validity_dict=derivation_step_validity_dict,
         derivation_dimensions_validity_dict=derivation_dimensions_validity_dict,
@@ -3601,6 +3642,7 @@ def modify_step(deriv_id: str, step_id: str):
                 #                      ('symbol_radio_2', 'existing symbol for E'),
                 #                      ('existing symbol for E', '4931'),
                 #                      ('submit_button', 'update symbols')])
+                list_of_updates = []
                 for this_key in request.form.keys():
                     if this_key.startswith("symbol_radio_"):
                         if request.form[this_key].startswith("symbol radio "):
@@ -3610,13 +3652,7 @@ def modify_step(deriv_id: str, step_id: str):
                             )
                             new_symbol_id = selected_string.split(" ")[0]
                             sympy_symbol = selected_string.split(" ")[1]
-                            compute.update_symbol_in_step(
-                                sympy_symbol,
-                                new_symbol_id,
-                                deriv_id,
-                                step_id,
-                                path_to_db,
-                            )
+                            list_of_updates.append((sympy_symbol, new_symbol_id))
                             flash("updated " + sympy_symbol + " as ID " + new_symbol_id)
                         elif request.form[this_key].startswith("existing symbol for "):
                             for find_key in request.form.keys():
@@ -3625,13 +3661,7 @@ def modify_step(deriv_id: str, step_id: str):
                                     sympy_symbol = find_key.replace(
                                         "existing symbol for ", ""
                                     )
-                                    compute.update_symbol_in_step(
-                                        sympy_symbol,
-                                        new_symbol_id,
-                                        deriv_id,
-                                        step_id,
-                                        path_to_db,
-                                    )
+                                    list_of_updates.append((sympy_symbol, new_symbol_id))
                                     flash(
                                         "updated "
                                         + sympy_symbol
@@ -3641,6 +3671,10 @@ def modify_step(deriv_id: str, step_id: str):
                         else:
                             flash("unrecognized button text")
                             logger.error("unrecognized button text")
+                # one write for all of the selections
+                compute.update_symbols_in_step(
+                    list_of_updates, deriv_id, step_id, path_to_db
+                )
                 logger.info("[trace page end " + trace_id + "]")
                 return redirect(
                     url_for(
@@ -3697,7 +3731,9 @@ def modify_step(deriv_id: str, step_id: str):
                     flash(str(err))
 
                 try:
-                    step_validity_msg = vir.validate_step(deriv_id, step_id, path_to_db)
+                    step_validity_msg = vir.validate_step_cached(
+                        deriv_id, step_id, path_to_db
+                    )
                 except Exception as err:
                     flash(str(err))
                     logger.error(str(err))
@@ -3842,7 +3878,7 @@ def modify_step(deriv_id: str, step_id: str):
         derivation_step_validity_dict = {}
         for this_step_id, step_dict in dat["derivations"][deriv_id]["steps"].items():
             try:
-                derivation_step_validity_dict[this_step_id] = vir.validate_step(
+                derivation_step_validity_dict[this_step_id] = vir.validate_step_cached(
                     deriv_id, this_step_id, path_to_db
                 )
             except Exception as err:
@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+
+# Physics Derivation Graph
+# Ben Payne, 2021
+# https://creativecommons.org/licenses/by/4.0/
+# Attribution 4.0 International (CC BY 4.0)
+
+"""
+Streaming writers for exports of the database content.
+
+Each writer emits one record at a time to a file handle instead of building
+the whole export as a string, so beyond the database content itself an export
+needs a bounded amount of memory and its time is linear in the size of the graph.
+Text formats can be written gzip-compressed directly.
+
+The tables used for the SQL export (and the dataframes in compute) are described
+by table_columns; the rows of each table come from a generator in table_rows.
+
+Formats:
+    json   -- the database content; what the database is loaded from
+    sql    -- SQLite3 file with one table per entry of table_columns
+    rdf    -- lossy; https://github.com/allofphysicsgraph/proofofconcept/issues/14
+    cypher -- CREATE statements for Neo4j
+
+This module does not read the database; callers pass the content.
+"""
+
+import gzip
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import time
+from typing import Any, Dict, TextIO
+
+import instrumentation  # a PDG file
+
+logger = logging.getLogger(__name__)
+
+# rows are inserted into SQLite in batches of this size
+sql_rows_per_batch = 1000
+
+table_columns = {
+    "derivations": ["deriv ID", "name", "notes", "creation date", "author"],
+    "expressions": [
+        "expression ID",
+        "latex",
+        "notes",
+        "creation date",
+        "author",
+        "AST",
+    ],
+    "infrules": [
+        "inference rule",
+        "number of feeds",
+        "number of inputs",
+        "number of outputs",
+        "latex",
+        "notes",
+        "creation date",
+        "author",
+    ],
+    "steps": ["step ID", "inference rule", "linear index"],
+    "step inputs": ["step ID", "expr local ID"],
+    "step feeds": ["step ID", "expr local ID"],
+    "step outputs": ["step ID", "expr local ID"],
+    "expr local global": ["expr local id", "expr global id"],
+    "symbols": [
+        "symbol id",
+        "latex",
+        "category",
+        "scope",
+        "references",
+        "name",
+        "dimensions",
+        "value",
+        "units",
+    ],
+    "measures": ["measure", "reference"],
+    "units": [
+        "unit",
+        "dimension: length",
+        "dimension: time",
+        "dimension: mass",
+        "dimension: temperature",
+        "dimension: electric charge",
+        "dimension: amount of substance",
+        "dimension: luminous intensity",
+        "reference",
+    ],
+    "operators": ["operator", "operator latex", "argument count", "scope"],
+}
+
+
+def derivation_rows(dat: dict):
+    """
+    >>> list(derivation_rows(dat))
+    """
+    for deriv_id, deriv_dict in dat["derivations"].items():
+        yield {
+            "deriv ID": deriv_id,
+            "name": deriv_dict["name"],
+            "notes": deriv_dict["notes"],
+            "creation date": deriv_dict["creation date"],
+            "author": deriv_dict["author"],
+        }
+
+
+def expression_rows(dat: dict):
+    """
+    >>> list(expression_rows(dat))
+    """
+    for expression_id, expression_dict in dat["expressions"].items():
+        yield {
+            "expression ID": expression_id,
+            "latex": expression_dict["latex"],
+            "notes": expression_dict["notes"],
+            "creation date": expression_dict["creation date"],
+            "author": expression_dict["author"],
+            "AST": expression_dict["AST"],
+        }
+
+
+def infrule_rows(dat: dict):
+    """
+    >>> list(infrule_rows(dat))
+    """
+    for infrule_name, infrule_dict in dat["inference rules"].items():
+        yield {
+            "inference rule": infrule_name,
+            "number of feeds": infrule_dict["number of feeds"],
+            "number of inputs": infrule_dict["number of inputs"],
+            "number of outputs": infrule_dict["number of outputs"],
+            "latex": infrule_dict["latex"],
+            "notes": infrule_dict["notes"],
+            "creation date": infrule_dict["creation date"],
+            "author": infrule_dict["author"],
+        }
+
+
+def step_rows(dat: dict):
+    """
+    >>> list(step_rows(dat))
+    """
+    for deriv_dict in dat["derivations"].values():
+        for step_id, step_dict in deriv_dict["steps"].items():
+            yield {
+                "step ID": step_id,
+                "inference rule": step_dict["inf rule"],
+                "linear index": step_dict["linear index"],
+            }
+
+
+def step_connection_rows(dat: dict, connection_type: str):
+    """
+    Args:
+        dat: database content
+        connection_type: "inputs", "feeds", or "outputs"
+
+    >>> list(step_connection_rows(dat, "inputs"))
+    """
+    for deriv_dict in dat["derivations"].values():
+        for step_id, step_dict in deriv_dict["steps"].items():
+            for expr_local_id in step_dict[connection_type]:
+                yield {"step ID": step_id, "expr local ID": expr_local_id}
+
+
+def local_to_global_rows(dat: dict):
+    """
+    >>> list(local_to_global_rows(dat))
+    """
+    for local_id, global_id in dat["expr local to global"].items():
+        yield {"expr local id": local_id, "expr global id": global_id}
+
+
+def symbol_rows(dat: dict):
+    """
+    constants have "values"; variables do not
+
+    >>> list(symbol_rows(dat))
+    """
+    for symbol_id, symbol_dict in dat["symbols"].items():
+        this_symb = {}
+        this_symb["symbol id"] = symbol_id
+        this_symb["latex"] = symbol_dict["latex"]
+        if "category" in symbol_dict.keys():
+            this_symb["category"] = symbol_dict["category"]
+        # TODO: an entry in a table should not be a list (tidy data)
+        this_symb["scope"] = ";".join(symbol_dict["scope"])
+        if "references" in symbol_dict.keys():
+            # TODO: an entry in a table should not be a list (tidy data)
+            this_symb["references"] = " ".join(symbol_dict["references"])
+        if "name" in symbol_dict.keys():
+            this_symb["name"] = symbol_dict["name"]
+        if "dimensions" in symbol_dict.keys():
+            # TODO: this is actually a dict
+            this_symb["dimensions"] = str(symbol_dict["dimensions"])
+        for value_dict in symbol_dict.get("values", []):
+            # TODO: a constant can have multiple values with different units
+            this_symb["value"] = value_dict["value"]
+            this_symb["units"] = value_dict["units"]
+        yield this_symb
+
+
+def measure_rows(dat: dict):
+    """
+    >>> list(measure_rows(dat))
+    """
+    for measure_name, measure_dict in dat["measures"].items():
+        if "references" in measure_dict.keys():
+            for ref in measure_dict["references"]:
+                yield {"measure": measure_name, "reference": ref}
+        else:
+            yield {"measure": measure_name}
+
+
+def unit_rows(dat: dict):
+    """
+    >>> list(unit_rows(dat))
+    """
+    for unit_name, unit_dict in dat["units"].items():
+        for this_ref in unit_dict["references"]:
+            this_unit = {"unit": unit_name}
+            # keys of "dimensions" match the "dimension: " columns of table_columns
+            for dimension_name, exponent in unit_dict.get("dimensions", {}).items():
+                this_unit["dimension: " + dimension_name] = exponent
+            this_unit["reference"] = this_ref
+            yield this_unit
+
+
+def operator_rows(dat: dict):
+    """
+    >>> list(operator_rows(dat))
+    """
+    for operator_name, operator_dict in dat["operators"].items():
+        for this_scope in operator_dict["scope"]:
+            yield {
+                "operator": operator_name,
+                "operator latex": operator_dict["latex"],
+                "argument count": operator_dict["argument count"],
+                "scope": this_scope,
+            }
+
+
+# keys match table_columns; each value returns a generator of rows (dicts)
+table_rows = {
+    "derivations": derivation_rows,
+    "expressions": expression_rows,
+    "infrules": infrule_rows,
+    "steps": step_rows,
+    "step inputs": lambda dat: step_connection_rows(dat, "inputs"),
+    "step feeds": lambda dat: step_connection_rows(dat, "feeds"),
+    "step outputs": lambda dat: step_connection_rows(dat, "outputs"),
+    "expr local global": local_to_global_rows,
+    "symbols": symbol_rows,
+    "measures": measure_rows,
+    "units": unit_rows,
+    "operators": operator_rows,
+}
+
+
+def write_json(dat: dict, fil: TextIO) -> None:
+    """
+    json.dump encodes and writes in chunks rather than building one string
+
+    >>> write_json(dat, open("data.json", "w"))
+    """
+    # logger.info("[trace]")
+    json.dump(dat, fil, indent=4, separators=(",", ": "), sort_keys=True)
+    return
+
+
+def write_rdf(dat: dict, fil: TextIO) -> None:
+    """
+    this conversion is lossy
+
+    https://www.w3.org/RDF/
+    https://en.wikipedia.org/wiki/Web_Ontology_Language
+
+    >>> write_rdf(dat, open("data.rdf", "w"))
+    """
+    # logger.info("[trace]")
+    # https://www.w3.org/TR/1999/REC-rdf-syntax-19990222/#basic
+    fil.write('<?xml version="1.0"?>')
+    fil.write("<rdf:RDF")
+    fil.write('  xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"')
+    fil.write('  xmlns:s="http://description.org/schema/">')
+    for expression_id, expression_dict in dat["expressions"].items():
+        fil.write(expression_id + " has_latex '" + expression_dict["latex"] + "'\n")
+    for infrule_name, infrule_dict in dat["inference rules"].items():
+        # https://stackoverflow.com/questions/22520932/python-remove-all-non-alphabet-chars-from-string
+        infrule_alnum = "".join(filter(str.isalnum, infrule_name))
+        fil.write(
+            infrule_alnum
+            + " has_input_count "
+            + str(infrule_dict["number of inputs"])
+            + "\n"
+        )
+        fil.write(
+            infrule_alnum
+            + " has_feed_count "
+            + str(infrule_dict["number of feeds"])
+            + "\n"
+        )
+        fil.write(
+            infrule_alnum
+            + " has_output_count "
+            + str(infrule_dict["number of outputs"])
+            + "\n"
+        )
+        fil.write(infrule_alnum + " has_latex '" + infrule_dict["latex"] + "'\n")
+    for deriv_id, deriv_dict in dat["derivations"].items():
+        for step_id, step_dict in deriv_dict["steps"].items():
+            fil.write(deriv_id + " has_step " + step_id + "\n")
+            fil.write(
+                step_id
+                + " has_infrule "
+                + "".join(filter(str.isalnum, step_dict["inf rule"]))
+                + "\n"
+            )
+            fil.write(
+                step_id + " has_linear_index " + str(step_dict["linear index"]) + "\n"
+            )
+            for expr_local_id in step_dict["inputs"]:
+                fil.write(step_id + " has_input_expr " + expr_local_id + "\n")
+            for expr_local_id in step_dict["feeds"]:
+                fil.write(step_id + " has_feed_expr " + expr_local_id + "\n")
+            for expr_local_id in step_dict["outputs"]:
+                fil.write(step_id + " has_output_expr " + expr_local_id + "\n")
+    for local_id, global_id in dat["expr local to global"].items():
+        fil.write(local_id + " local_is_global " + global_id + "\n")
+    fil.write("</rdf:RDF>")
+    return
+
+
+def write_cypher(dat: dict, fil: TextIO) -> None:
+    """
+    https://neo4j.com/docs/cypher-manual/current/clauses/create/#create-create-single-node
+
+    >>> write_cypher(dat, open("neo4j.txt", "w"))
+    """
+    # logger.info("[trace]")
+    for expression_id, expression_dict in dat["expressions"].items():
+        fil.write("CREATE (id" + expression_id + ":expression {\n")
+        if len(expression_dict["name"]) > 0:
+            fil.write("  name: '" + expression_dict["name"] + "',\n")
+        if len(expression_dict["notes"]) > 0:
+            fil.write("  notes: '" + expression_dict["notes"] + "',\n")
+        fil.write("  creation_date: '" + expression_dict["creation date"] + "',\n")
+        fil.write("  author: '" + expression_dict["author"] + "',\n")
+        # TODO: not clear how to include AST and references to symbols
+        fil.write(
+            "       latex: '"
+            + expression_dict["latex"].replace("\\", "\\\\").replace("'", "\\'")
+            + "'})\n"
+        )
+    for infrule_name, infrule_dict in dat["inference rules"].items():
+        # https://stackoverflow.com/questions/22520932/python-remove-all-non-alphabet-chars-from-string
+        fil.write(
+            "CREATE (" + "".join(filter(str.isalnum, infrule_name)) + ":infrule {\n"
+        )
+        fil.write("       num_inputs: " + str(infrule_dict["number of inputs"]) + ",\n")
+        fil.write("       num_feeds: " + str(infrule_dict["number of feeds"]) + ",\n")
+        fil.write(
+            "       num_outputs: " + str(infrule_dict["number of outputs"]) + ",\n"
+        )
+        fil.write("       author: " + str(infrule_dict["author"]) + ",\n")
+        fil.write(
+            "       creation_date: " + str(infrule_dict["creation date"]) + ",\n"
+        )
+        fil.write("       latex: '" + infrule_dict["latex"] + "'})\n")
+
+    for deriv_id, deriv_dict in dat["derivations"].items():
+        fil.write("CREATE (" + deriv_id + ":derivation {\n")
+        if len(deriv_dict["name"]) > 0:
+            fil.write(
+                "  name: '" + "".join(filter(str.isalnum, deriv_dict["name"])) + "',\n"
+            )
+        if len(deriv_dict["notes"]) > 0:
+            fil.write("  notes: '" + deriv_dict["notes"] + "',\n")
+        fil.write("  creation_date: '" + deriv_dict["creation date"] + "',\n")
+        fil.write("  author: '" + deriv_dict["author"] + "'}\n")
+
+        # https://neo4j.com/docs/cypher-manual/current/syntax/comments/
+        for step_id, step_dict in deriv_dict["steps"].items():
+            fil.write("CREATE (id" + step_id + ":step {\n")
+            fil.write("  creation_date: '" + step_dict["creation date"] + "',\n")
+            fil.write("  author: '" + step_dict["author"] + "'}\n")
+            # step to deriv via linear index
+            fil.write(
+                "CREATE (id"
+                + step_id
+                + ")<-[:linear_index {linear_index: '"
+                + str(step_dict["linear index"])
+                + "}']-(id"
+                + deriv_id
+                + ")\n"
+            )
+            # step to infrule
+            fil.write(
+                "CREATE (id"
+                + step_id
+                + ")<-[:infrule]-("
+                + "".join(filter(str.isalnum, step_dict["inf rule"]))
+                + ")\n"
+            )
+
+            # within each step, link to expr
+            for connection_type in ["inputs", "feeds"]:
+                for expr_local_id in step_dict[connection_type]:
+                    fil.write(
+                        "CREATE (id"
+                        + step_id
+                        + ")<-[:expr { local_id: '"
+                        + expr_local_id
+                        + "'}]-(id"
+                        + dat["expr local to global"][expr_local_id]
+                        + ")\n"
+                    )
+            for expr_local_id in step_dict["outputs"]:
+                fil.write(
+                    "CREATE (id"
+                    + step_id
+                    + ")-[:expr { local_id: '"
+                    + expr_local_id
+                    + "'}]->(id"
+                    + dat["expr local to global"][expr_local_id]
+                    + ")\n"
+                )
+
+    # for symbol_id, symbol_dict in dat['symbols'].items():
+    #    fil.write("CREATE ()")
+
+    # for operator_name, operator_dict in dat['operators'].items():
+    #    fil.write("CREATE ()")
+    return
+
+
+def write_sql(dat: dict, path_to_sql: str) -> None:
+    """
+    One table per entry of table_columns. Rows are inserted in batches
+    straight from the row generators rather than through dataframes.
+    As with the previous export through pandas, every value is stored as text
+    and each table has an "index" column; missing values are NULL.
+
+    Args:
+        dat: database content
+        path_to_sql: SQLite3 file to create; an existing file is replaced
+    Returns:
+        None
+    Raises:
+
+    >>> write_sql(dat, "physics_derivation_graph.sqlite3")
+    """
+    # logger.info("[trace]")
+    if os.path.isfile(path_to_sql):
+        os.remove(path_to_sql)
+    try:
+        cnx = sqlite3.connect(path_to_sql)
+    except sqlite3.Error as err:
+        logger.error("unable to connect to SQL file " + path_to_sql)
+        raise Exception(
+            "unable to connect to SQL file " + path_to_sql + "; " + str(err)
+        )
+    try:
+        with cnx:
+            for table_name, list_of_columns in table_columns.items():
+                quoted_columns = ['"index"'] + [
+                    '"' + column + '"' for column in list_of_columns
+                ]
+                cnx.execute(
+                    'CREATE TABLE "'
+                    + table_name
+                    + '" ("index" INTEGER, '
+                    + ", ".join(column + " TEXT" for column in quoted_columns[1:])
+                    + ")"
+                )
+                insert_str = (
+                    'INSERT INTO "'
+                    + table_name
+                    + '" ('
+                    + ", ".join(quoted_columns)
+                    + ") VALUES ("
+                    + ", ".join(["?"] * len(quoted_columns))
+                    + ")"
+                )
+                batch = []
+                for row_index, row in enumerate(table_rows[table_name](dat)):
+                    batch.append(
+                        [row_index]
+                        + [
+                            None if row.get(column) is None else str(row[column])
+                            for column in list_of_columns
+                        ]
+                    )
+                    if len(batch) == sql_rows_per_batch:
+                        cnx.executemany(insert_str, batch)
+                        batch = []
+                cnx.executemany(insert_str, batch)
+    finally:
+        cnx.close()
+    return
+
+
+# keys are the format names used by the navigation page and the API
+export_formats = {  # type: Dict[str, Dict[str, Any]]
+    "json": {"file name": "data.json", "writer": write_json, "text": True},
+    "sql": {
+        "file name": "physics_derivation_graph.sqlite3",
+        "writer": write_sql,
+        "text": False,
+    },
+    "rdf": {"file name": "data.rdf", "writer": write_rdf, "text": True},
+    "cypher": {"file name": "neo4j.txt", "writer": write_cypher, "text": True},
+}
+
+
+def export_to_file(
+    dat: dict, export_format: str, path_to_file: str, compress: bool = False
+) -> str:
+    """
+    Write one format; the file appears at path_to_file only once it is complete.
+
+    Args:
+        dat: database content
+        export_format: a key of export_formats
+        path_to_file: where the export is placed; ".gz" is appended if compress
+        compress: gzip the output
+    Returns:
+        path of the file written
+    Raises:
+        Exception if the format is not recognized
+
+    >>> export_to_file(dat, "rdf", "data.rdf", compress=True)
+    'data.rdf.gz'
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+    if export_format not in export_formats.keys():
+        logger.error("unrecognized export format: " + export_format)
+        raise Exception("unrecognized export format: " + export_format)
+    writer = export_formats[export_format]["writer"]
+    if compress:
+        path_to_file += ".gz"
+    tmp_path = path_to_file + "." + trace_id
+
+    start_time = time.perf_counter()
+    try:
+        if export_formats[export_format]["text"]:
+            if compress:
+                with gzip.open(tmp_path, "wt", encoding="utf-8") as fil:
+                    writer(dat, fil)
+            else:
+                with open(tmp_path, "w") as fil:
+                    writer(dat, fil)
+        else:
+            writer(dat, tmp_path)
+            if compress:
+                # SQLite writes pages in place, so the file is compressed afterwards
+                with open(tmp_path, "rb") as uncompressed_file:
+                    with gzip.open(tmp_path + ".gz", "wb") as compressed_file:
+                        shutil.copyfileobj(uncompressed_file, compressed_file)
+                os.replace(tmp_path + ".gz", tmp_path)
+        os.replace(tmp_path, path_to_file)
+    finally:
+        for leftover_path in [tmp_path, tmp_path + ".gz"]:
+            if os.path.isfile(leftover_path):
+                os.remove(leftover_path)
+        instrumentation.record_timing(
+            "export",
+            export_format + (".gz" if compress else ""),
+            time.perf_counter() - start_time,
+        )
+
+    logger.info("[trace end " + trace_id + "]")
+    return path_to_file
+
+
+# EOF
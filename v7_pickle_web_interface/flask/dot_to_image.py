@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+# Physics Derivation Graph
+# Ben Payne, 2021
+# https://creativecommons.org/licenses/by/4.0/
+# Attribution 4.0 International (CC BY 4.0)
+
+"""
+Render Graphviz DOT to PNG or SVG using neato or dot.
+
+Rendered images are stored in a content-addressed cache: the file name is
+the md5 of the DOT source, the layout program, the output format, and the
+modification time of each image the DOT embeds (the PNGs of expressions
+are re-rendered under the same name when the Latex changes).
+A diagram that has not changed is laid out once, no matter how often it is viewed.
+The cache has a size limit; the least recently used images are removed first.
+
+Each layout runs in its own temporary folder, so workers never share a .dot file.
+At most max_concurrent_layouts layouts run at once, and concurrent requests
+for the same diagram wait on a single layout.
+
+SVG is smaller than PNG for large derivations. In the SVG the embedded PNGs are
+referenced by URL (/static/...) rather than by path, so the SVG must be shown
+with <object> rather than <img>, which does not load referenced images.
+
+this module relies on neato and dot being available on the command line
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import random
+import re
+import shutil
+from subprocess import PIPE  # https://docs.python.org/3/library/subprocess.html
+import tempfile
+import threading
+
+import instrumentation  # a PDG file
+
+logger = logging.getLogger(__name__)
+
+proc_timeout = 30
+
+static_folder = "/home/appuser/app/static/"
+graphviz_cache_folder = static_folder + "graphviz_cache/"
+# once the cache exceeds this size, least recently used images are removed
+graphviz_cache_max_bytes = 100 * 1024 * 1024
+
+# neato and dot are separate processes, so threads that wait on them
+# are sufficient to bound the number of concurrent layouts
+max_concurrent_layouts = 2
+
+list_of_output_formats = ["png", "svg"]
+list_of_layout_programs = ["neato", "dot"]
+
+image_attribute_pattern = re.compile(r'image="([^"]+)"')
+
+layout_executor = {}  # type: dict
+# keys are the name of the cached image; values are futures for layouts in progress
+layouts_in_progress = {}  # type: dict
+layouts_in_progress_lock = threading.Lock()
+
+
+def name_in_graphviz_cache(
+    dot_source: str, output_format: str, layout_program: str
+) -> str:
+    """
+    Args:
+        dot_source: content of a .dot file
+        output_format: "png" or "svg"
+        layout_program: "neato" or "dot"
+    Returns:
+        file name of the image, without the folder
+    Raises:
+
+    >>> name_in_graphviz_cache("digraph { a -> b; }", "png", "neato")
+    """
+    # logger.info("[trace]")
+    key_str = layout_program + "\n" + output_format + "\n" + dot_source
+    for path_to_embedded_image in sorted(
+        set(image_attribute_pattern.findall(dot_source))
+    ):
+        try:
+            file_stat = os.stat(path_to_embedded_image)
+        except FileNotFoundError:
+            continue
+        key_str += (
+            "\n"
+            + path_to_embedded_image
+            + " "
+            + str(file_stat.st_mtime_ns)
+            + " "
+            + str(file_stat.st_size)
+        )
+    return hashlib.md5(key_str.encode("utf-8")).hexdigest() + "." + output_format
+
+
+def run_layout(
+    dot_source: str, output_format: str, layout_program: str, path_to_image: str
+) -> None:
+    """
+    Runs in a temporary folder; the image is moved to path_to_image
+
+    Args:
+        dot_source: content of a .dot file
+        output_format: "png" or "svg"
+        layout_program: "neato" or "dot"
+        path_to_image: where the image is placed
+    Returns:
+        None
+    Raises:
+        Exception if the layout program fails
+
+    >>> run_layout("digraph { a -> b; }", "png", "neato", "/tmp/a.png")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    tmp_graphviz_folder = tempfile.mkdtemp(prefix="tmp_graphviz_folder_")
+    try:
+        with open(os.path.join(tmp_graphviz_folder, "graphviz.dot"), "w") as fil:
+            fil.write(dot_source)
+
+        # neato -Tpng graphviz.dot > /home/appuser/app/static/graphviz.png
+        process = instrumentation.run_subprocess(
+            [
+                layout_program,
+                "-T" + output_format,
+                "graphviz.dot",
+                "-ographviz." + output_format,
+            ],
+            stdout=PIPE,
+            stderr=PIPE,
+            timeout=proc_timeout,
+            cwd=tmp_graphviz_folder,
+        )
+        layout_stdout = process.stdout.decode("utf-8")
+        if len(layout_stdout) > 0:
+            logger.debug(layout_stdout)
+        layout_stderr = process.stderr.decode("utf-8")
+        if len(layout_stderr) > 0:
+            logger.debug(layout_stderr)
+
+        path_to_output = os.path.join(tmp_graphviz_folder, "graphviz." + output_format)
+        if (process.returncode != 0) or (not os.path.isfile(path_to_output)):
+            logger.error(layout_program + " failed; " + layout_stderr[-500:])
+            raise Exception(layout_program + " failed; " + layout_stderr[-500:])
+
+        if output_format == "svg":
+            with open(path_to_output, "r") as fil:
+                svg_str = fil.read()
+            with open(path_to_output, "w") as fil:
+                fil.write(svg_str.replace('"' + static_folder, '"/static/'))
+
+        # move then rename so that a partially written image is never served
+        shutil.move(path_to_output, path_to_image + "." + trace_id)
+        os.replace(path_to_image + "." + trace_id, path_to_image)
+    finally:
+        shutil.rmtree(tmp_graphviz_folder, ignore_errors=True)
+
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+def layout_and_store_in_cache(
+    dot_source: str, output_format: str, layout_program: str, image_name: str, future
+) -> None:
+    """
+    body of a layout task; see request_layout
+
+    >>> layout_and_store_in_cache(dot_source, "png", "neato", image_name, future)
+    """
+    # logger.info("[trace]")
+    try:
+        run_layout(
+            dot_source,
+            output_format,
+            layout_program,
+            graphviz_cache_folder + image_name,
+        )
+    except Exception as err:
+        with layouts_in_progress_lock:
+            layouts_in_progress.pop(image_name, None)
+        future.set_exception(err)
+        return
+    with layouts_in_progress_lock:
+        layouts_in_progress.pop(image_name, None)
+    future.set_result(image_name)
+    enforce_graphviz_cache_size_limit()
+    return
+
+
+def request_layout(
+    dot_source: str, output_format: str = "png", layout_program: str = "neato"
+) -> concurrent.futures.Future:
+    """
+    Start the layout unless the image is cached or already being laid out.
+
+    Args:
+        dot_source: content of a .dot file
+        output_format: "png" or "svg"
+        layout_program: "neato" or "dot"
+    Returns:
+        concurrent.futures.Future whose result is the file name in graphviz_cache_folder
+    Raises:
+        Exception if the format or the layout program is not supported
+
+    >>> request_layout("digraph { a -> b; }", "svg").result()
+    """
+    # logger.info("[trace]")
+    if output_format not in list_of_output_formats:
+        logger.error("unsupported Graphviz output format: " + output_format)
+        raise Exception("unsupported Graphviz output format: " + output_format)
+    if layout_program not in list_of_layout_programs:
+        logger.error("unsupported Graphviz layout program: " + layout_program)
+        raise Exception("unsupported Graphviz layout program: " + layout_program)
+
+    image_name = name_in_graphviz_cache(dot_source, output_format, layout_program)
+    path_to_image = graphviz_cache_folder + image_name
+    if os.path.isfile(path_to_image):
+        try:
+            # the modification time is used to find the least recently used images
+            os.utime(path_to_image)
+        except FileNotFoundError:  # evicted by another worker
+            pass
+        else:
+            future = concurrent.futures.Future()  # type: concurrent.futures.Future
+            future.set_result(image_name)
+            return future
+
+    with layouts_in_progress_lock:
+        if image_name in layouts_in_progress.keys():
+            return layouts_in_progress[image_name]
+        future = concurrent.futures.Future()
+        layouts_in_progress[image_name] = future
+        if "executor" not in layout_executor.keys():
+            os.makedirs(graphviz_cache_folder, exist_ok=True)
+            layout_executor["executor"] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_concurrent_layouts, thread_name_prefix="pdg_graphviz"
+            )
+    layout_executor["executor"].submit(
+        layout_and_store_in_cache,
+        dot_source,
+        output_format,
+        layout_program,
+        image_name,
+        future,
+    )
+    return future
+
+
+def enforce_graphviz_cache_size_limit() -> int:
+    """
+    Remove the least recently used images
+    until the cache is under graphviz_cache_max_bytes
+
+    Returns:
+        number of files removed
+    Raises:
+
+    >>> enforce_graphviz_cache_size_limit()
+    0
+    """
+    # logger.info("[trace]")
+    list_of_entries = []
+    total_bytes = 0
+    for entry in os.scandir(graphviz_cache_folder):
+        if entry.is_file() and (entry.name.split(".")[-1] in list_of_output_formats):
+            file_stat = entry.stat()
+            list_of_entries.append((file_stat.st_mtime, file_stat.st_size, entry.path))
+            total_bytes += file_stat.st_size
+
+    number_removed = 0
+    if total_bytes > graphviz_cache_max_bytes:
+        for mtime, size, path_to_image in sorted(list_of_entries):
+            try:
+                os.remove(path_to_image)
+            except FileNotFoundError:  # removed by another worker
+                pass
+            total_bytes -= size
+            number_removed += 1
+            if total_bytes <= graphviz_cache_max_bytes:
+                break
+        logger.debug("removed " + str(number_removed) + " images from graphviz cache")
+    return number_removed
+
+
+def create_image_from_dot(
+    dot_source: str, output_format: str = "png", layout_program: str = "neato"
+) -> str:
+    """
+    Args:
+        dot_source: content of a .dot file
+        output_format: "png" or "svg"
+        layout_program: "neato" or "dot"
+    Returns:
+        name of the image relative to static/, for use with url_for('static', ...)
+    Raises:
+        Exception if the layout fails
+
+    >>> create_image_from_dot("digraph { a -> b; }", "svg")
+    'graphviz_cache/5d0b8f0e9c6ba3cbb4b9f1f2f1a7c6d3.svg'
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    future = request_layout(dot_source, output_format, layout_program)
+    # the layout may wait for other layouts in the pool
+    image_name = future.result(timeout=proc_timeout * (max_concurrent_layouts + 1))
+
+    logger.info("[trace end " + trace_id + "]")
+    return os.path.relpath(graphviz_cache_folder + image_name, static_folder)
+
+
+# EOF
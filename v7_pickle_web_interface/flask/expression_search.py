@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# Physics Derivation Graph
+# Ben Payne, 2021
+# https://creativecommons.org/licenses/by/4.0/
+# Attribution 4.0 International (CC BY 4.0)
+
+"""
+Search expressions using an inverted index.
+
+The index maps each token to the expressions containing that token.
+Tokens are taken from the Latex, the name, and the notes of each expression,
+plus the symbol IDs in the AST. Tokens are lower case;
+a Latex command like "\\frac" is indexed both as "\\frac" and as "frac".
+
+A query is a set of terms separated by spaces; all terms must match (AND).
+Alternatives are separated by " OR " or "|".
+A term ending in "*" matches every token with that prefix.
+Results are ranked by the number and rarity of the matching tokens,
+weighted by the field the token was found in.
+
+The index is kept per database and is updated when the database version
+changes (see common_lib.get_db_version); only expressions that were added,
+edited, or deleted since the previous version are re-indexed.
+A search costs a lookup per term rather than a scan of every expression.
+"""
+
+import bisect
+import logging
+import math
+import re
+import threading
+
+import common_lib as clib  # a PDG file
+
+logger = logging.getLogger(__name__)
+
+# a match in the Latex counts more than a match in the notes
+field_weights = {"latex": 3.0, "symbol": 2.0, "name": 2.0, "notes": 1.0}
+
+# keys are path_to_db; see get_search_index
+search_index_per_db = {}  # type: dict
+search_index_lock = threading.Lock()
+
+
+def tokens_of_text(text: str, include_command_names: bool = True) -> list:
+    """
+    Args:
+        text: Latex or plain text
+        include_command_names: whether "\\frac" also yields "frac"
+    Returns:
+        list_of_tokens: lower case
+    Raises:
+
+    >>> tokens_of_text("\\frac{a}{2 b}")
+    ['\\frac', 'frac', 'a', '2', 'b']
+    """
+    # logger.info("[trace]")
+    list_of_tokens = []
+    for token in re.findall(r"\\[A-Za-z]+|[A-Za-z]+|\d+", text):
+        token = token.lower()
+        list_of_tokens.append(token)
+        if include_command_names and token.startswith("\\"):
+            list_of_tokens.append(token[1:])
+    return list_of_tokens
+
+
+def field_tokens_of_expression(expr_dict: dict) -> dict:
+    """
+    Args:
+        expr_dict: an entry of dat["expressions"]
+    Returns:
+        {token: score}, where the score is the sum of the field weights
+    Raises:
+
+    >>> field_tokens_of_expression({"latex": "a^2", "AST": "Pow(Symbol('pdg9139'), Integer(2))"})
+    {'a': 3.0, '2': 3.0, '9139': 2.0}
+    """
+    # logger.info("[trace]")
+    token_scores = {}  # type: dict
+    for field in ["latex", "name", "notes"]:
+        for token in set(tokens_of_text(str(expr_dict.get(field, "")))):
+            token_scores[token] = token_scores.get(token, 0.0) + field_weights[field]
+    for symbol_id in set(re.findall(r"pdg(\d+)", str(expr_dict.get("AST", "")))):
+        token_scores[symbol_id] = (
+            token_scores.get(symbol_id, 0.0) + field_weights["symbol"]
+        )
+    return token_scores
+
+
+def add_to_index(search_index: dict, expr_global_id: str, expr_dict: dict) -> None:
+    """
+    >>> add_to_index(search_index, "0000040490", dat["expressions"]["0000040490"])
+    """
+    # logger.info("[trace]")
+    token_scores = field_tokens_of_expression(expr_dict)
+    search_index["tokens per expression"][expr_global_id] = {
+        "indexed fields": [expr_dict.get(f) for f in ["latex", "name", "notes", "AST"]],
+        "token scores": token_scores,
+    }
+    for token, score in token_scores.items():
+        if token not in search_index["postings"].keys():
+            search_index["postings"][token] = {}
+            bisect.insort(search_index["sorted tokens"], token)
+        search_index["postings"][token][expr_global_id] = score
+    return
+
+
+def remove_from_index(search_index: dict, expr_global_id: str) -> None:
+    """
+    >>> remove_from_index(search_index, "0000040490")
+    """
+    # logger.info("[trace]")
+    entry = search_index["tokens per expression"].pop(expr_global_id)
+    for token in entry["token scores"].keys():
+        del search_index["postings"][token][expr_global_id]
+        if len(search_index["postings"][token]) == 0:
+            del search_index["postings"][token]
+            token_indx = bisect.bisect_left(search_index["sorted tokens"], token)
+            del search_index["sorted tokens"][token_indx]
+    return
+
+
+def update_index(search_index: dict, dat: dict) -> None:
+    """
+    Re-index only the expressions that were added, edited, or deleted.
+
+    Args:
+        search_index: see get_search_index
+        dat: the nested dictionary from clib.read_db
+    Returns:
+        None
+    Raises:
+
+    >>> update_index(search_index, dat)
+    """
+    # logger.info("[trace]")
+    number_of_changes = 0
+    for expr_global_id in list(search_index["tokens per expression"].keys()):
+        if expr_global_id not in dat["expressions"].keys():
+            remove_from_index(search_index, expr_global_id)
+            number_of_changes += 1
+    for expr_global_id, expr_dict in dat["expressions"].items():
+        entry = search_index["tokens per expression"].get(expr_global_id)
+        if entry is not None:
+            if entry["indexed fields"] == [
+                expr_dict.get(f) for f in ["latex", "name", "notes", "AST"]
+            ]:
+                continue
+            remove_from_index(search_index, expr_global_id)
+        add_to_index(search_index, expr_global_id, expr_dict)
+        number_of_changes += 1
+    logger.debug("re-indexed " + str(number_of_changes) + " expressions")
+    return
+
+
+def get_search_index(path_to_db: str) -> dict:
+    """
+    The caller must hold search_index_lock.
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        search_index = {"db version": int,
+                        "postings": {token: {expr_global_id: score}},
+                        "sorted tokens": [token],
+                        "tokens per expression": {expr_global_id: {...}}}
+    Raises:
+
+    >>> get_search_index("pdg.db")
+    """
+    # logger.info("[trace]")
+    db_version = clib.get_db_version(path_to_db)
+    if path_to_db not in search_index_per_db.keys():
+        search_index_per_db[path_to_db] = {
+            "db version": None,
+            "postings": {},
+            "sorted tokens": [],
+            "tokens per expression": {},
+        }
+        update_index(search_index_per_db[path_to_db], clib.read_db(path_to_db))
+    elif search_index_per_db[path_to_db]["db version"] != db_version:
+        update_index(search_index_per_db[path_to_db], clib.read_db(path_to_db))
+    search_index_per_db[path_to_db]["db version"] = db_version
+    return search_index_per_db[path_to_db]
+
+
+def matches_for_term(search_index: dict, term: str) -> dict:
+    """
+    Args:
+        search_index: see get_search_index
+        term: a token, or a prefix followed by "*"
+    Returns:
+        {expr_global_id: score}
+    Raises:
+
+    >>> matches_for_term(search_index, "fra*")
+    """
+    # logger.info("[trace]")
+    number_of_expressions = max(1, len(search_index["tokens per expression"]))
+    if term.endswith("*"):
+        prefix = term[:-1]
+        start_indx = bisect.bisect_left(search_index["sorted tokens"], prefix)
+        list_of_tokens = []
+        sorted_tokens = search_index["sorted tokens"]
+        while (start_indx < len(sorted_tokens)) and sorted_tokens[
+            start_indx
+        ].startswith(prefix):
+            list_of_tokens.append(sorted_tokens[start_indx])
+            start_indx += 1
+    else:
+        list_of_tokens = [term]
+
+    matches = {}  # type: dict
+    for token in list_of_tokens:
+        postings = search_index["postings"].get(token, {})
+        # rare tokens count more than common tokens
+        inverse_document_frequency = 1.0 + math.log(
+            number_of_expressions / max(1, len(postings))
+        )
+        for expr_global_id, score in postings.items():
+            matches[expr_global_id] = max(
+                matches.get(expr_global_id, 0.0), score * inverse_document_frequency
+            )
+    return matches
+
+
+def parse_query(query: str) -> list:
+    """
+    Args:
+        query: terms separated by spaces; alternatives separated by " OR " or "|"
+    Returns:
+        list of alternatives, each a list of terms that must all match
+    Raises:
+
+    >>> parse_query("cos 2 OR sin*")
+    [['cos', '2'], ['sin*']]
+    """
+    # logger.info("[trace]")
+    list_of_alternatives = []
+    for alternative in re.split(r"\s+OR\s+|\|", query.strip()):
+        list_of_terms = []
+        for word in alternative.split():
+            is_prefix = word.endswith("*")
+            # "\frac" should only match the command, not the word "frac"
+            list_of_tokens = tokens_of_text(word, include_command_names=False)
+            if is_prefix and (len(list_of_tokens) > 0):
+                list_of_tokens[-1] += "*"
+            list_of_terms.extend(list_of_tokens)
+        if len(list_of_terms) > 0:
+            list_of_alternatives.append(list_of_terms)
+    return list_of_alternatives
+
+
+def search_expressions(query: str, path_to_db: str) -> list:
+    """
+    Args:
+        query: see parse_query
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        list_of_expr_global_ids: best match first
+    Raises:
+
+    >>> search_expressions("cos 2", "pdg.db")
+    """
+    # logger.info("[trace]")
+    scores = {}  # type: dict
+    with search_index_lock:
+        search_index = get_search_index(path_to_db)
+        for list_of_terms in parse_query(query):
+            alternative_scores = None  # type: ignore
+            for term in list_of_terms:
+                matches = matches_for_term(search_index, term)
+                if alternative_scores is None:
+                    alternative_scores = matches
+                else:
+                    alternative_scores = {
+                        expr_global_id: score + matches[expr_global_id]
+                        for expr_global_id, score in alternative_scores.items()
+                        if expr_global_id in matches.keys()
+                    }
+                if len(alternative_scores) == 0:
+                    break
+            for expr_global_id, score in (alternative_scores or {}).items():
+                scores[expr_global_id] = max(scores.get(expr_global_id, 0.0), score)
+    return sorted(scores.keys(), key=lambda expr_global_id: -scores[expr_global_id])
+
+
+# EOF
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# Physics Derivation Graph
+# Ben Payne, 2021
+# https://creativecommons.org/licenses/by/4.0/
+# Attribution 4.0 International (CC BY 4.0)
+
+"""
+Record where the time of each request is spent.
+
+Timings are grouped by category ("route", "database", "subprocess", "sympy")
+and name (e.g., the route "/list_all_symbols" or the program "latex").
+For each name the count, total, maximum, and a histogram of durations are kept.
+
+Within a request, the time spent in each category is also accumulated,
+and the slowest recent requests are kept along with that breakdown,
+so that the nested call that makes a page slow can be identified.
+Timed functions can call each other (validate_step calls read_db),
+so the breakdown of a request can add up to more than its duration.
+
+A request can additionally be profiled with cProfile; see start_profile.
+
+The data is kept in memory per process (each gunicorn worker has its own)
+and is shown on /monitoring/timing.
+
+This module does not import other PDG files, so any of them can import it.
+"""
+
+import collections
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets; the last bucket is everything slower
+histogram_bounds_in_seconds = [0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0]
+
+# timings[category][name] = {"count": int, "total seconds": float,
+#                            "max seconds": float, "histogram": [int]}
+timings = {}  # type: dict
+timings_lock = threading.Lock()
+
+# the time per category of the request being handled by this thread
+current_request = threading.local()
+
+number_of_slow_requests_to_keep = 50
+slowest_requests = []  # type: list
+number_of_profiles_to_keep = 10
+recent_profiles = collections.deque(
+    maxlen=number_of_profiles_to_keep
+)  # type: collections.deque
+
+
+def record_timing(category: str, name: str, seconds: float) -> None:
+    """
+    Args:
+        category: e.g., "database"
+        name: e.g., "read_db"
+        seconds: duration
+    Returns:
+        None
+    Raises:
+
+    >>> record_timing("database", "read_db", 0.002)
+    """
+    # logging turned off because this function gets called a lot!
+    # logger.info("[trace]")
+    bucket_indx = len(histogram_bounds_in_seconds)
+    for indx, bound in enumerate(histogram_bounds_in_seconds):
+        if seconds <= bound:
+            bucket_indx = indx
+            break
+    with timings_lock:
+        entry = timings.setdefault(category, {}).setdefault(
+            name,
+            {
+                "count": 0,
+                "total seconds": 0.0,
+                "max seconds": 0.0,
+                "histogram": [0] * (len(histogram_bounds_in_seconds) + 1),
+            },
+        )
+        entry["count"] += 1
+        entry["total seconds"] += seconds
+        entry["max seconds"] = max(entry["max seconds"], seconds)
+        entry["histogram"][bucket_indx] += 1
+
+    seconds_per_category = getattr(current_request, "seconds per category", None)
+    if (seconds_per_category is not None) and (category != "route"):
+        key = category + ": " + name
+        seconds_per_category[key] = seconds_per_category.get(key, 0.0) + seconds
+    return
+
+
+def timed(category: str, name: str = ""):
+    """
+    decorator; record the duration of every call of the function
+
+    >>> @timed("database")
+    ... def read_db(path_to_db):
+    ...     pass
+    """
+
+    def decorator(function_to_time):
+        name_of_timing = name or function_to_time.__name__
+
+        @functools.wraps(function_to_time)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function_to_time(*args, **kwargs)
+            finally:
+                record_timing(
+                    category, name_of_timing, time.perf_counter() - start_time
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def run_subprocess(list_of_args: list, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run, timed by the name of the program
+
+    >>> run_subprocess(["dot", "-Tpng", "tmp.dot", "-otmp.png"], timeout=30)
+    """
+    # logger.info("[trace]")
+    start_time = time.perf_counter()
+    try:
+        return subprocess.run(list_of_args, **kwargs)
+    finally:
+        record_timing(
+            "subprocess", str(list_of_args[0]), time.perf_counter() - start_time
+        )
+
+
+def start_request() -> None:
+    """
+    called before each request; see end_request
+
+    >>> start_request()
+    """
+    # logger.info("[trace]")
+    setattr(current_request, "seconds per category", {})
+    return
+
+
+def end_request(route: str, seconds: float) -> None:
+    """
+    Record the latency of the route and keep the request
+    if it is one of the slowest recent requests.
+
+    Args:
+        route: the URL rule, e.g. "/review_derivation/<deriv_id>/"
+        seconds: duration of the request
+    Returns:
+        None
+    Raises:
+
+    >>> end_request("/list_all_symbols", 0.4)
+    """
+    # logger.info("[trace]")
+    record_timing("route", route, seconds)
+    seconds_per_category = getattr(current_request, "seconds per category", None) or {}
+    setattr(current_request, "seconds per category", None)
+    with timings_lock:
+        if (len(slowest_requests) < number_of_slow_requests_to_keep) or (
+            seconds > slowest_requests[-1]["seconds"]
+        ):
+            slowest_requests.append(
+                {
+                    "route": route,
+                    "seconds": seconds,
+                    "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "seconds per category": sorted(
+                        seconds_per_category.items(), key=lambda x: -x[1]
+                    ),
+                }
+            )
+            slowest_requests.sort(key=lambda x: -x["seconds"])
+            del slowest_requests[number_of_slow_requests_to_keep:]
+    return
+
+
+def start_profile():
+    """
+    Returns:
+        profiler, or None if this thread is already being profiled
+    Raises:
+
+    >>> profiler = start_profile()
+    """
+    # logger.info("[trace]")
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as err:  # another profiler is active
+        logger.debug("unable to profile request: " + str(err))
+        return None
+    return profiler
+
+
+def end_profile(profiler, route: str, number_of_lines: int = 40) -> None:
+    """
+    Keep the functions with the largest cumulative time; see recent_profiles
+
+    >>> end_profile(profiler, "/list_all_symbols")
+    """
+    # logger.info("[trace]")
+    profiler.disable()
+    stats_stream = io.StringIO()
+    pstats.Stats(profiler, stream=stats_stream).sort_stats("cumulative").print_stats(
+        number_of_lines
+    )
+    with timings_lock:
+        recent_profiles.appendleft(
+            {
+                "route": route,
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "stats": stats_stream.getvalue(),
+            }
+        )
+    return
+
+
+def timing_report() -> dict:
+    """
+    for the monitoring page
+
+    Returns:
+        report = {"histogram bounds": list,
+                  "timings": {category: [(name, entry)]}, slowest first by total
+                  "slowest requests": list,
+                  "recent profiles": list}
+    Raises:
+
+    >>> timing_report()
+    """
+    # logger.info("[trace]")
+    with timings_lock:
+        report = {
+            "histogram bounds": [str(x) for x in histogram_bounds_in_seconds]
+            + ["more"],
+            "timings": {},
+            "slowest requests": list(slowest_requests),
+            "recent profiles": list(recent_profiles),
+        }  # type: dict
+        for category, entries in timings.items():
+            report["timings"][category] = sorted(
+                [
+                    (name, dict(entry, histogram=list(entry["histogram"])))
+                    for name, entry in entries.items()
+                ],
+                key=lambda x: -x[1]["total seconds"],
+            )
+    return report
+
+
+# EOF
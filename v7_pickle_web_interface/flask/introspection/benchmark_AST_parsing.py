@@ -0,0 +1,72 @@
+"""
+compare the time to build Sympy expressions from the AST strings in data.json
+using the parser in latex_to_sympy against the eval used previously
+
+python3 benchmark_AST_parsing.py
+"""
+import json
+import time
+import latex_to_sympy
+from latex_to_sympy import get_sympy_expr_from_AST_str
+
+with open('data.json') as json_file:
+    dat = json.load(json_file)
+
+list_of_ast_str = [expr_dict['AST'] for expr_dict in dat['expressions'].values() if len(expr_dict['AST'].strip()) > 0]
+
+
+def get_sympy_expr_from_AST_str_with_eval(ast_str):
+    """
+    the previous implementation, without the cache
+    """
+    ast_str = ast_str.replace("Function", "sympy.Function")
+    ast_str = ast_str.replace("Derivative", "sympy.Derivative")
+    ast_str = ast_str.replace("Rational", "sympy.Rational")
+    ast_str = ast_str.replace("Abs", "sympy.Abs")
+    ast_str = ast_str.replace("Float", "sympy.Float")
+    ast_str = ast_str.replace("exp", "sympy.exp")
+    ast_str = ast_str.replace("log", "sympy.log")
+    ast_str = ast_str.replace("cos", "sympy.cos")
+    ast_str = ast_str.replace("sin", "sympy.sin")
+    ast_str = ast_str.replace("Equality", "sympy.Equality")
+    ast_str = ast_str.replace("Integer", "sympy.Integer")
+    ast_str = ast_str.replace("Add", "sympy.Add")
+    ast_str = ast_str.replace("Symbol", "sympy.Symbol")
+    ast_str = ast_str.replace("Mul", "sympy.Mul")
+    ast_str = ast_str.replace("Pow", "sympy.Pow")
+    ast_str = ast_str.replace("Integral", "sympy.Integral")
+    ast_str = ast_str.replace("Tuple", "sympy.Tuple")
+    return eval(ast_str, vars(latex_to_sympy))
+
+
+def time_all(function_to_time):
+    number_of_failures = 0
+    start_time = time.perf_counter()
+    for ast_str in list_of_ast_str:
+        try:
+            function_to_time(ast_str)
+        except Exception:
+            number_of_failures += 1
+    return time.perf_counter() - start_time, number_of_failures
+
+
+# Sympy caches constructor results, so each approach is run twice
+for attempt in ['first pass', 'second pass']:
+    eval_seconds, eval_failures = time_all(get_sympy_expr_from_AST_str_with_eval)
+    latex_to_sympy.AST_intern_table.clear()
+    parser_seconds, parser_failures = time_all(get_sympy_expr_from_AST_str.__wrapped__)
+    interned_seconds, _ = time_all(get_sympy_expr_from_AST_str.__wrapped__)
+    print(attempt + ': ' + str(len(list_of_ast_str)) + ' AST strings')
+    print('  eval:                       %.3f s, %d failed' % (eval_seconds, eval_failures))
+    print('  parser, empty intern table: %.3f s, %d failed' % (parser_seconds, parser_failures))
+    print('  parser, full intern table:  %.3f s' % interned_seconds)
+
+number_of_differences = 0
+for ast_str in list_of_ast_str:
+    try:
+        if get_sympy_expr_from_AST_str_with_eval(ast_str) != get_sympy_expr_from_AST_str(ast_str):
+            number_of_differences += 1
+            print('differs: ' + ast_str)
+    except Exception:
+        pass
+print(str(number_of_differences) + ' expressions differ')
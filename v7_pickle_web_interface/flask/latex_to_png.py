@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+
+# Physics Derivation Graph
+# Ben Payne, 2021
+# https://creativecommons.org/licenses/by/4.0/
+# Attribution 4.0 International (CC BY 4.0)
+
+"""
+Render Latex to PNG using latex and dvipng.
+
+Rendered PNGs are stored in a content-addressed cache: the file name is
+the md5 of the .tex source, so the same expression is only rendered once
+no matter how many pages or PNG names refer to it.
+The cache has a size limit; the least recently used PNGs are removed first.
+
+Each render runs latex and dvipng in its own temporary folder
+(passed as cwd to subprocess) so the working directory of the web
+application is never changed and renders can run concurrently.
+At most max_concurrent_renders renders run at once, and concurrent requests
+for the same .tex source wait on a single render.
+Expressions that miss the cache are rendered in batches, one page per expression,
+so that N expressions do not cost N launches of latex and dvipng.
+
+The width and height of each PNG copied out of the cache are recorded in a
+sidecar SQLite database along with the MD5 of the PNG content,
+so that pages needing the size of a PNG do not have to decode it.
+
+this module relies on latex and dvipng being available on the command line
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import struct
+from subprocess import PIPE  # https://docs.python.org/3/library/subprocess.html
+import tempfile
+import threading
+
+import instrumentation  # a PDG file
+
+logger = logging.getLogger(__name__)
+
+proc_timeout = 30
+
+render_cache_folder = "/home/appuser/app/static/render_cache/"
+# once the cache exceeds this size, least recently used PNGs are removed
+render_cache_max_bytes = 200 * 1024 * 1024
+
+# latex and dvipng are separate processes, so threads that wait on them
+# are sufficient to bound the number of concurrent renders
+max_concurrent_renders = 4
+# number of expressions rendered by one run of latex and dvipng
+max_batch_size = 50
+
+# sidecar store of PNG width, height, and content hash; see png_dimensions
+path_to_png_metadata_db = "/home/appuser/app/png_metadata.db"
+
+render_executor = {}  # type: dict
+# keys are the md5 of the .tex source; values are futures for renders in progress
+renders_in_progress = {}  # type: dict
+renders_in_progress_lock = threading.Lock()
+
+
+def tex_source_for_expr(input_latex_str: str) -> str:
+    """
+    The same document as compute.create_tex_file_for_expr
+
+    Args:
+        input_latex_str: Latex of the expression, without math delimiters
+    Returns:
+        the content of a .tex file
+    Raises:
+
+    >>> tex_source_for_expr('a = b')
+    """
+    # logger.info("[trace]")
+    tex_str = "\\documentclass[12pt]{article}\n"
+    tex_str += "\\thispagestyle{empty}\n"
+    # if a package is not available, latex pauses while waiting for user input;
+    # see the comments in compute.create_tex_file_for_expr
+    tex_str += "\\usepackage{amsmath}\n"
+    tex_str += "\\begin{document}\n"
+    tex_str += "\\huge{\n"
+    tex_str += "$" + input_latex_str + "$\n"
+    tex_str += "}\n"
+    tex_str += "\\end{document}\n"
+    return tex_str
+
+
+def md5_of_tex_source(tex_source: str) -> str:
+    """
+    >>> md5_of_tex_source(tex_source_for_expr('a = b'))
+    """
+    return hashlib.md5(tex_source.encode("utf-8")).hexdigest()
+
+
+def path_in_render_cache(tex_md5: str) -> str:
+    """
+    >>> path_in_render_cache("0cc175b9c0f1b6a831c399e269772661")
+    '/home/appuser/app/static/render_cache/0cc175b9c0f1b6a831c399e269772661.png'
+    """
+    return render_cache_folder + tex_md5 + ".png"
+
+
+def tex_source_for_batch(list_of_latex: list) -> str:
+    r"""
+    One page per expression, using the same preamble as tex_source_for_expr.
+    \pagestyle{empty} removes the page number from every page,
+    so each page cropped with "dvipng -T tight" matches a single-expression render.
+
+    Args:
+        list_of_latex: list of Latex strings
+    Returns:
+        the content of a .tex file
+    Raises:
+
+    >>> tex_source_for_batch(['a = b', 'c = d'])
+    """
+    # logger.info("[trace]")
+    tex_str = "\\documentclass[12pt]{article}\n"
+    tex_str += "\\pagestyle{empty}\n"
+    tex_str += "\\usepackage{amsmath}\n"
+    tex_str += "\\begin{document}\n"
+    for input_latex_str in list_of_latex:
+        tex_str += "\\huge{\n"
+        tex_str += "$" + input_latex_str + "$\n"
+        tex_str += "}\n"
+        tex_str += "\\newpage\n"
+    tex_str += "\\end{document}\n"
+    return tex_str
+
+
+def run_latex_and_dvipng(list_of_latex: list, list_of_png_paths: list) -> None:
+    """
+    Render every expression with a single latex run and a single dvipng run,
+    since starting TeX costs more than typesetting one expression.
+    Runs in a temporary folder; page N of the output is moved to list_of_png_paths[N-1].
+
+    Args:
+        list_of_latex: list of Latex strings
+        list_of_png_paths: where each PNG is placed
+    Returns:
+        None
+    Raises:
+        Exception if latex or dvipng fail
+
+    >>> run_latex_and_dvipng(['a = b'], ['/tmp/a.png'])
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    tmp_latex_folder = tempfile.mkdtemp(prefix="tmp_latex_folder_")
+    try:
+        with open(os.path.join(tmp_latex_folder, "lat.tex"), "w") as lat_file:
+            lat_file.write(tex_source_for_batch(list_of_latex))
+
+        process = instrumentation.run_subprocess(
+            ["latex", "-halt-on-error", "lat.tex"],
+            stdout=PIPE,
+            stderr=PIPE,
+            # TeX startup dominates, so a batch takes little longer than one expression
+            timeout=proc_timeout + len(list_of_latex),
+            cwd=tmp_latex_folder,
+        )
+        latex_stdout = process.stdout.decode("utf-8")
+        logger.debug("latex std out:" + str(latex_stdout))
+        logger.debug("latex std err:" + process.stderr.decode("utf-8"))
+
+        if "Text line contains an invalid character" in latex_stdout:
+            logger.error("tex input contains invalid charcter")
+            raise Exception("no png generated due to invalid character in tex input.")
+        if process.returncode != 0:
+            raise Exception("latex failed; " + latex_stdout[-500:])
+
+        # dvipng file.dvi -T tight -o file%d.png
+        # writes one PNG per page: lat1.png, lat2.png, ...
+        process = instrumentation.run_subprocess(
+            ["dvipng", "lat.dvi", "-T", "tight", "-o", "lat%d.png"],
+            stdout=PIPE,
+            stderr=PIPE,
+            timeout=proc_timeout + len(list_of_latex),
+            cwd=tmp_latex_folder,
+        )
+        png_stdout = process.stdout.decode("utf-8")
+        png_stderr = process.stderr.decode("utf-8")
+        if (len(png_stdout) > 0) and ("This is dvipng" not in png_stdout):
+            logger.debug("png std out %s", png_stdout)
+        if len(png_stderr) > 0:
+            logger.debug("png std err %s", png_stderr)
+
+        number_of_pages = len(
+            [
+                file_name
+                for file_name in os.listdir(tmp_latex_folder)
+                if file_name.startswith("lat") and file_name.endswith(".png")
+            ]
+        )
+        if number_of_pages == 0:
+            logger.error("PNG creation failed")
+            raise Exception("no PNG created. Check 'usepackage' in latex")
+        # an expression that spills onto a second page would shift every later
+        # page onto the wrong expression, so a batch must have one page per expression.
+        # A single expression keeps its first page, as a single render would.
+        if (len(list_of_latex) > 1) and (number_of_pages != len(list_of_latex)):
+            logger.error(
+                str(number_of_pages)
+                + " pages for "
+                + str(len(list_of_latex))
+                + " expressions"
+            )
+            raise Exception(
+                "batch produced "
+                + str(number_of_pages)
+                + " pages for "
+                + str(len(list_of_latex))
+                + " expressions"
+            )
+
+        for page_index, path_to_png in enumerate(list_of_png_paths):
+            page_png = os.path.join(
+                tmp_latex_folder, "lat" + str(page_index + 1) + ".png"
+            )
+            # move then rename so that a partially written PNG is never served
+            shutil.move(page_png, path_to_png + "." + trace_id)
+            os.replace(path_to_png + "." + trace_id, path_to_png)
+    finally:
+        shutil.rmtree(tmp_latex_folder, ignore_errors=True)
+
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+def render_batch_and_store_in_cache(list_of_renders: list) -> None:
+    """
+    body of a render task; see request_renders
+
+    If latex fails for the batch, or an expression does not fit on one page,
+    the batch is split in half and each half is rendered separately,
+    so one such expression does not prevent the others from being rendered.
+
+    Args:
+        list_of_renders: list of (input_latex_str, tex_md5, future)
+    Returns:
+        None; the result or exception is set on each future
+    Raises:
+
+    >>> render_batch_and_store_in_cache([('a = b', tex_md5, future)])
+    """
+    # logger.info("[trace]")
+    try:
+        run_latex_and_dvipng(
+            [input_latex_str for (input_latex_str, _, _) in list_of_renders],
+            [path_in_render_cache(tex_md5) for (_, tex_md5, _) in list_of_renders],
+        )
+    except Exception as err:
+        if len(list_of_renders) > 1:
+            half = len(list_of_renders) // 2
+            render_batch_and_store_in_cache(list_of_renders[:half])
+            render_batch_and_store_in_cache(list_of_renders[half:])
+            return
+        input_latex_str, tex_md5, future = list_of_renders[0]
+        with renders_in_progress_lock:
+            renders_in_progress.pop(tex_md5, None)
+        future.set_exception(err)
+        return
+
+    for input_latex_str, tex_md5, future in list_of_renders:
+        with renders_in_progress_lock:
+            renders_in_progress.pop(tex_md5, None)
+        future.set_result(path_in_render_cache(tex_md5))
+    enforce_render_cache_size_limit()
+    return
+
+
+def request_renders(list_of_latex: list) -> dict:
+    """
+    Start rendering each expression unless its PNG is cached or already being rendered.
+
+    Expressions that need rendering are grouped into batches (see run_latex_and_dvipng);
+    the batches are spread over max_concurrent_renders threads.
+
+    Args:
+        list_of_latex: list of Latex strings
+    Returns:
+        dict where the keys are the Latex strings and the values are
+        concurrent.futures.Future whose result is the path to the cached PNG
+    Raises:
+
+    >>> request_renders(['a = b'])['a = b'].result()
+    """
+    # logger.info("[trace]")
+    futures = {}  # type: dict
+    list_of_renders = []
+    for input_latex_str in list_of_latex:
+        if input_latex_str in futures.keys():
+            continue
+        tex_md5 = md5_of_tex_source(tex_source_for_expr(input_latex_str))
+        path_to_png = path_in_render_cache(tex_md5)
+
+        if os.path.isfile(path_to_png):
+            try:
+                # the modification time is used to find the least recently used PNGs
+                os.utime(path_to_png)
+            except FileNotFoundError:  # evicted by another worker
+                pass
+            else:
+                future = concurrent.futures.Future()  # type: concurrent.futures.Future
+                future.set_result(path_to_png)
+                futures[input_latex_str] = future
+                continue
+
+        with renders_in_progress_lock:
+            if tex_md5 not in renders_in_progress.keys():
+                future = concurrent.futures.Future()
+                renders_in_progress[tex_md5] = future
+                list_of_renders.append((input_latex_str, tex_md5, future))
+            futures[input_latex_str] = renders_in_progress[tex_md5]
+
+    if len(list_of_renders) > 0:
+        with renders_in_progress_lock:
+            if "executor" not in render_executor.keys():
+                os.makedirs(render_cache_folder, exist_ok=True)
+                render_executor["executor"] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_concurrent_renders, thread_name_prefix="pdg_render"
+                )
+        # enough batches to use every thread, but no batch larger than max_batch_size
+        batch_size = min(
+            max_batch_size, -(-len(list_of_renders) // max_concurrent_renders)
+        )
+        for start_index in range(0, len(list_of_renders), batch_size):
+            render_executor["executor"].submit(
+                render_batch_and_store_in_cache,
+                list_of_renders[start_index : start_index + batch_size],
+            )
+    return futures
+
+
+def enforce_render_cache_size_limit() -> int:
+    """
+    Remove the least recently used PNGs until the cache is under render_cache_max_bytes
+
+    Returns:
+        number of files removed
+    Raises:
+
+    >>> enforce_render_cache_size_limit()
+    0
+    """
+    # logger.info("[trace]")
+    list_of_entries = []
+    total_bytes = 0
+    for entry in os.scandir(render_cache_folder):
+        if entry.is_file() and entry.name.endswith(".png"):
+            file_stat = entry.stat()
+            list_of_entries.append((file_stat.st_mtime, file_stat.st_size, entry.path))
+            total_bytes += file_stat.st_size
+
+    number_removed = 0
+    if total_bytes > render_cache_max_bytes:
+        for mtime, size, path_to_png in sorted(list_of_entries):
+            try:
+                os.remove(path_to_png)
+            except FileNotFoundError:  # removed by another worker
+                pass
+            total_bytes -= size
+            number_removed += 1
+            if total_bytes <= render_cache_max_bytes:
+                break
+        logger.debug("removed " + str(number_removed) + " PNGs from render cache")
+    return number_removed
+
+
+def copy_to_destination(path_to_cached_png: str, path_to_png: str) -> None:
+    """
+    copy then rename so that a partially written PNG is never served;
+    the dimensions of the PNG are recorded in the sidecar store
+
+    >>> copy_to_destination(path_in_render_cache(tex_md5), "/tmp/a.png")
+    """
+    tmp_path = path_to_png + "." + str(random.randint(1000000, 9999999))
+    shutil.copy(path_to_cached_png, tmp_path)
+    os.replace(tmp_path, path_to_png)
+    try:
+        record_png_metadata(path_to_png)
+    except Exception as err:  # the PNG is still usable without the metadata
+        logger.error("failed to record metadata of " + path_to_png + ": " + str(err))
+    return
+
+
+def dimensions_from_png_header(png_header: bytes) -> tuple:
+    """
+    The width and height are the first fields of the IHDR chunk,
+    which the PNG specification requires to directly follow the signature,
+    so the PNG does not need to be decoded.
+    http://www.libpng.org/pub/png/spec/1.2/PNG-Chunks.html#C.IHDR
+
+    Args:
+        png_header: at least the first 24 bytes of a PNG file
+    Returns:
+        (width, height) in pixels
+    Raises:
+        Exception if the bytes are not the start of a PNG
+
+    >>> dimensions_from_png_header(open("a.png", "rb").read(24))
+    (120, 40)
+    """
+    # logger.info("[trace]")
+    if (len(png_header) < 24) or (not png_header.startswith(b"\x89PNG\r\n\x1a\n")):
+        logger.error("not a PNG")
+        raise Exception("not a PNG")
+    width, height = struct.unpack(">II", png_header[16:24])
+    return width, height
+
+
+def connect_to_png_metadata_db() -> sqlite3.Connection:
+    """
+    >>> connect_to_png_metadata_db()
+    """
+    # logger.info("[trace]")
+    conn = sqlite3.connect(path_to_png_metadata_db, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS png_metadata ("
+        "path TEXT PRIMARY KEY, width INTEGER, height INTEGER, "
+        "png_md5 TEXT, mtime_ns INTEGER, size INTEGER)"
+    )
+    return conn
+
+
+def record_png_metadata(path_to_png: str) -> tuple:
+    """
+    Args:
+        path_to_png: PNG to record
+    Returns:
+        (width, height) in pixels
+    Raises:
+
+    >>> record_png_metadata("/home/appuser/app/static/0000040490.png")
+    (120, 40)
+    """
+    # logger.info("[trace]")
+    file_stat = os.stat(path_to_png)
+    with open(path_to_png, "rb") as png_file:
+        png_content = png_file.read()
+    width, height = dimensions_from_png_header(png_content[:24])
+    conn = connect_to_png_metadata_db()
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO png_metadata VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    path_to_png,
+                    width,
+                    height,
+                    hashlib.md5(png_content).hexdigest(),
+                    file_stat.st_mtime_ns,
+                    file_stat.st_size,
+                ),
+            )
+    finally:
+        conn.close()
+    return width, height
+
+
+def png_dimensions(path_to_png: str) -> tuple:
+    """
+    The sidecar entry is used if the file has not been modified since it was recorded;
+    otherwise (e.g., the PNG was created by other code) the PNG header is read
+    and the entry is updated.
+
+    Args:
+        path_to_png: PNG file
+    Returns:
+        (width, height) in pixels
+    Raises:
+
+    >>> png_dimensions("/home/appuser/app/static/0000040490.png")
+    (120, 40)
+    """
+    # logger.info("[trace]")
+    file_stat = os.stat(path_to_png)
+    conn = connect_to_png_metadata_db()
+    try:
+        row = conn.execute(
+            "SELECT width, height, mtime_ns, size FROM png_metadata WHERE path=?",
+            (path_to_png,),
+        ).fetchone()
+    finally:
+        conn.close()
+    if (
+        (row is not None)
+        and (row[2] == file_stat.st_mtime_ns)
+        and (row[3] == file_stat.st_size)
+    ):
+        return row[0], row[1]
+    return record_png_metadata(path_to_png)
+
+
+def create_pngs_from_latex(latex_per_png_path: dict) -> dict:
+    """
+    Render several expressions; expressions that are not cached are rendered in batches.
+
+    Args:
+        latex_per_png_path: keys are the path of the PNG to create;
+                            values are the Latex of the expression
+    Returns:
+        errors: keys are the paths of PNGs that could not be created;
+                values are the error message
+    Raises:
+
+    >>> create_pngs_from_latex({"/home/appuser/app/static/a.png": "a = b"})
+    {}
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    futures = request_renders(list(latex_per_png_path.values()))
+
+    errors = {}
+    for path_to_png, input_latex_str in latex_per_png_path.items():
+        try:
+            copy_to_destination(futures[input_latex_str].result(), path_to_png)
+        except Exception as err:
+            logger.error(path_to_png + ": " + str(err))
+            errors[path_to_png] = str(err)
+
+    logger.info("[trace end " + trace_id + "]")
+    return errors
+
+
+# EOF
@@ -19,6 +19,7 @@ from sympy import *  # addresses cosh, sinh, tanh
 from sympy.vector import cross, dot
 from sympy.vector.deloperator import Del
 from sympy.parsing.latex import parse_latex  # type: ignore
+from sympy.parsing.latex.errors import LaTeXParsingError  # type: ignore
 
 # https://docs.sympy.org/latest/modules/physics/units/quantities.html
 from sympy.physics.units import *
@@ -33,16 +34,18 @@ from sympy.physics.quantum.dagger import Dagger
 from sympy.physics.quantum.operator import Operator
 
 from typing import Tuple  # , TextIO
+import ast as python_ast  # "AST" in this module refers to sympy.srepr
+import collections
+import functools
 import logging
+import pickle
 import random
 import re
-import os
-
-# move and copy files
-import shutil
-
-from subprocess import PIPE  # https://docs.python.org/3/library/subprocess.html
-import subprocess  # https://stackoverflow.com/questions/39187886/what-is-the-difference-between-subprocess-popen-and-subprocess-run/39187984
+import sqlite3
+import threading
+import time
+import instrumentation  # a PDG file
+import dot_to_image  # a PDG file
 
 # https://docs.sympy.org/latest/modules/physics/quantum/dagger.html
 from sympy.physics.quantum.dagger import Dagger  # type: ignore
@@ -53,6 +56,18 @@ logger = logging.getLogger(__name__)
 
 proc_timeout = 30
 
+# parse_latex is slow and the same Latex is parsed by many steps and pages,
+# so results are cached per process; see parse_latex_cached
+parse_latex_cache = collections.OrderedDict()  # type: collections.OrderedDict
+parse_latex_cache_max_size = 4096
+parse_latex_cache_lock = threading.Lock()
+parse_latex_cache_statistics = {"hits": 0, "disk hits": 0, "misses": 0}
+# shared by gunicorn workers and kept across restarts; None disables
+path_to_parse_latex_cache_db = "/home/appuser/app/parse_latex_cache.db"
+# once the database has more entries, the least recently used are removed
+parse_latex_cache_db_max_rows = 50000
+timed_parse_latex = instrumentation.timed("sympy", "parse_latex")(parse_latex)
+
 
 # https://pymotw.com/3/doctest/
 # how to use doctest for the entire file:
@@ -64,47 +79,261 @@ proc_timeout = 30
 # doctest.run_docstring_examples(split_expr_into_lhs_rhs, globals(), verbose=True)
 
 
-def create_AST_png_for_latex(expr_latex: str, output_filename: str) -> str:
+def create_AST_png_for_latex(expr_latex: str) -> str:
     """
     for input, assume the latex string has had presentation-related syntax removed
 
-    return the name of the image PNG file
-    >>> create_AST_png_for_latex('a = b','filename')
+    return the name of the image PNG file, relative to static/;
+    the PNG is named by the hash of the DOT, see dot_to_image
+    >>> create_AST_png_for_latex('a = b')
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
 
     try:
-        symp_lat = parse_latex(expr_latex)
+        symp_lat = parse_latex_cached(expr_latex)
     except sympy.SympifyError as err:
         logger.error(err)
         raise Exception("Sympy unable to parse latex: " + expr_latex)
         sympy_lat = ""
     graphviz_of_AST_for_expr = sympy.printing.dot.dotprint(symp_lat)
-    dot_filename = "tmp.dot"
-    with open(dot_filename, "w") as fil:
-        fil.write(graphviz_of_AST_for_expr)
-
-    # neato -Tpng graphviz.dot > /home/appuser/app/static/graphviz.png
-    if not os.path.exists("/home/appuser/app/static/" + output_filename):
-        process = subprocess.run(
-            ["dot", "-Tpng", dot_filename, "-o" + output_filename],
-            stdout=PIPE,
-            stderr=PIPE,
-            timeout=proc_timeout,
-        )
-        neato_stdout = process.stdout.decode("utf-8")
-        if len(neato_stdout) > 0:
-            logger.debug(neato_stdout)
-        neato_stderr = process.stderr.decode("utf-8")
-        if len(neato_stderr) > 0:
-            logger.debug(neato_stderr)
-
-        shutil.move(output_filename, "/home/appuser/app/static/" + output_filename)
+
+    output_filename = dot_to_image.create_image_from_dot(
+        graphviz_of_AST_for_expr, "png", "dot"
+    )
     logger.info("[trace end " + trace_id + "]")
     return output_filename
 
 
+class LatexParseFailed(LaTeXParsingError, sympy.SympifyError):
+    """
+    Raised by parse_latex_cached for Latex that Sympy cannot parse,
+    whether the failure is new or read from the cache.
+    It is a subclass of both exceptions parse_latex raises for invalid Latex,
+    so callers that catch either one also catch this.
+    """
+
+    def __init__(self, message: str):
+        Exception.__init__(self, message)
+        self.message = message
+
+    def __str__(self) -> str:
+        return self.message
+
+
+def connect_to_parse_latex_cache_db() -> sqlite3.Connection:
+    """
+    Entries are tagged with the Sympy version because the pickled expressions
+    may not load in a different version.
+    "last used" is the time of the last write or read; see evict_parse_latex_cache_db
+
+    >>> connect_to_parse_latex_cache_db()
+    """
+    # logger.info("[trace]")
+    conn = sqlite3.connect(path_to_parse_latex_cache_db, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS parse_latex ("
+        "latex TEXT PRIMARY KEY, sympy_version TEXT, pickled_result BLOB, "
+        "last_used REAL NOT NULL DEFAULT 0)"
+    )
+    try:  # databases created before "last used" was added
+        conn.execute(
+            "ALTER TABLE parse_latex ADD COLUMN last_used REAL NOT NULL DEFAULT 0"
+        )
+    except sqlite3.OperationalError:  # duplicate column name
+        pass
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS parse_latex_last_used ON parse_latex (last_used)"
+    )
+    return conn
+
+
+def evict_parse_latex_cache_db(conn: sqlite3.Connection) -> int:
+    """
+    Remove entries of other Sympy versions, then the least recently used entries
+    until at most parse_latex_cache_db_max_rows remain.
+
+    Args:
+        conn: see connect_to_parse_latex_cache_db
+    Returns:
+        number of entries removed
+    Raises:
+
+    >>> evict_parse_latex_cache_db(connect_to_parse_latex_cache_db())
+    0
+    """
+    # logger.info("[trace]")
+    with conn:
+        number_removed = conn.execute(
+            "DELETE FROM parse_latex WHERE sympy_version!=?", (sympy.__version__,)
+        ).rowcount
+        number_of_rows = conn.execute("SELECT COUNT(*) FROM parse_latex").fetchone()[0]
+        if number_of_rows > parse_latex_cache_db_max_rows:
+            number_removed += conn.execute(
+                "DELETE FROM parse_latex WHERE latex IN "
+                "(SELECT latex FROM parse_latex ORDER BY last_used LIMIT ?)",
+                (number_of_rows - parse_latex_cache_db_max_rows,),
+            ).rowcount
+    return number_removed
+
+
+def read_parse_from_disk(latex_expr_str: str):
+    """
+    Args:
+        latex_expr_str: Latex with presentation markings removed
+    Returns:
+        the cached result (see parse_latex_cached), or None
+    Raises:
+
+    >>> read_parse_from_disk("a = b")
+    ('parsed', Eq(a, b))
+    """
+    # logger.info("[trace]")
+    if path_to_parse_latex_cache_db is None:
+        return None
+    try:
+        conn = connect_to_parse_latex_cache_db()
+        try:
+            row = conn.execute(
+                "SELECT pickled_result FROM parse_latex "
+                "WHERE latex=? AND sympy_version=?",
+                (latex_expr_str, sympy.__version__),
+            ).fetchone()
+            if row is not None:
+                with conn:
+                    conn.execute(
+                        "UPDATE parse_latex SET last_used=? WHERE latex=?",
+                        (time.time(), latex_expr_str),
+                    )
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        result = pickle.loads(row[0])
+        if result[0] != "parsed":  # failures were written to disk by older versions
+            return None
+        return result
+    except Exception as err:  # the cache is optional; fall back to parsing
+        logger.debug("unable to read parse_latex cache: " + str(err))
+        return None
+
+
+def write_parse_to_disk(latex_expr_str: str, result: tuple) -> None:
+    """
+    Only successful parses are written; see parse_latex_cached.
+    About one write in parse_latex_cache_max_size also trims the database.
+
+    >>> write_parse_to_disk("a = b", ('parsed', parse_latex("a = b")))
+    """
+    # logger.info("[trace]")
+    if path_to_parse_latex_cache_db is None:
+        return
+    try:
+        pickled_result = pickle.dumps(result)
+        conn = connect_to_parse_latex_cache_db()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO parse_latex VALUES (?, ?, ?, ?)",
+                    (latex_expr_str, sympy.__version__, pickled_result, time.time()),
+                )
+            if random.randint(1, parse_latex_cache_max_size) == 1:
+                evict_parse_latex_cache_db(conn)
+        finally:
+            conn.close()
+    except Exception as err:  # the cache is optional
+        logger.debug("unable to write parse_latex cache: " + str(err))
+    return
+
+
+def parse_latex_cached(latex_expr_str: str):
+    """
+    parse_latex with a bounded least-recently-used cache keyed by the
+    Latex after remove_latex_presention_markings.
+    Misses are looked up in the database at path_to_parse_latex_cache_db
+    before parsing.
+
+    SymPy expressions are immutable, so sharing one object between callers is safe.
+    Latex that Sympy cannot parse (LaTeXParsingError or SympifyError) is cached
+    in this process only, and every lookup raises LatexParseFailed.
+    Other exceptions (e.g. antlr4 missing) are not cached.
+
+    Args:
+        latex_expr_str: Latex
+    Returns:
+        sympy_expr
+    Raises:
+        LatexParseFailed if the Latex cannot be parsed;
+        any other exception parse_latex raises
+
+    >>> parse_latex_cached('a = b')
+    Eq(a, b)
+    """
+    # logging turned off because this function gets called a lot!
+    # logger.info("[trace]")
+    latex_expr_str = remove_latex_presention_markings(latex_expr_str)
+
+    with parse_latex_cache_lock:
+        result = parse_latex_cache.get(latex_expr_str)
+        if result is not None:
+            parse_latex_cache.move_to_end(latex_expr_str)
+            parse_latex_cache_statistics["hits"] += 1
+
+    if result is None:
+        result = read_parse_from_disk(latex_expr_str)
+        if result is not None:
+            with parse_latex_cache_lock:
+                parse_latex_cache_statistics["disk hits"] += 1
+        else:
+            # the lock is not held while parsing so that other threads are not blocked
+            try:
+                result = ("parsed", timed_parse_latex(latex_expr_str))
+            except (LaTeXParsingError, sympy.SympifyError) as err:
+                result = ("failed", type(err).__name__ + ": " + str(err))
+            else:
+                write_parse_to_disk(latex_expr_str, result)
+            with parse_latex_cache_lock:
+                parse_latex_cache_statistics["misses"] += 1
+        with parse_latex_cache_lock:
+            parse_latex_cache[latex_expr_str] = result
+            while len(parse_latex_cache) > parse_latex_cache_max_size:
+                parse_latex_cache.popitem(last=False)
+
+    if result[0] == "failed":
+        raise LatexParseFailed(result[1])
+    return result[1]
+
+
+def parse_latex_cache_info() -> dict:
+    """
+    for the monitoring page
+
+    Returns:
+        counts and hit rates of parse_latex_cached
+        and of get_sympy_expr_from_AST_str
+    Raises:
+
+    >>> parse_latex_cache_info()
+    {'hits': 3, 'disk hits': 1, 'misses': 1, 'hit rate': 0.8, 'size': 2, ...}
+    """
+    # logger.info("[trace]")
+    with parse_latex_cache_lock:
+        cache_info = dict(parse_latex_cache_statistics)  # type: dict
+        cache_info["size"] = len(parse_latex_cache)
+    cache_info["max size"] = parse_latex_cache_max_size
+    number_of_hits = cache_info["hits"] + cache_info["disk hits"]
+    cache_info["hit rate"] = number_of_hits / max(
+        1, number_of_hits + cache_info["misses"]
+    )
+    ast_cache_info = get_sympy_expr_from_AST_str.cache_info()
+    cache_info["AST hits"] = ast_cache_info.hits
+    cache_info["AST misses"] = ast_cache_info.misses
+    cache_info["AST hit rate"] = ast_cache_info.hits / max(
+        1, ast_cache_info.hits + ast_cache_info.misses
+    )
+    return cache_info
+
+
 def list_symbols_used_in_latex_from_sympy(expr_latex: str) -> list:
     """
     input: latex expression as string
@@ -119,7 +348,7 @@ def list_symbols_used_in_latex_from_sympy(expr_latex: str) -> list:
     list_of_symbols = []
     logger.debug("expr_latex =" + expr_latex)
     try:
-        symp_lat = parse_latex(expr_latex)
+        symp_lat = parse_latex_cached(expr_latex)
     except sympy.SympifyError as err:
         logger.error(err)
         raise Exception("Sympy unable to parse latex (1): " + expr_latex)
@@ -135,52 +364,300 @@ def list_symbols_used_in_latex_from_sympy(expr_latex: str) -> list:
     return list_of_symbols
 
 
+# an AST string is the output of sympy.srepr, e.g. "Pow(Symbol('pdg9139'), Integer(2))"
+AST_token_pattern = re.compile(
+    r"\s*(?:(?P<string>'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")"
+    r"|(?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)"
+    r"|(?P<name>[A-Za-z_][A-Za-z0-9_]*)"
+    r"|(?P<punctuation>[(),=*\[\]]))"
+)
+
+# Sympy constructors sympify their arguments, and sympify evaluates strings.
+# Only these constructors may be given a string
+AST_names_taking_strings = [
+    "Symbol",
+    "Dummy",
+    "Wild",
+    "Function",
+    "Float",
+    "Str",
+    "Bra",
+    "Ket",
+    "Operator",
+]
+# functions (rather than Sympy classes) that appear in the AST of expressions
+AST_functions = {"cross": cross, "dot": dot}
+
+# keys are the text of a subtree, e.g. "Symbol('pdg9139')"; the same symbols and
+# numbers appear in many expressions, so each is only built once
+AST_intern_table = {}  # type: dict
+AST_intern_table_max_size = 100000
+
+
+@functools.lru_cache(maxsize=1)
+def get_names_allowed_in_AST() -> dict:
+    """
+    Only Sympy classes (e.g., Symbol, Add), Sympy objects (e.g., pi, meter),
+    and AST_functions can be referenced by an AST string,
+    so parsing cannot run arbitrary code.
+
+    Returns:
+        {name: Sympy class or object}
+    Raises:
+
+    >>> get_names_allowed_in_AST()["Integer"]
+    <class 'sympy.core.numbers.Integer'>
+    """
+    # logger.info("[trace]")
+    names_allowed_in_AST = {}
+    # the names imported by this module (e.g., Ket, meter) are allowed, but the
+    # top-level Sympy names take precedence; "Tuple" is typing.Tuple in this module
+    for namespace in [globals(), vars(sympy)]:
+        for name, obj in namespace.items():
+            if (isinstance(obj, type) and issubclass(obj, sympy.Basic)) or isinstance(
+                obj, sympy.Basic
+            ):
+                names_allowed_in_AST[name] = obj
+    names_allowed_in_AST.update(AST_functions)
+    return names_allowed_in_AST
+
+
+def tokens_of_AST_str(ast_str: str) -> list:
+    """
+    Args:
+        ast_str: output of sympy.srepr
+    Returns:
+        list_of_tokens: each token is (kind, text, start, end),
+                        where start and end are character positions in ast_str
+    Raises:
+        Exception if ast_str contains anything else
+
+    >>> tokens_of_AST_str("Integer(2)")
+    [('name', 'Integer', 0, 7), ('punctuation', '(', 7, 8), ('number', '2', 8, 9), ('punctuation', ')', 9, 10)]
+    """
+    # logger.info("[trace]")
+    list_of_tokens = []
+    position = 0
+    ast_str = ast_str.rstrip()
+    while position < len(ast_str):
+        match = AST_token_pattern.match(ast_str, position)
+        kind = None if match is None else match.lastgroup
+        if (match is None) or (kind is None):
+            raise Exception(
+                "unexpected character at position "
+                + str(position)
+                + " of AST "
+                + ast_str
+            )
+        list_of_tokens.append(
+            (kind, match.group(kind), match.start(kind), match.end(kind))
+        )
+        position = match.end()
+    return list_of_tokens
+
+
+def contains_string(value) -> bool:
+    """
+    >>> contains_string([Integer(1), "x"])
+    True
+    """
+    # logger.info("[trace]")
+    if isinstance(value, str):
+        return True
+    if isinstance(value, list):
+        return any(contains_string(element) for element in value)
+    return False
+
+
+def parse_AST_value(
+    ast_str: str, list_of_tokens: list, indx: int, matching_paren: dict
+):
+    """
+    Recursive descent parser for the output of sympy.srepr
+
+    Args:
+        ast_str: output of sympy.srepr
+        list_of_tokens: see tokens_of_AST_str
+        indx: index in list_of_tokens of the first token of the value
+        matching_paren: {index of "(": index of the matching ")"}
+    Returns:
+        value: Sympy object, class, or Python literal
+        indx: index of the token after the value
+    Raises:
+        Exception for names that are not in get_names_allowed_in_AST
+
+    >>> parse_AST_value("Integer(2)", tokens_of_AST_str("Integer(2)"), 0, {1: 3})
+    (2, 4)
+    """
+    # logging turned off because this function gets called a lot!
+    # logger.info("[trace]")
+    if indx >= len(list_of_tokens):
+        raise Exception("AST ended unexpectedly: " + ast_str)
+    kind, text, start, end = list_of_tokens[indx]
+
+    if kind == "string":
+        # a Python string literal; literal_eval does not run code
+        return python_ast.literal_eval(text), indx + 1
+    if kind == "number":
+        if ("." in text) or ("e" in text) or ("E" in text):
+            return float(text), indx + 1
+        return int(text), indx + 1
+    if text == "(":
+        value, close_indx = parse_AST_product(
+            ast_str, list_of_tokens, indx + 1, matching_paren
+        )
+        if close_indx != matching_paren[indx]:
+            raise Exception("unbalanced parentheses in AST " + ast_str)
+        return value, close_indx + 1
+    if text == "[":
+        list_of_values = []
+        indx += 1
+        while list_of_tokens[indx][1] != "]":
+            value, indx = parse_AST_product(
+                ast_str, list_of_tokens, indx, matching_paren
+            )
+            list_of_values.append(value)
+            if list_of_tokens[indx][1] == ",":
+                indx += 1
+        return list_of_values, indx + 1
+    if kind != "name":
+        raise Exception("unexpected " + text + " in AST " + ast_str)
+
+    if text in ["True", "False", "None"]:
+        return {"True": True, "False": False, "None": None}[text], indx + 1
+    if text not in get_names_allowed_in_AST().keys():
+        raise Exception(text + " is not a Sympy class in AST " + ast_str)
+    value = get_names_allowed_in_AST()[text]
+    name = text
+    indx += 1
+
+    # a call; "Function('f')(Symbol('x'))" is a call of a call
+    while (indx < len(list_of_tokens)) and (list_of_tokens[indx][1] == "("):
+        close_indx = matching_paren[indx]
+        subtree_str = ast_str[start : list_of_tokens[close_indx][3]]
+        if subtree_str in AST_intern_table.keys():
+            value = AST_intern_table[subtree_str]
+            indx = close_indx + 1
+            continue
+
+        list_of_args = []
+        dict_of_kwargs = {}
+        indx += 1
+        while indx < close_indx:
+            if (list_of_tokens[indx][0] == "name") and (
+                list_of_tokens[indx + 1][1] == "="
+            ):
+                keyword = list_of_tokens[indx][1]
+                kwarg, indx = parse_AST_value(
+                    ast_str, list_of_tokens, indx + 2, matching_paren
+                )
+                if not isinstance(kwarg, (bool, int, type(None))):
+                    raise Exception(
+                        "keyword " + keyword + " is not a literal in AST " + ast_str
+                    )
+                dict_of_kwargs[keyword] = kwarg
+            else:
+                arg, indx = parse_AST_product(
+                    ast_str, list_of_tokens, indx, matching_paren
+                )
+                list_of_args.append(arg)
+            if list_of_tokens[indx][1] == ",":
+                indx += 1
+        if indx != close_indx:
+            raise Exception("unbalanced arguments in AST " + ast_str)
+
+        if not (
+            (isinstance(value, type) and issubclass(value, sympy.Basic))
+            or (name in AST_functions.keys())
+        ):
+            raise Exception(name + " is not callable in AST " + ast_str)
+        if (name not in AST_names_taking_strings) and contains_string(list_of_args):
+            raise Exception(name + " cannot take a string in AST " + ast_str)
+        value = value(*list_of_args, **dict_of_kwargs)
+        # only the first call of "Function('f')(...)" may take strings
+        name = ""
+
+        if len(AST_intern_table) >= AST_intern_table_max_size:
+            AST_intern_table.clear()
+        AST_intern_table[subtree_str] = value
+        indx = close_indx + 1
+    return value, indx
+
+
+def parse_AST_product(
+    ast_str: str, list_of_tokens: list, indx: int, matching_paren: dict
+):
+    """
+    Some AST strings were edited by hand and use "*" rather than Mul,
+    e.g. "Bra('pdg4679')*Ket('pdg2090')".
+    The Python operator is used because for quantum objects it differs from Mul.
+
+    Args and Returns: see parse_AST_value
+    Raises:
+
+    >>> parse_AST_product("Integer(2)*Integer(3)", tokens_of_AST_str("Integer(2)*Integer(3)"), 0, {1: 3, 6: 8})
+    (6, 9)
+    """
+    # logging turned off because this function gets called a lot!
+    # logger.info("[trace]")
+    value, indx = parse_AST_value(ast_str, list_of_tokens, indx, matching_paren)
+    while (indx < len(list_of_tokens)) and (list_of_tokens[indx][1] == "*"):
+        factor, indx = parse_AST_value(
+            ast_str, list_of_tokens, indx + 1, matching_paren
+        )
+        # "'a' * 1000000000" would be a string of 1 GB
+        if isinstance(value, (str, list)) or isinstance(factor, (str, list)):
+            raise Exception("only Sympy objects can be multiplied in AST " + ast_str)
+        value = value * factor
+    return value, indx
+
+
+# the same expression is used by many steps, so the parsed result is cached.
+# SymPy expressions are immutable, so sharing one object between callers is safe
+@functools.lru_cache(maxsize=4096)
+@instrumentation.timed("sympy")
 def get_sympy_expr_from_AST_str(ast_str: str):
     """
-    returns a sympy expression as a string intended for evaluation
+    Build the Sympy expression described by an AST string (the output of sympy.srepr).
+    The string is parsed rather than evaluated because the AST is editable by users;
+    see parse_AST_value.
+
+    Results are cached by ast_str; see get_sympy_expr_from_AST_str.cache_info()
+    For a comparison with the previous eval-based implementation,
+    see introspection/benchmark_AST_parsing.py
 
     >>> get_sympy_expr_from_AST_str("Pow(Symbol('pdg9139'), Integer(2))")
-    "sympy.Pow(sympy.Symbol('pdg9139'), sympy.Integer(2))"
+    pdg9139**2
 
     >>> get_sympy_expr_from_AST_str("Mul(Symbol('pdg1939'), Pow(Mul(Integer(2), Symbol('pdg9139')), Integer(-1)))")
-    "sympy.Mul(sympy.Symbol('pdg1939'), sympy.Pow(sympy.Mul(sympy.Integer(2), sympy.Symbol('pdg9139')), sympy.Integer(-1)))"
+    pdg1939/(2*pdg9139)
 
     """
     # logging turned off because this function gets called a lot!
     # logger.info("[trace]")
-    orignal_ast_str = ast_str
-
-    ast_str = ast_str.replace("Function", "sympy.Function")
-    ast_str = ast_str.replace("Derivative", "sympy.Derivative")
-    ast_str = ast_str.replace("Rational", "sympy.Rational")
-    ast_str = ast_str.replace("Abs", "sympy.Abs")
-    ast_str = ast_str.replace("Float", "sympy.Float")
-    ast_str = ast_str.replace("exp", "sympy.exp")
-    ast_str = ast_str.replace(
-        "log", "sympy.log"
-    )  # natural log -- https://docs.sympy.org/latest/tutorial/simplification.html#exponentials-and-logarithms
-    ast_str = ast_str.replace("cos", "sympy.cos")
-    ast_str = ast_str.replace("sin", "sympy.sin")
-    ast_str = ast_str.replace("Equality", "sympy.Equality")
-    ast_str = ast_str.replace("Integer", "sympy.Integer")
-    ast_str = ast_str.replace("Add", "sympy.Add")
-    ast_str = ast_str.replace("Symbol", "sympy.Symbol")
-    ast_str = ast_str.replace("Mul", "sympy.Mul")
-    ast_str = ast_str.replace("Pow", "sympy.Pow")
-    ast_str = ast_str.replace("Integral", "sympy.Integral")
-    ast_str = ast_str.replace("Tuple", "sympy.Tuple")
-
     try:
-        return eval(ast_str)
+        list_of_tokens = tokens_of_AST_str(ast_str)
+        matching_paren = {}
+        list_of_open_indx = []
+        for indx, token in enumerate(list_of_tokens):
+            if token[1] == "(":
+                list_of_open_indx.append(indx)
+            elif token[1] == ")":
+                if len(list_of_open_indx) == 0:
+                    raise Exception("unbalanced parentheses")
+                matching_paren[list_of_open_indx.pop()] = indx
+        if len(list_of_open_indx) > 0:
+            raise Exception("unbalanced parentheses")
+        sympy_expr, indx = parse_AST_product(
+            ast_str, list_of_tokens, 0, matching_paren
+        )
+        if indx != len(list_of_tokens):
+            raise Exception("unexpected text after position " + str(indx))
     except Exception as err:
         logger.error(str(err))
-        logger.error(
-            'unable to eval AST for "' + orignal_ast_str + '" aka "' + ast_str + '"'
-        )
-        raise Exception(
-            'unable to eval AST for "' + orignal_ast_str + '" aka "' + ast_str + '"'
-        )
-    return sympy.Symbol("nothing")
+        logger.error('unable to parse AST for "' + ast_str + '"')
+        raise Exception('unable to parse AST for "' + ast_str + '"')
+    return sympy_expr
 
 
 def get_symbol_IDs_from_AST_str(ast_str: str) -> list:
@@ -321,7 +798,7 @@ def create_sympy_expr_tree_from_latex(latex_expr_str: str):
 
     logger.debug(latex_expr_str)
     try:
-        sympy_expr = parse_latex(latex_expr_str)
+        sympy_expr = parse_latex_cached(latex_expr_str)
     except Exception as err:
         logger.error(str(err))
         raise Exception("59932922 invalid latex; do not proceed")
@@ -355,7 +832,7 @@ def get_symbols_from_latex(latex_expr_str: str) -> list:
     latex_expr_str = remove_latex_presention_markings(latex_expr_str)
 
     logger.debug(latex_expr_str)
-    my_sym = list(parse_latex(latex_expr_str).free_symbols)
+    my_sym = list(parse_latex_cached(latex_expr_str).free_symbols)
     logger.info("[trace end " + trace_id + "]")
     return my_sym
 
@@ -383,8 +860,8 @@ def split_expr_into_lhs_rhs(latex_expr_str: str) -> Tuple[str, str]:
         logger.debug("found to: " + latex_expr_str)
         latex_as_list = latex_expr_str.split("\\to")
         if len(latex_as_list) == 2:
-            lhs = parse_latex(remove_latex_presention_markings(latex_as_list[0]))
-            rhs = parse_latex(remove_latex_presention_markings(latex_as_list[1]))
+            lhs = parse_latex_cached(latex_as_list[0])
+            rhs = parse_latex_cached(latex_as_list[1])
             logger.info("[trace end " + trace_id + "]")
             return lhs, rhs
         else:
@@ -397,7 +874,7 @@ def split_expr_into_lhs_rhs(latex_expr_str: str) -> Tuple[str, str]:
     else:
         try:
             logger.debug(latex_expr_str)
-            sympy_expr = parse_latex(latex_expr_str)
+            sympy_expr = parse_latex_cached(latex_expr_str)
         except sympy.SympifyError as err:
             logger.error(str(err))
             return "failed symp", "failed symp"
@@ -11,6 +11,12 @@ The purpose of this file is to transform log files on the webserver (e.g., Digit
 into records that can be used to inform visualizations presented to the user.
 
 Reinventing Prometheus/Graphana for specific log files and specific views. 
+
+auth.log is ingested incrementally (see ingest_auth_log): the byte offset of the
+last line read is stored, so each call only parses lines appended since then.
+Per day, the distinct IP addresses (with country) and the attempts per user name
+are kept in a small SQLite store, and the monitoring plots are drawn from those
+aggregates rather than from a dataframe of every line.
 """
 
 # the order of installation matters for these two :(
@@ -26,24 +32,48 @@ import matplotlib.pyplot as plt # type: ignore
 # https://pythonhosted.org/python-geoip/
 from geoip import geolite2 # type: ignore
 import os
+import csv
 import logging
+import sqlite3
 
 logger = logging.getLogger(__name__)
 
+path_to_auth_log_stats_db = '/home/appuser/app/auth_log_stats.db'
+# lines parsed and aggregated per transaction; see ingest_auth_log
+max_lines_per_batch = 20000
+
+# "Jan  3 06:25:01 server sshd[1234]: message" or, with ISO timestamps,
+# "2021-01-03T06:25:01.123456+00:00 server sshd[1234]: message"
+auth_line_pattern = re.compile(
+    r'^(?:(?P<iso_date>\d{4}-\d\d-\d\d)T\S+'
+    r'|(?P<month>[A-Z][a-z]{2}) +(?P<day>\d{1,2}) \d\d:\d\d:\d\d)'
+    r' (?P<server>\S+) (?P<service>[^\s\[:]+)(?:\[(?P<pid>\d+)\])?:? (?P<message>.*)$')
+username_pattern = re.compile(
+    r'^(?:Failed password for invalid user |Failed password for |Invalid user )(\S*)')
+ip_pattern = re.compile('(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\\.'+
+                        '(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\\.'+
+                        '(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\\.'+
+                        '(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])')
+month_number = {name: indx + 1 for indx, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+# the same addresses appear in many lines, so geolite2 is asked once per address
+country_per_ip = {}  # type: dict
+max_cached_ips = 200000
+country_name_per_code = {}  # type: dict
+
 
 def extract_username(msg):
     """
         Helper functions should not have trace turned on
         because the logger is triggered per dataframe row
-    >>> 
+    >>> extract_username('Invalid user admin from 1.2.3.4 port 22')
+    'admin'
     """
 #    logger.info('[trace]')
-    if msg.startswith('Failed password for invalid user '):
-        return msg.replace('Failed password for invalid user ','').split(' ')[0]
-    elif msg.startswith('Failed password for '):
-        return msg.replace('Failed password for ','').split(' ')[0]
-    elif msg.startswith('Invalid user '):
-        return msg.replace('Invalid user ','').split(' ')[0]
+    match = username_pattern.match(msg)
+    if match:
+        return match.group(1)
     else:
         return None
 
@@ -51,15 +81,13 @@ def extract_ip(msg):
     """
         Helper functions should not have trace turned on
         because the logger is triggered per dataframe row
-    >>> 
+    >>> extract_ip('Invalid user admin from 1.2.3.4 port 22')
+    '1.2.3.4'
     """
 #    logger.info('[trace]')
 
 # ### append IP as column in df
-    res = re.findall('(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.'+
-                     '(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.'+
-                     '(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.'+
-                     '(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])',msg)
+    res = ip_pattern.findall(msg)
     if len(res)==0:
         return None
     elif len(res)==1:
@@ -68,6 +96,44 @@ def extract_ip(msg):
         return '.'.join(res[1])
         #raise Exception(res)
 
+
+def load_country_names(path_to_country_code_table: str) -> dict:
+    """
+    download country code lookup table from https://dev.maxmind.com/geoip/legacy/codes/iso3166/
+    https://dev.maxmind.com/static/csv/codes/iso3166.csv
+
+    >>> load_country_names('iso3166.csv')['A1']
+    'Anonymous Proxy'
+    """
+    logger.info('[trace]')
+    if path_to_country_code_table not in country_name_per_code.keys():
+        with open(path_to_country_code_table, 'r', newline='') as f:
+            country_name_per_code[path_to_country_code_table] = {
+                row[0]: row[1] for row in csv.reader(f) if len(row) >= 2}
+    return country_name_per_code[path_to_country_code_table]
+
+
+def country_of_ip(ip, country_names: dict):
+    """
+        Helper functions should not have trace turned on
+        because the logger is triggered per line
+    >>> country_of_ip('1.2.3.4', load_country_names('iso3166.csv'))
+    """
+#    logger.info('[trace]')
+    # ## IP to country code using library, then country code to name using lookup table
+    if not ip:
+        return None
+    if ip not in country_per_ip.keys():
+        if len(country_per_ip) >= max_cached_ips:
+            country_per_ip.clear()
+        match = geolite2.lookup(ip)
+        if match:
+            country_per_ip[ip] = country_names.get(match.country)
+        else:
+            country_per_ip[ip] = None
+    return country_per_ip[ip]
+
+
 #def country_if_ip(ip, country_code_df):
 #    """
 #    >>> 
@@ -91,7 +157,7 @@ def auth_log_to_df(path_to_auth_log, path_to_country_code_table):
     logger.info('[trace]')
     # download country code lookup table from https://dev.maxmind.com/geoip/legacy/codes/iso3166/
     # https://dev.maxmind.com/static/csv/codes/iso3166.csv
-    country_code_df = pandas.read_csv(path_to_country_code_table, header=None, names=['country code', 'name'])
+    country_names = load_country_names(path_to_country_code_table)
 
     def country_if_ip(ip):
         """
@@ -100,16 +166,7 @@ def auth_log_to_df(path_to_auth_log, path_to_country_code_table):
         >>> 
         """
 #        logger.info('[trace]')
-        # ## IP to country code using library, then country code to name using lookup table
-        if ip:
-            match = geolite2.lookup(ip)
-            if match:
-                return country_code_df[country_code_df['country code']==match.country]['name'].values[0]
-            else:
-                return None
-        else:
-            return None
-        return None
+        return country_of_ip(ip, country_names)
 
 
     if not os.path.exists(path_to_auth_log):
@@ -253,4 +310,241 @@ def plot_country_per_day_vs_time(df,path_to_save_to: str,output_filename: str) -
     shutil.move(output_filename, path_to_save_to + output_filename)
     return
 
+
+# # incremental ingestion of auth.log into daily aggregates
+
+def connect_to_auth_log_stats_db(path_to_store: str) -> sqlite3.Connection:
+    """
+    daily_ip:       distinct IP addresses per day, with the country of each
+    daily_username: number of attempts per user name per day
+    ingest_state:   inode and byte offset of the last line read from each log
+
+    >>> connect_to_auth_log_stats_db('auth_log_stats.db')
+    """
+#    logger.info('[trace]')
+    # transactions are begun explicitly; see ingest_auth_log
+    conn = sqlite3.connect(path_to_store, timeout=60, isolation_level=None)
+    conn.execute('CREATE TABLE IF NOT EXISTS daily_ip ('
+                 'day TEXT, ip TEXT, country TEXT, PRIMARY KEY (day, ip))')
+    conn.execute('CREATE TABLE IF NOT EXISTS daily_username ('
+                 'day TEXT, username TEXT, count INTEGER, PRIMARY KEY (day, username))')
+    conn.execute('CREATE TABLE IF NOT EXISTS ingest_state ('
+                 'path TEXT PRIMARY KEY, inode INTEGER, offset INTEGER)')
+    return conn
+
+
+def parse_auth_line(line: str, today: datetime.date):
+    """
+    syslog timestamps lack the year; a date later in the year than today
+    is assumed to be from last year
+
+        Helper functions should not have trace turned on
+        because the logger is triggered per line
+    >>> parse_auth_line('Jan  3 06:25:01 server sshd[1234]: Invalid user admin from 1.2.3.4', datetime.date(2021, 2, 1))
+    {'day': '2021-01-03', 'server name': 'server', 'service name': 'sshd', 'pid': '1234', 'message': 'Invalid user admin from 1.2.3.4'}
+    """
+#    logger.info('[trace]')
+    match = auth_line_pattern.match(line)
+    if not match:
+        return None
+    if match.group('iso_date'):
+        day = match.group('iso_date')
+    else:
+        month = month_number.get(match.group('month'))
+        if month is None:
+            return None
+        day_of_month = int(match.group('day'))
+        year = today.year
+        if (month, day_of_month) > (today.month, today.day):
+            year -= 1
+        day = '%04d-%02d-%02d' % (year, month, day_of_month)
+    return {'day': day,
+            'server name': match.group('server'),
+            'service name': match.group('service'),
+            'pid': match.group('pid'),
+            'message': match.group('message')}
+
+
+def ingest_auth_log(path_to_auth_log: str, path_to_country_code_table: str,
+                    path_to_store: str = path_to_auth_log_stats_db,
+                    max_seconds=None) -> int:
+    """
+    Parse the lines appended to auth.log since the previous call and add them
+    to the daily aggregates. Each batch of lines is added in the same transaction
+    that advances the stored offset, so a line is counted once even if
+    several gunicorn workers ingest at the same time.
+
+    When the inode changes (log rotation) or the file is shorter than the
+    offset, reading starts again from the beginning of the file.
+    A partially written last line is left for the next call.
+
+    Args:
+        path_to_auth_log: e.g., '/home/appuser/app/logs/auth.log'
+        path_to_country_code_table: see load_country_names
+        path_to_store: SQLite file of the aggregates
+        max_seconds: stop after the batch that exceeds this duration;
+                     the remaining lines are ingested by the next call
+    Returns:
+        number of lines ingested
+    Raises:
+
+    >>> ingest_auth_log('logs/auth.log', 'iso3166.csv', 'auth_log_stats.db')
+    """
+    logger.info('[trace]')
+    if not os.path.exists(path_to_auth_log):
+        logger.debug('no auth log at ' + path_to_auth_log)
+        return 0
+    country_names = load_country_names(path_to_country_code_table)
+    today = datetime.date.today()
+    start_time = time.time()
+    number_of_lines_ingested = 0
+
+    conn = connect_to_auth_log_stats_db(path_to_store)
+    try:
+        with open(path_to_auth_log, 'rb') as f:
+            while True:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    file_stat = os.fstat(f.fileno())
+                    row = conn.execute('SELECT inode, offset FROM ingest_state WHERE path=?',
+                                       (path_to_auth_log,)).fetchone()
+                    if (row is None) or (row[0] != file_stat.st_ino) or (row[1] > file_stat.st_size):
+                        offset = 0
+                    else:
+                        offset = row[1]
+
+                    f.seek(offset)
+                    country_per_day_and_ip = {}  # type: dict
+                    attempts_per_day_and_username = {}  # type: dict
+                    number_of_lines_in_batch = 0
+                    for raw_line in f:
+                        if not raw_line.endswith(b'\n'):
+                            break  # still being written
+                        offset += len(raw_line)
+                        number_of_lines_in_batch += 1
+                        # https://security.stackexchange.com/questions/18207/security-of-log-files-injecting-malicious-code-in-log-files/18209
+                        line = raw_line.decode('utf-8', errors='replace').replace('\x00', '').rstrip('\n')
+                        line_as_dict = parse_auth_line(line, today)
+                        if line_as_dict is not None:
+                            ip = extract_ip(line_as_dict['message'])
+                            if ip and ((line_as_dict['day'], ip) not in country_per_day_and_ip.keys()):
+                                country_per_day_and_ip[(line_as_dict['day'], ip)] = country_of_ip(ip, country_names)
+                            username = extract_username(line_as_dict['message'])
+                            if username is not None:
+                                key = (line_as_dict['day'], username)
+                                attempts_per_day_and_username[key] = attempts_per_day_and_username.get(key, 0) + 1
+                        if number_of_lines_in_batch >= max_lines_per_batch:
+                            break
+
+                    conn.executemany('INSERT OR IGNORE INTO daily_ip VALUES (?, ?, ?)',
+                                     [(day, ip, country) for (day, ip), country in country_per_day_and_ip.items()])
+                    conn.executemany('INSERT INTO daily_username VALUES (?, ?, ?) '
+                                     'ON CONFLICT(day, username) DO UPDATE SET count = count + excluded.count',
+                                     [(day, username, count) for (day, username), count in attempts_per_day_and_username.items()])
+                    conn.execute('INSERT OR REPLACE INTO ingest_state VALUES (?, ?, ?)',
+                                 (path_to_auth_log, file_stat.st_ino, offset))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                number_of_lines_ingested += number_of_lines_in_batch
+                if number_of_lines_in_batch < max_lines_per_batch:
+                    break
+                if (max_seconds is not None) and (time.time() - start_time > max_seconds):
+                    logger.debug('stopped ingesting auth log after ' + str(number_of_lines_ingested) + ' lines')
+                    break
+    finally:
+        conn.close()
+    logger.debug('ingested ' + str(number_of_lines_ingested) + ' lines of ' + path_to_auth_log)
+    return number_of_lines_ingested
+
+
+def query_auth_log_stats(path_to_store: str, query: str) -> list:
+    """
+    >>> query_auth_log_stats('auth_log_stats.db', 'SELECT day, COUNT(*) FROM daily_ip GROUP BY day')
+    """
+    logger.info('[trace]')
+    conn = connect_to_auth_log_stats_db(path_to_store)
+    try:
+        return conn.execute(query).fetchall()
+    finally:
+        conn.close()
+
+
+def save_plot(path_to_save_to: str, output_filename: str) -> None:
+    """
+    >>> save_plot("/home/appuser/app/static/", 'unique_usernames_2021-01-03.png')
+    """
+    logger.info('[trace]')
+    plt.savefig(output_filename, format='png', bbox_inches = "tight")
+    shutil.move(output_filename, path_to_save_to + output_filename)
+    return
+
+
+def plot_username_distribution_from_store(path_to_store: str, path_to_save_to: str, output_filename: str) -> None:
+    """
+    same plot as plot_username_distribution, from the daily aggregates
+
+    >>> plot_username_distribution_from_store('auth_log_stats.db', "/home/appuser/app/static/", 'unique_usernames_')
+    """
+    logger.info('[trace]')
+    rows = query_auth_log_stats(path_to_store,
+                                'SELECT username, SUM(count) AS attempts FROM daily_username '
+                                'GROUP BY username ORDER BY attempts DESC LIMIT 20')
+    # https://stackoverflow.com/a/8228808/1164295
+    plt.close('all')
+    plt.bar(range(len(rows)), [row[1] for row in rows], align='center')
+    _=plt.xticks(range(len(rows)), [row[0] for row in rows], rotation='vertical')
+    _=plt.ylabel('number of login attempts')
+    _=plt.xlabel('user name attempted')
+    save_plot(path_to_save_to, output_filename)
+    return
+
+
+def plot_daily_count_from_store(path_to_store: str, table_name: str, ylabel: str, title: str,
+                                path_to_save_to: str, output_filename: str) -> None:
+    """
+    number of rows per day of daily_ip (unique IP addresses) or
+    daily_username (unique user names); see plot_ip_vs_time and plot_username_vs_time
+
+    >>> plot_daily_count_from_store('auth_log_stats.db', 'daily_ip', 'number of unique IP addresses', 'IP addresses observed per day', "/home/appuser/app/static/", 'unique_IP_address_per_day_')
+    """
+    logger.info('[trace]')
+    if table_name not in ['daily_ip', 'daily_username']:
+        raise Exception('no daily counts in ' + table_name)
+    rows = query_auth_log_stats(path_to_store,
+                                'SELECT day, COUNT(*) FROM ' + table_name + ' GROUP BY day ORDER BY day')
+    # https://stackoverflow.com/a/8228808/1164295
+    plt.close('all')
+    plt.bar(range(len(rows)), [row[1] for row in rows], align='center')
+    _=plt.xticks(range(len(rows)), [row[0] for row in rows], rotation='vertical')
+    _=plt.ylabel(ylabel)
+    _=plt.title(title)
+    save_plot(path_to_save_to, output_filename)
+    return
+
+
+def plot_country_per_day_from_store(path_to_store: str, path_to_save_to: str, output_filename: str) -> None:
+    """
+    same plot as plot_country_per_day_vs_time, from the daily aggregates
+
+    >>> plot_country_per_day_from_store('auth_log_stats.db', "/home/appuser/app/static/", 'unique_IP_address_per_country_above_threshold_per_day_')
+    """
+    logger.info('[trace]')
+    rows = query_auth_log_stats(path_to_store,
+                                'SELECT day, country, COUNT(*) FROM daily_ip WHERE country IS NOT NULL '
+                                'GROUP BY day, country HAVING COUNT(*) > 4')
+    # https://stackoverflow.com/a/8228808/1164295
+    plt.close('all')
+    if len(rows) > 0:
+        # https://stackoverflow.com/questions/26683654/making-a-stacked-barchart-in-pandas
+        gb_reduced = pandas.DataFrame(rows, columns=['day', 'country', 'ip']).set_index(['day', 'country'])['ip']
+        gb_reduced.unstack(level=-1).plot(kind='bar', stacked=True)
+        # https://stackoverflow.com/questions/4700614/how-to-put-the-legend-out-of-the-plot/43439132#43439132
+        _=plt.legend(bbox_to_anchor=(1.04,1), loc="upper left")
+    _=plt.ylabel('unique IP addresses per country')
+    _=plt.title('IP address per country observed per day where count>4')
+    save_plot(path_to_save_to, output_filename)
+    return
+
 # EOF
@@ -11,13 +11,184 @@ separate the API routes and functions into this file and thus make controller.py
 # https://stackoverflow.com/a/16994175/1164295
 from flask import current_app
 
+import bisect
+import hashlib
+import hmac
+import os
 import common_lib as clib
+import compute
+import db_export
+import validate_steps_sympy as vir
+import validate_dimensions_sympy as vdim
 from flask import Blueprint, flash, g, redirect, render_template, jsonify, request, session, url_for
+
+try:
+    import msgpack  # type: ignore
+except ImportError:  # the binary response is optional; JSON is always available
+    msgpack = None
+
 path_to_db = "pdg.db"
 
 # https://flask.palletsprojects.com/en/1.1.x/tutorial/views/
 bp = Blueprint('pdg_api', __name__, url_prefix='/api')
 
+# the collection endpoints (.../all and .../list) accept
+#   limit=N and cursor=KEY  for pages of N entries, sorted by key, after KEY;
+#                           the URL of the next page is in the "Link" header
+#   fields=a,b              to return only those fields of each entry
+#   format=msgpack          (or "Accept: application/msgpack") for MessagePack
+# and return an ETag derived from the database version, so that
+# a poll with If-None-Match gets "304 Not Modified" without reading the database
+default_page_size = 100
+max_page_size = 1000
+api_media_types = ["application/json", "application/msgpack"]
+
+
+def requested_media_type() -> str:
+    """
+    >>> requested_media_type()
+    'application/json'
+    """
+    if request.args.get("format") == "msgpack":
+        return "application/msgpack"
+    return request.accept_mimetypes.best_match(api_media_types, default="application/json")
+
+
+def request_has_api_token() -> bool:
+    """
+    for routes that change state; see config.Config.API_TOKEN
+
+    >>> request_has_api_token()
+    False
+    """
+    api_token = current_app.config.get("API_TOKEN")
+    if api_token is None:
+        return False
+    return hmac.compare_digest(
+        request.headers.get("Authorization", ""), "Bearer " + api_token
+    )
+
+
+def etag_for_request():
+    """
+    The database version changes whenever the content changes;
+    the inode distinguishes a database that was replaced and started counting again.
+    The query string and media type are included because they change the response.
+
+    Returns:
+        etag (str), or None if the database lacks a version counter
+    >>> etag_for_request()
+    """
+    db_version = clib.get_db_version(path_to_db)
+    if db_version is None:
+        return None
+    return hashlib.md5(
+        (
+            str(os.stat(path_to_db).st_ino)
+            + " "
+            + str(db_version)
+            + " "
+            + request.full_path
+            + " "
+            + requested_media_type()
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def api_response(payload, etag):
+    """
+    serialize as JSON or MessagePack and attach the ETag
+
+    >>> api_response({"a": 1}, etag_for_request())
+    """
+    media_type = requested_media_type()
+    if media_type == "application/msgpack":
+        if msgpack is None:
+            return "Error: MessagePack is not available on this server; use JSON", 406
+        response = current_app.response_class(
+            msgpack.packb(payload, use_bin_type=True), mimetype=media_type
+        )
+    else:
+        response = jsonify(payload)
+    if etag is not None:
+        response.set_etag(etag)
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+def collection_response(collection_name: str, keys_only: bool):
+    """
+    response for the .../all (keys_only=False) and .../list (keys_only=True) endpoints
+
+    Without limit or cursor the whole collection is returned;
+    fields alone selects the fields of every entry.
+
+    >>> collection_response("expressions", False)
+    """
+    etag = etag_for_request()
+    if (etag is not None) and request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers["Vary"] = "Accept"
+        return response
+
+    dat = clib.read_db(path_to_db)
+    collection = dat[collection_name]
+    if not any(arg in request.args for arg in ["limit", "cursor", "fields"]):
+        if keys_only:
+            return api_response(list(collection.keys()), etag)
+        return api_response(collection, etag)
+
+    list_of_keys = sorted(collection.keys())
+    is_paged = ("limit" in request.args) or ("cursor" in request.args)
+    if is_paged:
+        try:
+            limit = int(request.args.get("limit", default_page_size))
+        except ValueError:
+            return "Error: limit must be an integer", 400
+        if limit < 1:
+            return "Error: limit must be positive", 400
+        limit = min(limit, max_page_size)
+        if "cursor" in request.args:
+            start_index = bisect.bisect_right(list_of_keys, str(request.args["cursor"]))
+        else:
+            start_index = 0
+        page_of_keys = list_of_keys[start_index : start_index + limit]
+    else:
+        page_of_keys = list_of_keys
+
+    if keys_only:
+        response = api_response(page_of_keys, etag)
+    else:
+        payload = {}  # type: dict
+        if "fields" in request.args:
+            list_of_fields = [
+                field.strip() for field in request.args["fields"].split(",") if field.strip()
+            ]
+            for key in page_of_keys:
+                entry = collection[key]
+                if isinstance(entry, dict):
+                    payload[key] = {
+                        field: entry[field] for field in list_of_fields if field in entry
+                    }
+                else:  # e.g., "expr local to global" maps IDs to IDs
+                    payload[key] = entry
+        else:
+            for key in page_of_keys:
+                payload[key] = collection[key]
+        response = api_response(payload, etag)
+
+    if isinstance(response, tuple):  # an error
+        return response
+    if is_paged and (start_index + limit < len(list_of_keys)) and (len(page_of_keys) > 0):
+        next_args = request.args.to_dict()  # type: dict
+        next_args["cursor"] = page_of_keys[-1]
+        next_args["limit"] = str(limit)
+        response.headers["Link"] = (
+            "<" + url_for(str(request.endpoint), **next_args) + '>; rel="next"'
+        )
+    return response
+
 
 
 @bp.route("/v1/resources/derivations/all", methods=["GET"])
@@ -27,8 +198,7 @@ def api_all_derivations():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(dat["derivations"])
+    return collection_response("derivations", False)
 
 
 @bp.route("/v1/resources/derivations/list", methods=["GET"])
@@ -38,8 +208,7 @@ def api_list_derivations():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(list(dat["derivations"].keys()))
+    return collection_response("derivations", True)
 
 
 @bp.route("/v1/resources/derivations", methods=["GET"])
@@ -68,6 +237,33 @@ def api_read_derivation_by_name():
         )
 
 
+@bp.route("/v1/resources/derivations/validity", methods=["GET"])
+def api_derivation_step_validity():
+    """
+    return the validation result for each step of a derivation;
+    steps that were validated before and have not changed are not validated again
+
+    /api/v1/resources/derivations/validity?deriv_id=000001
+    >>>
+    """
+    current_app.logger.info("[trace]")
+    dat = clib.read_db(path_to_db)
+    if "deriv_id" in request.args:
+        deriv_id = str(request.args["deriv_id"])
+    else:
+        return "Error: No deriv_id field provided. Please specify a deriv_id."
+    if deriv_id not in dat["derivations"].keys():
+        return "Error: deriv_id " + deriv_id + " not found; see derivations/list"
+    step_validity_dict = {}
+    for step_id in dat["derivations"][deriv_id]["steps"].keys():
+        try:
+            step_validity_dict[step_id] = vir.validate_step_cached(deriv_id, step_id, path_to_db)
+        except Exception as err:
+            current_app.logger.error(str(err))
+            step_validity_dict[step_id] = "failed"
+    return jsonify(step_validity_dict)
+
+
 @bp.route("/v1/resources/expressions/all", methods=["GET"])
 def api_all_expressions():
     """
@@ -75,8 +271,7 @@ def api_all_expressions():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(dat["expressions"])
+    return collection_response("expressions", False)
 
 
 @bp.route("/v1/resources/expressions/list", methods=["GET"])
@@ -86,8 +281,7 @@ def api_list_expressions():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(list(dat["expressions"].keys()))
+    return collection_response("expressions", True)
 
 
 @bp.route("/v1/resources/expressions", methods=["GET"])
@@ -116,6 +310,83 @@ def api_read_expression_by_id():
         )
 
 
+@bp.route("/v1/resources/expressions/dimensions", methods=["GET"])
+def api_expression_dimension_report():
+    """
+    check the dimensional consistency of every expression;
+    expressions that have not changed since the previous check are not checked again
+
+    /api/v1/resources/expressions/dimensions
+    >>>
+    """
+    current_app.logger.info("[trace]")
+    return jsonify(vdim.validate_dimensions_of_all_expressions(path_to_db))
+
+
+def ids_of_edit():
+    """
+    symbol_id and expr_global_id arguments of the affected_steps routes
+
+    Returns:
+        list_of_symbol_ids, list_of_expr_global_ids
+    >>> ids_of_edit()
+    ([], [])
+    """
+    list_of_symbol_ids = [
+        x for x in str(request.args.get("symbol_id", "")).split(",") if len(x) > 0
+    ]
+    list_of_expr_global_ids = [
+        x for x in str(request.args.get("expr_global_id", "")).split(",") if len(x) > 0
+    ]
+    return list_of_symbol_ids, list_of_expr_global_ids
+
+
+@bp.route("/v1/resources/affected_steps", methods=["GET"])
+def api_steps_affected_by_edit():
+    """
+    the expressions, steps, and derivations that depend on the given
+    symbols and expressions; to validate and render them again,
+    see api_revalidate_steps_affected_by_edit
+
+    /api/v1/resources/affected_steps?symbol_id=1054,9139&expr_global_id=9999999953
+    >>>
+    """
+    current_app.logger.info("[trace]")
+    list_of_symbol_ids, list_of_expr_global_ids = ids_of_edit()
+    if len(list_of_symbol_ids) + len(list_of_expr_global_ids) == 0:
+        return "Error: No symbol_id or expr_global_id field provided."
+    return jsonify(
+        compute.steps_affected_by_edit(
+            list_of_symbol_ids, list_of_expr_global_ids, path_to_db
+        )
+    )
+
+
+@bp.route("/v1/resources/affected_steps/revalidate", methods=["POST"])
+def api_revalidate_steps_affected_by_edit():
+    """
+    validate and render again the steps that depend on the given
+    symbols and expressions. The work is queued (see compute.revalidate_after_edit)
+    and the response is returned immediately.
+    Requires the API token (see request_has_api_token);
+    exempt from CSRF protection in controller.py since no cookie is used
+
+    curl -X POST -H "Authorization: Bearer $API_TOKEN" \
+        "/api/v1/resources/affected_steps/revalidate?symbol_id=1054"
+    >>>
+    """
+    current_app.logger.info("[trace]")
+    if not request_has_api_token():
+        return "Error: missing or wrong API token", 403
+    list_of_symbol_ids, list_of_expr_global_ids = ids_of_edit()
+    if len(list_of_symbol_ids) + len(list_of_expr_global_ids) == 0:
+        return "Error: No symbol_id or expr_global_id field provided.", 400
+    compute.revalidate_after_edit(
+        list_of_symbol_ids, list_of_expr_global_ids, path_to_db
+    )
+    return jsonify({"status": "revalidation queued"}), 202
+
+
 @bp.route("/v1/resources/infrules/all", methods=["GET"])
 def api_all_infrules():
     """
@@ -123,8 +394,7 @@ def api_all_infrules():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(dat["inference rules"])
+    return collection_response("inference rules", False)
 
 
 @bp.route("/v1/resources/infrules/list", methods=["GET"])
@@ -134,8 +404,7 @@ def api_list_infrules():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(list(dat["inference rules"].keys()))
+    return collection_response("inference rules", True)
 
 
 @bp.route("/v1/resources/infrules", methods=["GET"])
@@ -163,8 +432,7 @@ def api_all_local_to_global():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(dat["expr local to global"])
+    return collection_response("expr local to global", False)
 
 
 @bp.route("/v1/resources/local_to_global/list", methods=["GET"])
@@ -174,8 +442,7 @@ def api_list_local():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(list(dat["expr local to global"].keys()))
+    return collection_response("expr local to global", True)
 
 
 @bp.route("/v1/resources/local_to_global", methods=["GET"])
@@ -203,8 +470,7 @@ def api_all_symbols():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(dat["symbols"])
+    return collection_response("symbols", False)
 
 
 @bp.route("/v1/resources/symbols/list", methods=["GET"])
@@ -214,8 +480,7 @@ def api_list_symbols():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(list(dat["symbols"].keys()))
+    return collection_response("symbols", True)
 
 
 @bp.route("/v1/resources/symbols", methods=["GET"])
@@ -243,8 +508,7 @@ def api_all_operators():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(dat["symbols"])
+    return collection_response("operators", False)
 
 
 @bp.route("/v1/resources/operators/list", methods=["GET"])
@@ -254,8 +518,7 @@ def api_list_operators():
     >>>
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    return jsonify(list(dat["operators"].keys()))
+    return collection_response("operators", True)
 
 
 @bp.route("/v1/resources/operators", methods=["GET"])
@@ -276,6 +539,28 @@ def api_operators_by_name():
         return "Error: operator_id " + operator_id + " not found see symbols/list"
 
 
+@bp.route("/v1/export", methods=["GET"])
+def api_export():
+    """
+    download the database in one format, optionally gzip-compressed
+
+    /api/v1/export?format=rdf&gzip=true
+    >>>
+    """
+    current_app.logger.info("[trace]")
+    if "format" in request.args:
+        export_format = str(request.args["format"])
+    else:
+        return "Error: No format field provided. Please specify a format."
+    if export_format not in db_export.export_formats.keys():
+        return "Error: format " + export_format + " not recognized"
+    compress = request.args.get("gzip", "false").lower() == "true"
+    export_file = compute.export_db_content_in_format(
+        path_to_db, export_format, compress
+    )
+    return redirect(url_for("static", filename=export_file))
+
+
 @bp.route("/v1/documentation", methods=["GET", "POST"])
 def api_documentation():
     """
@@ -288,25 +573,79 @@ def api_documentation():
 
 
 @bp.route("/v1/derivations_that_contain_expr_global_id", methods=["GET", "POST"])
-def what_derivations_contain_expr_global_id(expr_global_id):
+def what_derivations_contain_expr_global_id():
     """
+    /api/v1/derivations_that_contain_expr_global_id?expr_global_id=9999999953
+
+    for many expressions per call, see api_derivations_per_expression
     >>> what_derivations_contain_expr_global_id()
     """
     current_app.logger.info("[trace]")
-    dat = clib.read_db(path_to_db)
-    list_of_derivations_containing_expr_global_id = []
     if "expr_global_id" in request.args:
         expr_global_id = str(request.args["expr_global_id"])
     else:
         return "Error: No expr_global_id field provided. Please specify a expr_global_id."
-    if expr_global_id in dat["expressions"].keys():
-        for deriv_id, deriv_dict in dat['derivations'].items():
-            for step_id, step_dict in deriv_dict['steps'].items():
-                for conn in ['feeds', 'inputs', 'outputs']:
-                    for expr_local_id in step_dict[conn]:
-                        if (expr_global_id == dat["expr local to global"][expr_local_id]):
-                            list_of_derivations_containing_expr_global_id.append(deriv_id)
-    else:
+    result_dict = compute.derivations_containing_expressions([expr_global_id], path_to_db)
+    if result_dict[expr_global_id] is None:
         return "Error: expr_global_id not in expressions."
+    return jsonify(result_dict[expr_global_id]["derivations"])
+
+
+# bounds the work of a single call of api_derivations_per_expression
+max_expressions_per_batch = 10000
+
+
+@bp.route("/v1/resources/expressions/derivations", methods=["GET", "POST"])
+def api_derivations_per_expression():
+    """
+    for each expression, the derivations that use it and every
+    (derivation, step, role) where it appears; role is "inputs", "feeds", or "outputs"
+
+    GET  /api/v1/resources/expressions/derivations?expr_global_id=9999999953,0000040490
+    POST /api/v1/resources/expressions/derivations
+         with the JSON body {"expr_global_ids": ["9999999953", "0000040490"]}
 
-    return jsonify(list_of_derivations_containing_expr_global_id)
+    IDs that are not expressions have the value null.
+    POST is exempt from CSRF protection in controller.py since it reads but does not change
+
+    >>> list_of_ids = [str(n).zfill(10) for n in range(max_expressions_per_batch)]
+    >>> response = controller.app.test_client().post(
+    ...     "/api/v1/resources/expressions/derivations",
+    ...     json={"expr_global_ids": list_of_ids},
+    ... )
+    >>> response.status_code, len(response.get_json())
+    (200, 10000)
+    >>> controller.app.test_client().post(
+    ...     "/api/v1/resources/expressions/derivations",
+    ...     json={"expr_global_ids": "9999999953"},
+    ... ).status_code
+    400
+    """
+    current_app.logger.info("[trace]")
+    if request.method == "POST":
+        request_json = request.get_json(silent=True)
+        if request_json is None:
+            request_json = {}
+        if not isinstance(request_json, dict):
+            return 'Error: the JSON body must be {"expr_global_ids": [...]}', 400
+        list_of_expr_global_ids = request_json.get("expr_global_ids", [])
+        if not isinstance(list_of_expr_global_ids, list) or not all(
+            isinstance(x, str) for x in list_of_expr_global_ids
+        ):
+            return "Error: expr_global_ids must be a list of strings", 400
+    else:
+        list_of_expr_global_ids = [
+            x for x in str(request.args.get("expr_global_id", "")).split(",") if len(x) > 0
+        ]
+    if len(list_of_expr_global_ids) == 0:
+        return "Error: No expr_global_id field provided."
+    if len(list_of_expr_global_ids) > max_expressions_per_batch:
+        return (
+            "Error: at most "
+            + str(max_expressions_per_batch)
+            + " expressions per call",
+            400,
+        )
+    return jsonify(
+        compute.derivations_containing_expressions(list_of_expr_global_ids, path_to_db)
+    )
@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+
+# Physics Derivation Graph
+# Ben Payne, 2021
+# https://creativecommons.org/licenses/by/4.0/
+# Attribution 4.0 International (CC BY 4.0)
+
+"""
+Normalized relational storage of the "dat" nested dictionary.
+
+The default storage (see common_lib.py) is JSON in a single cell of the table "data".
+Every edit, even a one-word note change, rewrites the entire graph.
+In this file each derivation, step, expression, symbol, operator, and inference rule
+is a row, so an edit only touches the rows that changed.
+
+Tables:
+* derivations
+* steps
+* step_expressions -- the inputs, feeds, and outputs of each step (edges)
+* expr_local_to_global
+* expressions
+* symbols
+* operators
+* inference_rules
+* units
+* measures
+
+Columns are named after the keys in "dat" (e.g. "creation date") so that
+rows map back to dictionaries without renaming.
+Keys that are not listed as columns (e.g. the "dimensions" of a symbol)
+are stored as JSON in the column "other" so that read and write are lossless.
+
+Functions in this file take a sqlite3 cursor; the connection, transaction,
+and the version counter are managed by common_lib.py
+"""
+
+import json
+import logging
+import random
+from typing_extensions import (
+    TypedDict,
+)  # https://mypy.readthedocs.io/en/stable/more_types.html
+
+logger = logging.getLogger(__name__)
+
+TABLE_DICT = TypedDict("TABLE_DICT", {"table": str, "key": str, "columns": list})
+
+# keys are the top-level keys of "dat"
+# "key" is the name of the primary key column
+# "columns" are the keys of the entry that are stored as separate columns
+ENTRY_TABLES = {
+    "derivations": {
+        "table": "derivations",
+        "key": "deriv_id",
+        "columns": ["name", "notes", "author", "creation date"],
+    },
+    "expressions": {
+        "table": "expressions",
+        "key": "expr_global_id",
+        "columns": ["latex", "AST", "name", "notes", "author", "creation date"],
+    },
+    "symbols": {
+        "table": "symbols",
+        "key": "symbol_id",
+        "columns": ["latex", "name", "category", "author", "creation date"],
+    },
+    "operators": {
+        "table": "operators",
+        "key": "operator_name",
+        "columns": ["latex", "argument count"],
+    },
+    "inference rules": {
+        "table": "inference_rules",
+        "key": "inf_rule",
+        "columns": [
+            "latex",
+            "number of feeds",
+            "number of inputs",
+            "number of outputs",
+            "assumptions",
+            "notes",
+            "author",
+            "creation date",
+        ],
+    },
+    "units": {"table": "units", "key": "unit_name", "columns": ["measure"]},
+    "measures": {"table": "measures", "key": "measure_name", "columns": []},
+}  # type: dict[str, TABLE_DICT]
+
+STEP_COLUMNS = ["inf rule", "linear index", "notes", "author", "creation date"]
+
+# the role of an expression in a step; the order matches the keys in "dat"
+STEP_EXPRESSION_ROLES = ["inputs", "feeds", "outputs"]
+
+
+def quote(column_name: str) -> str:
+    """
+    column names contain spaces, so they need to be quoted in SQL
+
+    >>> quote("creation date")
+    '"creation date"'
+    """
+    return '"' + column_name + '"'
+
+
+def create_tables(cur) -> None:
+    """
+    Columns other than the primary key are declared without a type
+    so that SQLite keeps the Python type (int, float, str) of each value.
+
+    Args:
+        cur: sqlite3 cursor
+    Returns:
+        None
+    Raises:
+
+    >>> create_tables(cur)
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    for entry_type, table_dict in ENTRY_TABLES.items():
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS "
+            + table_dict["table"]
+            + " ("
+            + table_dict["key"]
+            + " TEXT PRIMARY KEY, "
+            + ", ".join([quote(col) for col in table_dict["columns"]] + ["other"])
+            + ")"
+        )
+
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS steps ("
+        + "step_id TEXT PRIMARY KEY, "
+        + "deriv_id TEXT NOT NULL, "
+        + ", ".join([quote(col) for col in STEP_COLUMNS] + ["other"])
+        + ")"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS steps_deriv_id ON steps (deriv_id)")
+
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS step_expressions ("
+        + "step_id TEXT NOT NULL, "
+        + "role TEXT NOT NULL, "
+        + "position INTEGER NOT NULL, "
+        + "expr_local_id TEXT NOT NULL, "
+        + "PRIMARY KEY (step_id, role, position))"
+    )
+
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS expr_local_to_global ("
+        + "expr_local_id TEXT PRIMARY KEY, "
+        + "expr_global_id TEXT NOT NULL)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS expr_local_to_global_global_id "
+        + "ON expr_local_to_global (expr_global_id)"
+    )
+
+    logger.info("[trace end " + trace_id + "]")
+    return
+
+
+def tables_exist(cur) -> bool:
+    """
+    >>> tables_exist(cur)
+    True
+    """
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='steps'")
+    return cur.fetchone() is not None
+
+
+def split_entry(columns: list, entry_dict: dict) -> list:
+    """
+    Convert a dict to the values of a row.
+    Keys missing from entry_dict are stored as NULL.
+
+    Args:
+        columns: list of keys that have their own column
+        entry_dict: one entry, e.g. dat["symbols"]["1054"]
+    Returns:
+        list of values in the order of columns, followed by the JSON of the other keys
+    Raises:
+
+    >>> split_entry(["latex"], {"latex": "a", "scope": ["real"]})
+    ['a', '{"scope": ["real"]}']
+    """
+    # logger.info("[trace]")
+    row_values = [entry_dict.get(col) for col in columns]
+    other_dict = {k: v for k, v in entry_dict.items() if k not in columns}
+    if len(other_dict) > 0:
+        row_values.append(json.dumps(other_dict))
+    else:
+        row_values.append(None)
+    return row_values
+
+
+def merge_row(columns: list, row_values) -> dict:
+    """
+    inverse of split_entry
+
+    >>> merge_row(["latex"], ['a', '{"scope": ["real"]}'])
+    {'latex': 'a', 'scope': ['real']}
+    """
+    # logger.info("[trace]")
+    entry_dict = {}
+    for col, value in zip(columns, row_values):
+        if value is not None:
+            entry_dict[col] = value
+    other_json = row_values[len(columns)]
+    if other_json is not None:
+        entry_dict.update(json.loads(other_json))
+    return entry_dict
+
+
+def read_dat(cur) -> dict:
+    """
+    Assemble the "dat" nested dictionary from the tables.
+    Rows are read in insertion order (rowid) to retain the order of keys.
+
+    Args:
+        cur: sqlite3 cursor
+    Returns:
+        dat: dict
+    Raises:
+
+    >>> read_dat(cur)
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    dat = {}  # type: dict
+    for entry_type, table_dict in ENTRY_TABLES.items():
+        dat[entry_type] = {}
+        for row in cur.execute(
+            "SELECT "
+            + ", ".join(
+                [table_dict["key"]]
+                + [quote(col) for col in table_dict["columns"]]
+                + ["other"]
+            )
+            + " FROM "
+            + table_dict["table"]
+            + " ORDER BY rowid"
+        ):
+            dat[entry_type][row[0]] = merge_row(table_dict["columns"], row[1:])
+
+    for deriv_id in dat["derivations"].keys():
+        dat["derivations"][deriv_id]["steps"] = {}
+
+    step_expressions = {}  # type: dict
+    for step_id, role, expr_local_id in cur.execute(
+        "SELECT step_id, role, expr_local_id FROM step_expressions "
+        + "ORDER BY step_id, role, position"
+    ):
+        step_expressions.setdefault(step_id, {}).setdefault(role, []).append(
+            expr_local_id
+        )
+
+    for row in cur.execute(
+        "SELECT step_id, deriv_id, "
+        + ", ".join([quote(col) for col in STEP_COLUMNS] + ["other"])
+        + " FROM steps ORDER BY rowid"
+    ):
+        step_id = row[0]
+        deriv_id = row[1]
+        step_dict = merge_row(STEP_COLUMNS, row[2:])
+        for role in STEP_EXPRESSION_ROLES:
+            step_dict[role] = step_expressions.get(step_id, {}).get(role, [])
+        if deriv_id not in dat["derivations"].keys():
+            logger.error("step " + step_id + " refers to missing " + deriv_id)
+            continue
+        dat["derivations"][deriv_id]["steps"][step_id] = step_dict
+
+    dat["expr local to global"] = {}
+    for expr_local_id, expr_global_id in cur.execute(
+        "SELECT expr_local_id, expr_global_id FROM expr_local_to_global ORDER BY rowid"
+    ):
+        dat["expr local to global"][expr_local_id] = expr_global_id
+
+    logger.info("[trace end " + trace_id + "]")
+    return dat
+
+
+def upsert_entry(cur, entry_type: str, entry_id: str, entry_dict: dict) -> None:
+    """
+    Insert or replace one row in the table for entry_type.
+    For derivations, only the derivation-level fields are written;
+    use upsert_step for the steps.
+
+    Args:
+        cur: sqlite3 cursor
+        entry_type: a top-level key of "dat", e.g. "symbols"
+        entry_id: key of the entry, e.g. "1054"
+        entry_dict: value of the entry
+    Returns:
+        None
+    Raises:
+        Exception if entry_type is not recognized
+
+    >>> upsert_entry(cur, "symbols", "1054", {"latex": "\\hbar"})
+    """
+    # logger.info("[trace]")
+    if entry_type == "expr local to global":
+        cur.execute(
+            "INSERT OR REPLACE INTO expr_local_to_global VALUES (?, ?)",
+            (entry_id, entry_dict),
+        )
+        return
+    if entry_type not in ENTRY_TABLES.keys():
+        logger.error("unrecognized entry type " + str(entry_type))
+        raise Exception("unrecognized entry type " + str(entry_type))
+    table_dict = ENTRY_TABLES[entry_type]
+    if entry_type == "derivations":
+        entry_dict = {k: v for k, v in entry_dict.items() if k != "steps"}
+    # "ON CONFLICT DO UPDATE" retains the rowid, and thereby the order of entries
+    cur.execute(
+        "INSERT INTO "
+        + table_dict["table"]
+        + " VALUES ("
+        + ", ".join(["?"] * (len(table_dict["columns"]) + 2))
+        + ") ON CONFLICT("
+        + table_dict["key"]
+        + ") DO UPDATE SET "
+        + ", ".join(
+            [
+                quote(col) + "=excluded." + quote(col)
+                for col in table_dict["columns"] + ["other"]
+            ]
+        ),
+        [entry_id] + split_entry(table_dict["columns"], entry_dict),
+    )
+    return
+
+
+def delete_entry(cur, entry_type: str, entry_id: str) -> None:
+    """
+    Deleting a derivation also deletes its steps.
+
+    >>> delete_entry(cur, "symbols", "1054")
+    """
+    # logger.info("[trace]")
+    if entry_type == "expr local to global":
+        cur.execute(
+            "DELETE FROM expr_local_to_global WHERE expr_local_id=?", (entry_id,)
+        )
+        return
+    if entry_type not in ENTRY_TABLES.keys():
+        logger.error("unrecognized entry type " + str(entry_type))
+        raise Exception("unrecognized entry type " + str(entry_type))
+    table_dict = ENTRY_TABLES[entry_type]
+    if entry_type == "derivations":
+        cur.execute(
+            "DELETE FROM step_expressions WHERE step_id IN "
+            + "(SELECT step_id FROM steps WHERE deriv_id=?)",
+            (entry_id,),
+        )
+        cur.execute("DELETE FROM steps WHERE deriv_id=?", (entry_id,))
+    cur.execute(
+        "DELETE FROM "
+        + table_dict["table"]
+        + " WHERE "
+        + table_dict["key"]
+        + "=?",
+        (entry_id,),
+    )
+    return
+
+
+def upsert_step(cur, deriv_id: str, step_id: str, step_dict: dict) -> None:
+    """
+    Insert or replace one step and its edges to expressions.
+
+    Args:
+        cur: sqlite3 cursor
+        deriv_id: numeric identifier of the derivation
+        step_id: numeric identifier of the step within the derivation
+        step_dict: dat["derivations"][deriv_id]["steps"][step_id]
+    Returns:
+        None
+    Raises:
+
+    >>> upsert_step(cur, "000001", "1029890", step_dict)
+    """
+    # logger.info("[trace]")
+    step_row_dict = {
+        k: v for k, v in step_dict.items() if k not in STEP_EXPRESSION_ROLES
+    }
+    cur.execute(
+        "INSERT INTO steps VALUES ("
+        + ", ".join(["?"] * (len(STEP_COLUMNS) + 3))
+        + ") ON CONFLICT(step_id) DO UPDATE SET deriv_id=excluded.deriv_id, "
+        + ", ".join(
+            [quote(col) + "=excluded." + quote(col) for col in STEP_COLUMNS + ["other"]]
+        ),
+        [step_id, deriv_id] + split_entry(STEP_COLUMNS, step_row_dict),
+    )
+    cur.execute("DELETE FROM step_expressions WHERE step_id=?", (step_id,))
+    cur.executemany(
+        "INSERT INTO step_expressions VALUES (?, ?, ?, ?)",
+        [
+            (step_id, role, position, expr_local_id)
+            for role in STEP_EXPRESSION_ROLES
+            for position, expr_local_id in enumerate(step_dict.get(role, []))
+        ],
+    )
+    return
+
+
+def delete_step(cur, step_id: str) -> None:
+    """
+    >>> delete_step(cur, "1029890")
+    """
+    # logger.info("[trace]")
+    cur.execute("DELETE FROM step_expressions WHERE step_id=?", (step_id,))
+    cur.execute("DELETE FROM steps WHERE step_id=?", (step_id,))
+    return
+
+
+def write_dat(cur, dat: dict, previous_dat) -> int:
+    """
+    Write "dat" to the tables.
+
+    If previous_dat is provided, only the entries that differ between
+    previous_dat and dat are written; otherwise every table is rewritten.
+    previous_dat must reflect the current content of the tables.
+
+    Args:
+        cur: sqlite3 cursor
+        dat: dict
+        previous_dat: dict or None
+    Returns:
+        number of entries written or deleted
+    Raises:
+
+    >>> write_dat(cur, dat, None)
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    if previous_dat is None:
+        for table_dict in ENTRY_TABLES.values():
+            cur.execute("DELETE FROM " + table_dict["table"])
+        cur.execute("DELETE FROM steps")
+        cur.execute("DELETE FROM step_expressions")
+        cur.execute("DELETE FROM expr_local_to_global")
+        previous_dat = {}
+
+    # all deletes are run before any upsert; otherwise a step that moved
+    # to a derivation that is written earlier would be deleted after its new row
+    number_of_changes = 0
+    list_of_entry_types = list(ENTRY_TABLES.keys()) + ["expr local to global"]
+    for entry_type in list_of_entry_types:
+        new_entries = dat.get(entry_type, {})
+        old_entries = previous_dat.get(entry_type, {})
+        for entry_id in old_entries.keys():
+            if entry_id not in new_entries.keys():
+                delete_entry(cur, entry_type, entry_id)
+                number_of_changes += 1
+            elif entry_type == "derivations":
+                new_steps = new_entries[entry_id].get("steps", {})
+                for step_id in old_entries[entry_id].get("steps", {}).keys():
+                    if step_id not in new_steps.keys():
+                        delete_step(cur, step_id)
+                        number_of_changes += 1
+
+    for entry_type in list_of_entry_types:
+        new_entries = dat.get(entry_type, {})
+        old_entries = previous_dat.get(entry_type, {})
+        for entry_id, entry_dict in new_entries.items():
+            if entry_type == "derivations":
+                old_deriv = dict(old_entries.get(entry_id, {}))
+                new_deriv = dict(entry_dict)
+                old_steps = old_deriv.pop("steps", {})
+                new_steps = new_deriv.pop("steps", {})
+                if (entry_id not in old_entries.keys()) or (old_deriv != new_deriv):
+                    upsert_entry(cur, entry_type, entry_id, new_deriv)
+                    number_of_changes += 1
+                for step_id, step_dict in new_steps.items():
+                    if old_steps.get(step_id) != step_dict:
+                        upsert_step(cur, entry_id, step_id, step_dict)
+                        number_of_changes += 1
+            elif (entry_id not in old_entries.keys()) or (
+                old_entries[entry_id] != entry_dict
+            ):
+                upsert_entry(cur, entry_type, entry_id, entry_dict)
+                number_of_changes += 1
+
+    logger.debug("relational write of " + str(number_of_changes) + " entries")
+    logger.info("[trace end " + trace_id + "]")
+    return number_of_changes
+
+
+# EOF
@@ -18,15 +18,18 @@ import sympy  # type: ignore
 from sympy.parsing.latex import parse_latex  # type: ignore
 import common_lib as clib
 from typing import Tuple  # , TextIO
+from fractions import Fraction
+import hashlib
 import logging
 import random
 import re
+import threading
 import latex_to_sympy
+import instrumentation  # a PDG file
 
 # https://docs.sympy.org/latest/modules/physics/units/examples.html
 # import sympy.physics.units.systems
 # import sympy.physics.units.systems.si
-from sympy.physics.units import mass, length, time, temperature, luminous_intensity, amount_of_substance, charge  # type: ignore
 from sympy.physics.units.systems.si import dimsys_SI  # type: ignore
 import sympy.physics.units  # type: ignore
 from sympy.vector import cross, dot  # type: ignore
@@ -45,9 +48,416 @@ logger = logging.getLogger(__name__)
 # doctest.run_docstring_examples(split_expr_into_lhs_rhs, globals(), verbose=True)
 
 
+# the keys of dat["symbols"][symbol_id]["dimensions"];
+# a dimension vector is the tuple of exponents in this order
+list_of_base_dimensions = [
+    "mass",
+    "length",
+    "time",
+    "temperature",
+    "electric charge",
+    "amount of substance",
+    "luminous intensity",
+]
+
+# SI dimensions (used by Sympy units like meter) expressed in the base dimensions
+SI_dimension_vectors = {
+    "mass": (1, 0, 0, 0, 0, 0, 0),
+    "length": (0, 1, 0, 0, 0, 0, 0),
+    "time": (0, 0, 1, 0, 0, 0, 0),
+    "temperature": (0, 0, 0, 1, 0, 0, 0),
+    "current": (0, 0, -1, 0, 1, 0, 0),
+    "amount_of_substance": (0, 0, 0, 0, 0, 1, 0),
+    "luminous_intensity": (0, 0, 0, 0, 0, 0, 1),
+}
+
+dimensionless = (0, 0, 0, 0, 0, 0, 0)
+
+# functions whose argument and result are dimensionless, e.g. sin(x)
+dimensionless_functions = (
+    sympy.exp,
+    sympy.log,
+    sympy.functions.elementary.trigonometric.TrigonometricFunction,
+    sympy.functions.elementary.trigonometric.InverseTrigonometricFunction,
+    sympy.functions.elementary.hyperbolic.HyperbolicFunction,
+)
+# functions whose result has the dimension of the argument, e.g. Abs(x)
+dimension_preserving_functions = (sympy.Abs, sympy.conjugate, sympy.re, sympy.im)
+
+# keys are path_to_db; see get_symbol_dimension_vectors
+symbol_dimension_vectors_per_db = {}  # type: dict
+# keys are from dimension_check_key; see check_dimensions_of_AST
+dimension_check_cache = {}  # type: dict
+dimension_check_cache_max_size = 100000
+dimension_lock = threading.Lock()
+
+
+def dimension_vector_of_symbol(symbol_id: str, symbol_dict: dict) -> tuple:
+    """
+    Args:
+        symbol_id: numeric identifier of the symbol
+        symbol_dict: an entry of dat["symbols"]
+    Returns:
+        tuple of exponents; see list_of_base_dimensions
+    Raises:
+        Exception if the symbol lacks dimensions
+
+    >>> dimension_vector_of_symbol("1054", dat["symbols"]["1054"])
+    (1, 2, -1, 0, 0, 0, 0)
+    """
+    # logger.info("[trace]")
+    if "dimensions" not in symbol_dict.keys():
+        raise Exception("dimensions missing for " + symbol_id)
+    return tuple(
+        int(symbol_dict["dimensions"].get(base_dimension, 0))
+        for base_dimension in list_of_base_dimensions
+    )
+
+
+def get_symbol_dimension_vectors(path_to_db: str) -> dict:
+    """
+    Computed once per database version; see common_lib.get_db_version
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        {symbol_id: dimension vector, or the error message if
+                    the symbol lacks dimensions}
+    Raises:
+
+    >>> get_symbol_dimension_vectors("pdg.db")["1054"]
+    (1, 2, -1, 0, 0, 0, 0)
+    """
+    # logger.info("[trace]")
+    db_version = clib.get_db_version(path_to_db)
+    with dimension_lock:
+        entry = symbol_dimension_vectors_per_db.get(path_to_db)
+        if (entry is not None) and (db_version is not None):
+            if entry["db version"] == db_version:
+                return entry["vectors"]
+
+    dat = clib.read_db(path_to_db)
+    symbol_dimension_vectors = {}  # type: dict
+    for symbol_id, symbol_dict in dat["symbols"].items():
+        try:
+            symbol_dimension_vectors[symbol_id] = dimension_vector_of_symbol(
+                symbol_id, symbol_dict
+            )
+        except Exception as err:
+            symbol_dimension_vectors[symbol_id] = str(err)
+    with dimension_lock:
+        symbol_dimension_vectors_per_db[path_to_db] = {
+            "db version": db_version,
+            "vectors": symbol_dimension_vectors,
+        }
+    return symbol_dimension_vectors
+
+
+def str_of_dimension_vector(dimension_vector) -> str:
+    """
+    >>> str_of_dimension_vector((1, 2, -1, 0, 0, 0, 0))
+    'mass length^2 time^-1'
+    """
+    # logger.info("[trace]")
+    if dimension_vector is None:
+        return "any (zero)"
+    list_of_factors = []
+    for base_dimension, power in zip(list_of_base_dimensions, dimension_vector):
+        if power == 1:
+            list_of_factors.append(base_dimension)
+        elif power != 0:
+            list_of_factors.append(base_dimension + "^" + str(power))
+    if len(list_of_factors) == 0:
+        return "dimensionless"
+    return " ".join(list_of_factors)
+
+
+def scale_dimension_vector(dimension_vector, power) -> tuple:
+    """
+    >>> scale_dimension_vector((0, 2, 0, 0, 0, 0, 0), Fraction(1, 2))
+    (0, 1, 0, 0, 0, 0, 0)
+    """
+    # logger.info("[trace]")
+    list_of_powers = []
+    for base_power in dimension_vector:
+        product = Fraction(base_power) * power
+        list_of_powers.append(
+            int(product) if product.denominator == 1 else product
+        )
+    return tuple(list_of_powers)
+
+
+def sum_of_dimension_vectors(list_of_vectors: list):
+    """
+    Zero (None) has any dimension, so the product of zero and anything is zero
+
+    >>> sum_of_dimension_vectors([(1, 0, 0, 0, 0, 0, 0), (0, 1, 0, 0, 0, 0, 0)])
+    (1, 1, 0, 0, 0, 0, 0)
+    """
+    # logger.info("[trace]")
+    if None in list_of_vectors:
+        return None
+    return tuple(sum(powers) for powers in zip(dimensionless, *list_of_vectors))
+
+
+def dimension_of_sympy_expr(
+    expr, symbol_dimension_vectors: dict, list_of_inconsistencies: list
+):
+    """
+    Propagate the dimensions of the PDG symbols through the expression tree.
+
+    Terms of a sum must have the same dimension; each mismatch is appended
+    to list_of_inconsistencies and the dimension of the first term is used.
+
+    Args:
+        expr: Sympy expression
+        symbol_dimension_vectors: see get_symbol_dimension_vectors
+        list_of_inconsistencies: appended to
+    Returns:
+        dimension vector, or None for zero (which has any dimension)
+    Raises:
+        Exception if the dimension cannot be determined
+
+    >>> dimension_of_sympy_expr(sympy.Symbol('pdg1054') * 2, vectors, [])
+    (1, 2, -1, 0, 0, 0, 0)
+    """
+    # logging turned off because this function gets called a lot!
+    # logger.info("[trace]")
+    if isinstance(expr, sympy.Symbol):
+        symbol_id = str(expr).replace("pdg", "")
+        if (not str(expr).startswith("pdg")) or (
+            symbol_id not in symbol_dimension_vectors.keys()
+        ):
+            raise Exception("no dimensions for symbol " + str(expr))
+        if isinstance(symbol_dimension_vectors[symbol_id], str):
+            raise Exception(symbol_dimension_vectors[symbol_id])
+        return symbol_dimension_vectors[symbol_id]
+    if expr.is_number:
+        if expr.is_zero:
+            return None
+        return dimensionless
+    if isinstance(expr, sympy.physics.units.Quantity):
+        return sum_of_dimension_vectors(
+            [
+                scale_dimension_vector(SI_dimension_vectors[str(dim.name)], power)
+                for dim, power in dimsys_SI.get_dimensional_dependencies(
+                    expr.dimension
+                ).items()
+            ]
+        )
+
+    list_of_arg_vectors = [
+        dimension_of_sympy_expr(arg, symbol_dimension_vectors, list_of_inconsistencies)
+        for arg in expr.args
+    ]
+
+    if isinstance(expr, sympy.Mul):
+        return sum_of_dimension_vectors(list_of_arg_vectors)
+    if isinstance(expr, sympy.Add):
+        list_of_term_vectors = [v for v in list_of_arg_vectors if v is not None]
+        if len(list_of_term_vectors) == 0:
+            return None
+        for term, term_vector in zip(expr.args, list_of_arg_vectors):
+            if (term_vector is not None) and (term_vector != list_of_term_vectors[0]):
+                list_of_inconsistencies.append(
+                    "the term "
+                    + str(term)
+                    + " has "
+                    + str_of_dimension_vector(term_vector)
+                    + " rather than "
+                    + str_of_dimension_vector(list_of_term_vectors[0])
+                )
+        return list_of_term_vectors[0]
+    if isinstance(expr, sympy.Pow):
+        base_vector, exponent_vector = list_of_arg_vectors
+        if exponent_vector not in [None, dimensionless]:
+            list_of_inconsistencies.append("the exponent of " + str(expr))
+        if base_vector is None:
+            return None
+        if base_vector == dimensionless:
+            return dimensionless
+        if not expr.exp.is_Rational:
+            raise Exception("non-numeric power of a dimensioned base: " + str(expr))
+        return scale_dimension_vector(
+            base_vector, Fraction(int(expr.exp.p), int(expr.exp.q))
+        )
+    if isinstance(expr, dimensionless_functions):
+        for arg, arg_vector in zip(expr.args, list_of_arg_vectors):
+            if arg_vector not in [None, dimensionless]:
+                list_of_inconsistencies.append(
+                    "the argument "
+                    + str(arg)
+                    + " of "
+                    + type(expr).__name__
+                    + " has "
+                    + str_of_dimension_vector(arg_vector)
+                )
+        return dimensionless
+    if isinstance(expr, dimension_preserving_functions):
+        return list_of_arg_vectors[0]
+    if isinstance(expr, sympy.Derivative):
+        # Derivative(f, (x, n)) has the dimension of f / x^n
+        list_of_vectors = [list_of_arg_vectors[0]]
+        for variable, count in expr.variable_count:
+            list_of_vectors.append(
+                scale_dimension_vector(
+                    dimension_of_sympy_expr(
+                        variable, symbol_dimension_vectors, list_of_inconsistencies
+                    ),
+                    -int(count),
+                )
+            )
+        return sum_of_dimension_vectors(list_of_vectors)
+    if isinstance(expr, sympy.Integral):
+        # Integral(f, (x, a, b)) has the dimension of f * x
+        list_of_vectors = [list_of_arg_vectors[0]]
+        for limit in expr.limits:
+            list_of_vectors.append(
+                dimension_of_sympy_expr(
+                    limit[0], symbol_dimension_vectors, list_of_inconsistencies
+                )
+            )
+        return sum_of_dimension_vectors(list_of_vectors)
+    if isinstance(expr, sympy.Tuple):
+        # the limits of Integral and Derivative; handled above
+        return dimensionless
+    raise Exception("no dimension rule for " + type(expr).__name__)
+
+
+def dimension_check_key(ast_str: str, symbol_dimension_vectors: dict) -> str:
+    """
+    The result of a check depends on the AST and on the dimensions of the
+    symbols in the AST, so editing a symbol only invalidates the expressions
+    that use that symbol.
+
+    >>> dimension_check_key("Pow(Symbol('pdg9139'), Integer(2))", vectors)
+    """
+    # logger.info("[trace]")
+    list_of_symbol_IDs = sorted(latex_to_sympy.get_symbol_IDs_from_AST_str(ast_str))
+    return hashlib.md5(
+        (
+            ast_str
+            + repr(
+                [
+                    (symb_ID, symbol_dimension_vectors.get(symb_ID))
+                    for symb_ID in list_of_symbol_IDs
+                ]
+            )
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+@instrumentation.timed("sympy")
+def check_dimensions_of_AST(ast_str: str, symbol_dimension_vectors: dict) -> dict:
+    """
+    The report does not depend on which expression the AST belongs to,
+    so it is cached on the AST and symbol dimensions alone;
+    see report_for_expression for adding the expression ID to error results.
+
+    Args:
+        ast_str: see latex_to_sympy.get_sympy_expr_from_AST_str
+        symbol_dimension_vectors: see get_symbol_dimension_vectors
+    Returns:
+        {"result": "dimensions are consistent", "inconsistent dimensions",
+                   "no LHS/RHS split", "error with getting LaTeX",
+                   or "error for dim",
+         "LHS": dimensions, "RHS": dimensions, "detail": explanation}
+    Raises:
+
+    >>> check_dimensions_of_AST("Equality(Symbol('pdg1054'), Symbol('pdg1054'))", vectors)
+    {'result': 'dimensions are consistent', ...}
+    """
+    # logger.info("[trace]")
+    cache_key = dimension_check_key(ast_str, symbol_dimension_vectors)
+    with dimension_lock:
+        if cache_key in dimension_check_cache.keys():
+            return dimension_check_cache[cache_key]
+
+    report = {"result": "", "LHS": "", "RHS": "", "detail": ""}
+    if "Equality(" not in ast_str:
+        report["result"] = "no LHS/RHS split"
+    else:
+        try:
+            expr = latex_to_sympy.get_sympy_expr_from_AST_str(ast_str)
+            LHS = expr.lhs
+            RHS = expr.rhs
+        except Exception as err:
+            logger.error(str(err))
+            logger.error("ast_str=" + ast_str)
+            report["result"] = "error with getting LaTeX"
+            report["detail"] = str(err)
+            LHS = None
+        if LHS is not None:
+            list_of_inconsistencies = []  # type: list
+            try:
+                LHS_vector = dimension_of_sympy_expr(
+                    LHS, symbol_dimension_vectors, list_of_inconsistencies
+                )
+                RHS_vector = dimension_of_sympy_expr(
+                    RHS, symbol_dimension_vectors, list_of_inconsistencies
+                )
+                report["LHS"] = str_of_dimension_vector(LHS_vector)
+                report["RHS"] = str_of_dimension_vector(RHS_vector)
+                if (
+                    (LHS_vector is not None)
+                    and (RHS_vector is not None)
+                    and (LHS_vector != RHS_vector)
+                ):
+                    list_of_inconsistencies.append("LHS and RHS differ")
+                if len(list_of_inconsistencies) > 0:
+                    report["result"] = "inconsistent dimensions"
+                    report["detail"] = "; ".join(list_of_inconsistencies)
+                else:
+                    report["result"] = "dimensions are consistent"
+            except Exception as err:
+                report["result"] = "error for dim"
+                report["detail"] = str(err)
+
+    with dimension_lock:
+        if len(dimension_check_cache) >= dimension_check_cache_max_size:
+            dimension_check_cache.clear()
+        dimension_check_cache[cache_key] = report
+    return report
+
+
+def report_for_expression(report: dict, expr_global_id: str) -> dict:
+    """
+    Args:
+        report: from check_dimensions_of_AST; not modified since it is cached
+        expr_global_id: numeric identifier of the expression
+    Returns:
+        a copy of report in which error results name the expression
+    Raises:
+
+    >>> report_for_expression({"result": "error for dim", "LHS": "", "RHS": "", "detail": ""}, "9999999953")
+    {'result': 'error for dim with 9999999953', 'LHS': '', 'RHS': '', 'detail': ''}
+    """
+    # logger.info("[trace]")
+    report = dict(report)
+    if report["result"] == "error with getting LaTeX":
+        report["result"] = "error with getting LaTeX for " + expr_global_id
+    elif report["result"] == "error for dim":
+        report["result"] = "error for dim with " + expr_global_id
+    return report
+
+
 def validate_dimensions(expr_global_id: str, path_to_db: str) -> str:
     """
-    >>> validate_dimensions()
+    For a single expression; see validate_dimensions_of_all_expressions
+
+    Args:
+        expr_global_id: numeric identifier of the expression
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        "dimensions are consistent", "inconsistent dimensions",
+        "no LHS/RHS split", or an error message
+    Raises:
+        Exception if expr_global_id is not in the database
+
+    >>> validate_dimensions("9999999953", "pdg.db")
+    'dimensions are consistent'
     """
     trace_id = str(random.randint(1000000, 9999999))
     logger.info("[trace start " + trace_id + "]")
@@ -61,82 +471,48 @@ def validate_dimensions(expr_global_id: str, path_to_db: str) -> str:
     else:
         raise Exception(expr_global_id + " is not in dat expressions")
 
-    if "Equality(" not in ast_str:
-        return "no LHS/RHS split"
-    expr = latex_to_sympy.get_sympy_expr_from_AST_str(ast_str)
-    try:
-        LHS = expr.lhs
-        RHS = expr.rhs
-    except Exception as err:
-        logger.error(str(err))
-        logger.error("ast_str=" + ast_str)
-        return "error with getting LaTeX for " + expr_global_id
-
-    logger.debug("LHS = " + str(LHS))  # LHS = pdg4201*pdg9491
-    logger.debug("RHS = " + str(RHS))  # RHS = 1/pdg9491
-
-    list_of_symbol_IDs = latex_to_sympy.get_symbol_IDs_from_AST_str(ast_str)
-    logger.debug(
-        "list of symbols = " + str(list_of_symbol_IDs)
-    )  # list of symbols = ['4201', '9491']
-
-    # for each symbol, what is the dimension according to PDG?
-
-    list_of_pairs = []
-    for symb_ID in list_of_symbol_IDs:
-        sym_dim = ""
-        if "dimensions" not in dat["symbols"][symb_ID]:
-            raise Exception("dimensions missing for " + symb_ID)
-        for dim, power in dat["symbols"][symb_ID]["dimensions"].items():
-            # logger.debug(dim + " to the " + str(power))
-            if power != 0:
-                # logger.debug(dim + "**" + str(power))
-                sym_dim += "(" + dim + "**" + str(power) + ")*"
-        logger.debug("total dim for pdg" + str(symb_ID) + " = " + sym_dim[:-1])
-        if len(sym_dim) == 0:
-            logger.debug(str(symb_ID) + " is dimensionless")
-            exec("pdg" + str(symb_ID) + " = mass/mass")
-        else:
-            exec("pdg" + str(symb_ID) + " = " + sym_dim[:-1].replace(" ", "_"))
-            # note that the "dimensions" used in PDG are same as waht is referenced in Sympy physics.units except for replacing ' ' with '_'
-            # https://github.com/sympy/sympy/blob/master/sympy/physics/units/systems/si.py
-
-    # the following if/else deals with the special case where
-    # one of the sides is an integer (e.g., 0 or 1 or something else)
-    # in that scenario, we do not evaluate the Sympy expression --
-    # just leave it as a Sympy number that does not have dimension
-    # If the following code were not present, then the dimensional check fails
-    #    logger.debug("new idea: " + str(LHS))
-    #    logger.debug("new idea: " + str(RHS))
-
-    #    if type(eval(str(LHS))) != type(1):
-    #        evaluated_LHS = eval(str(LHS))
-    #    else:
-    #        evaluated_LHS = eval("sympy.Integer(0)")
-    #    if type(eval(str(RHS))) != type(1):
-    #        evaluated_RHS = eval(str(RHS))
-    #    else:
-    #        evaluated_RHS = eval("sympy.Integer(0)")
-
-    #    logger.debug(str(evaluated_LHS) + " | " + str(evaluated_RHS))
-
-    # the following fail because evaluating raw Sympy is not supported
-    #    logger.debug("LHS dim = " + str(eval(str(LHS))))
-    #    logger.debug("RHS dim = " + str(eval(str(RHS))))
-
-    try:
-        determine_consistency = dimsys_SI.equivalent_dims(
-            eval(str(LHS)), eval(str(RHS))
-        )
-    except Exception as err:
-        return "error for dim with " + expr_global_id
+    report = report_for_expression(
+        check_dimensions_of_AST(ast_str, get_symbol_dimension_vectors(path_to_db)),
+        expr_global_id,
+    )
+    logger.debug(str(report))
+    logger.info("[trace end " + trace_id + "]")
+    return report["result"]
 
-    if determine_consistency:
-        return "dimensions are consistent"
-    else:
-        return "inconsistent dimensions"
 
-    return "dim not checked"
+def validate_dimensions_of_all_expressions(path_to_db: str) -> dict:
+    """
+    Check every expression in the database.
+    Symbol dimensions are computed once, and expressions whose AST and symbol
+    dimensions are unchanged since the previous check are not checked again.
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+    Returns:
+        {"summary": {result: count},
+         "expressions": {expr_global_id: see report_for_expression}}
+    Raises:
+
+    >>> validate_dimensions_of_all_expressions("pdg.db")["summary"]
+    {'dimensions are consistent': 612, 'inconsistent dimensions': 25, ...}
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    dat = clib.read_db(path_to_db)
+    symbol_dimension_vectors = get_symbol_dimension_vectors(path_to_db)
+    dimension_report = {"summary": {}, "expressions": {}}  # type: dict
+    for expr_global_id, expr_dict in dat["expressions"].items():
+        report = check_dimensions_of_AST(expr_dict["AST"], symbol_dimension_vectors)
+        dimension_report["expressions"][expr_global_id] = report_for_expression(
+            report, expr_global_id
+        )
+        dimension_report["summary"][report["result"]] = (
+            dimension_report["summary"].get(report["result"], 0) + 1
+        )
+    logger.info("[trace end " + trace_id + "]")
+    return dimension_report
 
 
 # EOF
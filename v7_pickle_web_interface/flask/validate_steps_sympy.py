@@ -38,14 +38,41 @@ import sympy  # type: ignore
 from sympy.parsing.latex import parse_latex  # type: ignore
 import common_lib as clib
 from typing import Tuple  # , TextIO
+import argparse
+import concurrent.futures
+import hashlib
 import logging
+import multiprocessing
 import random
 import re
+import sqlite3
+import threading
+import time
 import latex_to_sympy
+import instrumentation  # a PDG file
 
 logger = logging.getLogger(__name__)
 
-
+# results of validate_step are stored on disk so that steps whose content
+# has not changed are not validated again; see validate_step_cached
+path_to_validation_results_db = "validation_results.db"
+
+# validate_step runs in worker processes so that a step which exceeds
+# validation_timeout can be killed; see validate_step_with_timeout
+validation_timeout = 30
+max_validation_workers = 2
+# "forkserver" rather than "fork": the gunicorn worker has threads (e.g. the
+# Latex rendering pool), and a child forked from a multithreaded process can
+# inherit a lock that another thread held and then deadlock on it.
+# The fork server imports this module once, so starting a worker is fast.
+validation_context = multiprocessing.get_context("forkserver")
+validation_context.set_forkserver_preload(["validate_steps_sympy"])
+idle_validation_workers = []  # type: list
+validation_workers_lock = threading.Lock()
+validation_worker_slots = threading.BoundedSemaphore(max_validation_workers)
+
+
+@instrumentation.timed("sympy")
 def validate_step(deriv_id: str, step_id: str, path_to_db: str) -> str:
     """
     The possible return strings from this function include:
@@ -143,282 +170,403 @@ def validate_step(deriv_id: str, step_id: str, path_to_db: str) -> str:
     #    logger.debug(str(latex_dict))
     #    logger.debug(step_dict["inf rule"])
 
-    if step_dict["inf rule"] == "add X to both sides":
-        logger.info("[trace end " + trace_id + "]")
-        return add_X_to_both_sides(latex_dict)
-    elif step_dict["inf rule"] == "subtract X from both sides":
-        logger.info("[trace end " + trace_id + "]")
-        return subtract_X_from_both_sides(latex_dict)
-    elif step_dict["inf rule"] == "multiply both sides by":
-        logger.info("[trace end " + trace_id + "]")
-        return multiply_both_sides_by(latex_dict)
-    elif step_dict["inf rule"] == "divide both sides by":
-        logger.info("[trace end " + trace_id + "]")
-        return divide_both_sides_by(latex_dict)
-    elif step_dict["inf rule"] == "change variable X to Y":
-        logger.info("[trace end " + trace_id + "]")
-        return change_variable_X_to_Y(latex_dict)
-    elif step_dict["inf rule"] == "add zero to LHS":
-        logger.info("[trace end " + trace_id + "]")
-        return add_zero_to_LHS(latex_dict)
-    elif step_dict["inf rule"] == "add zero to RHS":
-        logger.info("[trace end " + trace_id + "]")
-        return add_zero_to_RHS(latex_dict)
-    elif step_dict["inf rule"] == "multiply LHS by unity":
-        logger.info("[trace end " + trace_id + "]")
-        return multiply_LHS_by_unity(latex_dict)
-    elif step_dict["inf rule"] == "multiply RHS by unity":
-        logger.info("[trace end " + trace_id + "]")
-        return multiply_RHS_by_unity(latex_dict)
-    elif step_dict["inf rule"] == "swap LHS with RHS":
-        logger.info("[trace end " + trace_id + "]")
-        return swap_LHS_with_RHS(latex_dict)
-    elif step_dict["inf rule"] == "take curl of both sides":
-        logger.info("[trace end " + trace_id + "]")
-        return take_curl_of_both_sides(latex_dict)
-    elif step_dict["inf rule"] == "apply divergence":
-        logger.info("[trace end " + trace_id + "]")
-        return apply_divergence(latex_dict)
-    elif step_dict["inf rule"] == "indefinite integral over":
-        logger.info("[trace end " + trace_id + "]")
-        return indefinite_integral_over(latex_dict)
-    elif step_dict["inf rule"] == "indefinite integration":
-        logger.info("[trace end " + trace_id + "]")
-        return indefinite_integration(latex_dict)
-    elif step_dict["inf rule"] == "indefinite integrate LHS over":
-        logger.info("[trace end " + trace_id + "]")
-        return indefinite_integrate_LHS_over(latex_dict)
-    elif step_dict["inf rule"] == "indefinite integrate RHS over":
-        logger.info("[trace end " + trace_id + "]")
-        return indefinite_integrate_RHS_over(latex_dict)
-    elif step_dict["inf rule"] == "integrate over from to":
-        logger.info("[trace end " + trace_id + "]")
-        return integrate_over_from_to(latex_dict)
-    elif step_dict["inf rule"] == "partially differentiate with respect to":
-        logger.info("[trace end " + trace_id + "]")
-        return partially_differentiate_with_respect_to(latex_dict)
-    elif step_dict["inf rule"] == "X cross both sides by":
-        logger.info("[trace end " + trace_id + "]")
-        return X_cross_both_sides_by(latex_dict)
-    elif step_dict["inf rule"] == "both sides cross X":
-        logger.info("[trace end " + trace_id + "]")
-        return both_sides_cross_X(latex_dict)
-    elif step_dict["inf rule"] == "X dot both sides":
-        logger.info("[trace end " + trace_id + "]")
-        return X_dot_both_sides(latex_dict)
-    elif step_dict["inf rule"] == "both sides dot X":
-        logger.info("[trace end " + trace_id + "]")
-        return both_sides_dot_X(latex_dict)
-    elif step_dict["inf rule"] == "make expr power":
-        logger.info("[trace end " + trace_id + "]")
-        return make_expr_power(latex_dict)
-    elif step_dict["inf rule"] == "select real parts":
-        logger.info("[trace end " + trace_id + "]")
-        return select_real_parts(latex_dict)
-    elif step_dict["inf rule"] == "select imag parts":
-        logger.info("[trace end " + trace_id + "]")
-        return select_imag_parts(latex_dict)
-    elif step_dict["inf rule"] == "sum exponents LHS":
-        logger.info("[trace end " + trace_id + "]")
-        return sum_exponents_LHS(latex_dict)
-    elif step_dict["inf rule"] == "sum exponents RHS":
-        logger.info("[trace end " + trace_id + "]")
-        return sum_exponents_RHS(latex_dict)
-    elif step_dict["inf rule"] == "add expr 1 to expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return add_expr_1_to_expr_2(latex_dict)
-    elif step_dict["inf rule"] == "substitute RHS of expr 1 into expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return substitute_RHS_of_expr_1_into_expr_2(latex_dict)
-    elif step_dict["inf rule"] == "substitute LHS of expr 1 into expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return substitute_LHS_of_expr_1_into_expr_2(latex_dict)
-    elif step_dict["inf rule"] == "mult expr 1 by expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return mult_expr_1_by_expr_2(latex_dict)
-    elif step_dict["inf rule"] == "LHS of expr 1 equals LHS of expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return LHS_of_expr_1_eq_LHS_of_expr_2(latex_dict)
-    elif step_dict["inf rule"] == "RHS of expr 1 equals RHS of expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return RHS_of_expr_1_eq_RHS_of_expr_2(latex_dict)
-    elif step_dict["inf rule"] == "raise both sides to power":
-        logger.info("[trace end " + trace_id + "]")
-        return raise_both_sides_to_power(latex_dict)
-    elif step_dict["inf rule"] == "claim expr 1 equals expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return claim_expr_1_equals_expr_2(latex_dict)
-    elif step_dict["inf rule"] == "claim LHS equals RHS":
-        logger.info("[trace end " + trace_id + "]")
-        return claim_LHS_equals_RHS(latex_dict)
-    elif step_dict["inf rule"] == "expand integrand":
-        logger.info("[trace end " + trace_id + "]")
-        return expand_integrand(latex_dict)
-    elif step_dict["inf rule"] == "function is even":
-        logger.info("[trace end " + trace_id + "]")
-        return function_is_even(latex_dict)
-    elif step_dict["inf rule"] == "function is odd":
-        logger.info("[trace end " + trace_id + "]")
-        return function_is_odd(latex_dict)
-    elif step_dict["inf rule"] == "conjugate function X":
-        logger.info("[trace end " + trace_id + "]")
-        return conjugate_function_X(latex_dict)
-    elif step_dict["inf rule"] == "conjugate both sides":
-        logger.info("[trace end " + trace_id + "]")
-        return conjugate_both_sides(latex_dict)
-    elif step_dict["inf rule"] == "conjugate transpose both sides":
-        logger.info("[trace end " + trace_id + "]")
-        return conjugate_transpose_both_sides(latex_dict)
-    elif step_dict["inf rule"] == "distribute conjugate transpose to factors":
-        logger.info("[trace end " + trace_id + "]")
-        return distribute_conjugate_transpose_to_factors(latex_dict)
-    elif step_dict["inf rule"] == "distribute conjugate to factors":
-        logger.info("[trace end " + trace_id + "]")
-        return distribute_conjugate_to_factors(latex_dict)
-    elif step_dict["inf rule"] == "expand magnitude to conjugate":
-        logger.info("[trace end " + trace_id + "]")
-        return expand_magnitude_to_conjugate(latex_dict)
-    elif step_dict["inf rule"] == "replace scalar with vector":
-        logger.info("[trace end " + trace_id + "]")
-        return replace_scalar_with_vector(latex_dict)
-    elif step_dict["inf rule"] == "simplify":
-        logger.info("[trace end " + trace_id + "]")
-        return simplify(latex_dict)
-    elif step_dict["inf rule"] == "factor out X":
-        logger.info("[trace end " + trace_id + "]")
-        return factor_out_x(latex_dict)
-    elif step_dict["inf rule"] == "factor out X from LHS":
-        logger.info("[trace end " + trace_id + "]")
-        return factor_out_x_from_lhs(latex_dict)
-    elif step_dict["inf rule"] == "factor out X from RHS":
-        logger.info("[trace end " + trace_id + "]")
-        return factor_out_x_from_rhs(latex_dict)
-    elif step_dict["inf rule"] == "differentiate with respect to":
-        logger.info("[trace end " + trace_id + "]")
-        return differentiate_with_respect_to(latex_dict)
-    elif step_dict["inf rule"] == "apply function to both sides of expression":
-        logger.info("[trace end " + trace_id + "]")
-        return apply_function_to_both_sides_of_expression(latex_dict)
-    elif step_dict["inf rule"] == "substitute LHS of two expressions into expr":
-        logger.info("[trace end " + trace_id + "]")
-        return substitute_LHS_of_two_expressions_into_expr(latex_dict)
-    elif step_dict["inf rule"] == "substitute LHS of three expressions into expr":
-        logger.info("[trace end " + trace_id + "]")
-        return substitute_LHS_of_three_expressions_into_expr(latex_dict)
-    elif step_dict["inf rule"] == "substitute LHS of four expressions into expr":
-        logger.info("[trace end " + trace_id + "]")
-        return substitute_LHS_of_four_expressions_into_expr(latex_dict)
-    elif step_dict["inf rule"] == "substitute LHS of five expressions into expr":
-        logger.info("[trace end " + trace_id + "]")
-        return substitute_LHS_of_five_expressions_into_expr(latex_dict)
-    elif step_dict["inf rule"] == "substitute LHS of six expressions into expr":
-        logger.info("[trace end " + trace_id + "]")
-        return substitute_LHS_of_six_expressions_into_expr(latex_dict)
-    elif step_dict["inf rule"] == "expr 1 is equivalent to expr 2 under the condition":
-        logger.info("[trace end " + trace_id + "]")
-        return expr_is_equivalent_to_expr_under_the_condition(latex_dict)
-    elif step_dict["inf rule"] == "change two variables in expr":
-        logger.info("[trace end " + trace_id + "]")
-        return change_two_variables_in_expr(latex_dict)
-    elif step_dict["inf rule"] == "change three variables in expr":
-        logger.info("[trace end " + trace_id + "]")
-        return change_three_variables_in_expr(latex_dict)
-    elif step_dict["inf rule"] == "change four variables in expr":
-        logger.info("[trace end " + trace_id + "]")
-        return change_four_variables_in_expr(latex_dict)
-    elif step_dict["inf rule"] == "change five variables in expr":
-        logger.info("[trace end " + trace_id + "]")
-        return change_five_variables_in_expr(latex_dict)
-    elif step_dict["inf rule"] == "change six variables in expr":
-        logger.info("[trace end " + trace_id + "]")
-        return change_six_variables_in_expr(latex_dict)
-    elif step_dict["inf rule"] == "LHS of expr 1 equals LHS of expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return LHS_of_expr_equals_LHS_of_expr(latex_dict)
-    elif step_dict["inf rule"] == "square root both sides":
-        logger.info("[trace end " + trace_id + "]")
-        return square_root_both_sides(latex_dict)
-    elif step_dict["inf rule"] == "divide expr 1 by expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return divide_expr_by_expr(latex_dict)
-    elif step_dict["inf rule"] == "separate two vector components":
-        logger.info("[trace end " + trace_id + "]")
-        return separate_two_vector_components(latex_dict)
-    elif step_dict["inf rule"] == "separate three vector components":
-        logger.info("[trace end " + trace_id + "]")
-        return separate_three_vector_components(latex_dict)
-    elif step_dict["inf rule"] == "separate vector into two trigonometric ratios":
-        logger.info("[trace end " + trace_id + "]")
-        return separate_vector_into_two_trigonometric_ratios(latex_dict)
-    elif step_dict["inf rule"] == "maximum of expr":
-        logger.info("[trace end " + trace_id + "]")
-        return maximum_of_expr(latex_dict)
-    elif step_dict["inf rule"] == "evaluate definite integral":
-        logger.info("[trace end " + trace_id + "]")
-        return evaluate_definite_integral(latex_dict)
-    elif step_dict["inf rule"] == "expr 1 is true under condition expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return expr_is_true_under_condition_expr(latex_dict)
-    elif step_dict["inf rule"] == "declare variable replacement":
-        logger.info("[trace end " + trace_id + "]")
-        return declare_variable_replacement(latex_dict)
-    elif step_dict["inf rule"] == "integrate":
-        logger.info("[trace end " + trace_id + "]")
-        return integrate(latex_dict)
-    elif step_dict["inf rule"] == "replace constant with value":
-        logger.info("[trace end " + trace_id + "]")
-        return replace_constant_with_value(latex_dict)
-    elif step_dict["inf rule"] == "expand LHS":
-        logger.info("[trace end " + trace_id + "]")
-        return expand_LHS(latex_dict)
-    elif step_dict["inf rule"] == "expand RHS":
-        logger.info("[trace end " + trace_id + "]")
-        return expand_RHS(latex_dict)
-    elif step_dict["inf rule"] == "multiply expr 1 by expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return multiply_expr_by_expr(latex_dict)
-    elif step_dict["inf rule"] == "apply operator to bra":
-        logger.info("[trace end " + trace_id + "]")
-        return apply_operator_to_bra(latex_dict)
-    elif step_dict["inf rule"] == "apply operator to ket":
-        logger.info("[trace end " + trace_id + "]")
-        return apply_operator_to_ket(latex_dict)
-    elif step_dict["inf rule"] == "drop non-dominant term":
-        logger.info("[trace end " + trace_id + "]")
-        return drop_nondominant_term(latex_dict)
-    elif step_dict["inf rule"] == "apply gradient to scalar function":
-        logger.info("[trace end " + trace_id + "]")
-        return apply_gradient_to_scalar_function(latex_dict)
-    #    elif step_dict["inf rule"] == "":
-    #        logger.info("[trace end " + trace_id + "]")
-    #        return (latex_dict)
-    #    elif step_dict["inf rule"] == "":
-    #        logger.info("[trace end " + trace_id + "]")
-    #        return (latex_dict)
-    #    elif step_dict["inf rule"] == "":
-    #        logger.info("[trace end " + trace_id + "]")
-    #        return (latex_dict)
-    #    elif step_dict["inf rule"] == "":
-    #        logger.info("[trace end " + trace_id + "]")
-    #        return (latex_dict)
-    #    elif step_dict["inf rule"] == "":
-    #        logger.info("[trace end " + trace_id + "]")
-    #        return (latex_dict)
-    #    elif step_dict["inf rule"] == "":
-    #        logger.info("[trace end " + trace_id + "]")
-    #        return (latex_dict)
-    #    elif step_dict["inf rule"] == "":
-    #        logger.info("[trace end " + trace_id + "]")
-    #        return (latex_dict)
-    elif step_dict["inf rule"] == "subtract expr 1 from expr 2":
-        logger.info("[trace end " + trace_id + "]")
-        return subtract_expr_1_from_expr_2(latex_dict)
-    else:
+    if step_dict["inf rule"] not in infrule_checkers.keys():
         logger.error("unexpected inf rule:" + step_dict["inf rule"])
         raise Exception("Unexpected inf rule: " + step_dict["inf rule"])
 
     logger.info("[trace end " + trace_id + "]")
-    return "This message should not be seen"
+    return infrule_checkers[step_dict["inf rule"]](latex_dict)
+
+
+def md5_of_checker_source() -> str:
+    """
+    The result of a step depends on the inference rule checkers, the helpers
+    they call, and the AST parser; a change to any of these (including a
+    constant) changes this md5, so stored results are not reused.
+
+    Returns:
+        md5 of the source of this file and of latex_to_sympy.py
+    Raises:
+
+    >>> md5_of_checker_source()
+    """
+    # logger.info("[trace]")
+    checker_md5 = hashlib.md5()
+    for path_to_source in [__file__, latex_to_sympy.__file__]:
+        with open(path_to_source, "rb") as fil:
+            checker_md5.update(fil.read())
+    return checker_md5.hexdigest()
+
+
+def validation_key_of_step(dat: dict, deriv_id: str, step_id: str) -> str:
+    """
+    md5 of everything the result of validate_step depends on:
+    the inference rule, the Latex and AST of each connected expression
+    (as in compute.hash_of_step, plus the AST), the SymPy version,
+    and the source of the checkers; see md5_of_checker_source.
+
+    Args:
+        dat: the nested dictionary from clib.read_db
+        deriv_id: numeric identifier of the derivation
+        step_id: numeric identifier of the step within the derivation
+    Returns:
+        md5 as a hex string
+    Raises:
+
+    >>> validation_key_of_step(dat, "000001", "1029890")
+    """
+    # logger.info("[trace]")
+    step_dict = dat["derivations"][deriv_id]["steps"][step_id]
+    step_str = (
+        step_dict["inf rule"]
+        + "|sympy "
+        + sympy.__version__
+        + "|checkers "
+        + checker_source_md5
+    )
+    for connection_type in ["inputs", "outputs", "feeds"]:
+        step_str += "|" + connection_type
+        for expr_local_id in step_dict[connection_type]:
+            expr_global_id = dat["expr local to global"][expr_local_id]
+            expr_dict = dat["expressions"][expr_global_id]
+            step_str += "|" + expr_dict["latex"] + "|" + expr_dict.get("AST", "")
+    return hashlib.md5(step_str.encode("utf-8")).hexdigest()
+
+
+def connect_to_validation_results_db(path_to_results_db: str):
+    """
+    one row per step; the row is replaced when the content of the step changes
+
+    >>> connect_to_validation_results_db("validation_results.db")
+    """
+    # logger.info("[trace]")
+    conn = clib.create_sql_connection(path_to_results_db)
+    if conn is None:
+        raise Exception("no connection to " + path_to_results_db)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS validation_results ("
+        + "deriv_id TEXT NOT NULL, "
+        + "step_id TEXT NOT NULL, "
+        + "step_key TEXT NOT NULL, "
+        + "result TEXT NOT NULL, "
+        + "PRIMARY KEY (deriv_id, step_id))"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS validation_results_step_key "
+        + "ON validation_results (step_key)"
+    )
+    return conn
+
+
+def validate_step_cached(
+    deriv_id: str,
+    step_id: str,
+    path_to_db: str,
+    path_to_results_db: str = path_to_validation_results_db,
+) -> str:
+    """
+    Same as validate_step, but the result is read from the results store
+    when the step (or another step with identical content) was already validated.
+
+    The step is validated in a worker process with a timeout;
+    see validate_step_with_timeout.
+    Exceptions raised by validate_step are not stored, so those steps are
+    validated again on the next call.
+
+    Args:
+        deriv_id: numeric identifier of the derivation
+        step_id: numeric identifier of the step within the derivation
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+        path_to_results_db: filename of the SQLite file of validation results
+    Returns:
+        the return string of validate_step
+    Raises:
+        Exception if validate_step raises an exception
+
+    >>> validate_step_cached("000001", "1029890", "pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    dat = clib.read_db(path_to_db)
+    step_key = validation_key_of_step(dat, deriv_id, step_id)
+
+    conn = connect_to_validation_results_db(path_to_results_db)
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT result FROM validation_results WHERE step_key=? LIMIT 1", (step_key,)
+    )
+    row = cur.fetchone()
+    conn.close()
+    if row is not None:
+        logger.info("[trace end " + trace_id + "]")
+        return row[0]
+
+    status, result, wall_time = validate_step_with_timeout(
+        deriv_id, step_id, path_to_db
+    )
+    if status == "error":
+        logger.error(result)
+        raise Exception(result)
+    # a timeout is stored so that the step is not retried on every page view;
+    # the stored result is replaced when the content of the step changes
+    store_validation_result(path_to_results_db, deriv_id, step_id, step_key, result)
+
+    logger.info("[trace end " + trace_id + "]")
+    return result
+
+
+def store_validation_result(
+    path_to_results_db: str, deriv_id: str, step_id: str, step_key: str, result: str
+) -> None:
+    """
+    Replacing the row evicts the result for the previous content of this step.
+    Failing to store the result should not fail the validation, so errors are logged.
+
+    >>> store_validation_result("validation_results.db", "000001", "1029890", key, "valid")
+    """
+    # logger.info("[trace]")
+    conn = connect_to_validation_results_db(path_to_results_db)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO validation_results VALUES (?, ?, ?, ?)",
+            (deriv_id, step_id, step_key, result),
+        )
+        conn.commit()
+    except sqlite3.Error as err:
+        logger.error("unable to store validation result; " + str(err))
+    conn.close()
+    return
+
+
+def evict_validation_results(
+    path_to_db: str, path_to_results_db: str = path_to_validation_results_db
+) -> int:
+    """
+    Remove stored results for steps that no longer exist or whose content changed.
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+        path_to_results_db: filename of the SQLite file of validation results
+    Returns:
+        number of results removed
+    Raises:
+
+    >>> evict_validation_results("pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    dat = clib.read_db(path_to_db)
+    conn = connect_to_validation_results_db(path_to_results_db)
+    list_of_stale_rows = []
+    for deriv_id, step_id, step_key in conn.execute(
+        "SELECT deriv_id, step_id, step_key FROM validation_results"
+    ).fetchall():
+        if (deriv_id not in dat["derivations"].keys()) or (
+            step_id not in dat["derivations"][deriv_id]["steps"].keys()
+        ):
+            list_of_stale_rows.append((deriv_id, step_id))
+            continue
+        try:
+            current_key = validation_key_of_step(dat, deriv_id, step_id)
+        except KeyError:  # step refers to a missing expression
+            current_key = ""
+        if current_key != step_key:
+            list_of_stale_rows.append((deriv_id, step_id))
+    conn.executemany(
+        "DELETE FROM validation_results WHERE deriv_id=? AND step_id=?",
+        list_of_stale_rows,
+    )
+    conn.commit()
+    conn.close()
+
+    logger.info("[trace end " + trace_id + "]")
+    return len(list_of_stale_rows)
+
+
+def validation_worker(connection) -> None:
+    """
+    Body of a validation worker process; see validate_step_with_timeout.
+    For each (deriv_id, step_id, path_to_db) received, run validate_step and
+    send (status, result, wall time) back. Exits when None is received.
+
+    >>> validation_worker(connection)
+    """
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:  # the parent closed its end of the pipe
+            break
+        if task is None:
+            break
+        deriv_id, step_id, path_to_db = task
+        start_time = time.time()
+        try:
+            result = validate_step(deriv_id, step_id, path_to_db)
+            status = "completed"
+        except Exception as err:
+            result = str(err)
+            status = "error"
+        connection.send((status, result, time.time() - start_time))
+    connection.close()
+    return
+
+
+def take_validation_worker() -> tuple:
+    """
+    Returns:
+        (process, connection) of an idle worker; a worker is started if none is idle
+    Raises:
+
+    >>> take_validation_worker()
+    """
+    # logger.info("[trace]")
+    with validation_workers_lock:
+        while len(idle_validation_workers) > 0:
+            proc, connection = idle_validation_workers.pop()
+            if proc.is_alive():
+                return proc, connection
+            connection.close()
+    parent_connection, child_connection = validation_context.Pipe()
+    proc = validation_context.Process(
+        target=validation_worker, args=(child_connection,), daemon=True
+    )
+    proc.start()
+    child_connection.close()
+    return proc, parent_connection
+
+
+@instrumentation.timed("sympy", "validate_step")
+def validate_step_with_timeout(
+    deriv_id: str,
+    step_id: str,
+    path_to_db: str,
+    step_timeout: float = validation_timeout,
+) -> Tuple[str, str, float]:
+    """
+    Run validate_step in a worker process so that a step which exceeds
+    step_timeout (e.g. a runaway sympy.simplify) is killed rather than
+    holding the calling thread. Unlike the SIGALRM-based timeout decorator
+    in compute.py, this works when called from any thread,
+    e.g. a gunicorn gthread worker.
+
+    Workers are reused for later steps; a worker is replaced only when
+    it is killed. At most max_validation_workers steps run at once
+    per process; further calls wait for a worker.
+
+    Args:
+        deriv_id: numeric identifier of the derivation
+        step_id: numeric identifier of the step within the derivation
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+        step_timeout: maximum number of seconds for the step
+    Returns:
+        status: "completed" or "error" or "timeout"
+        result: the return string of validate_step, or the error message
+        wall_time: seconds
+    Raises:
+
+    >>> validate_step_with_timeout("000001", "1029890", "pdg.db")
+    ('completed', 'valid', 0.41)
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    with validation_worker_slots:
+        proc, connection = take_validation_worker()
+        start_time = time.time()
+        try:
+            connection.send((deriv_id, step_id, path_to_db))
+            if connection.poll(step_timeout):
+                status, result, wall_time = connection.recv()
+                with validation_workers_lock:
+                    idle_validation_workers.append((proc, connection))
+                logger.info("[trace end " + trace_id + "]")
+                return status, result, wall_time
+            status = "timeout"
+            result = "validation exceeded " + str(step_timeout) + " seconds"
+            logger.warning(deriv_id + " " + step_id + ": " + result)
+        except (EOFError, OSError):  # the worker exited without sending a result
+            status = "error"
+            result = "validation process exited with code " + str(proc.exitcode)
+            logger.error(deriv_id + " " + step_id + ": " + result)
+        proc.kill()
+        proc.join()
+        connection.close()
+
+    logger.info("[trace end " + trace_id + "]")
+    return status, result, time.time() - start_time
+
+
+def validate_all_steps(
+    path_to_db: str,
+    step_timeout: float = validation_timeout,
+    path_to_results_db: str = path_to_validation_results_db,
+) -> dict:
+    """
+    Validate every step of every derivation, with steps run in parallel
+    in the worker processes of validate_step_with_timeout.
+    Results other than errors are stored, as in validate_step_cached.
+
+    This is slow, so it is not run by the web server; see the command line
+    usage at the end of this file.
+
+    Args:
+        path_to_db: filename of the SQL database containing
+                    a JSON entry that returns a nested dictionary
+        step_timeout: maximum number of seconds per step
+        path_to_results_db: filename of the SQLite file of validation results
+    Returns:
+        report: {deriv_id: {step_id: {"inf rule": str,
+                                      "status": "completed" or "error" or "timeout",
+                                      "result": str,
+                                      "wall time": float}}}
+    Raises:
+
+    >>> validate_all_steps("pdg.db")
+    """
+    trace_id = str(random.randint(1000000, 9999999))
+    logger.info("[trace start " + trace_id + "]")
+
+    dat = clib.read_db(path_to_db)
+
+    report = {}  # type: dict
+    for deriv_id, deriv_dict in dat["derivations"].items():
+        report[deriv_id] = {}
+        for step_id, step_dict in deriv_dict["steps"].items():
+            report[deriv_id][step_id] = {"inf rule": step_dict["inf rule"]}
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_validation_workers
+    ) as executor:
+        future_per_step = {
+            executor.submit(
+                validate_step_with_timeout, deriv_id, step_id, path_to_db, step_timeout
+            ): (deriv_id, step_id)
+            for deriv_id in report.keys()
+            for step_id in report[deriv_id].keys()
+        }
+        for future in concurrent.futures.as_completed(future_per_step):
+            deriv_id, step_id = future_per_step[future]
+            status, result, wall_time = future.result()
+            step_report = report[deriv_id][step_id]
+            step_report["status"] = status
+            step_report["result"] = result
+            step_report["wall time"] = wall_time
+            if status != "error":
+                store_validation_result(
+                    path_to_results_db,
+                    deriv_id,
+                    step_id,
+                    validation_key_of_step(dat, deriv_id, step_id),
+                    result,
+                )
+
+    logger.info("[trace end " + trace_id + "]")
+    return report
 
 
 def add_X_to_both_sides(latex_dict: dict) -> str:
@@ -2959,4 +3107,125 @@ def apply_gradient_to_scalar_function(latex_dict: dict) -> str:
     return "no check performed"
 
 
+# keys are names of inference rules; values are the function that checks a step
+# built once when this module is imported, rather than comparing the inference rule
+# against each name in turn
+infrule_checkers = {
+    "add X to both sides": add_X_to_both_sides,
+    "subtract X from both sides": subtract_X_from_both_sides,
+    "multiply both sides by": multiply_both_sides_by,
+    "divide both sides by": divide_both_sides_by,
+    "change variable X to Y": change_variable_X_to_Y,
+    "add zero to LHS": add_zero_to_LHS,
+    "add zero to RHS": add_zero_to_RHS,
+    "multiply LHS by unity": multiply_LHS_by_unity,
+    "multiply RHS by unity": multiply_RHS_by_unity,
+    "swap LHS with RHS": swap_LHS_with_RHS,
+    "take curl of both sides": take_curl_of_both_sides,
+    "apply divergence": apply_divergence,
+    "indefinite integral over": indefinite_integral_over,
+    "indefinite integration": indefinite_integration,
+    "indefinite integrate LHS over": indefinite_integrate_LHS_over,
+    "indefinite integrate RHS over": indefinite_integrate_RHS_over,
+    "integrate over from to": integrate_over_from_to,
+    "partially differentiate with respect to": partially_differentiate_with_respect_to,
+    "X cross both sides by": X_cross_both_sides_by,
+    "both sides cross X": both_sides_cross_X,
+    "X dot both sides": X_dot_both_sides,
+    "both sides dot X": both_sides_dot_X,
+    "make expr power": make_expr_power,
+    "select real parts": select_real_parts,
+    "select imag parts": select_imag_parts,
+    "sum exponents LHS": sum_exponents_LHS,
+    "sum exponents RHS": sum_exponents_RHS,
+    "add expr 1 to expr 2": add_expr_1_to_expr_2,
+    "substitute RHS of expr 1 into expr 2": substitute_RHS_of_expr_1_into_expr_2,
+    "substitute LHS of expr 1 into expr 2": substitute_LHS_of_expr_1_into_expr_2,
+    "mult expr 1 by expr 2": mult_expr_1_by_expr_2,
+    "LHS of expr 1 equals LHS of expr 2": LHS_of_expr_1_eq_LHS_of_expr_2,
+    "RHS of expr 1 equals RHS of expr 2": RHS_of_expr_1_eq_RHS_of_expr_2,
+    "raise both sides to power": raise_both_sides_to_power,
+    "claim expr 1 equals expr 2": claim_expr_1_equals_expr_2,
+    "claim LHS equals RHS": claim_LHS_equals_RHS,
+    "expand integrand": expand_integrand,
+    "function is even": function_is_even,
+    "function is odd": function_is_odd,
+    "conjugate function X": conjugate_function_X,
+    "conjugate both sides": conjugate_both_sides,
+    "conjugate transpose both sides": conjugate_transpose_both_sides,
+    "distribute conjugate transpose to factors": distribute_conjugate_transpose_to_factors,
+    "distribute conjugate to factors": distribute_conjugate_to_factors,
+    "expand magnitude to conjugate": expand_magnitude_to_conjugate,
+    "replace scalar with vector": replace_scalar_with_vector,
+    "simplify": simplify,
+    "factor out X": factor_out_x,
+    "factor out X from LHS": factor_out_x_from_lhs,
+    "factor out X from RHS": factor_out_x_from_rhs,
+    "differentiate with respect to": differentiate_with_respect_to,
+    "apply function to both sides of expression": apply_function_to_both_sides_of_expression,
+    "substitute LHS of two expressions into expr": substitute_LHS_of_two_expressions_into_expr,
+    "substitute LHS of three expressions into expr": substitute_LHS_of_three_expressions_into_expr,
+    "substitute LHS of four expressions into expr": substitute_LHS_of_four_expressions_into_expr,
+    "substitute LHS of five expressions into expr": substitute_LHS_of_five_expressions_into_expr,
+    "substitute LHS of six expressions into expr": substitute_LHS_of_six_expressions_into_expr,
+    "expr 1 is equivalent to expr 2 under the condition": expr_is_equivalent_to_expr_under_the_condition,
+    "change two variables in expr": change_two_variables_in_expr,
+    "change three variables in expr": change_three_variables_in_expr,
+    "change four variables in expr": change_four_variables_in_expr,
+    "change five variables in expr": change_five_variables_in_expr,
+    "change six variables in expr": change_six_variables_in_expr,
+    "square root both sides": square_root_both_sides,
+    "divide expr 1 by expr 2": divide_expr_by_expr,
+    "separate two vector components": separate_two_vector_components,
+    "separate three vector components": separate_three_vector_components,
+    "separate vector into two trigonometric ratios": separate_vector_into_two_trigonometric_ratios,
+    "maximum of expr": maximum_of_expr,
+    "evaluate definite integral": evaluate_definite_integral,
+    "expr 1 is true under condition expr 2": expr_is_true_under_condition_expr,
+    "declare variable replacement": declare_variable_replacement,
+    "integrate": integrate,
+    "replace constant with value": replace_constant_with_value,
+    "expand LHS": expand_LHS,
+    "expand RHS": expand_RHS,
+    "multiply expr 1 by expr 2": multiply_expr_by_expr,
+    "apply operator to bra": apply_operator_to_bra,
+    "apply operator to ket": apply_operator_to_ket,
+    "drop non-dominant term": drop_nondominant_term,
+    "apply gradient to scalar function": apply_gradient_to_scalar_function,
+    "subtract expr 1 from expr 2": subtract_expr_1_from_expr_2,
+}
+
+# part of the key of stored results; see validation_key_of_step
+checker_source_md5 = md5_of_checker_source()
+
+
+if __name__ == "__main__":
+    # python3 validate_steps_sympy.py pdg.db --timeout 60
+    parser = argparse.ArgumentParser(
+        description="validate every step of every derivation and store the results"
+    )
+    parser.add_argument("path_to_db", help="e.g., pdg.db")
+    parser.add_argument(
+        "--timeout", type=float, default=validation_timeout, help="seconds per step"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=max_validation_workers,
+        help="number of steps to validate at once",
+    )
+    args = parser.parse_args()
+    max_validation_workers = args.processes
+    validation_worker_slots = threading.BoundedSemaphore(max_validation_workers)
+
+    report = validate_all_steps(args.path_to_db, args.timeout)
+    count_per_status = {}  # type: dict
+    for deriv_id, step_reports in report.items():
+        for step_id, step_report in step_reports.items():
+            status = step_report.get("status", "not validated")
+            count_per_status[status] = count_per_status.get(status, 0) + 1
+            if status != "completed":
+                print(deriv_id, step_id, status + ":", step_report.get("result"))
+    print(count_per_status)
+
 # EOF